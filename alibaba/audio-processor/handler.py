@@ -2,18 +2,27 @@
 Audio Processor for Alibaba Cloud Function Compute
 Processes audio from MNS queue and transcribes using Qwen-ASR (Paraformer)
 """
-import json
+import contextlib
 import logging
 import os
 import sys
+import tempfile
+import threading
 import time
-from typing import Any, Dict, Optional
+from concurrent.futures import ThreadPoolExecutor, wait
+from itertools import pairwise
+from typing import Any, Dict, Optional, Tuple
 
-# Add services to path
-sys.path.insert(0, os.path.dirname(__file__))
+# FC already runs from the code root; append (not prepend) so stdlib imports
+# don't probe this directory first when loaded from elsewhere
+_CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+if _CODE_DIR not in sys.path:
+    sys.path.append(_CODE_DIR)
 
 # Configure structured JSON logging for SLS
-from services.utility import UtilityService
+from services.utility import (UtilityService, ceil_minutes, create_http_session, file_caption,
+                              format_with_cache, json_dumps, json_loads, needs_llm_formatting,
+                              remove_quietly)
 UtilityService.setup_logging(
     'audio-processor',
     bot_token=os.environ.get('TELEGRAM_BOT_TOKEN'),
@@ -27,6 +36,10 @@ TABLESTORE_INSTANCE = os.environ.get('TABLESTORE_INSTANCE', 'twbot-prod')
 MNS_ENDPOINT = os.environ.get('MNS_ENDPOINT')
 REGION = os.environ.get('REGION', 'eu-central-1')
 WHISPER_BACKEND = os.environ.get('WHISPER_BACKEND', 'qwen-asr')
+AUDIO_JOBS_QUEUE = os.environ.get('AUDIO_JOBS_QUEUE', 'telegram-whisper-bot-prod-audio-jobs')
+OSS_BUCKET = os.environ.get('OSS_BUCKET', 'twbot-prod-audio')
+OSS_ENDPOINT = os.environ.get('OSS_ENDPOINT', 'oss-eu-central-1.aliyuncs.com')
+OWNER_ID = int(os.environ.get('OWNER_ID', '0') or 0)
 
 # Diarization threshold — audio below this skips two-pass diarization (fast path)
 DIARIZATION_THRESHOLD = 60  # seconds
@@ -43,6 +56,16 @@ AUTO_FILE_THRESHOLD = 8000  # ~2 pages A4
 FC_TIMEOUT = int(os.environ.get('FC_TIMEOUT', '600'))
 SAFETY_MARGIN = 30
 
+# Max MNS messages pulled per poll and processed in parallel
+AUDIO_WORKERS = int(os.environ.get('AUDIO_WORKERS', '4'))
+DOWNLOAD_CHUNK_SIZE = 1 << 20  # 1 MiB streaming writes for URL imports
+
+# Exact-match cache of LLM formatting output in the formatted_cache table ("1" = on)
+FORMAT_CACHE = os.environ.get('FORMAT_CACHE', '') == '1'
+
+# use_yo=False: ё→е in one pass
+_YO_TABLE = str.maketrans('ёЁ', 'еЕ')
+
 
 class ProgressManager:
     """Manages Telegram progress messages with rate limiting and ETA."""
@@ -50,7 +73,9 @@ class ProgressManager:
     MIN_UPDATE_INTERVAL = 3  # seconds — Telegram rate limit
 
     STAGES = {
+        'start': '🔄 Обработка началась...',
         'download': '📥 Загружаю файл...',
+        'convert': '⚙️ Конвертирую аудио...',
         'transcribe': '🎙 Распознаю речь...',
         'transcribe_chunk': '🎙 Распознаю речь... (часть {current} из {total})',
         'diarize': '🔄 Распознаю спикеров... (~{eta})',
@@ -61,12 +86,23 @@ class ProgressManager:
         'deliver': '📤 Отправляю результат...',
     }
 
-    def __init__(self, tg, chat_id, message_id, audio_duration=0):
+    def __init__(self, tg, chat_id, message_id, audio_duration=0, executor=None):
         self.tg = tg
         self.chat_id = chat_id
         self.message_id = message_id
         self.audio_duration = audio_duration
         self._last_update = 0
+        self._last_text = None
+        # With an executor, edits are sent in the background; a newer text
+        # supersedes any edit still waiting, so the latest one always wins
+        self._executor = executor
+        self._send_lock = threading.Lock()
+        self._seq = 0
+        self._pending = None
+        # A throttled text is kept and sent when the interval ends (trailing edge)
+        self._state_lock = threading.Lock()
+        self._trailing = None
+        self._timer = None
 
     def _estimate_eta(self, stage_key):
         """Estimate remaining time based on audio duration."""
@@ -83,25 +119,89 @@ class ProgressManager:
         return ''
 
     def update(self, text, force=False):
-        """Send progress update with rate limiting."""
+        """Send progress update with rate limiting.
+
+        A throttled update is coalesced, not dropped: the newest one goes out
+        when MIN_UPDATE_INTERVAL ends, unless a forced update or flush() comes first.
+        """
         if not self.message_id:
             return
-        now = time.monotonic()
-        if not force and (now - self._last_update) < self.MIN_UPDATE_INTERVAL:
-            return
-        try:
-            self.tg.edit_message_text(self.chat_id, self.message_id, text)
-            self._last_update = now
-        except Exception as e:
-            logger.debug(f"Progress update failed: {e}")
+        with self._state_lock:
+            if text == self._last_text:
+                return
+            now = time.monotonic()
+            wait = self.MIN_UPDATE_INTERVAL - (now - self._last_update)
+            if not force and wait > 0:
+                self._trailing = text
+                if self._timer is None:
+                    self._timer = threading.Timer(wait, self._send_trailing)
+                    self._timer.daemon = True
+                    self._timer.start()
+                return
+            self._cancel_trailing()
+            self._push(text, now)
+
+    def _push(self, text, now):
+        """Record and send `text`. Caller holds _state_lock."""
+        self._last_update = now
+        self._last_text = text
+        self._seq += 1
+        if self._executor is None:
+            self._send(self._seq, text)
+        else:
+            self._pending = self._executor.submit(self._send, self._seq, text)
+
+    def _cancel_trailing(self):
+        self._trailing = None
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _send_trailing(self):
+        with self._state_lock:
+            self._timer = None
+            text, self._trailing = self._trailing, None
+            if text is not None and text != self._last_text:
+                self._push(text, time.monotonic())
+
+    def _send(self, seq, text):
+        with self._send_lock:
+            if seq != self._seq:
+                return  # superseded by a newer update
+            try:
+                self.tg.edit_message_text(self.chat_id, self.message_id, text)
+            except Exception as e:
+                logger.debug("Progress update failed: %s", e)
+                if seq == self._seq:
+                    self._last_text = None  # allow the same text to be retried
+
+    def flush(self, timeout=10):
+        """Drop any coalesced update and wait for a background edit,
+        so neither can overwrite what comes next."""
+        with self._state_lock:
+            self._cancel_trailing()
+            pending = self._pending
+        if pending is not None:
+            try:
+                pending.result(timeout=timeout)
+            except Exception as e:
+                logger.debug("Progress flush failed: %s", e)
+
+    def stage(self, stage_key, force=True, **kwargs):
+        """Show a predefined stage message.
 
-    def stage(self, stage_key, **kwargs):
-        """Show a predefined stage message."""
+        Stage changes are forced; per-chunk ticks pass force=False so they
+        are throttled to MIN_UPDATE_INTERVAL.
+        """
         template = self.STAGES.get(stage_key, stage_key)
         if '{eta}' in template:
             kwargs.setdefault('eta', self._estimate_eta(stage_key))
         text = template.format(**kwargs) if kwargs else template
-        self.update(text, force=True)
+        self.update(text, force=force)
+
+    def chunk(self, stage_key, current, total):
+        """Throttled per-chunk progress; the last chunk is always shown."""
+        self.stage(stage_key, force=(current >= total), current=current, total=total)
 
 # Credentials - FC provides STS credentials automatically
 ALIBABA_ACCESS_KEY = (
@@ -125,22 +225,123 @@ DASHSCOPE_API_KEY = os.environ.get('DASHSCOPE_API_KEY')
 _db_service = None
 _telegram_service = None
 _audio_service = None
+_service_lock = threading.Lock()  # poll_queue runs jobs in threads
+
+# Shared keep-alive pool for Telegram + DashScope, reused across warm invocations
+_http_session = create_http_session(pool_size=32)
+
+# Small pool for independent Tablestore/Telegram round-trips within a job
+_io_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix='io')
+
+# Fire-and-forget Telegram UI calls (progress edits, typing) off the job's critical path
+_ui_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='tg-ui')
+
+
+def _send_typing(tg, chat_id):
+    """Show 'typing' without waiting for the Telegram round-trip."""
+    _ui_executor.submit(tg.send_chat_action, chat_id, 'typing')
+
+
+# Post-delivery work (billing log, job status, low-balance notice, temp-file
+# unlinks) runs here so process_job returns as soon as the user has the
+# transcript. handler() drains it before the invocation ends — FC may freeze
+# the instance after return.
+_post_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix='post')
+_post_pending = set()
+_post_lock = threading.Lock()
+
+
+def _submit_post(fn, *args):
+    """Queue post-delivery work and track it until done."""
+    future = _post_pool.submit(fn, *args)
+    with _post_lock:
+        _post_pending.add(future)
+
+    def _done(f):
+        with _post_lock:
+            _post_pending.discard(f)
+        if f.exception() is not None:
+            logger.error("Post-delivery task failed: %s", f.exception())
+
+    future.add_done_callback(_done)
+    return future
+
+
+def drain_post_work(timeout=30):
+    """Wait for queued post-delivery work and OSS deletes. Returns False if it timed out."""
+    deadline = time.monotonic() + timeout
+    with _post_lock:
+        pending = list(_post_pending)
+    not_done = ()
+    if pending:
+        _, not_done = wait(pending, timeout=timeout)
+        if not_done:
+            logger.warning("%d post-delivery task(s) still running after %ss", len(not_done), timeout)
+
+    # Post work may itself queue OSS deletes, so drain those second
+    audio_module = sys.modules.get('services.audio')
+    if audio_module is not None:
+        if not audio_module.AudioService.drain_oss_cleanup(max(0.0, deadline - time.monotonic())):
+            return False
+    return not not_done
+
+
+def _run_concurrently(*calls):
+    """Run independent I/O callables in parallel. Returns results in order, re-raises first error."""
+    futures = [_io_pool.submit(fn) for fn in calls]
+    return [f.result() for f in futures]
+
+
+# Per-container user cache: warm instances often see the same user again within a minute.
+# Only settings are read from it — balance is reserved by the webhook and must be fresh.
+USER_CACHE_TTL = 60  # seconds
+USER_CACHE_MAX = 2048
+_user_cache = {}  # user_id -> (expires_at, user dict)
+_user_cache_lock = threading.Lock()
+
+
+def _get_user_cached(db, user_id, fresh=False):
+    """db.get_user() with a short TTL cache. fresh=True bypasses (and refreshes) the cache."""
+    now = time.monotonic()
+    if not fresh:
+        with _user_cache_lock:
+            entry = _user_cache.get(user_id)
+        if entry and entry[0] > now:
+            return entry[1]
+
+    user = db.get_user(user_id)
+    if user:
+        with _user_cache_lock:
+            if len(_user_cache) >= USER_CACHE_MAX:
+                for key in [k for k, (exp, _) in _user_cache.items() if exp <= now]:
+                    del _user_cache[key]
+                if len(_user_cache) >= USER_CACHE_MAX:
+                    _user_cache.pop(next(iter(_user_cache)))  # oldest insert
+            _user_cache[user_id] = (now + USER_CACHE_TTL, user)
+    return user
+
+
+def _invalidate_user_cache(user_id):
+    with _user_cache_lock:
+        _user_cache.pop(user_id, None)
 
 
 def get_db_service():
     """Get or create Tablestore service instance."""
     global _db_service
     if _db_service is None:
-        if not ALIBABA_ACCESS_KEY or not ALIBABA_SECRET_KEY:
-            raise ValueError("Alibaba credentials not configured")
-        from services.tablestore_service import TablestoreService
-        _db_service = TablestoreService(
-            endpoint=TABLESTORE_ENDPOINT,
-            access_key_id=ALIBABA_ACCESS_KEY,
-            access_key_secret=ALIBABA_SECRET_KEY,
-            instance_name=TABLESTORE_INSTANCE,
-            security_token=ALIBABA_SECURITY_TOKEN
-        )
+        with _service_lock:
+            if _db_service is None:
+                if not ALIBABA_ACCESS_KEY or not ALIBABA_SECRET_KEY:
+                    raise ValueError("Alibaba credentials not configured")
+                from services.tablestore_service import TablestoreService
+                _db_service = TablestoreService(
+                    endpoint=TABLESTORE_ENDPOINT,
+                    access_key_id=ALIBABA_ACCESS_KEY,
+                    access_key_secret=ALIBABA_SECRET_KEY,
+                    instance_name=TABLESTORE_INSTANCE,
+                    security_token=ALIBABA_SECURITY_TOKEN
+                )
     return _db_service
 
 
@@ -148,10 +349,12 @@ def get_telegram_service():
     """Get or create Telegram service instance."""
     global _telegram_service
     if _telegram_service is None:
-        if not TELEGRAM_BOT_TOKEN:
-            raise ValueError("TELEGRAM_BOT_TOKEN not configured")
-        from services.telegram import TelegramService
-        _telegram_service = TelegramService(TELEGRAM_BOT_TOKEN)
+        with _service_lock:
+            if _telegram_service is None:
+                if not TELEGRAM_BOT_TOKEN:
+                    raise ValueError("TELEGRAM_BOT_TOKEN not configured")
+                from services.telegram import TelegramService
+                _telegram_service = TelegramService(TELEGRAM_BOT_TOKEN, session=_http_session)
     return _telegram_service
 
 
@@ -159,71 +362,105 @@ def get_audio_service():
     """Get or create Audio service instance."""
     global _audio_service
     if _audio_service is None:
-        if not DASHSCOPE_API_KEY:
-            raise ValueError("DASHSCOPE_API_KEY not configured")
-        from services.audio import AudioService
-        _audio_service = AudioService(
-            whisper_backend=WHISPER_BACKEND,
-            alibaba_api_key=DASHSCOPE_API_KEY,
-            oss_config={
-                'bucket': os.environ.get('OSS_BUCKET', 'twbot-prod-audio'),
-                'endpoint': os.environ.get('OSS_ENDPOINT', 'oss-eu-central-1.aliyuncs.com'),
-                'access_key_id': ALIBABA_ACCESS_KEY,
-                'access_key_secret': ALIBABA_SECRET_KEY,
-                'security_token': ALIBABA_SECURITY_TOKEN,
-            }
-        )
+        with _service_lock:
+            if _audio_service is None:
+                if not DASHSCOPE_API_KEY:
+                    raise ValueError("DASHSCOPE_API_KEY not configured")
+                from services.audio import AudioService
+                _audio_service = AudioService(
+                    whisper_backend=WHISPER_BACKEND,
+                    alibaba_api_key=DASHSCOPE_API_KEY,
+                    oss_config={
+                        'bucket': OSS_BUCKET,
+                        'endpoint': OSS_ENDPOINT,
+                        'access_key_id': ALIBABA_ACCESS_KEY,
+                        'access_key_secret': ALIBABA_SECRET_KEY,
+                        'security_token': ALIBABA_SECURITY_TOKEN,
+                    },
+                    http_session=_http_session,
+                )
     return _audio_service
 
 
+def initializer(_context: Any) -> None:
+    """FC initializer: build services before the first invocation.
+
+    Runs once per instance, so SDK imports and client setup (tablestore,
+    oss2, mns) are paid outside the user's wait. Failures are logged and
+    left to the lazy getters to retry on first use.
+    """
+    started = time.monotonic()
+    try:
+        get_db_service()
+        get_telegram_service()
+        get_audio_service()._get_oss_bucket()
+        import services.mns_service  # noqa: F401 — poll_queue imports it on every timer tick
+    except Exception as e:
+        logger.warning("Initializer preload failed, falling back to lazy init: %s", e)
+    logger.info("Initializer done in %.2fs", time.monotonic() - started)
+
+
+def _normalize_event(event: Any) -> Tuple[Dict[str, Any], str]:
+    """Parse an FC event once and classify it.
+
+    Returns (event, kind) with kind in {'poll', 'mns', 'job', 'unknown'};
+    timer payloads and direct-invocation bodies are unwrapped.
+    """
+    # MNS delivers bytes, HTTP/direct invocation a dict; nested payloads may be str
+    event = _as_dict(event)
+
+    # Timer trigger format: {'triggerTime': '...', 'triggerName': '...', 'payload': '...'}
+    if 'triggerName' in event:
+        event = _as_dict(event.get('payload', '{}'))
+
+    if event.get('action') == 'poll_queue':
+        return event, 'poll'
+    if 'Message' in event or 'job_id' in event:
+        return event, 'mns'
+    # Direct invocation with job data
+    if 'body' in event:
+        return _as_dict(event['body']), 'job'
+    return event, 'unknown'
+
+
+def _as_dict(value: Any) -> Dict[str, Any]:
+    """Decode a JSON str/bytes payload; an already-parsed dict passes through."""
+    return value if type(value) is dict else json_loads(value)
+
+
+def _unknown_event(event: Dict[str, Any]) -> Dict[str, Any]:
+    logger.warning("Unknown event format: %s", event)
+    return {'statusCode': 200, 'body': 'Unknown event format'}
+
+
+# Late-bound lambdas so the targets can be patched in tests
+_DISPATCH = {
+    'poll': lambda _event: poll_queue(),
+    'mns': lambda event: process_mns_message(event),
+    'job': lambda event: process_job(event),
+    'unknown': _unknown_event,
+}
+
+
 def handler(event: Dict[str, Any], _context: Any) -> Dict[str, Any]:
     """
     FC handler for audio processing
     Triggered by timer or MNS message
     """
     try:
-        # Parse event - can be bytes, str, or dict
-        if isinstance(event, bytes):
-            event = json.loads(event.decode('utf-8'))
-        elif isinstance(event, str):
-            event = json.loads(event)
-
-        logger.info(f"Audio processor triggered, event type: {type(event)}")
-
-        # Check if this is a timer trigger (polling mode)
-        # Timer trigger format: {'triggerTime': '...', 'triggerName': '...', 'payload': '...'}
-        if 'triggerName' in event:
-            payload = event.get('payload', '{}')
-            if isinstance(payload, str):
-                payload = json.loads(payload)
-            if payload.get('action') == 'poll_queue':
-                return poll_queue()
-            event = payload  # Use payload for further processing
-
-        if event.get('action') == 'poll_queue':
-            return poll_queue()
-
-        # Check if this is an MNS message
-        if 'Message' in event or 'job_id' in event:
-            return process_mns_message(event)
-
-        # Direct invocation with job data
-        if 'body' in event:
-            body = event.get('body', '{}')
-            if isinstance(body, str):
-                body = json.loads(body)
-            return process_job(body)
-
-        logger.warning(f"Unknown event format: {event}")
-        return {'statusCode': 200, 'body': 'Unknown event format'}
-
+        event, kind = _normalize_event(event)
+        logger.info("Audio processor triggered, event kind: %s", kind)
+        return _DISPATCH[kind](event)
     except Exception as e:
-        logger.error(f"Error in audio processor: {e}", exc_info=True)
-        return {'statusCode': 500, 'body': json.dumps({'error': str(e)})}
+        logger.error("Error in audio processor: %s", e, exc_info=True)
+        return {'statusCode': 500, 'body': json_dumps({'error': str(e)})}
+    finally:
+        drain_post_work()
 
 
 def poll_queue() -> Dict[str, Any]:
-    """Poll MNS queue for one message and process it."""
+    """Poll MNS queue for a batch of messages and process them concurrently."""
+    from concurrent.futures import as_completed
     from services.mns_service import MNSService
 
     try:
@@ -233,41 +470,78 @@ def poll_queue() -> Dict[str, Any]:
             endpoint=MNS_ENDPOINT,
             access_key_id=ALIBABA_ACCESS_KEY,
             access_key_secret=ALIBABA_SECRET_KEY,
-            queue_name=os.environ.get('AUDIO_JOBS_QUEUE', 'telegram-whisper-bot-prod-audio-jobs')
+            queue_name=AUDIO_JOBS_QUEUE
         )
 
         # Short poll: 1s wait, 600s visibility (audio processing can take up to 300s)
-        msg = mns.receive_message(wait_seconds=1, visibility_timeout=600)
-        if not msg:
+        msgs = mns.batch_receive_messages(batch_size=AUDIO_WORKERS, wait_seconds=1,
+                                          visibility_timeout=600)
+        if not msgs:
             return {'statusCode': 200, 'body': 'No messages in queue'}
 
-        job_data = msg['data']
-        job_id = job_data.get('job_id', 'unknown')
-        logger.info(f"Polled job {job_id} from MNS queue")
+        if len(msgs) == 1:
+            return {'statusCode': 200, 'body': _process_polled_message(mns, msgs[0])}
+
+        # Jobs are I/O-bound (Telegram, OSS, DashScope) — run them side by side
+        # so one long transcription doesn't hold the rest of the batch
+        results = []
+        with ThreadPoolExecutor(max_workers=len(msgs)) as pool:
+            futures = [pool.submit(_process_polled_message, mns, msg) for msg in msgs]
+            for future in as_completed(futures):
+                results.append(future.result())
+        return {'statusCode': 200, 'body': '; '.join(results)}
 
+    except Exception as e:
+        logger.error("Error polling queue: %s", e)
+        return {'statusCode': 500, 'body': str(e)}
+
+
+def _process_polled_message(mns, msg) -> str:
+    """Process one polled MNS message, delete it on success. Returns status line."""
+    job_data = msg['data']
+    job_id = job_data.get('job_id', 'unknown')
+    logger.info("Polled job %s from MNS queue", job_id)
+
+    try:
         result = process_job(job_data)
+    except Exception as e:
+        logger.error("Unhandled error processing job %s: %s", job_id, e, exc_info=True)
+        return f'Job {job_id} failed: {e}'
+
+    if not result.get('ok', False):
+        return f'Job {job_id} failed: {result.get("error")}'
+
+    # One delete attempt inline; backed-off retries go to the post pool so this
+    # worker isn't held (a missed delete is only a redelivery, skipped as duplicate)
+    if not _delete_polled_message(mns, msg['receipt_handle'], job_id):
+        _submit_post(_retry_delete_polled_message, mns, msg['receipt_handle'], job_id)
+    return f'Processed job {job_id}'
 
-        if result.get('ok', False):
-            # Retry delete to prevent duplicate processing on transient failure
-            for attempt in range(3):
-                try:
-                    mns.delete_message(msg['receipt_handle'])
-                    logger.info(f"Deleted MNS message for job {job_id}")
-                    break
-                except Exception as e:
-                    logger.warning(f"MNS delete_message attempt {attempt + 1}/3 failed: {e}")
-                    if attempt < 2:
-                        import time
-                        time.sleep(1 << attempt)  # 1s, 2s
-            else:
-                logger.error(f"MNS delete_message failed after 3 attempts for job {job_id}, may be redelivered")
-            return {'statusCode': 200, 'body': f'Processed job {job_id}'}
-        else:
-            return {'statusCode': 200, 'body': f'Job {job_id} failed: {result.get("error")}'}
 
+MNS_DELETE_ATTEMPTS = 3
+
+
+def _delete_polled_message(mns, receipt_handle, job_id, attempt=0) -> bool:
+    """Delete a processed MNS message. Returns True once it is gone."""
+    try:
+        if mns.delete_message(receipt_handle):
+            logger.info("Deleted MNS message for job %s", job_id)
+            return True
+        error = 'not deleted'
     except Exception as e:
-        logger.error(f"Error polling queue: {e}")
-        return {'statusCode': 500, 'body': str(e)}
+        error = e
+    logger.warning("MNS delete_message attempt %s/%s failed: %s", attempt + 1, MNS_DELETE_ATTEMPTS, error)
+    return False
+
+
+def _retry_delete_polled_message(mns, receipt_handle, job_id):
+    """Remaining delete attempts with 1s, 2s backoff (runs on the post pool)."""
+    for attempt in range(1, MNS_DELETE_ATTEMPTS):
+        time.sleep(1 << (attempt - 1))
+        if _delete_polled_message(mns, receipt_handle, job_id, attempt):
+            return
+    logger.error("MNS delete_message failed after %s attempts for job %s, may be redelivered",
+                 MNS_DELETE_ATTEMPTS, job_id)
 
 
 def process_mns_message(event: Dict[str, Any]) -> Dict[str, Any]:
@@ -276,7 +550,7 @@ def process_mns_message(event: Dict[str, Any]) -> Dict[str, Any]:
     if 'Message' in event:
         message = event['Message']
         if isinstance(message, str):
-            job_data = json.loads(message)
+            job_data = json_loads(message)
         else:
             job_data = message
     else:
@@ -288,11 +562,12 @@ def process_mns_message(event: Dict[str, Any]) -> Dict[str, Any]:
 def _download_from_oss(oss_key):
     """Download file from OSS to /tmp. Returns local path or raises Exception."""
     import oss2
+    from services.audio import AudioService
     ak = ALIBABA_ACCESS_KEY
     sk = ALIBABA_SECRET_KEY
     st = ALIBABA_SECURITY_TOKEN
-    endpoint = os.environ.get('OSS_ENDPOINT', 'oss-eu-central-1.aliyuncs.com')
-    bucket_name = os.environ.get('OSS_BUCKET', 'twbot-prod-audio')
+    endpoint = OSS_ENDPOINT
+    bucket_name = OSS_BUCKET
 
     if not endpoint.startswith('http'):
         endpoint = f'https://{endpoint}'
@@ -301,12 +576,13 @@ def _download_from_oss(oss_key):
         auth = oss2.StsAuth(ak, sk, st)
     else:
         auth = oss2.Auth(ak, sk)
-    bucket = oss2.Bucket(auth, endpoint, bucket_name)
+    bucket = oss2.Bucket(auth, endpoint, bucket_name, session=AudioService.shared_oss_session())
 
     ext = os.path.splitext(oss_key)[1] or '.mp3'
-    local_path = f"/tmp/oss_upload_{int(time.time())}{ext}"
+    fd, local_path = tempfile.mkstemp(suffix=ext, prefix='oss_upload_', dir='/tmp')
+    os.close(fd)  # unique name per job; oss2 reopens the path itself
     bucket.get_object_to_file(oss_key, local_path)
-    logger.info(f"[download] OSS download done: {oss_key} → {local_path}")
+    logger.debug("[download] OSS download done: %s → %s", oss_key, local_path)
     return local_path
 
 
@@ -339,10 +615,10 @@ def _download_from_url(url, max_size=100 * 1024 * 1024):
                    '.mp4', '.mov', '.mkv', '.webm'):
         ext = '.mp3'
 
-    local_path = f"/tmp/url_download_{int(time.time())}{ext}"
+    fd, local_path = tempfile.mkstemp(suffix=ext, prefix='url_download_', dir='/tmp')
     downloaded = 0
-    with open(local_path, 'wb') as f:
-        for chunk in response.iter_content(chunk_size=8192):
+    with os.fdopen(fd, 'wb') as f:
+        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
             downloaded += len(chunk)
             if downloaded > max_size:
                 f.close()
@@ -350,19 +626,31 @@ def _download_from_url(url, max_size=100 * 1024 * 1024):
                 raise Exception(f"File too large (>{max_size / 1024 / 1024:.0f} MB)")
             f.write(chunk)
 
-    logger.info(f"[download] URL download done: {url[:80]} → {local_path}, size={downloaded}b")
+    logger.debug("[download] URL download done: %s → %s, size=%sb", url[:80], local_path, downloaded)
     return local_path
 
 
 def _download_and_convert(tg, audio, file_id, chat_id, progress_id, progress=None,
-                          file_type=None):
-    """Download file from Telegram/OSS/URL and convert for ASR. Returns (local_path, converted_path)."""
-    logger.info(f"[download] start file_id={file_id}, type={file_type}")
+                          file_type=None, cleanup=None, file_path_future=None,
+                          duration_hint=0):
+    """Download file from Telegram/OSS/URL and convert for ASR.
+
+    Temp files are registered on the `cleanup` ExitStack as soon as they
+    exist, so a failed conversion does not leak the download.
+    file_path_future: Telegram getFile result prefetched at job start.
+    duration_hint: duration from the Telegram message. When known, a Telegram
+    download is fed to ffmpeg as it arrives instead of converted afterwards.
+    Returns (local_path, converted_path, audio_duration) — duration comes from the conversion.
+    """
+    logger.debug("[download] start file_id=%s, type=%s", file_id, file_type)
     if progress:
         progress.stage('download')
     elif progress_id:
-        tg.edit_message_text(chat_id, progress_id, "📥 Загружаю файл...")
-    tg.send_chat_action(chat_id, 'typing')
+        tg.edit_message_text(chat_id, progress_id, ProgressManager.STAGES['download'])
+    if not progress_id:  # the stage text already shows activity
+        _send_typing(tg, chat_id)
+
+    stream = None
 
     # Route by file type
     if file_type == 'oss_upload':
@@ -370,77 +658,127 @@ def _download_and_convert(tg, audio, file_id, chat_id, progress_id, progress=Non
     elif file_type == 'url_import':
         local_path = _download_from_url(file_id)
     else:
-        telegram_file_path = tg.get_file_path(file_id)
+        telegram_file_path = (file_path_future.result() if file_path_future is not None
+                              else tg.get_file_path(file_id))
         if not telegram_file_path:
             raise Exception("Failed to get file path from Telegram")
-        local_path = tg.download_file(telegram_file_path)
-        if not local_path:
-            raise Exception("Failed to download file from Telegram")
+        # Voice notes skip the transcode; other media with a known duration
+        # (it picks the bitrate tier) is converted while it downloads
+        if duration_hint > 0 and file_type != 'voice':
+            stream = audio.start_mp3_stream(duration_hint)
+        try:
+            local_path = tg.download_file(telegram_file_path,
+                                          on_chunk=stream.write if stream else None)
+            if not local_path:
+                raise Exception("Failed to download file from Telegram")
+        except BaseException:
+            # Don't leave ffmpeg and its partial MP3 behind on a warm instance
+            if stream:
+                stream.abort()
+            raise
+
+    if cleanup is not None:
+        cleanup.callback(remove_quietly, local_path)
 
     # FFmpeg conversion can take minutes for large files (500MB)
     if progress_id:
-        tg.edit_message_text(chat_id, progress_id, "⚙️ Конвертирую аудио...")
-    tg.send_chat_action(chat_id, 'typing')
+        tg.edit_message_text(chat_id, progress_id, ProgressManager.STAGES['convert'])
+    _send_typing(tg, chat_id)
 
-    converted_path = audio.prepare_audio_for_asr(local_path)
+    converted_path = None
+    if stream:
+        converted_path, audio_duration = stream.finish(local_path)
+        if converted_path:
+            # The download copy was only kept as a fallback input — free /tmp
+            # now instead of holding both files through ASR and formatting
+            remove_quietly(local_path)
+        else:
+            logger.info("[download] streamed conversion failed, converting the downloaded file")
+    if not converted_path:
+        # Telegram voice notes are OGG/Opus, which the ASR accepts without a transcode
+        converted_path, audio_duration = audio.prepare_audio_for_asr(
+            local_path, passthrough=(file_type == 'voice'))
     if not converted_path:
         raise Exception("Failed to convert audio to MP3")
+    # converted_path == local_path when the transcode was skipped
+    if cleanup is not None and converted_path != local_path:
+        cleanup.callback(remove_quietly, converted_path)
 
     if progress:
         progress.stage('transcribe')
     elif progress_id:
-        tg.edit_message_text(chat_id, progress_id, "🎙 Распознаю речь...")
-    tg.send_chat_action(chat_id, 'typing')
+        tg.edit_message_text(chat_id, progress_id, ProgressManager.STAGES['transcribe'])
+    if not progress_id:
+        _send_typing(tg, chat_id)
 
     try:
         fsize = os.path.getsize(converted_path)
     except OSError:
         fsize = 0
-    logger.info(f"[download] done path={converted_path}, size={fsize}b")
-    return local_path, converted_path
+    logger.debug("[download] done path=%s, size=%sb, duration=%.1fs", converted_path, fsize, audio_duration)
+    return local_path, converted_path, audio_duration
 
 
 def _transcribe_simple(audio, tg, converted_path, chat_id, progress_id, progress=None):
     """Simple ASR without diarization."""
     def chunk_progress(current, total):
         if progress and total > 1:
-            progress.stage('transcribe_chunk', current=current, total=total)
+            progress.chunk('transcribe_chunk', current, total)
         elif progress_id and total > 1:
             tg.edit_message_text(chat_id, progress_id,
-                f"🎙 Распознаю речь... (часть {current} из {total})")
+                ProgressManager.STAGES['transcribe_chunk'].format(current=current, total=total))
 
     return audio.transcribe_audio(converted_path, progress_callback=chunk_progress)
 
 
 def _transcribe(audio, tg, converted_path, actual_duration, chat_id, progress_id,
-                speaker_labels, progress=None):
-    """Run ASR with optional diarization. Returns (text, is_dialogue)."""
+                speaker_labels, progress=None, debug=None):
+    """Run ASR with optional diarization. Returns (text, is_dialogue).
+
+    debug: dict filled with the diarization diagnostics of this job.
+    """
     use_diarization = actual_duration >= DIARIZATION_THRESHOLD
-    logger.info(f"[transcribe] mode={'diarization' if use_diarization else 'simple'}, duration={actual_duration:.1f}s")
+    logger.debug("[transcribe] mode=%s, duration=%.1fs", 'diarization' if use_diarization else 'simple', actual_duration)
     if use_diarization:
         if progress:
             progress.stage('diarize')
 
+        last_stage = None
+
         def diarize_progress(stage_text):
+            # Called on the diarization thread: repeats are dropped and the
+            # Telegram edit never blocks it (ProgressManager already sends in the background)
+            nonlocal last_stage
+            if stage_text == last_stage:
+                return
+            last_stage = stage_text
             if progress:
                 progress.update(stage_text)
             elif progress_id:
-                tg.edit_message_text(chat_id, progress_id, stage_text)
+                _ui_executor.submit(tg.edit_message_text, chat_id, progress_id, stage_text)
 
         raw_text, segments = audio.transcribe_with_diarization(
             converted_path,
-            progress_callback=diarize_progress
+            progress_callback=diarize_progress,
+            debug=debug
         )
         if segments:
-            unique_speakers = len(set(s.get('speaker_id', 0) for s in segments))
+            # One pass over the segment dicts; the rest works on the flat id list
+            speaker_ids = [s.get('speaker_id', 0) for s in segments]
+            unique_speakers = len(set(speaker_ids))
             if unique_speakers >= 2:
-                # Count speaker transitions to filter false dialogue detection
-                transitions = sum(1 for i in range(1, len(segments))
-                                  if segments[i].get('speaker_id') != segments[i-1].get('speaker_id'))
+                # Count speaker transitions to filter false dialogue detection;
+                # stop as soon as there are enough to call it a dialogue
+                transitions = 0
+                for a, b in pairwise(speaker_ids):
+                    if a != b:
+                        transitions += 1
+                        if transitions >= MIN_DIALOGUE_TRANSITIONS:
+                            break
                 if transitions >= MIN_DIALOGUE_TRANSITIONS:
                     return audio.format_dialogue(segments, show_speakers=speaker_labels), True
                 # Too few transitions — likely misdetected monologue
-                logger.info(f"Diarization found {unique_speakers} speakers but only {transitions} transitions, treating as monologue")
+                logger.info("Diarization found %s speakers but only %s transitions, treating as monologue", unique_speakers, transitions)
             # 1 speaker (or false multi-speaker): use raw_text, will go through LLM
             return (raw_text or ' '.join(s.get('text', '') for s in segments)), False
         # Diarization failed: fallback to regular ASR
@@ -450,30 +788,41 @@ def _transcribe(audio, tg, converted_path, actual_duration, chat_id, progress_id
     return _transcribe_simple(audio, tg, converted_path, chat_id, progress_id, progress), False
 
 
+def _format_with_llm(audio, text, **options):
+    """format_text_with_llm behind the formatted_cache table when FORMAT_CACHE is on (write after delivery)."""
+    if not FORMAT_CACHE:
+        return audio.format_text_with_llm(text, **options)
+    return format_with_cache(audio, get_db_service(), text, store=_submit_post, **options)
+
+
 def _format_transcription(audio, text, is_dialogue, settings, converted_path,
-                          tg, chat_id, progress_id, progress=None):
-    """Format transcribed text with LLM if needed. Returns formatted_text."""
+                          tg, chat_id, progress_id, progress=None, audio_duration=None):
+    """Format transcribed text with LLM if needed. Returns formatted_text.
+
+    audio_duration: seconds, already known from conversion; probed only when omitted.
+    """
     use_yo = settings.get('use_yo', True)
     speaker_labels = settings.get('speaker_labels', False)
     backend = settings.get('llm_backend', 'assemblyai')
-    logger.info(f"[format] is_dialogue={is_dialogue}, speaker_labels={speaker_labels}, backend={backend}, input_chars={len(text)}")
+    logger.debug("[format] is_dialogue=%s, speaker_labels=%s, backend=%s, input_chars=%s", is_dialogue, speaker_labels, backend, len(text))
 
     def llm_progress_callback(current, total):
         """Progress callback for chunked LLM formatting."""
         if progress:
-            progress.stage('format_chunk', current=current, total=total)
+            progress.chunk('format_chunk', current, total)
         elif progress_id:
             tg.edit_message_text(chat_id, progress_id,
-                f"✏️ Форматирую текст... (часть {current} из {total})")
+                ProgressManager.STAGES['format_chunk'].format(current=current, total=total))
 
     if is_dialogue:
         if len(text) > 100:
             if progress:
                 progress.stage('format_dialogue')
             elif progress_id:
-                tg.edit_message_text(chat_id, progress_id, "✏️ Форматирую диалог...")
-            tg.send_chat_action(chat_id, 'typing')
-            formatted = audio.format_text_with_llm(
+                tg.edit_message_text(chat_id, progress_id, ProgressManager.STAGES['format_dialogue'])
+            _send_typing(tg, chat_id)
+            formatted = _format_with_llm(
+                audio,
                 text,
                 use_code_tags=settings.get('use_code_tags', False),
                 use_yo=use_yo,
@@ -485,21 +834,23 @@ def _format_transcription(audio, text, is_dialogue, settings, converted_path,
         else:
             formatted = text
         if not use_yo:
-            formatted = formatted.replace('ё', 'е').replace('Ё', 'Е')
-        logger.info(f"[format] done output_chars={len(formatted)}")
+            formatted = formatted.translate(_YO_TABLE)
+        logger.debug("[format] done output_chars=%s", len(formatted))
         return formatted
 
-    if len(text) > 100:
+    if needs_llm_formatting(text, settings.get('use_code_tags', False)):
         if progress:
             progress.stage('format')
         elif progress_id:
-            tg.edit_message_text(chat_id, progress_id, "✏️ Форматирую текст...")
-        tg.send_chat_action(chat_id, 'typing')
+            tg.edit_message_text(chat_id, progress_id, ProgressManager.STAGES['format'])
+        _send_typing(tg, chat_id)
 
-        audio_duration = audio.get_audio_duration(converted_path)
+        if audio_duration is None:
+            audio_duration = audio.get_audio_duration(converted_path)
         is_chunked = audio_duration > audio.ASR_MAX_CHUNK_DURATION
 
-        formatted = audio.format_text_with_llm(
+        formatted = _format_with_llm(
+            audio,
             text,
             use_code_tags=settings.get('use_code_tags', False),
             use_yo=use_yo,
@@ -508,20 +859,20 @@ def _format_transcription(audio, text, is_dialogue, settings, converted_path,
             backend=settings.get('llm_backend', 'assemblyai'),
             progress_callback=llm_progress_callback,
             speaker_labels=speaker_labels)
-        logger.info(f"[format] done output_chars={len(formatted)}")
+        logger.debug("[format] done output_chars=%s", len(formatted))
         return formatted
 
     formatted = text
     if not use_yo:
-        formatted = formatted.replace('ё', 'е').replace('Ё', 'Е')
-    logger.info(f"[format] done output_chars={len(formatted)}")
+        formatted = formatted.translate(_YO_TABLE)
+    logger.debug("[format] done output_chars=%s", len(formatted))
     return formatted
 
 
 def _send_ai_action_buttons(tg, chat_id, job_id):
     """Send AI action buttons after successful large file transcription."""
     try:
-        keyboard = json.dumps({
+        keyboard = json_dumps({
             'inline_keyboard': [
                 [{'text': '📰 Написать новость', 'callback_data': f'ai_news_{job_id}'},
                  {'text': '📋 Саммари', 'callback_data': f'ai_sum_{job_id}'}],
@@ -537,7 +888,7 @@ def _send_ai_action_buttons(tg, chat_id, job_id):
             reply_markup=keyboard
         )
     except Exception as e:
-        logger.warning(f"[ai-actions] failed to send buttons: {e}")
+        logger.warning("[ai-actions] failed to send buttons: %s", e)
 
 
 def _deliver_result(tg, chat_id, progress_id, formatted_text, settings,
@@ -548,6 +899,7 @@ def _deliver_result(tg, chat_id, progress_id, formatted_text, settings,
     """
     if progress:
         progress.stage('deliver')
+        progress.flush()  # a late progress edit must not overwrite the result
     long_text_mode = settings.get('long_text_mode', 'split')
 
     # Auto-file for long transcripts (journalist workflow)
@@ -559,9 +911,19 @@ def _deliver_result(tg, chat_id, progress_id, formatted_text, settings,
         delivery_mode = 'file'
     else:
         delivery_mode = 'split'
-    logger.info(f"[deliver] mode={delivery_mode}, chars={len(formatted_text)}, auto_file={auto_file}, chat={chat_id}")
-    use_code = settings.get('use_code_tags', False)
-    if use_code:
+    logger.debug("[deliver] mode=%s, chars=%s, auto_file=%s, chat=%s", delivery_mode, len(formatted_text), auto_file, chat_id)
+
+    if delivery_mode == 'file':
+        if progress_id:
+            tg.delete_message(chat_id, progress_id)
+        caption = file_caption(formatted_text)
+        from datetime import datetime
+        filename = f"transcript_{datetime.now().strftime('%Y-%m-%d_%H%M')}.txt"
+        tg.send_as_file(chat_id, formatted_text, caption=caption, filename=filename)
+        return
+
+    # Code tags only apply to text delivery — the file carries the plain transcript
+    if settings.get('use_code_tags', False):
         result_text = f"<code>{formatted_text}</code>"
         parse_mode = 'HTML'
     else:
@@ -570,20 +932,92 @@ def _deliver_result(tg, chat_id, progress_id, formatted_text, settings,
 
     if delivery_mode == 'edit':
         tg.edit_message_text(chat_id, progress_id, result_text, parse_mode=parse_mode)
-    elif delivery_mode == 'file':
-        if progress_id:
-            tg.delete_message(chat_id, progress_id)
-        first_dot = formatted_text.find('.')
-        caption = (formatted_text[:first_dot+1] if 0 < first_dot < 200 else formatted_text[:200]) + "..."
-        from datetime import datetime
-        filename = f"transcript_{datetime.now().strftime('%Y-%m-%d_%H%M')}.txt"
-        tg.send_as_file(chat_id, formatted_text, caption=caption, filename=filename)
     else:
         if progress_id:
             tg.delete_message(chat_id, progress_id)
         tg.send_long_message(chat_id, result_text, parse_mode=parse_mode)
 
 
+# User-facing failure messages, matched by substring of the lowercased error (first match wins)
+_ERROR_MESSAGES = (
+    (('invalidparameter', 'duration'),
+     "Аудио слишком длинное для обработки. Попробуйте отправить файл короче 60 минут."),
+    (('timeout',),
+     "Обработка заняла слишком много времени. Попробуйте файл поменьше."),
+    (('transcription empty', 'no speech'),
+     "Не удалось распознать речь. Проверьте качество аудио."),
+)
+_DEFAULT_ERROR_MESSAGE = "Произошла ошибка при обработке аудио. Попробуйте позже."
+
+
+class JobTrace:
+    """Per-stage timings for one job, logged as a single record when it completes.
+
+    Stage details stay at DEBUG; production logging gets one structured line per job.
+    """
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.fields = {}
+        self._start = self._last = time.perf_counter()
+
+    def mark(self, stage, **fields):
+        """Record the time since the previous mark as `<stage>_ms`, plus any extra fields."""
+        now = time.perf_counter()
+        self.fields[f'{stage}_ms'] = round((now - self._last) * 1000)
+        self._last = now
+        self.fields.update(fields)
+
+    def as_dict(self):
+        return {'job_id': self.job_id,
+                'total_ms': round((time.perf_counter() - self._start) * 1000),
+                **self.fields}
+
+
+def _finalize_job(db, tg, job_id, user_id, user_id_int, chat_id, duration,
+                  formatted_text, balance_updated):
+    """Post-delivery bookkeeping: log + job completion, then low-balance warning."""
+    # The log row, the user's last_activity and the job completion go out as
+    # one BatchWriteRow, overlapped with the balance re-read
+    fresh_user, _ = _run_concurrently(
+        lambda: _get_user_cached(db, user_id_int, fresh=True) if balance_updated else None,
+        lambda: db.batch_write([
+            db.transcription_log_op({
+                'user_id': user_id, 'duration': duration,
+                'char_count': len(formatted_text), 'status': 'completed'
+            }),
+            db.user_update_op(user_id, {}),
+            ('audio_jobs', [('job_id', job_id)], {
+                'status': 'completed',
+                'result': json_dumps({'text_length': len(formatted_text)}),
+                'transcript': formatted_text,
+            }, 'update'),
+        ]),
+    )
+
+    # Low balance warning (actual balance from DB, reserved at queue time)
+    if balance_updated:
+        new_balance = fresh_user.get('balance_minutes', 0) if fresh_user else 0
+        if 0 < new_balance < 5:
+            tg.send_message(chat_id,
+                f"⚠️ <b>Низкий баланс!</b>\nОсталось: {new_balance} мин.\nПополнить: /buy_minutes",
+                parse_mode='HTML')
+        elif new_balance <= 0:
+            tg.send_message(chat_id,
+                f"❌ <b>Баланс исчерпан!</b>\nПополнить: /buy_minutes",
+                parse_mode='HTML')
+    logger.info("Job %s bookkeeping done", job_id)
+
+
+def _user_error_message(error: Exception) -> str:
+    """Map a processing exception to the message shown to the user."""
+    error_str = str(error).lower()
+    for needles, message in _ERROR_MESSAGES:
+        if any(needle in error_str for needle in needles):
+            return message
+    return _DEFAULT_ERROR_MESSAGE
+
+
 def process_job(job_data: Dict[str, Any]) -> Dict[str, Any]:
     """Process a single audio processing job (orchestrator)."""
     # Set trace context from webhook-handler (for correlated logs)
@@ -599,7 +1033,7 @@ def process_job(job_data: Dict[str, Any]) -> Dict[str, Any]:
     duration = job_data.get('duration', 0)
 
     if job_id is None or user_id is None or chat_id is None or file_id is None:
-        logger.error(f"Invalid job data: {job_data}")
+        logger.error("Invalid job data: %s", job_data)
         return {'ok': False, 'error': 'Missing required fields'}
 
     job_id = str(job_id)
@@ -612,57 +1046,71 @@ def process_job(job_data: Dict[str, Any]) -> Dict[str, Any]:
     if status_message_id:
         status_message_id = int(status_message_id)
 
-    logger.info(f"Processing job {job_id} for user {user_id}")
+    logger.info("Processing job %s for user %s", job_id, user_id)
 
     db = get_db_service()
     tg = get_telegram_service()
     audio = get_audio_service()
 
-    local_path = None
-    converted_path = None
+    cleanup = contextlib.ExitStack()
+    trace = JobTrace(job_id)
 
     try:
+        # Read-only lookups needed later (Telegram getFile, user settings) start
+        # now and overlap the dedup check, status update and progress message
+        file_path_future = (None if file_type in ('oss_upload', 'url_import')
+                            else _io_pool.submit(tg.get_file_path, file_id))
+        user_future = _io_pool.submit(_get_user_cached, db, user_id_int, duration == 0)
+
         # Dedup: MNS guarantees at-least-once delivery; skip if already processed
         existing_job = db.get_job(job_id)
         if existing_job and existing_job.get('status') in ('processing', 'completed'):
-            logger.warning(f"Job {job_id} already {existing_job['status']}, skipping (MNS redelivery)")
+            logger.warning("Job %s already %s, skipping (MNS redelivery)", job_id, existing_job['status'])
             return {'ok': True, 'result': 'duplicate'}
 
-        db.update_job(job_id, {'status': 'processing'})
-
-        # Progress message
+        # Status update and progress message are independent — one RTT instead of two
         if status_message_id:
             progress_id = status_message_id
-            tg.edit_message_text(chat_id, progress_id, "🔄 Обработка началась...")
+            _run_concurrently(
+                lambda: db.update_job(job_id, {'status': 'processing'}),
+                lambda: tg.edit_message_text(chat_id, progress_id, ProgressManager.STAGES['start']),
+            )
         else:
-            progress_msg = tg.send_message(chat_id, "🔄 Обработка началась...")
+            _, progress_msg = _run_concurrently(
+                lambda: db.update_job(job_id, {'status': 'processing'}),
+                lambda: tg.send_message(chat_id, ProgressManager.STAGES['start']),
+            )
             progress_id = progress_msg['result']['message_id'] if progress_msg and progress_msg.get('ok') else None
+        trace.mark('start')
 
         # Time budget watchdog
         deadline = time.monotonic() + FC_TIMEOUT - SAFETY_MARGIN
 
         # ProgressManager with ETA
-        progress = ProgressManager(tg, chat_id, progress_id, audio_duration=duration)
+        progress = ProgressManager(tg, chat_id, progress_id, audio_duration=duration,
+                                   executor=_ui_executor)
 
         # Step 1: Download and convert
-        local_path, converted_path = _download_and_convert(
+        _, converted_path, converted_duration = _download_and_convert(
             tg, audio, file_id, chat_id, progress_id, progress=progress,
-            file_type=file_type)
+            file_type=file_type, cleanup=cleanup, file_path_future=file_path_future,
+            duration_hint=duration)
+        trace.mark('download', file_type=file_type, audio_duration=converted_duration)
 
-        # Load user settings
-        user = db.get_user(user_id_int)
+        # User settings (cached; documents need a fresh balance for the check below)
+        user = user_future.result()
         settings_json = user.get('settings', '{}') if user else '{}'
-        settings = json.loads(settings_json) if isinstance(settings_json, str) else (settings_json or {})
+        settings = json_loads(settings_json) if isinstance(settings_json, str) else (settings_json or {})
 
         # Documents may arrive with duration=0 — detect real duration
         actual_duration = duration
         if duration == 0:
-            actual_duration = audio.get_audio_duration(converted_path)
-            logger.info(f"Job {job_id}: document duration was 0, detected {actual_duration:.1f}s")
+            actual_duration = converted_duration
+            logger.info("Job %s: document duration was 0, detected %.1fs", job_id, actual_duration)
             # Update ProgressManager with real duration for ETA
             progress.audio_duration = actual_duration
 
-            actual_minutes = (int(actual_duration) + 59) // 60
+            actual_minutes = ceil_minutes(actual_duration)
             balance = user.get('balance_minutes', 0) if user else 0
             if balance < actual_minutes:
                 deficit = actual_minutes - balance
@@ -681,15 +1129,17 @@ def process_job(job_data: Dict[str, Any]) -> Dict[str, Any]:
             duration = int(actual_duration)
 
         # Step 2: Transcribe
+        diarization_debug = {}
         text, is_dialogue = _transcribe(audio, tg, converted_path, actual_duration,
                                         chat_id, progress_id,
                                         settings.get('speaker_labels', False),
-                                        progress=progress)
+                                        progress=progress, debug=diarization_debug)
+        trace.mark('transcribe', is_dialogue=is_dialogue, asr_chars=len(text or ''))
 
         # Debug diarization output for admin
-        owner_id = int(os.environ.get('OWNER_ID', 0))
+        owner_id = OWNER_ID
         if owner_id and chat_id == owner_id and settings.get('debug_mode', False):
-            debug_text = audio.get_diarization_debug()
+            debug_text = audio.get_diarization_debug(diarization_debug)
             if debug_text:
                 tg.send_message(owner_id, f"<pre>{debug_text}</pre>", parse_mode='HTML')
 
@@ -700,25 +1150,33 @@ def process_job(job_data: Dict[str, Any]) -> Dict[str, Any]:
             db.update_job(job_id, {'status': 'failed', 'error': 'no_speech'})
             return {'ok': True, 'result': 'no_speech'}
 
+        # The audio isn't read again once transcribed (formatting gets the known
+        # duration), so the temp files are unlinked while the LLM call runs
+        if converted_duration or actual_duration:
+            _submit_post(cleanup.pop_all().close)
+
         # Step 3: Format text (with watchdog check)
         remaining = deadline - time.monotonic()
         if remaining < 60:
-            logger.warning(f"[watchdog] low time budget ({remaining:.0f}s), skipping LLM formatting")
+            logger.warning("[watchdog] low time budget (%.0fs), skipping LLM formatting", remaining)
             formatted_text = text
         else:
             formatted_text = _format_transcription(audio, text, is_dialogue, settings,
                                                    converted_path, tg, chat_id, progress_id,
-                                                   progress=progress)
+                                                   progress=progress,
+                                                   audio_duration=converted_duration or actual_duration)
+        trace.mark('format', chars=len(formatted_text))
 
         # Step 4: Balance already reserved at queue time (webhook).
         # For duration=0 documents, deduct now (actual duration detected above).
         reserved_minutes = job_data.get('reserved_minutes', 0)
-        duration_minutes = (duration + 59) // 60
+        duration_minutes = ceil_minutes(duration)
         extra_minutes = max(0, duration_minutes - reserved_minutes)
         if extra_minutes > 0:
             balance_updated = db.update_user_balance(user_id_int, -extra_minutes)
+            _invalidate_user_cache(user_id_int)
             if not balance_updated:
-                logger.error(f"CRITICAL: Failed to deduct extra {extra_minutes} min from user {user_id}!")
+                logger.error("CRITICAL: Failed to deduct extra %s min from user %s!", extra_minutes, user_id)
                 try:
                     if owner_id:
                         tg.send_message(
@@ -728,48 +1186,29 @@ def process_job(job_data: Dict[str, Any]) -> Dict[str, Any]:
                             f"Требуется ручная корректировка."
                         )
                 except Exception as notify_err:
-                    logger.error(f"Failed to notify owner about balance error: {notify_err}")
-        balance = user.get('balance_minutes', 0) if user else 0
+                    logger.error("Failed to notify owner about balance error: %s", notify_err)
         balance_updated = True  # For low balance warning
 
         # Step 5: Deliver result
         _deliver_result(tg, chat_id, progress_id, formatted_text, settings,
                         is_dialogue=is_dialogue, progress=progress)
+        trace.mark('deliver')
 
-        # Low balance warning (after delivery so user sees result first)
-        if balance_updated:
-            # Read actual balance from DB (was reserved at queue time)
-            fresh_user = db.get_user(user_id_int)
-            new_balance = fresh_user.get('balance_minutes', 0) if fresh_user else 0
-            if 0 < new_balance < 5:
-                tg.send_message(chat_id,
-                    f"⚠️ <b>Низкий баланс!</b>\nОсталось: {new_balance} мин.\nПополнить: /buy_minutes",
-                    parse_mode='HTML')
-            elif new_balance <= 0:
-                tg.send_message(chat_id,
-                    f"❌ <b>Баланс исчерпан!</b>\nПополнить: /buy_minutes",
-                    parse_mode='HTML')
-
-        # Log transcription (after delivery to reduce perceived latency)
-        db.log_transcription({
-            'user_id': user_id, 'duration': duration,
-            'char_count': len(formatted_text), 'status': 'completed'
-        })
-        db.update_job(job_id, {
-            'status': 'completed',
-            'result': json.dumps({'text_length': len(formatted_text)}),
-            'transcript': formatted_text,
-        })
+        # Bookkeeping runs in the background: the user already has the result
+        _submit_post(_finalize_job, db, tg, job_id, user_id, user_id_int, chat_id,
+                     duration, formatted_text, balance_updated)
 
         # AI action buttons for large file uploads (oss_upload via /upload)
         if file_type == 'oss_upload' and len(formatted_text) > 500:
             _send_ai_action_buttons(tg, chat_id, job_id)
 
-        logger.info(f"Job {job_id} completed successfully")
+        job_trace = trace.as_dict()
+        logger.info("Job %s completed in %sms", job_id, job_trace['total_ms'],
+                    extra={'job_trace': job_trace})
         return {'ok': True, 'result': 'completed'}
 
     except Exception as e:
-        logger.error(f"Error processing job {job_id}: {e}", exc_info=True)
+        logger.error("Error processing job %s: %s", job_id, e, exc_info=True)
         db.update_job(job_id, {'status': 'failed', 'error': str(e)[:200]})
 
         # Refund reserved balance on processing failure
@@ -777,27 +1216,15 @@ def process_job(job_data: Dict[str, Any]) -> Dict[str, Any]:
         if reserved_minutes > 0:
             try:
                 db.update_user_balance(user_id_int, +reserved_minutes)
-                logger.info(f"Refunded {reserved_minutes} min to user {user_id} after job failure")
+                _invalidate_user_cache(user_id_int)
+                logger.info("Refunded %s min to user %s after job failure", reserved_minutes, user_id)
             except Exception as refund_err:
-                logger.error(f"CRITICAL: Failed to refund {reserved_minutes} min to user {user_id}: {refund_err}")
-
-        error_str = str(e).lower()
-        if 'invalidparameter' in error_str or 'duration' in error_str:
-            user_msg = "Аудио слишком длинное для обработки. Попробуйте отправить файл короче 60 минут."
-        elif 'timeout' in error_str:
-            user_msg = "Обработка заняла слишком много времени. Попробуйте файл поменьше."
-        elif 'transcription empty' in error_str or 'no speech' in error_str:
-            user_msg = "Не удалось распознать речь. Проверьте качество аудио."
-        else:
-            user_msg = "Произошла ошибка при обработке аудио. Попробуйте позже."
+                logger.error("CRITICAL: Failed to refund %s min to user %s: %s", reserved_minutes, user_id, refund_err)
+
+        user_msg = _user_error_message(e)
         tg.send_message(chat_id, user_msg)
 
         return {'ok': False, 'error': str(e)}
 
     finally:
-        for path in (local_path, converted_path):
-            if path:
-                try:
-                    os.remove(path)
-                except OSError:
-                    pass
+        _submit_post(cleanup.close)  # unlink off the return path; handler() drains it
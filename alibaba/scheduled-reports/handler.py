@@ -8,11 +8,22 @@ import logging
 from datetime import datetime, timedelta
 import pytz
 import requests
-from tablestore import OTSClient, INF_MIN, INF_MAX, Direction
+from tablestore import (
+    OTSClient, INF_MIN, INF_MAX, Direction, CapacityUnit,
+    SingleColumnCondition, ComparatorType,
+    SearchQuery, MatchAllQuery, Sum, ColumnsToGet, ColumnReturnType,
+    Row, Condition, RowExistenceExpectation,
+)
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Search index on users (terraform/tablestore.tf) used for report aggregates
+USERS_SEARCH_INDEX = 'users_index'
+
+# Reports already generated by this warm instance, keyed by UTC date
+_report_cache = {}
+
 
 def handler(event, context):
     """
@@ -37,8 +48,8 @@ def handler(event, context):
         os.environ.get('TABLESTORE_INSTANCE')
     )
 
-    # Generate daily report
-    report = generate_daily_report(client)
+    # Generate daily report (timer retries reuse the day's report)
+    report = get_daily_report(client)
 
     # Send report to owner
     send_telegram_message(bot_token, owner_id, report)
@@ -47,92 +58,66 @@ def handler(event, context):
     return {'statusCode': 200, 'body': 'Report sent'}
 
 
-def generate_daily_report(client) -> str:
-    """Generate daily statistics report."""
-    now = datetime.now(pytz.utc)
-    yesterday = now - timedelta(days=1)
+def get_daily_report(client) -> str:
+    """Return today's report, generating it only on the first call per UTC day.
+
+    Checked in the module-level dict first, then the report_cache table,
+    so FC timer retries and repeat requests skip the table scans.
+    """
+    report_date = datetime.now(pytz.utc).strftime('%Y-%m-%d')
+    if report_date in _report_cache:
+        return _report_cache[report_date]
 
-    # Get transcription logs for last 24 hours
     try:
-        inclusive_start = [('log_id', INF_MIN)]
-        exclusive_end = [('log_id', INF_MAX)]
-
-        consumed, next_pk, rows, next_token = client.get_range(
-            'transcription_logs',
-            Direction.FORWARD,
-            inclusive_start,
-            exclusive_end,
-            [],
-            5000
-        )
+        consumed, row, next_token = client.get_row('report_cache', [('report_date', report_date)],
+                                                   ['body'], None, 1)
+        if row and row.attribute_columns:
+            _report_cache[report_date] = row.attribute_columns[0][1]
+            return _report_cache[report_date]
+    except Exception as e:
+        logger.warning(f"Report cache read failed: {e}")
 
-        # Filter by date and calculate stats
-        total_transcriptions = 0
-        total_duration = 0
-        total_chars = 0
-        unique_users = set()
-
-        for row in rows:
-            row_dict = _row_to_dict(row)
-            timestamp_str = row_dict.get('timestamp', '')
-
-            if timestamp_str:
-                try:
-                    ts = datetime.fromisoformat(timestamp_str.replace('Z', '+00:00'))
-                    if ts >= yesterday:
-                        total_transcriptions += 1
-                        total_duration += row_dict.get('duration', 0)
-                        total_chars += row_dict.get('char_count', 0)
-                        unique_users.add(row_dict.get('user_id'))
-                except (ValueError, TypeError):
-                    pass
-
-        # Get user stats
-        user_start = [('user_id', INF_MIN)]
-        user_end = [('user_id', INF_MAX)]
-
-        consumed, next_pk, user_rows, next_token = client.get_range(
-            'users',
-            Direction.FORWARD,
-            user_start,
-            user_end,
-            [],
-            1000
-        )
+    try:
+        report = generate_daily_report(client)
+    except Exception as e:
+        logger.error(f"Error generating report: {e}")
+        return f"❌ Ошибка генерации отчёта: {e}"
 
-        total_users = len(user_rows)
-        total_balance = sum(_row_to_dict(r).get('balance_minutes', 0) for r in user_rows)
+    _report_cache[report_date] = report
+    try:
+        client.put_row('report_cache',
+                       Row([('report_date', report_date)], [('body', report)]),
+                       Condition(RowExistenceExpectation.IGNORE))
+    except Exception as e:
+        logger.warning(f"Report cache write failed: {e}")
+    return report
 
-        # Get payment stats
-        pay_start = [('payment_id', INF_MIN)]
-        pay_end = [('payment_id', INF_MAX)]
 
-        consumed, next_pk, pay_rows, next_token = client.get_range(
-            'payment_logs',
-            Direction.FORWARD,
-            pay_start,
-            pay_end,
-            [],
-            1000
-        )
+def generate_daily_report(client) -> str:
+    """Generate daily statistics report. Raises on Tablestore errors."""
+    now = datetime.now(pytz.utc)
+    yesterday = now - timedelta(days=1)
+
+    # Get transcription logs for last 24 hours
+    log_columns = _columns(
+        _rows_since(client, 'transcription_logs', 'log_id', yesterday,
+                    ['user_id', 'duration', 'char_count', 'timestamp']),
+        ('user_id', 'duration', 'char_count'))
+    total_transcriptions = log_columns['rows']
+    total_duration = sum(log_columns['duration'])
+    total_chars = sum(log_columns['char_count'])
+    unique_users = set(log_columns['user_id'])
 
-        payments_24h = 0
-        stars_24h = 0
-        for row in pay_rows:
-            row_dict = _row_to_dict(row)
-            timestamp_str = row_dict.get('timestamp', '')
-            if timestamp_str:
-                try:
-                    ts = datetime.fromisoformat(timestamp_str.replace('Z', '+00:00'))
-                    if ts >= yesterday:
-                        payments_24h += 1
-                        stars_24h += row_dict.get('stars_amount', 0)
-                except (ValueError, TypeError):
-                    pass
+    # Get user stats
+    total_users, total_balance = _user_totals(client)
 
-    except Exception as e:
-        logger.error(f"Error generating report: {e}")
-        return f"❌ Ошибка генерации отчёта: {e}"
+    # Get payment stats
+    pay_columns = _columns(
+        _rows_since(client, 'payment_logs', 'payment_id', yesterday,
+                    ['stars_amount', 'timestamp']),
+        ('stars_amount',))
+    payments_24h = pay_columns['rows']
+    stars_24h = sum(pay_columns['stars_amount'])
 
     # Format report
     report = (
@@ -152,6 +137,98 @@ def generate_daily_report(client) -> str:
     return report
 
 
+def _rows_since(client, table_name: str, pk_name: str, since: datetime, columns: list):
+    """Stream rows whose `timestamp` is at or after since (columns must include it).
+
+    The bot writes timestamps as canonical UTC isoformat strings, but rows
+    from the Firestore migration may use a 'Z' suffix, a space separator or
+    another offset. So the server-side filter is only a coarse bound on the
+    date prefix a day earlier (every format starts with YYYY-MM-DD), and the
+    exact check runs here on the normalized value. xget_range follows
+    next_start_primary_key.
+    """
+    lower_bound = (since - timedelta(days=1)).strftime('%Y-%m-%d')
+    cutoff = since.astimezone(pytz.utc).isoformat()
+    column_filter = SingleColumnCondition('timestamp', lower_bound, ComparatorType.GREATER_EQUAL,
+                                          pass_if_missing=False)
+    for row in client.xget_range(
+        table_name,
+        Direction.FORWARD,
+        [(pk_name, INF_MIN)],
+        [(pk_name, INF_MAX)],
+        CapacityUnit(0, 0),
+        columns_to_get=columns,
+        column_filter=column_filter,
+    ):
+        for col in row.attribute_columns or ():
+            if col[0] == 'timestamp':
+                timestamp = _utc_sort_key(col[1])
+                if timestamp is not None and timestamp >= cutoff:
+                    yield row
+                break
+
+
+def _utc_sort_key(value):
+    """Canonical UTC isoformat of a stored timestamp, or None if it can't be read."""
+    if type(value) is not str:
+        return None
+    if value[10:11] == 'T' and value.endswith('+00:00'):
+        return value
+    try:
+        ts = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=pytz.utc)
+    return ts.astimezone(pytz.utc).isoformat()
+
+
+def _user_totals(client) -> tuple:
+    """Return (user count, total balance), aggregated by the users search index.
+
+    Falls back to streaming balance_minutes when the index is unavailable
+    (e.g. not yet created or still syncing).
+    """
+    try:
+        search_response = client.search(
+            'users', USERS_SEARCH_INDEX,
+            SearchQuery(MatchAllQuery(), limit=0, get_total_count=True,
+                        aggs=[Sum('balance_minutes', missing_value=0, name='total_balance')]),
+            columns_to_get=ColumnsToGet(return_type=ColumnReturnType.NONE)
+        )
+        aggs = {agg.name: agg.value for agg in search_response.agg_results}
+        return search_response.total_count, int(aggs.get('total_balance') or 0)
+    except Exception as e:
+        logger.warning(f"Users search index unavailable, scanning table: {e}")
+
+    total_users = 0
+    total_balance = 0
+    for row in client.xget_range('users', Direction.FORWARD,
+                                 [('user_id', INF_MIN)], [('user_id', INF_MAX)],
+                                 CapacityUnit(0, 0), columns_to_get=['balance_minutes']):
+        total_users += 1
+        total_balance += _row_to_dict(row).get('balance_minutes', 0)
+    return total_users, total_balance
+
+
+def _columns(rows, names: tuple) -> dict:
+    """Collect the named attribute columns of rows into per-column lists.
+
+    Reads row.attribute_columns directly instead of building a dict per row;
+    the 'rows' key holds the row count. Missing cells are simply absent.
+    """
+    columns = {name: [] for name in names}
+    count = 0
+    for row in rows:
+        count += 1
+        for col in row.attribute_columns or ():
+            values = columns.get(col[0])
+            if values is not None:
+                values.append(col[1])
+    columns['rows'] = count
+    return columns
+
+
 def send_telegram_message(bot_token: str, chat_id: str, text: str):
     """Send message via Telegram Bot API."""
     url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
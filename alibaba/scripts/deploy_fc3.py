@@ -5,14 +5,18 @@ Uses alibabacloud-fc20230330 SDK
 """
 import os
 import sys
-import base64
+import compileall
+import tempfile
 import zipfile
-import io
 import json
 
 script_dir = os.path.dirname(os.path.abspath(__file__))
 alibaba_dir = os.path.dirname(script_dir)
 
+# Code packages are uploaded here and referenced by FC (must be in the function's region).
+# Required, and never the user-audio bucket: packages are deleted once FC has taken the code.
+DEPLOY_OSS_BUCKET = os.environ.get('DEPLOY_OSS_BUCKET')
+
 
 def get_credentials():
     """Get credentials from aliyun CLI config."""
@@ -33,22 +37,52 @@ def get_credentials():
     return None
 
 
-def create_zip_package(source_dir: str) -> bytes:
-    """Create zip package from source directory."""
-    buffer = io.BytesIO()
-    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
+def create_zip_package(source_dir: str) -> str:
+    """Create zip package from source directory, returning the temp file path.
+
+    The archive is streamed to disk rather than built in memory; the caller
+    removes the file. Bytecode is compiled first and shipped in __pycache__
+    so a cold start skips parsing; it is only picked up when the local Python
+    matches the FC runtime (python3.10), otherwise the runtime compiles as before.
+    """
+    compileall.compile_dir(source_dir, quiet=1)
+    fd, zip_path = tempfile.mkstemp(suffix='.zip')
+    with os.fdopen(fd, 'wb') as f, zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED) as zf:
         for root, dirs, files in os.walk(source_dir):
-            dirs[:] = [d for d in dirs if d not in ['__pycache__', '.git', 'node_modules']]
+            dirs[:] = [d for d in dirs if d not in ['.git', 'node_modules']]
 
             for file in files:
-                if file.endswith(('.pyc', '.zip', '.b64', '.DS_Store')):
+                if file.endswith(('.zip', '.b64', '.DS_Store')):
                     continue
 
                 file_path = os.path.join(root, file)
                 arcname = os.path.relpath(file_path, source_dir)
                 zf.write(file_path, arcname)
 
-    return buffer.getvalue()
+    return zip_path
+
+
+def upload_zip_package(zip_path: str, function_name: str, creds: dict, region: str):
+    """Upload the package to OSS, returning its InputCodeLocation fields."""
+    import oss2
+
+    object_name = f"deploy/{function_name.replace('$', '/')}.zip"
+    _deploy_bucket(oss2, creds, region).put_object_from_file(object_name, zip_path)
+    return {'oss_bucket_name': DEPLOY_OSS_BUCKET, 'oss_object_name': object_name}
+
+
+def delete_zip_package(object_name: str, creds: dict, region: str):
+    """Remove an uploaded package; FC keeps its own copy once update_function returns."""
+    import oss2
+    try:
+        _deploy_bucket(oss2, creds, region).delete_object(object_name)
+    except oss2.exceptions.OssError as e:
+        print(f"     ! Could not delete oss://{DEPLOY_OSS_BUCKET}/{object_name}: {e}")
+
+
+def _deploy_bucket(oss2, creds: dict, region: str):
+    auth = oss2.Auth(creds['access_key_id'], creds['access_key_secret'])
+    return oss2.Bucket(auth, f'oss-{region}.aliyuncs.com', DEPLOY_OSS_BUCKET)
 
 
 def deploy_function(function_name: str, source_dir: str, region: str = 'eu-central-1'):
@@ -76,21 +110,21 @@ def deploy_function(function_name: str, source_dir: str, region: str = 'eu-centr
     client = FCClient(config)
 
     # Create zip package
-    zip_data = create_zip_package(source_dir)
-    zip_base64 = base64.b64encode(zip_data).decode('utf-8')
-    print(f"     Package size: {len(zip_data) / 1024:.1f} KB")
+    zip_path = create_zip_package(source_dir)
+    print(f"     Package size: {os.path.getsize(zip_path) / 1024:.1f} KB")
 
     # Update function code using FC 3.0 API
     try:
+        # Reference the package in OSS rather than sending it base64-encoded inline
+        code_location = upload_zip_package(zip_path, function_name, creds, region)
         request = fc_models.UpdateFunctionRequest(
             body=fc_models.UpdateFunctionInput(
-                code=fc_models.InputCodeLocation(
-                    zip_file=zip_base64
-                )
+                code=fc_models.InputCodeLocation(**code_location)
             )
         )
 
         response = client.update_function(function_name, request)
+        delete_zip_package(code_location['oss_object_name'], creds, region)
         print(f"     ✓ {function_name} deployed successfully")
         print(f"       checksum: {response.body.code_checksum[:16]}...")
         return True
@@ -103,10 +137,17 @@ def deploy_function(function_name: str, source_dir: str, region: str = 'eu-centr
             print(f"     ✗ Failed: {error_msg[:200]}")
         return False
 
+    finally:
+        os.remove(zip_path)
+
 
 def main():
     print("=== Alibaba Cloud Function Compute 3.0 Deployment ===\n")
 
+    if not DEPLOY_OSS_BUCKET:
+        print("✗ DEPLOY_OSS_BUCKET is not set (a dedicated bucket for code packages, not the audio bucket)")
+        return 1
+
     region = 'eu-central-1'
     service = 'telegram-whisper-bot-prod'
 
@@ -6,7 +6,9 @@ Migrates user data, trial requests, and logs from GCP Firestore to Alibaba Table
 import os
 import sys
 import json
+import time
 import logging
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from datetime import datetime
 
 # Configure logging
@@ -28,6 +30,12 @@ TABLESTORE_INSTANCE = os.environ.get('TABLESTORE_INSTANCE', 'twbot-prod')
 ALIBABA_ACCESS_KEY = os.environ.get('ALIBABA_ACCESS_KEY', '')
 ALIBABA_SECRET_KEY = os.environ.get('ALIBABA_SECRET_KEY', '')
 
+# BatchWriteRow accepts at most 200 rows per request
+BATCH_SIZE = 200
+BATCH_RETRIES = 3
+# Concurrent BatchWriteRow requests per table, overlapping Firestore streaming
+WRITE_WORKERS = 4
+
 
 def init_firestore():
     """Initialize Firestore client"""
@@ -54,64 +62,128 @@ def init_tablestore():
         return None
 
 
+def batch_put_rows(tablestore_client, table_name, rows):
+    """Write rows with BatchWriteRow, BATCH_SIZE per request. Returns rows written.
+
+    Full batches are sent on WRITE_WORKERS threads while `rows` keeps
+    streaming; at most 2 * WRITE_WORKERS batches are held in memory.
+    """
+    count = 0
+    in_flight = set()
+
+    with ThreadPoolExecutor(max_workers=WRITE_WORKERS) as executor:
+        def submit(batch):
+            nonlocal count, in_flight
+            if len(in_flight) >= 2 * WRITE_WORKERS:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                count += sum(future.result() for future in done)
+            in_flight.add(executor.submit(_write_batch, tablestore_client, table_name, batch))
+
+        batch = []
+        batch_keys = set()
+        for row in rows:
+            key = tuple(row.primary_key)
+            # A batch may not contain the same primary key twice
+            if len(batch) == BATCH_SIZE or key in batch_keys:
+                submit(batch)
+                batch = []
+                batch_keys = set()
+            batch.append(row)
+            batch_keys.add(key)
+        if batch:
+            submit(batch)
+
+        count += sum(future.result() for future in in_flight)
+    return count
+
+
+def _write_batch(tablestore_client, table_name, rows):
+    """Send one BatchWriteRow request, retrying failed rows with exponential backoff."""
+    from tablestore import (BatchWriteRowRequest, TableInBatchWriteRowItem, PutRowItem,
+                            Condition, RowExistenceExpectation)
+
+    pending = rows
+    errors = {}
+    for attempt in range(BATCH_RETRIES + 1):
+        if attempt:
+            time.sleep(0.5 * 2 ** (attempt - 1))
+
+        request = BatchWriteRowRequest()
+        request.add(TableInBatchWriteRowItem(table_name, [
+            PutRowItem(row, Condition(RowExistenceExpectation.IGNORE)) for row in pending
+        ]))
+        try:
+            response = tablestore_client.batch_write_row(request)
+        except Exception as e:
+            errors = {id(row): str(e) for row in pending}
+            continue
+
+        errors = {}
+        failed = []
+        for item in response.get_failed_of_put():
+            row = pending[item.index]
+            failed.append(row)
+            errors[id(row)] = f"{item.error_code} {item.error_message}"
+        pending = failed
+        if not pending:
+            break
+
+    for row in pending:
+        logger.error(f"Failed to migrate {table_name} row {row.primary_key}: {errors.get(id(row))}")
+    return len(rows) - len(pending)
+
+
 def migrate_users(firestore_client, tablestore_client):
     """Migrate users collection"""
     logger.info("Migrating users...")
-    from tablestore import Row, Condition, RowExistenceExpectation
+    from tablestore import Row
 
     users_ref = firestore_client.collection('users')
     docs = users_ref.stream()
 
-    count = 0
-    for doc in docs:
-        user_data = doc.to_dict()
-        user_id = doc.id
-
-        # Prepare row for Tablestore
-        primary_key = [('user_id', str(user_id))]
-
-        # Convert data to Tablestore format
-        attribute_columns = []
-
-        # Balance (convert to integer minutes * 100 for precision)
-        balance = user_data.get('balance_minutes', 0)
-        if isinstance(balance, float):
-            balance = int(balance * 100)  # Store as cents for precision
-        attribute_columns.append(('balance_minutes', int(balance)))
-
-        # Trial status
-        trial_status = user_data.get('trial_status', 'none')
-        attribute_columns.append(('trial_status', str(trial_status)))
-
-        # User name
-        first_name = user_data.get('first_name', '')
-        last_name = user_data.get('last_name', '')
-        user_name = f"{first_name} {last_name}".strip()
-        attribute_columns.append(('user_name', user_name))
-
-        # Timestamps
-        created_at = user_data.get('created_at')
-        if created_at:
-            attribute_columns.append(('created_at', str(created_at)))
-
-        last_activity = user_data.get('last_activity')
-        if last_activity:
-            attribute_columns.append(('last_activity', str(last_activity)))
-
-        # Settings (as JSON)
-        settings = user_data.get('settings', {})
-        attribute_columns.append(('settings', json.dumps(settings)))
-
-        # Write to Tablestore
-        try:
-            row = Row(primary_key, attribute_columns)
-            condition = Condition(RowExistenceExpectation.IGNORE)
-            tablestore_client.put_row('users', row, condition)
-            count += 1
-            logger.debug(f"Migrated user {user_id}")
-        except Exception as e:
-            logger.error(f"Failed to migrate user {user_id}: {e}")
+    def rows():
+        for doc in docs:
+            user_data = doc.to_dict()
+            user_id = doc.id
+
+            # Prepare row for Tablestore
+            primary_key = [('user_id', str(user_id))]
+
+            # Convert data to Tablestore format
+            attribute_columns = []
+
+            # Balance (convert to integer minutes * 100 for precision)
+            balance = user_data.get('balance_minutes', 0)
+            if isinstance(balance, float):
+                balance = int(balance * 100)  # Store as cents for precision
+            attribute_columns.append(('balance_minutes', int(balance)))
 
+            # Trial status
+            trial_status = user_data.get('trial_status', 'none')
+            attribute_columns.append(('trial_status', str(trial_status)))
+
+            # User name
+            first_name = user_data.get('first_name', '')
+            last_name = user_data.get('last_name', '')
+            user_name = f"{first_name} {last_name}".strip()
+            attribute_columns.append(('user_name', user_name))
+
+            # Timestamps
+            created_at = user_data.get('created_at')
+            if created_at:
+                attribute_columns.append(('created_at', str(created_at)))
+
+            last_activity = user_data.get('last_activity')
+            if last_activity:
+                attribute_columns.append(('last_activity', str(last_activity)))
+
+            # Settings (as JSON)
+            settings = user_data.get('settings', {})
+            attribute_columns.append(('settings', json.dumps(settings)))
+
+            yield Row(primary_key, attribute_columns)
+
+    count = batch_put_rows(tablestore_client, 'users', rows())
     logger.info(f"Migrated {count} users")
     return count
 
@@ -119,31 +191,26 @@ def migrate_users(firestore_client, tablestore_client):
 def migrate_trial_requests(firestore_client, tablestore_client):
     """Migrate trial_requests collection"""
     logger.info("Migrating trial requests...")
-    from tablestore import Row, Condition, RowExistenceExpectation
+    from tablestore import Row
 
     ref = firestore_client.collection('trial_requests')
     docs = ref.stream()
 
-    count = 0
-    for doc in docs:
-        data = doc.to_dict()
-        user_id = doc.id
+    def rows():
+        for doc in docs:
+            data = doc.to_dict()
+            user_id = doc.id
 
-        primary_key = [('user_id', str(user_id))]
-        attribute_columns = [
-            ('status', str(data.get('status', 'pending'))),
-            ('user_name', str(data.get('user_name', ''))),
-            ('request_timestamp', str(data.get('request_timestamp', datetime.now().isoformat()))),
-        ]
+            primary_key = [('user_id', str(user_id))]
+            attribute_columns = [
+                ('status', str(data.get('status', 'pending'))),
+                ('user_name', str(data.get('user_name', ''))),
+                ('request_timestamp', str(data.get('request_timestamp', datetime.now().isoformat()))),
+            ]
 
-        try:
-            row = Row(primary_key, attribute_columns)
-            condition = Condition(RowExistenceExpectation.IGNORE)
-            tablestore_client.put_row('trial_requests', row, condition)
-            count += 1
-        except Exception as e:
-            logger.error(f"Failed to migrate trial request {user_id}: {e}")
+            yield Row(primary_key, attribute_columns)
 
+    count = batch_put_rows(tablestore_client, 'trial_requests', rows())
     logger.info(f"Migrated {count} trial requests")
     return count
 
@@ -151,38 +218,33 @@ def migrate_trial_requests(firestore_client, tablestore_client):
 def migrate_payment_logs(firestore_client, tablestore_client):
     """Migrate payment_logs collection"""
     logger.info("Migrating payment logs...")
-    from tablestore import Row, Condition, RowExistenceExpectation
+    from tablestore import Row
     import uuid
 
     ref = firestore_client.collection('payment_logs')
     docs = ref.stream()
 
-    count = 0
-    for doc in docs:
-        data = doc.to_dict()
-        payment_id = doc.id or str(uuid.uuid4())
-
-        primary_key = [('payment_id', str(payment_id))]
-        attribute_columns = [
-            ('user_id', str(data.get('user_id', ''))),
-            ('amount', int(data.get('amount', 0))),
-            ('stars_amount', int(data.get('stars_amount', 0))),
-            ('minutes_added', int(data.get('minutes_added', 0))),
-            ('timestamp', str(data.get('timestamp', datetime.now().isoformat()))),
-        ]
-
-        charge_id = data.get('telegram_payment_charge_id')
-        if charge_id:
-            attribute_columns.append(('telegram_payment_charge_id', str(charge_id)))
+    def rows():
+        for doc in docs:
+            data = doc.to_dict()
+            payment_id = doc.id or str(uuid.uuid4())
+
+            primary_key = [('payment_id', str(payment_id))]
+            attribute_columns = [
+                ('user_id', str(data.get('user_id', ''))),
+                ('amount', int(data.get('amount', 0))),
+                ('stars_amount', int(data.get('stars_amount', 0))),
+                ('minutes_added', int(data.get('minutes_added', 0))),
+                ('timestamp', str(data.get('timestamp', datetime.now().isoformat()))),
+            ]
 
-        try:
-            row = Row(primary_key, attribute_columns)
-            condition = Condition(RowExistenceExpectation.IGNORE)
-            tablestore_client.put_row('payment_logs', row, condition)
-            count += 1
-        except Exception as e:
-            logger.error(f"Failed to migrate payment {payment_id}: {e}")
+            charge_id = data.get('telegram_payment_charge_id')
+            if charge_id:
+                attribute_columns.append(('telegram_payment_charge_id', str(charge_id)))
+
+            yield Row(primary_key, attribute_columns)
 
+    count = batch_put_rows(tablestore_client, 'payment_logs', rows())
     logger.info(f"Migrated {count} payment logs")
     return count
 
@@ -190,7 +252,7 @@ def migrate_payment_logs(firestore_client, tablestore_client):
 def migrate_transcription_logs(firestore_client, tablestore_client, days=30):
     """Migrate recent transcription_logs"""
     logger.info(f"Migrating transcription logs (last {days} days)...")
-    from tablestore import Row, Condition, RowExistenceExpectation
+    from tablestore import Row
     from datetime import timedelta
     import uuid
 
@@ -200,28 +262,23 @@ def migrate_transcription_logs(firestore_client, tablestore_client, days=30):
     # Query recent logs
     docs = ref.where('timestamp', '>=', cutoff).stream()
 
-    count = 0
-    for doc in docs:
-        data = doc.to_dict()
-        log_id = doc.id or str(uuid.uuid4())
-
-        primary_key = [('log_id', str(log_id))]
-        attribute_columns = [
-            ('user_id', str(data.get('user_id', ''))),
-            ('timestamp', str(data.get('timestamp', datetime.now().isoformat()))),
-            ('duration', int(data.get('duration', 0))),
-            ('char_count', int(data.get('char_count', 0))),
-            ('status', str(data.get('status', 'completed'))),
-        ]
+    def rows():
+        for doc in docs:
+            data = doc.to_dict()
+            log_id = doc.id or str(uuid.uuid4())
+
+            primary_key = [('log_id', str(log_id))]
+            attribute_columns = [
+                ('user_id', str(data.get('user_id', ''))),
+                ('timestamp', str(data.get('timestamp', datetime.now().isoformat()))),
+                ('duration', int(data.get('duration', 0))),
+                ('char_count', int(data.get('char_count', 0))),
+                ('status', str(data.get('status', 'completed'))),
+            ]
 
-        try:
-            row = Row(primary_key, attribute_columns)
-            condition = Condition(RowExistenceExpectation.IGNORE)
-            tablestore_client.put_row('transcription_logs', row, condition)
-            count += 1
-        except Exception as e:
-            logger.error(f"Failed to migrate log {log_id}: {e}")
+            yield Row(primary_key, attribute_columns)
 
+    count = batch_put_rows(tablestore_client, 'transcription_logs', rows())
     logger.info(f"Migrated {count} transcription logs")
     return count
 
@@ -279,13 +336,19 @@ def main():
         logger.error("Cannot proceed without Tablestore client")
         sys.exit(1)
 
-    # Run migrations
-    results = {
-        'users': migrate_users(firestore_client, tablestore_client),
-        'trial_requests': migrate_trial_requests(firestore_client, tablestore_client),
-        'payment_logs': migrate_payment_logs(firestore_client, tablestore_client),
-        'transcription_logs': migrate_transcription_logs(firestore_client, tablestore_client),
+    # Run migrations (collections are independent, so migrate them concurrently)
+    migrations = {
+        'users': migrate_users,
+        'trial_requests': migrate_trial_requests,
+        'payment_logs': migrate_payment_logs,
+        'transcription_logs': migrate_transcription_logs,
     }
+    with ThreadPoolExecutor(max_workers=len(migrations)) as executor:
+        futures = {
+            collection: executor.submit(migrate, firestore_client, tablestore_client)
+            for collection, migrate in migrations.items()
+        }
+        results = {collection: future.result() for collection, future in futures.items()}
 
     # Verify
     verify_migration(tablestore_client)
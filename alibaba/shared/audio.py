@@ -11,9 +11,14 @@ import logging
 import re
 import tempfile
 import subprocess
+import threading
 import time
 import uuid
 import base64
+import collections
+import functools
+import mmap
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Optional, Tuple
 
 
@@ -34,14 +39,55 @@ class AudioService:
     # ASR chunking limits (DashScope API hard limit: 3 min per request)
     ASR_MAX_DURATION = 180        # 3 min — DashScope API hard limit
     ASR_MAX_CHUNK_DURATION = 150  # 2.5 min — safe chunk size with margin
+    ASR_PARALLEL_WORKERS = 4      # concurrent DashScope requests for a chunked file
+
+    # is_video_file(): extension fallback and ffprobe format_name substrings
+    VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv', '.webm', '.m4v', '.mpg', '.mpeg')
+    VIDEO_FORMATS = ('mp4', 'mov', 'avi', 'mkv', 'webm', 'matroska', 'mpeg', 'mpg')
+
+    # Inline audio sent to ASR/LLM APIs is labelled by file suffix (voice
+    # passthrough hands over OGG/Opus as-is); anything else is the MP3 we produced
+    AUDIO_MIME_TYPES = {
+        '.mp3': 'audio/mpeg',
+        '.wav': 'audio/wav',
+        '.ogg': 'audio/ogg',
+        '.oga': 'audio/ogg',
+        '.opus': 'audio/ogg',
+        '.m4a': 'audio/mp4',
+        '.flac': 'audio/flac',
+        '.webm': 'audio/webm'
+    }
+
+    # OSS uploads: files from 4 MB go up as 2 MB parts on 4 parallel connections
+    OSS_MULTIPART_THRESHOLD = 4 * 1024 * 1024
+    OSS_PART_SIZE = 2 * 1024 * 1024
+    OSS_UPLOAD_THREADS = 4
 
     # Whisper backend options
     BACKEND_OPENAI = 'openai'
     BACKEND_FASTER_WHISPER = 'faster-whisper'
     BACKEND_QWEN_ASR = 'qwen-asr'  # Alibaba Qwen3-ASR (fastest: 92ms TTFT)
 
+    # Whisper's long-form fallback schedule: a segment is re-decoded at the next
+    # temperature only when it fails the compression / log-prob thresholds
+    WHISPER_FALLBACK_TEMPERATURES = (0.0, 0.2, 0.4, 0.6, 0.8, 1.0)
+
+    # faster-whisper models are loaded once per process and shared by every instance
+    # (one copy in VRAM): (model name, batched) -> (model, batched)
+    _shared_whisper_models = {}
+    _shared_whisper_lock = threading.Lock()
+
+    # Temp OSS objects are deleted in the background; the FC handler waits on
+    # them (drain_oss_cleanup) before returning so a frozen instance loses none
+    _oss_cleanup_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix='oss-cleanup')
+    _oss_cleanup_pending = set()
+    _oss_cleanup_lock = threading.Lock()
+
+    # One oss2 keep-alive pool for every Bucket the process opens (lazy, see shared_oss_session)
+    _oss_session = None
+
     def __init__(self, metrics_service=None, openai_client=None, whisper_backend: str = None,
-                 alibaba_api_key: str = None, oss_config: dict = None):
+                 alibaba_api_key: str = None, oss_config: dict = None, http_session=None):
         """
         Initialize AudioService
 
@@ -56,6 +102,7 @@ class AudioService:
                         - endpoint: OSS endpoint (e.g., oss-eu-central-1.aliyuncs.com)
                         - access_key_id: Alibaba AccessKey ID
                         - access_key_secret: Alibaba AccessKey Secret
+            http_session: Optional shared requests.Session (keep-alive pool) for DashScope
         """
         self.metrics_service = metrics_service
         self.openai_client = openai_client
@@ -69,8 +116,7 @@ class AudioService:
         # Alibaba OSS configuration
         self.oss_config = oss_config or {}
         self._oss_bucket = None  # Lazy-loaded OSS bucket
-        self._diarization_debug = {}  # Debug info for admin diagnostics
-        self._session = None  # Lazy HTTP session for connection pooling
+        self._session = http_session  # Lazy HTTP session for connection pooling
 
         # Faster-whisper model (lazy-loaded)
         self._faster_whisper_model = None
@@ -78,6 +124,22 @@ class AudioService:
             'WHISPER_MODEL',
             'dvislobokov/faster-whisper-large-v3-turbo-russian'
         )
+        # VAD segments decoded as a batch (faster-whisper >= 1.1); 0 = sequential
+        self._faster_whisper_batch_size = int(os.environ.get('WHISPER_BATCH_SIZE', '16'))
+        # Greedy by default; Whisper's temperature fallback re-decodes only failing segments
+        self._faster_whisper_beam_size = int(os.environ.get('WHISPER_BEAM_SIZE', '1'))
+        # poll_queue runs up to AUDIO_WORKERS jobs at once against the shared model;
+        # one CTranslate2 worker per job lets their transcribe() calls run in parallel
+        self._faster_whisper_num_workers = int(os.environ.get(
+            'WHISPER_NUM_WORKERS', os.environ.get('AUDIO_WORKERS', '4')))
+        # Seconds before a slow LLM formatting call is hedged on the other backend; 0 = off
+        self._llm_hedge_delay = float(os.environ.get('LLM_HEDGE_DELAY', '0'))
+        if self.whisper_backend == self.BACKEND_FASTER_WHISPER:
+            # Load at startup so the first request doesn't pay the model load
+            try:
+                self._initialize_faster_whisper()
+            except RuntimeError as e:
+                logging.warning(f"faster-whisper preload failed, retrying on first use: {e}")
         
     @property
     def _http_session(self):
@@ -167,34 +229,55 @@ class AudioService:
         except Exception as e:
             logging.warning(f"Progress callback failed: {e}")
 
+    # "Duration: 00:01:23.45" line ffmpeg prints for its input on stderr
+    _FFMPEG_DURATION_RE = re.compile(r'Duration: (\d+):(\d+):(\d+(?:\.\d+)?)')
+
     def convert_to_mp3(self, input_path: str, output_path: Optional[str] = None) -> Optional[str]:
         """
         Convert audio file to MP3 with adaptive settings based on duration.
         Automatically adjusts bitrate to optimize for ASR quality vs file size.
         Returns path to converted file or None on error.
         """
-        if not output_path:
-            output_path = tempfile.NamedTemporaryFile(delete=False, suffix=".mp3", dir='/tmp').name
+        return self._convert_to_mp3(input_path, output_path)[0]
+
+    def _convert_to_mp3(self, input_path: str,
+                        output_path: Optional[str] = None) -> Tuple[Optional[str], float]:
+        """convert_to_mp3 that also returns the duration (seconds) seen during conversion.
 
+        Without an explicit output_path, input that is already MP3 within the
+        selected tier is returned as-is (or remuxed with -c:a copy when only the
+        container differs) instead of being re-encoded.
+        """
         duration = self.get_audio_duration(input_path)
         bitrate, sample_rate, tier = self._select_bitrate(duration)
         logging.info(f"Audio {duration:.1f}s - tier '{tier}': {bitrate} @ {sample_rate}Hz")
 
+        reuse = None if output_path else self._mp3_reuse_mode(input_path, bitrate, sample_rate)
+        if reuse == 'as-is':
+            logging.info(f"Input already MP3 {bitrate} @ {sample_rate}Hz mono, skipping transcode")
+            return input_path, duration
+
+        if not output_path:
+            output_path = tempfile.NamedTemporaryFile(delete=False, suffix=".mp3", dir='/tmp').name
+
+        if reuse == 'remux':
+            # MP3 stream in another container: copy it out, no decode/encode
+            codec_args = ('-c:a', 'copy')
+        else:
+            codec_args = self._mp3_encode_args(bitrate, sample_rate)
+
         ffmpeg_command = [
             'ffmpeg', '-y',
             '-i', input_path,
             '-vn',                    # strip video/artwork (M4A from iOS often has cover art)
-            '-acodec', 'libmp3lame',  # explicit MP3 codec
-            '-b:a', bitrate,
-            '-ar', sample_rate,
-            '-ac', self.AUDIO_CHANNELS,
+            *codec_args,
             '-threads', self.FFMPEG_THREADS,
             output_path
         ]
 
         try:
             logging.info(f"Converting audio: {input_path} -> {output_path}")
-            subprocess.run(
+            result = subprocess.run(
                 ffmpeg_command,
                 check=True,
                 capture_output=True,
@@ -202,22 +285,79 @@ class AudioService:
                 timeout=self.FFMPEG_TIMEOUT
             )
 
+            # ffmpeg already parsed the input header — trust it over the
+            # ffprobe value, which falls back to 600s when probing fails
+            match = self._FFMPEG_DURATION_RE.search(result.stderr or '')
+            if match:
+                h, m, sec = match.groups()
+                duration = int(h) * 3600 + int(m) * 60 + float(sec)
+
             output_size = os.path.getsize(output_path)
             logging.info(f"FFmpeg conversion successful. Output: {output_path} ({output_size} bytes)")
-            return output_path
+            return output_path, duration
 
         except subprocess.TimeoutExpired:
             logging.error(f"FFmpeg conversion timed out after {self.FFMPEG_TIMEOUT} seconds")
             if os.path.exists(output_path):
                 os.remove(output_path)
-            return None
+            return None, 0.0
 
         except subprocess.CalledProcessError as e:
             logging.error(f"FFmpeg conversion failed. Error: {e.stderr}")
             if os.path.exists(output_path):
                 os.remove(output_path)
-            return None
+            return None, 0.0
+
+        finally:
+            self._drop_page_cache(input_path)  # ffmpeg read it once; only the output is reused
             
+    def _mp3_encode_args(self, bitrate: str, sample_rate: str) -> tuple:
+        """Mono libmp3lame encoder settings shared by every MP3 conversion."""
+        return ('-acodec', 'libmp3lame', '-b:a', bitrate, '-ar', sample_rate, '-ac', self.AUDIO_CHANNELS)
+
+    def _mp3_reuse_mode(self, input_path: str, bitrate: str, sample_rate: str) -> Optional[str]:
+        """
+        Decide whether an input can skip the MP3 encode for the given tier.
+        Returns 'as-is' (plain MP3 file), 'remux' (MP3 stream in another container)
+        or None (full transcode needed).
+        """
+        info = self.get_audio_info(input_path)
+        if not info or info.get('codec') != 'mp3' or info.get('channels') != 1:
+            return None
+        if info.get('sample_rate') != int(sample_rate):
+            return None
+        # Container bit_rate includes a little framing overhead, allow 10%
+        max_bit_rate = int(bitrate.rstrip('k')) * 1000 * 1.1
+        if not 0 < info.get('bit_rate', 0) <= max_bit_rate:
+            return None
+        return 'as-is' if info.get('format') == 'mp3' else 'remux'
+
+    def start_mp3_stream(self, duration: float) -> 'Mp3Stream':
+        """
+        Start an MP3 conversion that reads its input from stdin, so a download
+        can be fed to ffmpeg while it is still arriving.
+
+        The input cannot be probed up front, so the bitrate tier comes from
+        the duration the caller already knows (Telegram message metadata).
+        """
+        output_path = tempfile.NamedTemporaryFile(delete=False, suffix=".mp3", dir='/tmp').name
+        bitrate, sample_rate, tier = self._select_bitrate(duration)
+        logging.info(f"Streaming conversion {duration:.1f}s - tier '{tier}': {bitrate} @ {sample_rate}Hz")
+
+        ffmpeg_command = [
+            'ffmpeg', '-y', '-nostats',
+            '-i', 'pipe:0',
+            '-vn',
+            *self._mp3_encode_args(bitrate, sample_rate),
+            '-threads', self.FFMPEG_THREADS,
+            output_path
+        ]
+        # stderr goes to a file: a full stderr pipe would stall ffmpeg while we feed stdin
+        stderr_file = tempfile.TemporaryFile()
+        process = subprocess.Popen(ffmpeg_command, stdin=subprocess.PIPE,
+                                   stdout=subprocess.DEVNULL, stderr=stderr_file)
+        return Mp3Stream(process, output_path, stderr_file, duration, self.FFMPEG_TIMEOUT)
+
     def extract_audio_from_video(self, video_path: str, output_path: Optional[str] = None) -> Optional[str]:
         """
         Extract audio track from video file
@@ -230,10 +370,7 @@ class AudioService:
             'ffmpeg', '-y',
             '-i', video_path,
             '-vn',  # No video output
-            '-acodec', 'mp3',  # Audio codec
-            '-b:a', self.AUDIO_BITRATE,
-            '-ar', self.AUDIO_SAMPLE_RATE,
-            '-ac', self.AUDIO_CHANNELS,
+            *self._mp3_encode_args(self.AUDIO_BITRATE, self.AUDIO_SAMPLE_RATE),
             '-threads', self.FFMPEG_THREADS,
             output_path
         ]
@@ -264,7 +401,53 @@ class AudioService:
             if os.path.exists(output_path):
                 os.remove(output_path)
             return None
+
+        finally:
+            self._drop_page_cache(video_path)
             
+    @classmethod
+    def _audio_mime_type(cls, audio_path: str) -> str:
+        """MIME type for inline audio, from the file suffix (MP3 by default)."""
+        return cls.AUDIO_MIME_TYPES.get(os.path.splitext(audio_path)[1].lower(), 'audio/mpeg')
+
+    @staticmethod
+    def _file_base64(path: str) -> str:
+        """Base64 of a file, encoded straight from a read-only mmap.
+
+        The page cache backs the input, so the raw audio is never copied into a
+        Python bytes object — only the encoded string is allocated.
+        """
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return ''  # mmap refuses empty files
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                    mapped.madvise(mmap.MADV_SEQUENTIAL)  # aggressive readahead, early reclaim
+                encoded = base64.b64encode(mapped).decode('ascii')
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+            return encoded
+
+    @staticmethod
+    def _drop_page_cache(path: str):
+        """
+        Tell the kernel a file's cached pages won't be read again (Linux only,
+        best effort). Temp audio is read once by ffmpeg and then deleted; dropping
+        it early keeps page-cache pressure off small instances.
+        """
+        if not hasattr(os, 'posix_fadvise'):
+            return
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
     # Allowed MIME types for audio processing (magic bytes detection)
     _ALLOWED_MIME_PREFIXES = ('audio/', 'video/', 'application/ogg', 'application/octet-stream')
 
@@ -288,42 +471,46 @@ class AudioService:
         logging.warning(f"MIME validation failed: {mime} for {file_path}")
         return False
 
-    def prepare_audio_for_asr(self, input_path: str) -> Optional[str]:
+    # Containers Qwen3-ASR / Fun-ASR accept as-is (Telegram voice notes are OGG/Opus)
+    ASR_NATIVE_SUFFIXES = ('.ogg', '.oga', '.opus')
+
+    def prepare_audio_for_asr(self, input_path: str,
+                              passthrough: bool = False) -> Tuple[Optional[str], float]:
         """
-        Prepare audio file for ASR: validate MIME, detect video, extract audio, convert to MP3.
+        Prepare audio file for ASR: validate MIME, convert to MP3 (video streams are dropped).
 
         Args:
             input_path: Path to input audio/video file
+            passthrough: Skip the MP3 transcode when the input is already in a container
+                         the ASR accepts (Telegram voice notes). The input path is returned.
 
         Returns:
-            Path to MP3 file ready for ASR, or None on error
+            (path to file ready for ASR, duration in seconds) — path is None on error.
+            The duration comes from the conversion itself, so callers need no extra ffprobe.
         """
         if not self._check_mime_type(input_path):
             logging.error(f"File rejected: invalid MIME type for {input_path}")
-            return None
-
-        processing_path = input_path
-        extracted_path = None
+            return None, 0.0
+
+        if passthrough and os.path.splitext(input_path)[1].lower() in self.ASR_NATIVE_SUFFIXES:
+            duration = self.get_audio_duration(input_path)
+            logging.info(f"OGG/Opus passthrough, skipping MP3 transcode ({duration:.1f}s)")
+            return input_path, duration
+
+        if self.whisper_backend == self.BACKEND_FASTER_WHISPER and not self.is_video_file(input_path):
+            # faster-whisper decodes the input to 16 kHz PCM itself (_decode_to_pcm16k):
+            # an MP3 in between is one more encode + decode
+            duration = self.get_audio_duration(input_path)
+            logging.info(f"faster-whisper decodes the input directly, skipping MP3 transcode ({duration:.1f}s)")
+            return input_path, duration
+
+        # One ffmpeg pass for audio and video alike: _convert_to_mp3 drops the
+        # video stream (-vn), so no ffprobe video check or separate extraction pass
         try:
-            if self.is_video_file(input_path):
-                logging.info("Video detected, extracting audio...")
-                extracted_path = self.extract_audio_from_video(input_path)
-                if not extracted_path:
-                    return None
-                processing_path = extracted_path
-
-            converted_path = self.convert_to_mp3(processing_path)
-            return converted_path  # None if conversion failed
+            return self._convert_to_mp3(input_path)  # (None, 0.0) if conversion failed
         except Exception as e:
             logging.error(f"Audio preparation failed: {e}")
-            return None
-        finally:
-            # Always clean up intermediate extracted file
-            if extracted_path and os.path.exists(extracted_path):
-                try:
-                    os.remove(extracted_path)
-                except OSError:
-                    pass
+            return None, 0.0
 
     def split_audio_chunks(self, audio_path: str, chunk_duration: int = None) -> list:
         """
@@ -347,11 +534,13 @@ class AudioService:
         chunks = []
         offset = 0
         chunk_index = 0
+        # Stream copy keeps the codec, so the chunk container must match (OGG passthrough)
+        suffix = os.path.splitext(audio_path)[1].lower() or '.mp3'
 
         try:
             while offset < total_duration:
                 chunk_path = tempfile.NamedTemporaryFile(
-                    delete=False, suffix=f"_chunk{chunk_index}.mp3", dir='/tmp'
+                    delete=False, suffix=f"_chunk{chunk_index}{suffix}", dir='/tmp'
                 ).name
 
                 ffmpeg_command = [
@@ -462,16 +651,30 @@ class AudioService:
         start_time = time.time()
 
         try:
-            segments, info = self._faster_whisper_model.transcribe(
-                audio_path,
+            options = dict(
                 language=language,
-                beam_size=5,
+                beam_size=self._faster_whisper_beam_size,
+                best_of=1,
+                temperature=self.WHISPER_FALLBACK_TEMPERATURES,
+                compression_ratio_threshold=2.4,
+                log_prob_threshold=-1.0,
+                no_speech_threshold=0.6,
                 vad_filter=True,
                 vad_parameters=dict(
                     min_silence_duration_ms=500,
                     speech_pad_ms=400
                 )
             )
+            if self._faster_whisper_batch_size:
+                options['batch_size'] = self._faster_whisper_batch_size
+            if 'distil' in self._faster_whisper_model_name.lower():
+                # Distilled checkpoints (e.g. Systran/faster-distil-whisper-large-v3)
+                # are trained for independent 30s windows — the chunked algorithm
+                options.update(condition_on_previous_text=False, chunk_length=30)
+            # Hand the model 16 kHz mono float32 straight from ffmpeg instead of a
+            # path it would decode and resample again itself
+            pcm = self._decode_to_pcm16k(audio_path)
+            segments, info = self._faster_whisper_model.transcribe(pcm, **options)
 
             # Collect all segments
             text_parts = []
@@ -500,26 +703,89 @@ class AudioService:
             logging.error(f"Faster-whisper error: {e}")
             raise
 
+    def _decode_to_pcm16k(self, audio_path: str):
+        """Decode any ffmpeg-readable file to the 16 kHz mono float32 array Whisper consumes."""
+        import numpy as np
+
+        result = subprocess.run(
+            [
+                'ffmpeg', '-nostdin', '-v', 'error',
+                '-i', audio_path,
+                '-vn',
+                '-f', 'f32le', '-ac', '1', '-ar', '16000',
+                '-threads', self.FFMPEG_THREADS,
+                'pipe:1'
+            ],
+            capture_output=True,
+            check=True,
+            timeout=self.FFMPEG_TIMEOUT
+        )
+        return np.frombuffer(result.stdout, dtype=np.float32)
+
     def _initialize_faster_whisper(self):
-        """Initialize faster-whisper model (lazy loading)"""
+        """Load the faster-whisper model, or reuse the one already loaded in this process"""
+        key = (self._faster_whisper_model_name, bool(self._faster_whisper_batch_size))
+        with AudioService._shared_whisper_lock:
+            shared = AudioService._shared_whisper_models.get(key)
+            if shared is None:
+                shared = self._load_faster_whisper()
+                AudioService._shared_whisper_models[key] = shared
+        self._faster_whisper_model, batched = shared
+        if not batched:
+            self._faster_whisper_batch_size = 0
+
+    def _load_faster_whisper(self):
+        """Load and warm up a faster-whisper model. Returns (model, batched)."""
+        # Split the cores between the parallel workers instead of every worker
+        # (and OpenMP) spawning one thread per core and thrashing on 4-vCPU hosts
+        cpu_threads = int(os.environ.get(
+            'WHISPER_CPU_THREADS',
+            max(1, (os.cpu_count() or 4) // self._faster_whisper_num_workers)))
+        os.environ.setdefault('OMP_NUM_THREADS', str(cpu_threads))  # read when ctranslate2 loads
         try:
             from faster_whisper import WhisperModel
             import torch
 
             # Detect GPU availability
             device = "cuda" if torch.cuda.is_available() else "cpu"
-            compute_type = "float16" if device == "cuda" else "int8"
+            # int8 weights + fp16 activations: half the weight/KV bandwidth of float16.
+            # Needs Turing or newer (T4, A10, RTX 30xx); override with WHISPER_COMPUTE_TYPE.
+            compute_type = os.environ.get(
+                'WHISPER_COMPUTE_TYPE', "int8_float16" if device == "cuda" else "int8")
 
             logging.info(f"Initializing faster-whisper: model={self._faster_whisper_model_name}, "
                         f"device={device}, compute_type={compute_type}")
 
-            self._faster_whisper_model = WhisperModel(
+            model = WhisperModel(
                 self._faster_whisper_model_name,
                 device=device,
-                compute_type=compute_type
+                compute_type=compute_type,
+                cpu_threads=cpu_threads,  # per worker; unused on GPU
+                num_workers=self._faster_whisper_num_workers
             )
 
+            # One decode of 1s of silence: CTranslate2 selects kernels and allocates
+            # its buffers here rather than on the first user's audio
+            try:
+                import numpy as np
+                segments, _ = model.transcribe(np.zeros(16000, dtype=np.float32), language='ru',
+                                               beam_size=1, vad_filter=False)
+                list(segments)
+            except Exception as e:
+                logging.warning(f"faster-whisper warm-up skipped: {e}")
+
+            batched = False
+            if self._faster_whisper_batch_size:
+                try:
+                    from faster_whisper import BatchedInferencePipeline
+                    model = BatchedInferencePipeline(model=model)
+                    batched = True
+                    logging.info(f"Batched inference enabled (batch_size={self._faster_whisper_batch_size})")
+                except ImportError:
+                    logging.warning("faster-whisper < 1.1: no BatchedInferencePipeline, decoding sequentially")
+
             logging.info("Faster-whisper model loaded successfully")
+            return model, batched
 
         except ImportError:
             raise RuntimeError(
@@ -558,7 +824,7 @@ class AudioService:
                 auth = oss2.StsAuth(access_key_id, access_key_secret, security_token)
             else:
                 auth = oss2.Auth(access_key_id, access_key_secret)
-            self._oss_bucket = oss2.Bucket(auth, endpoint, bucket_name)
+            self._oss_bucket = oss2.Bucket(auth, endpoint, bucket_name, session=self.shared_oss_session())
             logging.info(f"OSS bucket initialized: {bucket_name}")
             return self._oss_bucket
 
@@ -569,6 +835,45 @@ class AudioService:
             logging.warning(f"Failed to initialize OSS bucket: {e}")
             return None
 
+    def _put_oss_file(self, bucket, oss_key: str, local_path: str, label: str):
+        """
+        Upload a local file with retry on transient failures.
+        Files at or above OSS_MULTIPART_THRESHOLD go up as parallel multipart parts.
+        """
+        try:
+            size = os.path.getsize(local_path)
+        except OSError:
+            size = 0  # the single PUT below reports the real error
+        last_err = None
+        for attempt in range(3):
+            try:
+                if size >= self.OSS_MULTIPART_THRESHOLD:
+                    import oss2
+                    oss2.resumable_upload(
+                        bucket, oss_key, local_path,
+                        store=oss2.ResumableStore(root='/tmp'),  # only /tmp is writable on FC
+                        multipart_threshold=self.OSS_MULTIPART_THRESHOLD,
+                        part_size=self.OSS_PART_SIZE,
+                        num_threads=self.OSS_UPLOAD_THREADS,
+                    )
+                else:
+                    bucket.put_object_from_file(oss_key, local_path)
+                return
+            except Exception as upload_err:
+                last_err = upload_err
+                logging.warning(f"OSS {label} attempt {attempt + 1}/3 failed: {upload_err}")
+                if attempt < 2:
+                    time.sleep(1 << attempt)  # 1s, 2s
+        raise last_err
+
+    @classmethod
+    def shared_oss_session(cls):
+        """oss2 Session shared by all buckets, so uploads, deletes and downloads reuse TLS connections."""
+        if cls._oss_session is None:
+            import oss2
+            cls._oss_session = oss2.Session()
+        return cls._oss_session
+
     def _upload_to_oss(self, local_path: str) -> Optional[str]:
         """
         Upload file to Alibaba OSS and return the OSS URL.
@@ -591,21 +896,8 @@ class AudioService:
             file_ext = os.path.splitext(local_path)[1] or '.mp3'
             oss_key = f"audio/{uuid.uuid4().hex}{file_ext}"
 
-            # Upload file with retry on transient failures
             logging.info(f"Uploading to OSS: {local_path} -> {oss_key}")
-            last_err = None
-            for attempt in range(3):
-                try:
-                    bucket.put_object_from_file(oss_key, local_path)
-                    last_err = None
-                    break
-                except Exception as upload_err:
-                    last_err = upload_err
-                    logging.warning(f"OSS upload attempt {attempt + 1}/3 failed: {upload_err}")
-                    if attempt < 2:
-                        time.sleep(1 << attempt)  # 1s, 2s
-            if last_err:
-                raise last_err
+            self._put_oss_file(bucket, oss_key, local_path, 'upload')
 
             # Return OSS URL
             bucket_name = self.oss_config.get('bucket')
@@ -619,20 +911,13 @@ class AudioService:
             return None
 
     def _delete_from_oss(self, oss_url: str):
-        """Delete file from OSS after transcription"""
-        bucket = self._get_oss_bucket()
-        if not bucket or not oss_url:
+        """Delete file from OSS after transcription (in the background)"""
+        if not oss_url:
             return
-
-        try:
-            # Extract key from oss://bucket/key
-            parts = oss_url.replace('oss://', '').split('/', 1)
-            if len(parts) == 2:
-                oss_key = parts[1]
-                bucket.delete_object(oss_key)
-                logging.info(f"Deleted from OSS: {oss_key}")
-        except Exception as e:
-            logging.warning(f"Failed to delete from OSS: {e}")
+        # Extract key from oss://bucket/key
+        parts = oss_url.replace('oss://', '').split('/', 1)
+        if len(parts) == 2:
+            self._cleanup_oss_key(parts[1])
 
     def _upload_to_oss_with_url(self, local_path: str, expiry: int = 3600) -> Tuple[Optional[str], Optional[str]]:
         """Upload to OSS and return (oss_key, signed_https_url) for async ASR.
@@ -653,20 +938,7 @@ class AudioService:
         try:
             file_ext = os.path.splitext(local_path)[1] or '.mp3'
             oss_key = f"diarization/{uuid.uuid4().hex}{file_ext}"
-            # Retry on transient failures
-            last_err = None
-            for attempt in range(3):
-                try:
-                    bucket.put_object_from_file(oss_key, local_path)
-                    last_err = None
-                    break
-                except Exception as upload_err:
-                    last_err = upload_err
-                    logging.warning(f"OSS diarization upload attempt {attempt + 1}/3 failed: {upload_err}")
-                    if attempt < 2:
-                        time.sleep(1 << attempt)  # 1s, 2s
-            if last_err:
-                raise last_err
+            self._put_oss_file(bucket, oss_key, local_path, 'diarization upload')
             signed_url = bucket.sign_url('GET', oss_key, expiry)
             logging.info(f"Uploaded to OSS for diarization: {oss_key}")
             return oss_key, signed_url
@@ -675,7 +947,7 @@ class AudioService:
             return None, None
 
     def _diarize_assemblyai(self, audio_path: str, language: str = 'ru',
-                            progress_callback=None) -> Tuple[Optional[str], List[dict]]:
+                            progress_callback=None, debug: Optional[dict] = None) -> Tuple[Optional[str], List[dict]]:
         """Diarization via AssemblyAI Universal-2.
 
         Workflow: upload file → submit transcription → poll until complete → parse utterances.
@@ -683,12 +955,13 @@ class AudioService:
         """
         import requests as req
 
-        self._diarization_debug = {'backend': 'assemblyai'}
+        debug = {} if debug is None else debug
+        debug['backend'] = 'assemblyai'
 
         api_key = os.environ.get('ASSEMBLYAI_API_KEY')
         if not api_key:
             logging.warning("ASSEMBLYAI_API_KEY not configured")
-            self._diarization_debug['error'] = 'no_api_key'
+            debug['error'] = 'no_api_key'
             return None, []
         headers = {'Authorization': api_key}
 
@@ -702,7 +975,7 @@ class AudioService:
                     headers=headers, data=f, timeout=60)
             if upload_resp.status_code != 200:
                 logging.warning(f"AssemblyAI upload failed: {upload_resp.status_code}")
-                self._diarization_debug['error'] = f'upload_failed:{upload_resp.status_code}'
+                debug['error'] = f'upload_failed:{upload_resp.status_code}'
                 return None, []
             upload_url = upload_resp.json()['upload_url']
 
@@ -722,10 +995,10 @@ class AudioService:
             if submit_resp.status_code != 200:
                 error_data = submit_resp.json() if submit_resp.text else {}
                 logging.warning(f"AssemblyAI submit failed: {submit_resp.status_code} - {error_data}")
-                self._diarization_debug['error'] = f'submit_failed:{submit_resp.status_code}'
+                debug['error'] = f'submit_failed:{submit_resp.status_code}'
                 return None, []
             transcript_id = submit_resp.json()['id']
-            self._diarization_debug['transcript_id'] = transcript_id
+            debug['transcript_id'] = transcript_id
 
             # Step 3: Poll until completed (exponential backoff: 1s → 2s → 4s → ... → 15s cap)
             # Wall-clock deadline: 240s leaves 60s headroom for upload/submit/delivery within FC 300s limit
@@ -743,12 +1016,12 @@ class AudioService:
                     break
                 if status == 'error':
                     logging.warning(f"AssemblyAI error: {data.get('error')}")
-                    self._diarization_debug['error'] = f'transcription_error:{data.get("error")}'
+                    debug['error'] = f'transcription_error:{data.get("error")}'
                     return None, []
                 poll_delay = min(poll_delay * 2, max_poll_delay)
             else:
                 logging.warning(f"AssemblyAI polling timeout after {max_wait}s")
-                self._diarization_debug['error'] = 'polling_timeout'
+                debug['error'] = 'polling_timeout'
                 return None, []
 
             # Step 4: Parse utterances
@@ -767,45 +1040,44 @@ class AudioService:
                     'end_time': utt.get('end', 0),
                 })
 
-            self._diarization_debug.update({
+            debug.update({
                 'model': 'universal-2',
                 'spk_segments': len(segments),
                 'unique_speakers': len(speaker_ids),
                 'fallback': 'none',
             })
             if segments:
-                self._diarization_debug['merged_detail'] = '; '.join(
+                debug['merged_detail'] = '; '.join(
                     f"spk{s['speaker_id']}:{s['text'][:20]}" for s in segments[:8])
 
             return raw_text, segments
 
         except Exception as e:
             logging.warning(f"AssemblyAI diarization failed: {e}", exc_info=True)
-            self._diarization_debug['fallback'] = f'exception: {e}'
+            debug['fallback'] = f'exception: {e}'
             return None, []
 
     def _diarize_gemini(self, audio_path: str, language: str = 'ru',
-                        progress_callback=None) -> Tuple[Optional[str], List[dict]]:
+                        progress_callback=None, debug: Optional[dict] = None) -> Tuple[Optional[str], List[dict]]:
         """Diarization via Gemini 3 Flash with audio input and structured output.
 
         Sends base64-encoded audio to Gemini with a JSON schema for structured diarization output.
         Returns (raw_text, segments) or (None, []) on failure.
         """
-        import requests as req
-
         api_key = os.environ.get('GOOGLE_API_KEY') or os.environ.get('GEMINI_API_KEY')
         if not api_key:
             logging.warning("GOOGLE_API_KEY not configured for diarization")
             return None, []
 
-        self._diarization_debug = {'backend': 'gemini'}
+        debug = {} if debug is None else debug
+        debug['backend'] = 'gemini'
 
         try:
             self._safe_callback(progress_callback, "\U0001f504 Распознаю с диаризацией (Gemini)...")
 
-            # Read and base64 encode audio
-            with open(audio_path, 'rb') as f:
-                audio_b64 = base64.b64encode(f.read()).decode('utf-8')
+            # Read and base64 encode audio (voice passthrough may hand over OGG/Opus)
+            audio_b64 = self._file_base64(audio_path)
+            audio_mime_type = self._audio_mime_type(audio_path)
 
             url = (f"https://generativelanguage.googleapis.com/v1beta/models/"
                    f"gemini-3-flash-preview:generateContent?key={api_key}")
@@ -813,7 +1085,7 @@ class AudioService:
             payload = {
                 "contents": [{
                     "parts": [
-                        {"inlineData": {"mimeType": "audio/mpeg", "data": audio_b64}},
+                        {"inlineData": {"mimeType": audio_mime_type, "data": audio_b64}},
                         {"text": (
                             "Transcribe this Russian audio conversation with speaker diarization. "
                             "Identify each unique speaker by voice and label them as \"1\", \"2\", \"3\", etc. "
@@ -847,7 +1119,8 @@ class AudioService:
                 }
             }
 
-            response = req.post(url, json=payload, timeout=120)
+            # Pooled keep-alive session: no fresh TLS handshake to googleapis per call
+            response = self._http_session.post(url, json=payload, timeout=(5, 120))
             if response.status_code != 200:
                 logging.warning(f"Gemini diarization failed: {response.status_code} "
                                 f"{response.text[:200]}")
@@ -885,26 +1158,27 @@ class AudioService:
 
             raw_text = ' '.join(s['text'] for s in segments)
 
-            self._diarization_debug.update({
+            debug.update({
                 'model': 'gemini-3-flash-preview',
                 'spk_segments': len(segments),
                 'unique_speakers': len(speaker_ids),
                 'fallback': 'none',
             })
             if segments:
-                self._diarization_debug['merged_detail'] = '; '.join(
+                debug['merged_detail'] = '; '.join(
                     f"spk{s['speaker_id']}:{s['text'][:20]}" for s in segments[:8])
 
             return raw_text, segments
 
         except Exception as e:
             logging.warning(f"Gemini diarization failed: {e}", exc_info=True)
-            self._diarization_debug['fallback'] = f'exception: {e}'
+            debug['fallback'] = f'exception: {e}'
             return None, []
 
     def transcribe_with_diarization(self, audio_path: str, language: str = 'ru',
                                      speaker_count: int = 0,
-                                     progress_callback=None) -> Tuple[Optional[str], List[dict]]:
+                                     progress_callback=None,
+                                     debug: Optional[dict] = None) -> Tuple[Optional[str], List[dict]]:
         """Diarization with configurable backend (DIARIZATION_BACKEND env var).
 
         Backends:
@@ -920,6 +1194,7 @@ class AudioService:
             language: Language code (default: 'ru')
             speaker_count: Expected number of speakers (0 = auto-detect)
             progress_callback: Optional callback(stage_text) for progress updates
+            debug: Optional dict filled with this call's diagnostics (see get_diarization_debug)
 
         Returns:
             (raw_text, segments) where segments = [{'speaker_id', 'text', 'begin_time', 'end_time'}]
@@ -927,7 +1202,7 @@ class AudioService:
         """
         from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError, as_completed
 
-        self._diarization_debug = {}  # Reset for each call
+        debug = {} if debug is None else debug  # per call: one AudioService serves concurrent jobs
 
         # Backend routing
         backend = os.environ.get('DIARIZATION_BACKEND', 'dashscope')
@@ -935,27 +1210,25 @@ class AudioService:
 
         if backend == 'assemblyai':
             result = self._diarize_assemblyai(audio_path, language,
-                                               progress_callback=progress_callback)
+                                               progress_callback=progress_callback, debug=debug)
             if result[1]:  # segments not empty
                 return result
             logging.warning("AssemblyAI returned no segments, falling back to dashscope")
             # Snapshot AssemblyAI debug, reset for DashScope
-            self._diarization_debug = {
-                'attempted_backend': 'assemblyai',
-                'attempted_debug': dict(self._diarization_debug),
-            }
+            attempted = dict(debug)
+            debug.clear()
+            debug.update(attempted_backend='assemblyai', attempted_debug=attempted)
 
         elif backend == 'gemini':
             result = self._diarize_gemini(audio_path, language,
-                                           progress_callback=progress_callback)
+                                           progress_callback=progress_callback, debug=debug)
             if result[1]:
                 return result
             logging.warning("Gemini returned no segments, falling back to dashscope")
             # Snapshot Gemini debug, reset for DashScope
-            self._diarization_debug = {
-                'attempted_backend': 'gemini',
-                'attempted_debug': dict(self._diarization_debug),
-            }
+            attempted = dict(debug)
+            debug.clear()
+            debug.update(attempted_backend='gemini', attempted_debug=attempted)
 
         # Default: DashScope two-pass diarization
         api_key = self.alibaba_api_key or os.environ.get('DASHSCOPE_API_KEY')
@@ -988,11 +1261,11 @@ class AudioService:
                 future_spk = executor.submit(
                     self._submit_async_transcription,
                     signed_url, 'fun-asr-mtl', spk_params, api_key,
-                    debug_prefix='pass1')
+                    debug_prefix='pass1', debug=debug)
                 future_txt = executor.submit(
                     self._submit_async_transcription,
                     signed_url, 'qwen3-asr-flash-filetrans', txt_params, api_key,
-                    debug_prefix='pass2')
+                    debug_prefix='pass2', debug=debug)
 
                 # Dynamic diarization timeout based on audio duration
                 audio_dur = self.get_audio_duration(audio_path)
@@ -1030,35 +1303,35 @@ class AudioService:
             text_segments = self._parse_text_segments(txt_result) if txt_result else []
             logging.info(f"[diarize] pass1_segments={len(speaker_segments)}, pass2_segments={len(text_segments)}")
 
-            self._diarization_debug['spk_segments'] = len(speaker_segments)
-            self._diarization_debug['txt_segments'] = len(text_segments)
+            debug['spk_segments'] = len(speaker_segments)
+            debug['txt_segments'] = len(text_segments)
 
             # Debug: segment details (first 5 of each)
             if speaker_segments:
-                self._diarization_debug['spk_detail'] = '; '.join(
+                debug['spk_detail'] = '; '.join(
                     f"spk{s['speaker_id']}[{s['begin_time']}-{s['end_time']}]"
                     for s in speaker_segments[:5]
                 )
             if text_segments:
                 is_word_level = len(text_segments) > 20
                 sample = 10 if is_word_level else 5
-                self._diarization_debug['txt_detail'] = '; '.join(
+                debug['txt_detail'] = '; '.join(
                     f"[{s['begin_time']}-{s['end_time']}]{s['text'][:20]}"
                     for s in text_segments[:sample]
                 )
                 if is_word_level:
-                    self._diarization_debug['txt_word_level'] = True
+                    debug['txt_word_level'] = True
 
             # Fallback cascade
             if not text_segments and not speaker_segments:
                 logging.warning("Both diarization passes returned no data")
-                self._diarization_debug['fallback'] = 'both_empty'
+                debug['fallback'] = 'both_empty'
                 return None, []
 
             if not text_segments:
                 # Pass 2 failed — use Pass 1 text (wrong language but has speakers)
                 logging.warning("Pass 2 failed, using Pass 1 text (may be inaccurate)")
-                self._diarization_debug['fallback'] = 'pass2_failed_using_pass1_text'
+                debug['fallback'] = 'pass2_failed_using_pass1_text'
                 raw_texts = [s['text'] for s in speaker_segments if s.get('text')]
                 raw_text = ' '.join(raw_texts) if raw_texts else None
                 return raw_text, speaker_segments
@@ -1066,13 +1339,13 @@ class AudioService:
             if not speaker_segments:
                 # Pass 1 failed — return text without speaker labels
                 logging.warning("Pass 1 failed, returning text without speaker labels")
-                self._diarization_debug['fallback'] = 'pass1_failed_no_speakers'
+                debug['fallback'] = 'pass1_failed_no_speakers'
                 raw_texts = [s['text'] for s in text_segments if s.get('text')]
                 raw_text = ' '.join(raw_texts) if raw_texts else None
                 return raw_text, []
 
             # Step 4: Merge — align speaker labels with accurate text
-            merged = self._align_speakers_with_text(speaker_segments, text_segments)
+            merged = self._align_speakers_with_text(speaker_segments, text_segments, debug=debug)
 
             # Gap ratio detection: if >30% of words didn't match any speaker,
             # diarization quality is poor — return text without speakers
@@ -1080,16 +1353,16 @@ class AudioService:
             merged_words = sum(len(s.get('text', '').split()) for s in merged)
             if total_words > 0:
                 gap_ratio = 1.0 - (merged_words / total_words)
-                self._diarization_debug['gap_ratio'] = f'{gap_ratio:.2f}'
+                debug['gap_ratio'] = f'{gap_ratio:.2f}'
                 if gap_ratio > 0.3:
                     logging.warning(f"[align] high gap ratio ({gap_ratio:.2f}), discarding speaker labels")
-                    self._diarization_debug['fallback'] = 'gap_ratio_too_high'
+                    debug['fallback'] = 'gap_ratio_too_high'
                     raw_texts = [s['text'] for s in text_segments if s.get('text')]
                     raw_text = ' '.join(raw_texts)
                     return raw_text, []
 
             # Debug: merged segment details (first 8)
-            self._diarization_debug['merged_detail'] = '; '.join(
+            debug['merged_detail'] = '; '.join(
                 f"spk{s['speaker_id']}:{s['text'][:20]}"
                 for s in merged[:8]
             )
@@ -1097,7 +1370,7 @@ class AudioService:
             raw_texts = [s['text'] for s in merged if s.get('text')]
             raw_text = ' '.join(raw_texts)
 
-            self._diarization_debug['fallback'] = 'none'
+            debug['fallback'] = 'none'
             logging.info(f"Two-pass diarization: {len(merged)} segments, "
                          f"{len(set(s['speaker_id'] for s in merged))} speakers, "
                          f"{len(raw_text)} chars")
@@ -1106,7 +1379,7 @@ class AudioService:
 
         except Exception as e:
             logging.warning(f"Diarization failed: {e}", exc_info=True)
-            self._diarization_debug['fallback'] = f'exception: {e}'
+            debug['fallback'] = f'exception: {e}'
             return None, []
         finally:
             self._cleanup_oss_key(oss_key)
@@ -1157,22 +1430,49 @@ class AudioService:
         return segments
 
     def _cleanup_oss_key(self, oss_key: Optional[str]):
-        """Delete an OSS object by key."""
+        """Delete an OSS object by key without blocking the caller."""
         if not oss_key:
             return
         bucket = self._get_oss_bucket()
         if bucket:
-            try:
-                bucket.delete_object(oss_key)
-                logging.info(f"Deleted from OSS: {oss_key}")
-            except Exception as e:
-                logging.warning(f"Failed to delete OSS key {oss_key}: {e}")
+            future = self._oss_cleanup_pool.submit(self._delete_oss_key, bucket, oss_key)
+            with self._oss_cleanup_lock:
+                self._oss_cleanup_pending.add(future)
+            future.add_done_callback(self._oss_cleanup_done)
+
+    @classmethod
+    def _oss_cleanup_done(cls, future):
+        with cls._oss_cleanup_lock:
+            cls._oss_cleanup_pending.discard(future)
+
+    @classmethod
+    def drain_oss_cleanup(cls, timeout: float = 30) -> bool:
+        """Wait for queued OSS deletes. Returns False if it timed out."""
+        from concurrent.futures import wait
+
+        with cls._oss_cleanup_lock:
+            pending = list(cls._oss_cleanup_pending)
+        if not pending:
+            return True
+        _, not_done = wait(pending, timeout=timeout)
+        if not_done:
+            logging.warning(f"{len(not_done)} OSS delete(s) still running after {timeout}s")
+        return not not_done
+
+    @staticmethod
+    def _delete_oss_key(bucket, oss_key: str):
+        try:
+            bucket.delete_object(oss_key)
+            logging.info(f"Deleted from OSS: {oss_key}")
+        except Exception as e:
+            logging.warning(f"Failed to delete OSS key {oss_key}: {e}")
 
     def _submit_async_transcription(self, signed_url: str, model: str,
                                       params: dict, api_key: str,
                                       poll_interval: int = 5,
                                       max_wait: int = 240,
-                                      debug_prefix: str = "") -> Optional[dict]:
+                                      debug_prefix: str = "",
+                                      debug: Optional[dict] = None) -> Optional[dict]:
         """Submit an async transcription job and poll until completion.
 
         Handles difference in input format:
@@ -1186,12 +1486,14 @@ class AudioService:
             api_key: DashScope API key
             poll_interval: Seconds between polls (default: 5)
             max_wait: Maximum wait time in seconds (default: 240)
-            debug_prefix: Prefix for debug keys in _diarization_debug (e.g. 'pass1', 'pass2')
+            debug_prefix: Prefix for debug keys in `debug` (e.g. 'pass1', 'pass2')
+            debug: Diagnostics dict of the calling transcribe_with_diarization
 
         Returns:
             Parsed transcription data dict, or None on failure
         """
         pfx = debug_prefix  # shorthand
+        debug = {} if debug is None else debug
         session = self._http_session
 
         url = "https://dashscope-intl.aliyuncs.com/api/v1/services/audio/asr/transcription"
@@ -1219,12 +1521,12 @@ class AudioService:
             req_repr = json.dumps({**payload, "input": {k: safe_url if 'url' in k else v
                                                          for k, v in input_data.items()}},
                                    ensure_ascii=False)[:800]
-            self._diarization_debug[f'{pfx}_request'] = req_repr
+            debug[f'{pfx}_request'] = req_repr
 
         response = session.post(url, headers=headers, json=payload, timeout=30)
 
         if pfx:
-            self._diarization_debug[f'{pfx}_submit_status'] = response.status_code
+            debug[f'{pfx}_submit_status'] = response.status_code
 
         if response.status_code != 200:
             try:
@@ -1233,8 +1535,8 @@ class AudioService:
                 error_data = {'raw': response.text[:200]}
             logging.warning(f"{model} submit failed: {response.status_code} - {error_data}")
             if pfx:
-                self._diarization_debug[f'{pfx}_submit_body'] = str(error_data)[:500]
-                self._diarization_debug[f'{pfx}_result'] = 'submit_failed'
+                debug[f'{pfx}_submit_body'] = str(error_data)[:500]
+                debug[f'{pfx}_result'] = 'submit_failed'
             return None
 
         try:
@@ -1242,18 +1544,18 @@ class AudioService:
         except (ValueError, KeyError):
             logging.warning(f"{model} malformed submit response")
             if pfx:
-                self._diarization_debug[f'{pfx}_result'] = 'malformed_submit_json'
+                debug[f'{pfx}_result'] = 'malformed_submit_json'
             return None
         task_id = task_data.get('output', {}).get('task_id')
         if not task_id:
             logging.warning(f"{model} returned no task_id: {task_data}")
             if pfx:
-                self._diarization_debug[f'{pfx}_submit_body'] = str(task_data)[:500]
-                self._diarization_debug[f'{pfx}_result'] = 'submit_failed'
+                debug[f'{pfx}_submit_body'] = str(task_data)[:500]
+                debug[f'{pfx}_result'] = 'submit_failed'
             return None
 
         if pfx:
-            self._diarization_debug[f'{pfx}_task_id'] = task_id
+            debug[f'{pfx}_task_id'] = task_id
 
         # Poll for completion
         poll_url = f"https://dashscope-intl.aliyuncs.com/api/v1/tasks/{task_id}"
@@ -1280,13 +1582,13 @@ class AudioService:
                 error_msg = poll_data.get('output', {}).get('message', 'unknown')
                 logging.warning(f"{model} task failed: {error_msg}")
                 if pfx:
-                    self._diarization_debug[f'{pfx}_poll_body'] = str(poll_data)[:500]
-                    self._diarization_debug[f'{pfx}_result'] = f'task_failed: {error_msg}'
+                    debug[f'{pfx}_poll_body'] = str(poll_data)[:500]
+                    debug[f'{pfx}_result'] = f'task_failed: {error_msg}'
                 return None
         else:
             logging.warning(f"{model} task timed out after {max_wait}s")
             if pfx:
-                self._diarization_debug[f'{pfx}_result'] = f'timeout_{max_wait}s'
+                debug[f'{pfx}_result'] = f'timeout_{max_wait}s'
             return None
 
         # Fetch transcription results
@@ -1307,8 +1609,8 @@ class AudioService:
         if not transcription_url:
             logging.warning(f"{model} returned no transcription_url")
             if pfx:
-                self._diarization_debug[f'{pfx}_poll_body'] = str(poll_data)[:500]
-                self._diarization_debug[f'{pfx}_result'] = 'no_transcription_url'
+                debug[f'{pfx}_poll_body'] = str(poll_data)[:500]
+                debug[f'{pfx}_result'] = 'no_transcription_url'
             return None
 
         trans_response = session.get(transcription_url, timeout=30)
@@ -1317,12 +1619,12 @@ class AudioService:
         except (ValueError, KeyError):
             logging.warning(f"{model} malformed transcription response")
             if pfx:
-                self._diarization_debug[f'{pfx}_result'] = 'malformed_transcription_json'
+                debug[f'{pfx}_result'] = 'malformed_transcription_json'
             return None
 
         if pfx:
-            self._diarization_debug[f'{pfx}_result'] = 'ok'
-            self._diarization_debug[f'{pfx}_transcription_len'] = len(
+            debug[f'{pfx}_result'] = 'ok'
+            debug[f'{pfx}_transcription_len'] = len(
                 json.dumps(trans_data, ensure_ascii=False))
 
         return trans_data
@@ -1380,7 +1682,8 @@ class AudioService:
         return norm_spk, norm_txt
 
     def _align_speakers_with_text(self, speaker_segments: List[dict],
-                                    text_segments: List[dict]) -> List[dict]:
+                                    text_segments: List[dict],
+                                    debug: Optional[dict] = None) -> List[dict]:
         """Align speaker labels with text using word-level timestamp estimation.
 
         Builds a word stream from text segments (linear interpolation for word times),
@@ -1414,7 +1717,8 @@ class AudioService:
         if abs(spk_max - txt_max) / max(spk_max, txt_max) > 0.1:
             # >10% difference — normalize
             logging.info(f"Diarization timeline mismatch: spk={spk_max}ms, txt={txt_max}ms, normalizing")
-            self._diarization_debug['timeline_normalized'] = f'{spk_max}ms/{txt_max}ms'
+            if debug is not None:
+                debug['timeline_normalized'] = f'{spk_max}ms/{txt_max}ms'
 
             # Use windowed normalization for long audio (>15 min)
             if max(spk_max, txt_max) > 900_000:
@@ -1582,15 +1886,15 @@ class AudioService:
         logging.info(f"[dialogue] segments={len(segments)}, speakers={len(speaker_map)}, output_chars={len(result)}")
         return result
 
-    def get_diarization_debug(self) -> Optional[str]:
-        """Format _diarization_debug dict into a human-readable text block for admin.
+    @staticmethod
+    def get_diarization_debug(dbg: Optional[dict]) -> Optional[str]:
+        """Format a transcribe_with_diarization debug dict into a human-readable text block for admin.
 
         Returns:
             Formatted debug text (HTML-safe, <=3900 chars) or None if no debug data
         """
         import html
 
-        dbg = self._diarization_debug
         if not dbg:
             return None
 
@@ -1708,6 +2012,7 @@ class AudioService:
                              audio_duration: float, progress_callback=None) -> str:
         """
         Transcribe long audio by splitting into chunks and concatenating results.
+        Chunks are sent to ASR concurrently (up to ASR_PARALLEL_WORKERS).
 
         Args:
             audio_path: Path to audio file
@@ -1718,29 +2023,39 @@ class AudioService:
         Returns:
             Concatenated transcribed text
         """
+        from concurrent.futures import ThreadPoolExecutor, as_completed
         chunks = self.split_audio_chunks(audio_path)
         total_chunks = len(chunks)
-        logging.info(f"Transcribing {total_chunks} chunks for {audio_duration:.0f}s audio")
+        workers = max(1, min(self.ASR_PARALLEL_WORKERS, total_chunks))
+        logging.info(f"Transcribing {total_chunks} chunks for {audio_duration:.0f}s audio, {workers} workers")
 
-        texts = []
+        # Chunks are independent requests — send them side by side, keep order
+        results = [None] * total_chunks
         failed_chunks = 0
+        completed = 0
         try:
-            for i, chunk_path in enumerate(chunks):
-                if total_chunks > 1:
-                    self._safe_callback(progress_callback, i + 1, total_chunks)
-
-                try:
-                    text = self._transcribe_single_qwen_asr(chunk_path, language)
-                    if text:
-                        texts.append(text)
-                except Exception as chunk_err:
-                    failed_chunks += 1
-                    logging.warning(f"Chunk {i+1}/{total_chunks} failed: {chunk_err}")
-                    # Continue with remaining chunks instead of failing entirely
-                    if failed_chunks > total_chunks // 2:
-                        raise RuntimeError(
-                            f"Too many chunks failed ({failed_chunks}/{total_chunks})")
-
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = {executor.submit(self._transcribe_single_qwen_asr, chunk_path, language): i
+                           for i, chunk_path in enumerate(chunks)}
+                for future in as_completed(futures):
+                    i = futures[future]
+                    completed += 1
+                    if total_chunks > 1:
+                        self._safe_callback(progress_callback, completed, total_chunks)
+
+                    try:
+                        results[i] = future.result()
+                    except Exception as chunk_err:
+                        failed_chunks += 1
+                        logging.warning(f"Chunk {i+1}/{total_chunks} failed: {chunk_err}")
+                        # Continue with remaining chunks instead of failing entirely
+                        if failed_chunks > total_chunks // 2:
+                            for pending in futures:
+                                pending.cancel()
+                            raise RuntimeError(
+                                f"Too many chunks failed ({failed_chunks}/{total_chunks})")
+
+            texts = [text for text in results if text]
             if not texts:
                 raise ValueError("Transcription empty")
 
@@ -1772,7 +2087,6 @@ class AudioService:
         Returns:
             Transcribed text
         """
-        import base64
         import pathlib
         import requests
 
@@ -1791,19 +2105,10 @@ class AudioService:
             logging.info(f"Audio file size: {file_size} bytes")
 
             # Determine MIME type
-            suffix = file_path.suffix.lower()
-            mime_types = {
-                '.mp3': 'audio/mpeg',
-                '.wav': 'audio/wav',
-                '.ogg': 'audio/ogg',
-                '.m4a': 'audio/mp4',
-                '.flac': 'audio/flac',
-                '.webm': 'audio/webm'
-            }
-            audio_mime_type = mime_types.get(suffix, 'audio/mpeg')
+            audio_mime_type = self._audio_mime_type(audio_path)
 
             # Encode audio as base64 data URI
-            base64_str = base64.b64encode(file_path.read_bytes()).decode('utf-8')
+            base64_str = self._file_base64(audio_path)
             data_uri = f"data:{audio_mime_type};base64,{base64_str}"
 
             logging.info(f"Encoded audio to base64 ({len(base64_str)} chars)")
@@ -1835,7 +2140,7 @@ class AudioService:
             }
 
             logging.info("Calling Qwen3-ASR-Flash API...")
-            response = requests.post(url, headers=headers, json=payload, timeout=120)
+            response = self._http_session.post(url, headers=headers, json=payload, timeout=120)
 
             duration = time.time() - start_time
             logging.info(f"API response received in {duration:.2f}s, status: {response.status_code}")
@@ -1941,14 +2246,9 @@ class AudioService:
             subprocess.TimeoutExpired: If transcription takes too long
             subprocess.CalledProcessError: If FFmpeg fails
         """
-        import subprocess
-
         # Get Whisper model path from environment
         model_path = os.getenv('WHISPER_MODEL_PATH', '/opt/whisper/models/ggml-base.bin')
 
-        # Temporary output file for transcription
-        output_json = f"{audio_path}.transcript.json"
-
         # Calculate timeout before try block to avoid unbound variable
         audio_duration = self.get_audio_duration(audio_path)
         timeout = max(int(audio_duration * 3), 60)
@@ -1975,16 +2275,46 @@ class AudioService:
 
             logging.info(f"Starting FFmpeg Whisper transcription (timeout: {timeout}s)")
 
-            result = subprocess.run(
-                ffmpeg_command,
-                capture_output=True,
-                text=True,
-                timeout=timeout,
-                check=True
-            )
-
-            # Parse output from stderr
-            transcription_text = self._parse_ffmpeg_whisper_output(result.stderr)
+            # stderr carries every segment as JSON: parse it line by line as ffmpeg
+            # writes it instead of buffering the whole log (tens of MB for 1h audio)
+            scanner = _WhisperSegmentScanner()
+            kept = []  # legacy-format / error lines, only needed if no JSON segments arrive
+            tail = collections.deque(maxlen=40)
+            process = subprocess.Popen(ffmpeg_command, stdout=subprocess.DEVNULL,
+                                       stderr=subprocess.PIPE, text=True, bufsize=1)
+            timed_out = threading.Event()
+
+            def kill_on_timeout():
+                timed_out.set()
+                process.kill()
+
+            timer = threading.Timer(timeout, kill_on_timeout)
+            timer.start()
+            try:
+                for line in process.stderr:
+                    before = len(scanner.texts)
+                    scanner.feed(line)
+                    if len(scanner.texts) > before:
+                        logging.debug(f"Whisper segment {len(scanner.texts)}")
+                    elif 'whisper' in line or any(m in line.lower() for m in self._WHISPER_STDERR_MARKERS):
+                        kept.append(line)
+                    else:
+                        tail.append(line)
+                returncode = process.wait()
+            finally:
+                timer.cancel()
+                process.stderr.close()
+
+            if timed_out.is_set():
+                raise subprocess.TimeoutExpired(ffmpeg_command, timeout)
+            if returncode != 0:
+                raise subprocess.CalledProcessError(returncode, ffmpeg_command,
+                                                    stderr=''.join(kept) + ''.join(tail))
+
+            if scanner.texts:
+                transcription_text = ' '.join(scanner.texts).strip()
+            else:
+                transcription_text = self._parse_ffmpeg_whisper_output(''.join(kept) + ''.join(tail))
 
             if not transcription_text or len(transcription_text.strip()) < 5:
                 raise ValueError("Whisper returned empty or invalid transcription")
@@ -2001,10 +2331,6 @@ class AudioService:
         except Exception as e:
             logging.error(f"Unexpected error in FFmpeg Whisper: {str(e)}")
             raise
-        finally:
-            # Cleanup temporary files
-            if os.path.exists(output_json):
-                os.remove(output_json)
 
     def transcribe_with_openai(self, audio_path: str, language: str = 'ru') -> str:
         """
@@ -2022,6 +2348,9 @@ class AudioService:
             
         return transcript.text
 
+    # stderr lines the legacy / error fallback of _parse_ffmpeg_whisper_output looks at
+    _WHISPER_STDERR_MARKERS = ('out of memory', 'segmentation fault', 'blank audio', 'continuation follows')
+
     def _parse_ffmpeg_whisper_output(self, ffmpeg_stderr: str) -> str:
         """
         Parse transcription text from FFmpeg stderr output.
@@ -2033,38 +2362,13 @@ class AudioService:
         Returns:
             Concatenated transcription text
         """
-        import json
         import re
-        
-        extracted_texts = []
-        stack = []
-        start_index = -1
-        
-        # Scan through the string to find balanced braces {}
-        # This handles nested braces correctly unlike simple regex
-        for i, char in enumerate(ffmpeg_stderr):
-            if char == '{':
-                if not stack:
-                    start_index = i
-                stack.append(char)
-            elif char == '}':
-                if stack:
-                    stack.pop()
-                    if not stack:
-                        # Found a potentially complete JSON block
-                        json_str = ffmpeg_stderr[start_index:i+1]
-                        try:
-                            # Verify it's valid JSON
-                            data = json.loads(json_str)
-                            
-                            # Check if it's a Whisper segment
-                            # Structure usually: {"t0":..., "t1":..., "text": "..."}
-                            if isinstance(data, dict) and 'text' in data:
-                                extracted_texts.append(data['text'].strip())
-                        except json.JSONDecodeError:
-                            # Not valid JSON (e.g. log text that happened to have balanced braces), ignore
-                            pass
-        
+
+        # Balanced-brace scan handles nested braces correctly unlike simple regex
+        scanner = _WhisperSegmentScanner()
+        scanner.feed(ffmpeg_stderr)
+        extracted_texts = scanner.texts
+
         if extracted_texts:
             return ' '.join(extracted_texts).strip()
             
@@ -2099,7 +2403,7 @@ class AudioService:
 
     def get_audio_duration(self, audio_path: str) -> float:
         """
-        Get audio duration in seconds using ffprobe.
+        Get audio duration in seconds (PyAV or ffprobe, see _probe_all).
 
         Args:
             audio_path: Path to audio file
@@ -2107,111 +2411,72 @@ class AudioService:
         Returns:
             Duration in seconds
         """
-        import subprocess
-        import json
-
         try:
-            result = subprocess.run(
-                [
-                    'ffprobe',
-                    '-v', 'quiet',
-                    '-print_format', 'json',
-                    '-show_format',
-                    audio_path
-                ],
-                capture_output=True,
-                text=True,
-                check=True,
-                timeout=10
-            )
-
-            data = json.loads(result.stdout)
-            duration = float(data['format']['duration'])
+            duration = self._probe_all(audio_path)['duration']
+            if duration <= 0:
+                raise ValueError("no duration in ffprobe output")
             logging.info(f"[duration] {duration:.1f}s from {audio_path}")
             return duration
         except Exception as e:
             logging.warning(f"Could not get audio duration: {e}, using default 600s")
             return 600.0  # Default 10 minutes
-            
-    def _build_format_prompt(self, text: str, use_code_tags: bool, use_yo: bool,
-                              is_chunked: bool, is_dialogue: bool,
-                              speaker_labels: bool = False) -> str:
-        """Single source of truth for LLM formatting prompt."""
-        code_tag_instruction = (
-            "Оберни ВЕСЬ текст в теги <code></code>."
-            if use_code_tags else
-            "НЕ используй теги <code>."
-        )
-
-        yo_instruction = (
-            "Сохраняй букву ё где она есть."
-            if use_yo else
-            "Заменяй все буквы ё на е."
-        )
-
-        extra_instructions = ""
-
-        if is_chunked:
-            extra_instructions += (
-                "10. ВАЖНО: этот текст собран из нескольких последовательных фрагментов одной записи. "
-                "На стыках фрагментов могут быть оборванные предложения, повторы слов или неестественные "
-                "переходы — исправь эти артефакты склейки, обеспечив плавный непрерывный текст.\n"
-            )
 
-        if is_dialogue and speaker_labels:
-            extra_instructions += (
-                "11. ФОРМАТ ДИАЛОГА С МЕТКАМИ СПИКЕРОВ: текст уже отформатирован как диалог "
-                "с метками «Спикер N:» и тире (\u2014). "
-                "ОБЯЗАТЕЛЬНО СОХРАНЯЙ все метки «Спикер N:» — они должны остаться в тексте как есть. "
-                "Некоторые реплики могут быть распределены с ошибками, поэтому осмысли весь диалог "
-                "и внеси коррективы там, где ты точно уверен, что исправление требуется. "
-                "Например, это касается спорных моментов с разрывом фраз одного и того же спикера. "
-                "НЕ меняй порядок реплик. НЕ добавляй пустые строки между репликами — "
-                "каждая реплика начинается с новой строки сразу после предыдущей, без отступов. "
-                "Правило 4 (абзацы) к диалогу НЕ применяется. "
-                "Также исправь пунктуацию и артефакты ASR внутри каждого блока.\n"
-            )
-        elif is_dialogue:
-            extra_instructions += (
-                "11. ФОРМАТ ДИАЛОГА: текст уже отформатирован как диалог с тире (\u2014). "
-                "Некоторые реплики могут быть распределены с ошибками, поэтому осмысли весь диалог "
-                "и внеси коррективы там, где ты точно уверен, что исправление требуется. "
-                "Например, это касается спорных моментов с разрывом фраз одного и того же спикера. "
-                "НЕ добавляй метки спикеров. НЕ меняй порядок реплик. "
-                "НЕ добавляй пустые строки между репликами — каждая реплика начинается "
-                "с новой строки сразу после предыдущей, без отступов. "
-                "Правило 4 (абзацы) к диалогу НЕ применяется. "
-                "Также исправь пунктуацию и артефакты ASR внутри каждого блока.\n"
-            )
-        else:
-            extra_instructions += (
-                "11. НЕ используй тире (\u2014) для оформления прямой речи. "
-                "Оформляй как связный текст, разделённый на абзацы по смыслу.\n"
-            )
+    def _probe_all(self, audio_path: str) -> dict:
+        """
+        Container and first audio stream from a single probe:
+        {'format', 'codec', 'sample_rate', 'bit_rate', 'channels', 'duration'}.
+        get_audio_info and get_audio_duration both read from it. Raises on failure.
 
-        return f"""Отформатируй транскрипцию аудиозаписи. Правила:
+        Read in-process with PyAV when it is installed (it ships with
+        faster-whisper); ffprobe otherwise, or when PyAV can't open the file.
+        """
+        info = _probe_with_pyav(audio_path)
+        if info is not None:
+            return info
+
+        data = self._ffprobe(
+            audio_path,
+            '-select_streams', 'a:0',
+            '-show_entries', 'format=duration,bit_rate,format_name:stream=codec_name,sample_rate,channels',
+        )
+        fmt = data.get('format', {})
+        stream = (data.get('streams') or [{}])[0]
 
-1. Исправь ЯВНЫЕ ошибки распознавания речи (артефакты, повторы, обрывки слов)
-2. Расставь знаки препинания по правилам русского языка
-3. НЕ заменяй слова на синонимы, НЕ меняй формы слов — сохраняй именно те слова, которые произнёс автор
-4. Раздели на абзацы по смыслу и интонации (минимум 2-3 предложения в абзаце, не разбивай каждое предложение отдельно)
-5. {code_tag_instruction}
-6. {yo_instruction}
-7. ВАЖНО: НЕ добавляй свои комментарии, НЕ веди диалог с пользователем
-8. ИМЕНА И ФАМИЛИИ: будь максимально консервативен с именами собственными. \
-Если слово похоже на фамилию/имя — НЕ заменяй его на похожее. \
-Не «исправляй» незнакомые фамилии на более распространённые.
-9. ШИПЯЩИЕ/СВИСТЯЩИЕ: ASR часто путает ш/щ/ч/ж/с/з/ц. \
-Исправляй только если результат явно не слово русского языка. \
-В сомнительных случаях — оставляй как распознал ASR.
-{extra_instructions}Обрати особое внимание на корректное написание топонимов (географических названий). \
-Приоритет: топонимы Таиланда (Бангкок, Паттайя, Пхукет, Краби, Чиангмай, Ко Самуи, \
-Ко Панган, Ко Чанг, Хуа Хин, Районг и т.д.), затем России. \
-Не заменяй правильные топонимы на похожие по звучанию слова.
+        def number(value, cast):
+            # ffprobe reports unknown values as "N/A"
+            try:
+                return cast(value)
+            except (TypeError, ValueError):
+                return cast(0)
+
+        return {
+            'format': fmt.get('format_name', 'unknown'),
+            'codec': stream.get('codec_name', 'unknown'),
+            'sample_rate': number(stream.get('sample_rate'), int),
+            'bit_rate': number(fmt.get('bit_rate'), int),
+            'channels': number(stream.get('channels'), int),
+            'duration': number(fmt.get('duration'), float),
+        }
 
-Текст для форматирования:
+    @staticmethod
+    def _ffprobe(audio_path: str, *args: str) -> dict:
+        """
+        Run ffprobe with JSON output. Results are cached per (path, mtime, size),
+        so an unchanged file is probed once however many callers ask.
+        Raises on failure; failures are not cached.
+        """
+        try:
+            st = os.stat(audio_path)
+        except OSError:
+            return _run_ffprobe(audio_path, args)
+        return _cached_ffprobe(audio_path, st.st_mtime_ns, st.st_size, args)
 
-{text}"""
+    def _build_format_prompt(self, text: str, use_code_tags: bool, use_yo: bool,
+                              is_chunked: bool, is_dialogue: bool,
+                              speaker_labels: bool = False) -> str:
+        """Single source of truth for LLM formatting prompt."""
+        return _format_prompt_head(bool(use_code_tags), bool(use_yo), bool(is_chunked),
+                                   bool(is_dialogue), bool(speaker_labels)) + text
 
     # Smart chunking threshold for LLM — ~600 RU words, fits in 8192 output tokens
     LLM_CHUNK_THRESHOLD = 4000
@@ -2284,6 +2549,9 @@ class AudioService:
 
     # Parallel LLM workers for chunk processing
     LLM_PARALLEL_WORKERS = 4
+    # Hedged formatting calls (primary + delayed secondary) for every chunk worker
+    _llm_hedge_pool = ThreadPoolExecutor(max_workers=2 * LLM_PARALLEL_WORKERS,
+                                         thread_name_prefix='llm-hedge')
 
     def _format_text_chunked(self, text: str, use_code_tags: bool, use_yo: bool,
                               is_chunked: bool, is_dialogue: bool, backend: str,
@@ -2309,14 +2577,9 @@ class AudioService:
 
         def _process_chunk(idx, chunk):
             """Process a single chunk through LLM with validation."""
-            if backend == 'assemblyai':
-                result = self.format_text_with_assemblyai(
-                    chunk, use_code_tags, use_yo, is_chunked, is_dialogue,
-                    speaker_labels=speaker_labels)
-            else:
-                result = self.format_text_with_qwen(
-                    chunk, use_code_tags, use_yo, is_chunked, is_dialogue,
-                    speaker_labels=speaker_labels)
+            result = self._format_with_backend(
+                chunk, backend, use_code_tags, use_yo, is_chunked, is_dialogue,
+                speaker_labels=speaker_labels)
 
             # LLM output validation — hallucination guard
             if len(result) < len(chunk) * 0.4:
@@ -2360,6 +2623,12 @@ class AudioService:
         Priority: backend param → LLM_BACKEND env var → 'assemblyai'.
         For long texts (> LLM_CHUNK_THRESHOLD), splits into semantic chunks.
         """
+        # Short clips never reach a backend: skip env lookup, prompt build and chunk split.
+        # maxsplit bounds the scan to the first 10 words of long transcripts.
+        if len(text.split(None, 10)) < 10:
+            logging.info("[llm] text too short for LLM formatting (< 10 words), returning original")
+            return _SPACED_ELLIPSIS_RE.sub('...', text)
+
         backend = backend or os.environ.get('LLM_BACKEND', 'assemblyai')
         logging.info(f"[llm] backend={backend}, is_dialogue={is_dialogue}, speaker_labels={speaker_labels}, input_chars={len(text)}")
 
@@ -2370,25 +2639,73 @@ class AudioService:
                 text, use_code_tags, use_yo, is_chunked, is_dialogue,
                 backend, progress_callback=progress_callback,
                 speaker_labels=speaker_labels)
-        elif backend == 'assemblyai':
-            result = self.format_text_with_assemblyai(
-                text, use_code_tags, use_yo, is_chunked, is_dialogue,
-                speaker_labels=speaker_labels)
-        else:  # 'qwen' fallback
-            result = self.format_text_with_qwen(
-                text, use_code_tags, use_yo, is_chunked, is_dialogue,
+        else:
+            result = self._format_with_backend(
+                text, backend, use_code_tags, use_yo, is_chunked, is_dialogue,
                 speaker_labels=speaker_labels)
 
         # Fix spaced ellipsis from ASR artifacts (". . ." → "...")
-        import re
-        result = re.sub(r'(?:\.\s){2,}\.', '...', result)
-        return result
+        return _SPACED_ELLIPSIS_RE.sub('...', result)
+
+    def _format_with_backend(self, text: str, backend: str, *args, speaker_labels: bool = False) -> str:
+        """One formatting call on `backend` ('assemblyai' or 'qwen'), hedged if LLM_HEDGE_DELAY is set.
+
+        With hedging, a primary call still running after the delay gets a
+        competing call on the other backend; the first one that actually
+        changed the text wins. The loser finishes in the background and is
+        discarded, so hedging trades extra LLM spend for tail latency. The
+        delay counts from when the primary starts (not from queueing on the
+        shared pool), and the primary runs as _is_fallback so the hedge is its
+        only fallback: a primary that fails early starts the other backend at
+        once instead of cascading into its own fallback call.
+        """
+        if backend == 'assemblyai':
+            primary, secondary = self.format_text_with_assemblyai, self.format_text_with_qwen
+        else:  # 'qwen' fallback
+            primary, secondary = self.format_text_with_qwen, self.format_text_with_assemblyai
+
+        if self._llm_hedge_delay <= 0:
+            return primary(text, *args, speaker_labels=speaker_labels)
+
+        from concurrent.futures import FIRST_COMPLETED, wait
+
+        started = threading.Event()
+
+        def run_primary():
+            started.set()
+            return primary(text, *args, _is_fallback=True, speaker_labels=speaker_labels)
+
+        pending = {self._llm_hedge_pool.submit(run_primary)}
+        started.wait()
+        done, pending = wait(pending, timeout=self._llm_hedge_delay)
+        hedged = False
+        while True:
+            for future in done:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logging.warning(f"[llm] hedged call failed: {e}")
+                    continue
+                if result != text:
+                    return result
+            if not hedged:
+                hedged = True
+                if pending:
+                    logging.info(f"[llm] {backend} slower than {self._llm_hedge_delay}s, hedging on the other backend")
+                else:
+                    logging.info(f"[llm] {backend} failed, falling back to the other backend")
+                pending.add(self._llm_hedge_pool.submit(
+                    secondary, text, *args, _is_fallback=True, speaker_labels=speaker_labels))
+            if not pending:
+                return text
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
 
     def format_text_with_qwen(self, text: str, use_code_tags: bool = False,
                                use_yo: bool = True, is_chunked: bool = False,
                                is_dialogue: bool = False,
                                _is_fallback: bool = False,
-                               speaker_labels: bool = False) -> str:
+                               speaker_labels: bool = False,
+                               _prompt: Optional[str] = None) -> str:
         """
         Format transcribed text using Qwen LLM (Alibaba) via REST API.
         Falls back to AssemblyAI LLM Gateway if Qwen fails.
@@ -2401,6 +2718,7 @@ class AudioService:
             is_dialogue: Whether text is a multi-speaker dialogue
             _is_fallback: Whether this is already a fallback call (prevents loops)
             speaker_labels: Whether text contains speaker labels to preserve
+            _prompt: Prompt already built by the failed primary backend
 
         Returns:
             Formatted text
@@ -2413,8 +2731,8 @@ class AudioService:
             logging.info(f"Text too short for LLM formatting ({word_count} words < 10), returning original")
             return text
 
-        prompt = self._build_format_prompt(text, use_code_tags, use_yo, is_chunked, is_dialogue,
-                                               speaker_labels=speaker_labels)
+        prompt = _prompt or self._build_format_prompt(text, use_code_tags, use_yo, is_chunked, is_dialogue,
+                                                          speaker_labels=speaker_labels)
 
         api_start_time = time.time()
 
@@ -2425,7 +2743,14 @@ class AudioService:
                     logging.warning("DASHSCOPE_API_KEY not set, returning original text")
                     return text
                 logging.warning("DASHSCOPE_API_KEY not set, falling back to AssemblyAI")
-                return self.format_text_with_assemblyai(text, use_code_tags, use_yo, is_chunked, is_dialogue, _is_fallback=True, speaker_labels=speaker_labels)
+                return self.format_text_with_assemblyai(text, use_code_tags, use_yo, is_chunked, is_dialogue, _is_fallback=True, speaker_labels=speaker_labels, _prompt=prompt)
+
+            if not _qwen_breaker.allow():
+                if _is_fallback:
+                    logging.warning("Qwen circuit open, returning original text")
+                    return text
+                logging.warning("Qwen circuit open, going straight to AssemblyAI")
+                return self.format_text_with_assemblyai(text, use_code_tags, use_yo, is_chunked, is_dialogue, _is_fallback=True, speaker_labels=speaker_labels, _prompt=prompt)
 
             # Model configurable via env var for easy rollback
             model = os.environ.get('LLM_QWEN_MODEL', 'qwen-turbo-latest')
@@ -2451,14 +2776,16 @@ class AudioService:
                 }
             }
 
-            response = requests.post(url, headers=headers, json=payload, timeout=60)
+            response = self._http_session.post(url, headers=headers, json=payload, timeout=60)
 
             if response.status_code == 200:
                 try:
                     data = response.json()
                 except (ValueError, KeyError):
+                    _qwen_breaker.record_failure()
                     logging.warning("Qwen LLM: malformed JSON response, returning original text")
                     return text
+                _qwen_breaker.record_success()
                 logging.debug(f"Qwen response: {data}")
 
                 # Extract text from response (prefer choices format —
@@ -2496,7 +2823,7 @@ class AudioService:
                         logging.warning("Qwen returned very short text, returning original")
                         return text
                     logging.warning("Qwen returned very short text, trying AssemblyAI fallback")
-                    return self.format_text_with_assemblyai(text, use_code_tags, use_yo, is_chunked, is_dialogue, _is_fallback=True, speaker_labels=speaker_labels)
+                    return self.format_text_with_assemblyai(text, use_code_tags, use_yo, is_chunked, is_dialogue, _is_fallback=True, speaker_labels=speaker_labels, _prompt=prompt)
 
                 # Log API call metrics
                 if self.metrics_service:
@@ -2504,20 +2831,23 @@ class AudioService:
 
                 return formatted_text
             else:
+                _qwen_breaker.record_failure()
                 if _is_fallback:
                     logging.warning(f"Qwen API error: {response.status_code} - {response.text}, returning original text")
                     return text
                 logging.warning(f"Qwen API error: {response.status_code} - {response.text}, trying AssemblyAI fallback")
-                return self.format_text_with_assemblyai(text, use_code_tags, use_yo, is_chunked, is_dialogue, _is_fallback=True, speaker_labels=speaker_labels)
+                return self.format_text_with_assemblyai(text, use_code_tags, use_yo, is_chunked, is_dialogue, _is_fallback=True, speaker_labels=speaker_labels, _prompt=prompt)
 
         except requests.RequestException as e:
+            _qwen_breaker.record_failure()
             if _is_fallback:
                 logging.warning(f"Qwen API request failed: {e}, returning original text")
                 return text
             logging.warning(f"Qwen API request failed: {e}, falling back to AssemblyAI")
-            return self.format_text_with_assemblyai(text, use_code_tags, use_yo, is_chunked, is_dialogue, _is_fallback=True, speaker_labels=speaker_labels)
+            return self.format_text_with_assemblyai(text, use_code_tags, use_yo, is_chunked, is_dialogue, _is_fallback=True, speaker_labels=speaker_labels, _prompt=prompt)
 
         except Exception as e:
+            _qwen_breaker.record_failure()
             api_duration = time.time() - api_start_time
             if self.metrics_service:
                 self.metrics_service.log_api_call('qwen-llm', api_duration, False, str(e))
@@ -2526,16 +2856,18 @@ class AudioService:
                 logging.warning(f"Qwen LLM failed: {e}, returning original text")
                 return text
             logging.warning(f"Qwen LLM failed: {e}, falling back to AssemblyAI")
-            return self.format_text_with_assemblyai(text, use_code_tags, use_yo, is_chunked, is_dialogue, _is_fallback=True, speaker_labels=speaker_labels)
+            return self.format_text_with_assemblyai(text, use_code_tags, use_yo, is_chunked, is_dialogue, _is_fallback=True, speaker_labels=speaker_labels, _prompt=prompt)
 
     def format_text_with_assemblyai(self, text: str, use_code_tags: bool = False,
                                       use_yo: bool = True, is_chunked: bool = False,
                                       is_dialogue: bool = False,
                                       _is_fallback: bool = False,
-                                      speaker_labels: bool = False) -> str:
+                                      speaker_labels: bool = False,
+                                      _prompt: Optional[str] = None) -> str:
         """
         Format transcribed text using AssemblyAI LLM Gateway (Gemini 3 Flash).
         Falls back to Qwen if this fails (unless already a fallback call).
+        The prompt is built once and handed to the fallback via _prompt.
         """
         import requests
 
@@ -2545,6 +2877,9 @@ class AudioService:
             logging.info(f"Text too short for LLM formatting ({word_count} words < 10), returning original")
             return text
 
+        prompt = _prompt or self._build_format_prompt(text, use_code_tags, use_yo, is_chunked, is_dialogue,
+                                                          speaker_labels=speaker_labels)
+
         api_start_time = time.time()
 
         try:
@@ -2554,10 +2889,7 @@ class AudioService:
                     logging.warning("ASSEMBLYAI_API_KEY not set, returning original text")
                     return text
                 logging.warning("ASSEMBLYAI_API_KEY not set, falling back to Qwen")
-                return self.format_text_with_qwen(text, use_code_tags, use_yo, is_chunked, is_dialogue, _is_fallback=True, speaker_labels=speaker_labels)
-
-            prompt = self._build_format_prompt(text, use_code_tags, use_yo, is_chunked, is_dialogue,
-                                                   speaker_labels=speaker_labels)
+                return self.format_text_with_qwen(text, use_code_tags, use_yo, is_chunked, is_dialogue, _is_fallback=True, speaker_labels=speaker_labels, _prompt=prompt)
 
             # Model configurable via env var for easy rollback
             model = os.environ.get('LLM_ASSEMBLYAI_MODEL', 'gemini-flash-latest')
@@ -2579,7 +2911,7 @@ class AudioService:
                 'max_tokens': 8192
             }
 
-            response = requests.post(url, headers=headers, json=payload, timeout=300)
+            response = self._http_session.post(url, headers=headers, json=payload, timeout=300)
 
             if response.status_code == 200:
                 try:
@@ -2639,7 +2971,7 @@ class AudioService:
                         logging.warning("AssemblyAI LLM returned very short text, returning original")
                         return text
                     logging.warning("AssemblyAI LLM returned very short text, trying Qwen fallback")
-                    return self.format_text_with_qwen(text, use_code_tags, use_yo, is_chunked, is_dialogue, _is_fallback=True, speaker_labels=speaker_labels)
+                    return self.format_text_with_qwen(text, use_code_tags, use_yo, is_chunked, is_dialogue, _is_fallback=True, speaker_labels=speaker_labels, _prompt=prompt)
 
                 # Log API call metrics
                 if self.metrics_service:
@@ -2651,7 +2983,7 @@ class AudioService:
                     logging.warning(f"AssemblyAI LLM API error: {response.status_code} - {response.text}, returning original text")
                     return text
                 logging.warning(f"AssemblyAI LLM API error: {response.status_code} - {response.text}, trying Qwen fallback")
-                return self.format_text_with_qwen(text, use_code_tags, use_yo, is_chunked, is_dialogue, _is_fallback=True, speaker_labels=speaker_labels)
+                return self.format_text_with_qwen(text, use_code_tags, use_yo, is_chunked, is_dialogue, _is_fallback=True, speaker_labels=speaker_labels, _prompt=prompt)
 
         except requests.exceptions.Timeout as e:
             # Timeout is NOT a reason to fallback — Gemini needs time, return original
@@ -2666,7 +2998,7 @@ class AudioService:
                 logging.warning(f"AssemblyAI LLM request failed: {e}, returning original text")
                 return text
             logging.warning(f"AssemblyAI LLM request failed: {e}, falling back to Qwen")
-            return self.format_text_with_qwen(text, use_code_tags, use_yo, is_chunked, is_dialogue, _is_fallback=True, speaker_labels=speaker_labels)
+            return self.format_text_with_qwen(text, use_code_tags, use_yo, is_chunked, is_dialogue, _is_fallback=True, speaker_labels=speaker_labels, _prompt=prompt)
 
         except Exception as e:
             api_duration = time.time() - api_start_time
@@ -2677,21 +3009,20 @@ class AudioService:
                 logging.warning(f"AssemblyAI LLM failed: {e}, returning original text")
                 return text
             logging.warning(f"AssemblyAI LLM failed: {e}, falling back to Qwen")
-            return self.format_text_with_qwen(text, use_code_tags, use_yo, is_chunked, is_dialogue, _is_fallback=True, speaker_labels=speaker_labels)
+            return self.format_text_with_qwen(text, use_code_tags, use_yo, is_chunked, is_dialogue, _is_fallback=True, speaker_labels=speaker_labels, _prompt=prompt)
 
     def is_video_file(self, file_path: str) -> bool:
         """
         Check if the file is a video based on format detection
         """
+        # Shares the cached ffprobe result with get_audio_duration / get_audio_info
         file_info = self.get_audio_info(file_path)
         if not file_info:
             # Fallback to extension check
-            video_extensions = ['.mp4', '.avi', '.mov', '.mkv', '.webm', '.m4v', '.mpg', '.mpeg']
-            return any(file_path.lower().endswith(ext) for ext in video_extensions)
-            
+            return file_path.lower().endswith(self.VIDEO_EXTENSIONS)
+
         format_name = file_info.get('format', '').lower()
-        video_formats = ['mp4', 'mov', 'avi', 'mkv', 'webm', 'matroska', 'mpeg', 'mpg']
-        return any(fmt in format_name for fmt in video_formats)
+        return any(fmt in format_name for fmt in self.VIDEO_FORMATS)
         
     def get_audio_info(self, audio_path: str) -> Optional[dict]:
         """
@@ -2699,35 +3030,342 @@ class AudioService:
         Returns dict with duration, bitrate, format, etc.
         """
         try:
-            ffprobe_command = [
-                'ffprobe',
-                '-v', 'error',
-                '-show_entries', 'format=duration,bit_rate,format_name',
-                '-show_entries', 'stream=codec_name,sample_rate,channels',
-                '-of', 'json',
-                audio_path
-            ]
-            
-            result = subprocess.run(
-                ffprobe_command,
-                capture_output=True,
-                text=True,
-                timeout=10
-            )
-            
-            if result.returncode == 0:
-                import json
-                data = json.loads(result.stdout)
-                return {
-                    'duration': float(data.get('format', {}).get('duration', 0)),
-                    'bit_rate': int(data.get('format', {}).get('bit_rate', 0)),
-                    'format': data.get('format', {}).get('format_name', 'unknown'),
-                    'codec': data.get('streams', [{}])[0].get('codec_name', 'unknown'),
-                    'sample_rate': int(data.get('streams', [{}])[0].get('sample_rate', 0)),
-                    'channels': int(data.get('streams', [{}])[0].get('channels', 0))
-                }
-                
+            return self._probe_all(audio_path)
         except Exception as e:
             logging.error(f"Error getting audio info: {e}")
-            
-        return None
\ No newline at end of file
+
+        return None
+
+
+class Mp3Stream:
+    """An ffmpeg MP3 conversion fed through stdin (see AudioService.start_mp3_stream)."""
+
+    def __init__(self, process, output_path: str, stderr_file, duration: float, timeout: int):
+        self.output_path = output_path
+        self.failed = False
+        self._process = process
+        self._stderr_file = stderr_file
+        self._duration = duration
+        self._timeout = timeout
+
+    def write(self, chunk: bytes):
+        """Feed input bytes. If ffmpeg has exited, mark the stream failed instead of raising."""
+        if self.failed:
+            return
+        try:
+            self._process.stdin.write(chunk)
+        except (OSError, ValueError):  # BrokenPipeError, or stdin already closed
+            self.failed = True
+
+    def finish(self, source_path: Optional[str] = None) -> Tuple[Optional[str], float]:
+        """
+        Close stdin and wait for ffmpeg.
+
+        Args:
+            source_path: The downloaded copy of the input, MIME-checked like
+                         prepare_audio_for_asr() does for file conversions
+
+        Returns:
+            (mp3 path, duration) — (None, 0.0) if the conversion failed. Inputs
+            that need a seekable file (MP4 with the index at the end) land here;
+            callers then convert source_path the usual way.
+        """
+        try:
+            self._process.stdin.close()
+        except OSError:
+            pass
+        try:
+            returncode = self._process.wait(timeout=self._timeout)
+        except subprocess.TimeoutExpired:
+            self._process.kill()
+            returncode = self._process.wait()
+        self._stderr_file.seek(0)
+        stderr = self._stderr_file.read().decode('utf-8', 'replace')
+        self._stderr_file.close()
+
+        if returncode != 0 or self.failed:
+            logging.warning(f"Streaming conversion failed (rc={returncode}): {stderr[-300:]}")
+            self._remove_output()
+            return None, 0.0
+        if source_path and not AudioService._check_mime_type(source_path):
+            logging.error(f"File rejected: invalid MIME type for {source_path}")
+            self._remove_output()
+            return None, 0.0
+
+        duration = self._duration
+        match = AudioService._FFMPEG_DURATION_RE.search(stderr)
+        if match:
+            h, m, sec = match.groups()
+            duration = int(h) * 3600 + int(m) * 60 + float(sec)
+        logging.info(f"Streaming conversion successful. Output: {self.output_path} "
+                     f"({os.path.getsize(self.output_path)} bytes)")
+        return self.output_path, duration
+
+    def abort(self):
+        """Stop ffmpeg and drop the partial output (download failed)."""
+        self.failed = True
+        self._process.kill()
+        self._process.wait()
+        self._stderr_file.close()
+        self._remove_output()
+
+    def _remove_output(self):
+        try:
+            os.remove(self.output_path)
+        except OSError:
+            pass
+
+
+# ". . ." left by ASR → "..."
+_SPACED_ELLIPSIS_RE = re.compile(r'(?:\.\s){2,}\.')
+
+# A complete Whisper segment on one piece of the log. The filter's JSON is flat
+# (t0, t1, text), so the C regex engine finds it without a Python-level scan.
+_WHISPER_JSON_RE = re.compile(r'\{[^{}]{0,4096}"text"\s*:\s*"(?:[^"\\]|\\.)*"[^{}]{0,4096}\}')
+
+
+class _CircuitBreaker:
+    """Consecutive-failure circuit breaker for one upstream API.
+
+    After `threshold` failures in a row the circuit opens and allow() returns
+    False for `cooldown` seconds. Then a single half-open probe is let through:
+    success closes the circuit, failure re-opens it for another cooldown.
+    """
+
+    def __init__(self, name: str, threshold: int = 5, cooldown: float = 60.0):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_at = 0.0  # when the half-open probe started; 0 = none in flight
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._failures < self.threshold:
+                return True
+            now = time.monotonic()
+            if now - self._opened_at < self.cooldown:
+                return False
+            # A probe that never reported back (early return) expires after a cooldown
+            if self._probe_at and now - self._probe_at < self.cooldown:
+                return False
+            self._probe_at = now
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self._failures >= self.threshold:
+                logging.info(f"[breaker] {self.name} closed")
+            self._failures = 0
+            self._probe_at = 0.0
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probe_at = 0.0
+            if self._failures >= self.threshold:
+                if self._failures == self.threshold:
+                    logging.warning(f"[breaker] {self.name} open after {self._failures} consecutive failures")
+                self._opened_at = time.monotonic()
+
+
+# Qwen formatting fails fast to AssemblyAI while DashScope is degraded,
+# instead of every request paying the 60s timeout first
+_qwen_breaker = _CircuitBreaker('qwen-llm')
+
+
+class _WhisperSegmentScanner:
+    """Incremental scan for Whisper JSON segments in ffmpeg stderr.
+
+    feed() accepts the log in any pieces (whole string or line by line). Flat
+    segments are matched by _WHISPER_JSON_RE; whatever is left with a brace
+    (objects split across pieces, nesting) goes through the balanced-brace scan.
+    """
+
+    def __init__(self):
+        self.texts = []
+        self._depth = 0
+        self._pending = []  # pieces of the object still open
+
+    def feed(self, chunk: str):
+        if not self._depth:
+            if '{' not in chunk:
+                return  # plain log line
+            last = 0
+            for match in _WHISPER_JSON_RE.finditer(chunk):
+                self._emit(match.group())
+                last = match.end()
+            if last:
+                chunk = chunk[last:]
+                if '{' not in chunk:
+                    return
+        start = 0
+        for i, char in enumerate(chunk):
+            if char == '{':
+                if not self._depth:
+                    start = i
+                self._depth += 1
+            elif char == '}' and self._depth:
+                self._depth -= 1
+                if not self._depth:
+                    self._pending.append(chunk[start:i + 1])
+                    self._emit(''.join(self._pending))
+                    self._pending = []
+        if self._depth:
+            self._pending.append(chunk[start:])
+
+    def _emit(self, json_str: str):
+        try:
+            data = json.loads(json_str)
+        except json.JSONDecodeError:
+            return  # log text that happened to have balanced braces
+        # Whisper segment: {"t0": ..., "t1": ..., "text": "..."}
+        if isinstance(data, dict) and 'text' in data:
+            self.texts.append(data['text'].strip())
+
+
+def _run_ffprobe(audio_path: str, args: tuple) -> dict:
+    # ffprobe JSON is ASCII: json.loads takes the raw bytes, no locale decode
+    result = subprocess.run(
+        ['ffprobe', '-v', 'error', *args, '-of', 'json', audio_path],
+        capture_output=True,
+        check=True,
+        timeout=10
+    )
+    return json.loads(result.stdout)
+
+
+@functools.lru_cache(maxsize=128)
+def _cached_ffprobe(audio_path: str, mtime_ns: int, size: int, args: tuple) -> dict:
+    """mtime/size are part of the key only: a rewritten file gets a fresh probe."""
+    return _run_ffprobe(audio_path, args)
+
+
+@functools.lru_cache(maxsize=None)
+def _pyav():
+    """PyAV module, or None when not installed. Imported on first probe, not at cold start."""
+    try:
+        import av
+    except ImportError:
+        return None
+    return av
+
+
+def _probe_with_pyav(audio_path: str) -> Optional[dict]:
+    """_probe_all() fields read by libavformat in-process (no ffprobe fork+exec).
+
+    None when PyAV is missing, can't open the file, or finds no audio stream
+    or duration, so the caller falls back to ffprobe.
+    """
+    if _pyav() is None:
+        return None
+    try:
+        st = os.stat(audio_path)
+    except OSError:
+        return None
+    return _cached_pyav_probe(audio_path, st.st_mtime_ns, st.st_size)
+
+
+@functools.lru_cache(maxsize=128)
+def _cached_pyav_probe(audio_path: str, mtime_ns: int, size: int) -> Optional[dict]:
+    """Keyed like _cached_ffprobe; a None result is cached too (ffprobe has its own cache)."""
+    av = _pyav()
+    try:
+        with av.open(audio_path) as container:
+            if not container.streams.audio or not container.duration:
+                return None
+            ctx = container.streams.audio[0].codec_context
+            layout = getattr(ctx, 'layout', None)
+            return {
+                'format': container.format.name,
+                'codec': ctx.name,
+                'sample_rate': int(ctx.sample_rate or 0),
+                'bit_rate': int(container.bit_rate or 0),
+                'channels': int(getattr(layout, 'nb_channels', 0) or getattr(ctx, 'channels', 0) or 0),
+                'duration': container.duration / av.time_base,
+            }
+    except Exception as e:
+        logging.debug(f"[probe] PyAV could not read {audio_path}: {e}, using ffprobe")
+        return None
+
+
+# LLM formatting prompt (AudioService._build_format_prompt). Everything except the
+# transcript depends only on five flags, so each head is rendered once per process.
+_FORMAT_PROMPT_TEMPLATE = """Отформатируй транскрипцию аудиозаписи. Правила:
+
+1. Исправь ЯВНЫЕ ошибки распознавания речи (артефакты, повторы, обрывки слов)
+2. Расставь знаки препинания по правилам русского языка
+3. НЕ заменяй слова на синонимы, НЕ меняй формы слов — сохраняй именно те слова, которые произнёс автор
+4. Раздели на абзацы по смыслу и интонации (минимум 2-3 предложения в абзаце, не разбивай каждое предложение отдельно)
+5. {code_tag_instruction}
+6. {yo_instruction}
+7. ВАЖНО: НЕ добавляй свои комментарии, НЕ веди диалог с пользователем
+8. ИМЕНА И ФАМИЛИИ: будь максимально консервативен с именами собственными. \
+Если слово похоже на фамилию/имя — НЕ заменяй его на похожее. \
+Не «исправляй» незнакомые фамилии на более распространённые.
+9. ШИПЯЩИЕ/СВИСТЯЩИЕ: ASR часто путает ш/щ/ч/ж/с/з/ц. \
+Исправляй только если результат явно не слово русского языка. \
+В сомнительных случаях — оставляй как распознал ASR.
+{extra_instructions}Обрати особое внимание на корректное написание топонимов (географических названий). \
+Приоритет: топонимы Таиланда (Бангкок, Паттайя, Пхукет, Краби, Чиангмай, Ко Самуи, \
+Ко Панган, Ко Чанг, Хуа Хин, Районг и т.д.), затем России. \
+Не заменяй правильные топонимы на похожие по звучанию слова.
+
+Текст для форматирования:
+
+"""
+
+_PROMPT_CODE_TAGS = "Оберни ВЕСЬ текст в теги <code></code>."
+_PROMPT_NO_CODE_TAGS = "НЕ используй теги <code>."
+_PROMPT_KEEP_YO = "Сохраняй букву ё где она есть."
+_PROMPT_NO_YO = "Заменяй все буквы ё на е."
+
+_PROMPT_CHUNKED = (
+    "10. ВАЖНО: этот текст собран из нескольких последовательных фрагментов одной записи. "
+    "На стыках фрагментов могут быть оборванные предложения, повторы слов или неестественные "
+    "переходы — исправь эти артефакты склейки, обеспечив плавный непрерывный текст.\n"
+)
+_PROMPT_DIALOGUE_LABELS = (
+    "11. ФОРМАТ ДИАЛОГА С МЕТКАМИ СПИКЕРОВ: текст уже отформатирован как диалог "
+    "с метками «Спикер N:» и тире (\u2014). "
+    "ОБЯЗАТЕЛЬНО СОХРАНЯЙ все метки «Спикер N:» — они должны остаться в тексте как есть. "
+    "Некоторые реплики могут быть распределены с ошибками, поэтому осмысли весь диалог "
+    "и внеси коррективы там, где ты точно уверен, что исправление требуется. "
+    "Например, это касается спорных моментов с разрывом фраз одного и того же спикера. "
+    "НЕ меняй порядок реплик. НЕ добавляй пустые строки между репликами — "
+    "каждая реплика начинается с новой строки сразу после предыдущей, без отступов. "
+    "Правило 4 (абзацы) к диалогу НЕ применяется. "
+    "Также исправь пунктуацию и артефакты ASR внутри каждого блока.\n"
+)
+_PROMPT_DIALOGUE = (
+    "11. ФОРМАТ ДИАЛОГА: текст уже отформатирован как диалог с тире (\u2014). "
+    "Некоторые реплики могут быть распределены с ошибками, поэтому осмысли весь диалог "
+    "и внеси коррективы там, где ты точно уверен, что исправление требуется. "
+    "Например, это касается спорных моментов с разрывом фраз одного и того же спикера. "
+    "НЕ добавляй метки спикеров. НЕ меняй порядок реплик. "
+    "НЕ добавляй пустые строки между репликами — каждая реплика начинается "
+    "с новой строки сразу после предыдущей, без отступов. "
+    "Правило 4 (абзацы) к диалогу НЕ применяется. "
+    "Также исправь пунктуацию и артефакты ASR внутри каждого блока.\n"
+)
+_PROMPT_MONOLOGUE = (
+    "11. НЕ используй тире (\u2014) для оформления прямой речи. "
+    "Оформляй как связный текст, разделённый на абзацы по смыслу.\n"
+)
+
+
+@functools.lru_cache(maxsize=None)
+def _format_prompt_head(use_code_tags: bool, use_yo: bool, is_chunked: bool,
+                        is_dialogue: bool, speaker_labels: bool) -> str:
+    """Formatting prompt up to (not including) the transcript; 24 variants at most."""
+    if is_dialogue:
+        style = _PROMPT_DIALOGUE_LABELS if speaker_labels else _PROMPT_DIALOGUE
+    else:
+        style = _PROMPT_MONOLOGUE
+    return _FORMAT_PROMPT_TEMPLATE.format(
+        code_tag_instruction=_PROMPT_CODE_TAGS if use_code_tags else _PROMPT_NO_CODE_TAGS,
+        yo_instruction=_PROMPT_KEEP_YO if use_yo else _PROMPT_NO_YO,
+        extra_instructions=(_PROMPT_CHUNKED if is_chunked else '') + style,
+    )
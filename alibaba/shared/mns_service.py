@@ -13,14 +13,29 @@ Usage:
     )
 """
 
+import functools
 import logging
 import json
 import base64
-from typing import Optional, Dict, Any, Callable
+import threading
+from typing import Optional, Dict, Any, Callable, List
 
 logger = logging.getLogger(__name__)
 
 
+@functools.lru_cache(maxsize=None)
+def _mns_message_class():
+    """Resolve the Message class once per process (its module varies by aliyun-mns version)."""
+    try:
+        from mns.mns_common import Message
+    except ImportError:
+        try:
+            from mns.message import Message
+        except ImportError:
+            from mns.queue import Message
+    return Message
+
+
 class MNSService:
     """
     Service for interacting with Alibaba Cloud MNS (Message Notification Service).
@@ -35,6 +50,9 @@ class MNSService:
             from mns.queue import Queue
 
             self.account = Account(endpoint, access_key_id, access_key_secret)
+            # MNSHttp keeps one unlocked http.client connection per Account;
+            # poll_queue workers and background delete retries share this instance
+            self._lock = threading.Lock()
             self.queue = self.account.get_queue(queue_name)
             self.queue_name = queue_name
             self.endpoint = endpoint
@@ -63,11 +81,7 @@ class MNSService:
         from mns.mns_exception import MNSExceptionBase
 
         try:
-            # Try multiple import paths for Message (varies by aliyun-mns version)
-            try:
-                from mns.mns_common import Message
-            except ImportError:
-                from mns.message import Message
+            Message = _mns_message_class()
 
             # Serialize message to JSON
             message_body = json.dumps(message_data, default=str)
@@ -78,7 +92,8 @@ class MNSService:
                 msg.delay_seconds = delay_seconds
 
             # Send message
-            send_msg = self.queue.send_message(msg)
+            with self._lock:
+                send_msg = self.queue.send_message(msg)
 
             logger.info(f"Published message {send_msg.message_id} to queue {self.queue_name}")
             return send_msg.message_id
@@ -105,7 +120,8 @@ class MNSService:
         from mns.mns_exception import MNSExceptionBase
 
         try:
-            recv_msg = self.queue.receive_message(wait_seconds)
+            with self._lock:
+                recv_msg = self.queue.receive_message(wait_seconds)
 
             # Parse message body
             message_data = json.loads(recv_msg.message_body)
@@ -128,6 +144,49 @@ class MNSService:
             logger.warning(f"Error receiving message: {e}")
             return None
 
+    def batch_receive_messages(self, batch_size: int = 16, wait_seconds: int = 1,
+                               visibility_timeout: int = 60) -> List[Dict[str, Any]]:
+        """
+        Receive up to batch_size messages in one request.
+
+        Args:
+            batch_size: Maximum number of messages (1-16, MNS limit)
+            wait_seconds: Long polling wait time (0-30)
+            visibility_timeout: Time message is hidden from other consumers
+
+        Returns:
+            List of dictionaries in receive_message format (empty if none)
+        """
+        from mns.mns_exception import MNSExceptionBase
+
+        try:
+            with self._lock:
+                recv_msgs = self.queue.batch_receive_message(max(1, min(batch_size, 16)), wait_seconds)
+        except MNSExceptionBase as e:
+            if 'MessageNotExist' not in str(e):
+                logger.warning(f"MNS error batch receiving messages: {e}")
+            return []
+        except Exception as e:
+            logger.warning(f"Error batch receiving messages: {e}")
+            return []
+
+        messages = []
+        for recv_msg in recv_msgs:
+            try:
+                message_data = json.loads(recv_msg.message_body)
+            except (json.JSONDecodeError, TypeError) as e:
+                # Leave it in the queue — it will be retried / dead-lettered by MNS
+                logger.warning(f"Skipping unparsable message {recv_msg.message_id}: {e}")
+                continue
+            messages.append({
+                'data': message_data,
+                'message_id': recv_msg.message_id,
+                'receipt_handle': recv_msg.receipt_handle,
+                'dequeue_count': recv_msg.dequeue_count,
+                'enqueue_time': recv_msg.enqueue_time,
+            })
+        return messages
+
     def delete_message(self, receipt_handle: str) -> bool:
         """
         Delete a message after successful processing.
@@ -141,7 +200,8 @@ class MNSService:
         from mns.mns_exception import MNSExceptionBase
 
         try:
-            self.queue.delete_message(receipt_handle)
+            with self._lock:
+                self.queue.delete_message(receipt_handle)
             logger.debug(f"Deleted message with handle {receipt_handle[:20]}...")
             return True
 
@@ -167,10 +227,11 @@ class MNSService:
         from mns.mns_exception import MNSExceptionBase
 
         try:
-            new_handle = self.queue.change_message_visibility(
-                receipt_handle,
-                visibility_timeout
-            )
+            with self._lock:
+                new_handle = self.queue.change_message_visibility(
+                    receipt_handle,
+                    visibility_timeout
+                )
             logger.debug(f"Changed visibility for message")
             return new_handle
 
@@ -191,7 +252,8 @@ class MNSService:
         from mns.mns_exception import MNSExceptionBase
 
         try:
-            attrs = self.queue.get_attributes()
+            with self._lock:
+                attrs = self.queue.get_attributes()
             return {
                 'active_messages': attrs.active_messages,
                 'inactive_messages': attrs.inactive_messages,
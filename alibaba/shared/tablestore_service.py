@@ -13,17 +13,85 @@ Usage:
     )
 """
 
+import itertools
 import logging
 import json
 import uuid
-from datetime import datetime, timedelta
-from typing import Optional, Dict, Any, List
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Dict, Any, Iterator, List, Tuple
 
-import pytz
+try:
+    from orjson import loads as _json_loads  # optional: 2-5x faster than stdlib json
+except ImportError:
+    _json_loads = json.loads
 
 logger = logging.getLogger(__name__)
 
 
+def _utc_now_iso() -> str:
+    """Current UTC time as ISO 8601, the format of every timestamp column."""
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _utc_sort_key(value) -> Optional[str]:
+    """Canonical UTC isoformat of a stored timestamp, or None if it can't be read.
+
+    Rows written through _utc_now_iso() take the fast path. Rows from the
+    Firestore migration may carry a 'Z' suffix, a space separator or another
+    offset, so they are parsed and normalized before any string comparison.
+    """
+    if type(value) is not str:
+        return None
+    if value[10:11] == 'T' and value.endswith('+00:00'):
+        return value
+    try:
+        ts = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    return ts.astimezone(timezone.utc).isoformat()
+
+
+# Column types Tablestore can't store natively, keyed by exact type. bool is
+# listed separately from int (a dict lookup doesn't follow subclassing).
+_SERIALIZERS = {
+    str: None, int: None, float: None,  # stored as is; the common case
+    bool: int,
+    dict: json.dumps,
+    list: json.dumps,
+    datetime: datetime.isoformat,
+}
+
+
+def _serialize_value(value: Any) -> Any:
+    """Python value → Tablestore column value (one dict lookup for the common types)."""
+    try:
+        serializer = _SERIALIZERS[type(value)]
+    except KeyError:
+        # Subclasses of the table's types (OrderedDict, datetime subclasses, ...)
+        if isinstance(value, datetime):
+            return value.isoformat()
+        if isinstance(value, (dict, list)):
+            return json.dumps(value)
+        return value
+    return value if serializer is None else serializer(value)
+
+
+def _deserialize_value(value: Any) -> Any:
+    """JSON-looking strings ('{...' / '[...') are parsed; everything else is returned as is.
+
+    Runs once per column of every row read, so plain strings are rejected on
+    their first character without entering a try block.
+    """
+    if type(value) is str and value[:1] in ('{', '['):
+        try:
+            return _json_loads(value)
+        except ValueError:  # json.JSONDecodeError and orjson.JSONDecodeError
+            pass
+    return value
+
+
 class TablestoreService:
     """
     Service for interacting with Alibaba Cloud Tablestore.
@@ -97,11 +165,11 @@ class TablestoreService:
             # Prepare attribute columns
             attribute_columns = []
             for key, value in user_data.items():
-                attribute_columns.append((key, self._serialize_value(value)))
+                attribute_columns.append((key, _serialize_value(value)))
 
             # Add created_at if not present
             if 'created_at' not in user_data:
-                attribute_columns.append(('created_at', datetime.now(pytz.utc).isoformat()))
+                attribute_columns.append(('created_at', _utc_now_iso()))
 
             row = Row(primary_key, attribute_columns)
             condition = Condition(RowExistenceExpectation.EXPECT_NOT_EXIST)
@@ -124,10 +192,10 @@ class TablestoreService:
             # Prepare update columns - use lowercase 'put' as per SDK docs
             update_columns = {'put': []}
             for key, value in updates.items():
-                update_columns['put'].append((key, self._serialize_value(value)))
+                update_columns['put'].append((key, _serialize_value(value)))
 
             # Add last_activity timestamp
-            update_columns['put'].append(('last_activity', datetime.now(pytz.utc).isoformat()))
+            update_columns['put'].append(('last_activity', _utc_now_iso()))
 
             # Create Row object with primary key and update columns
             row = Row(primary_key, update_columns)
@@ -140,21 +208,74 @@ class TablestoreService:
             logger.error(f"Error updating user {user_id}: {e}")
             return False
 
+    def user_update_op(self, user_id: int, updates: Dict[str, Any]) -> Tuple[str, List[Tuple[str, Any]], Dict[str, Any], str]:
+        """Build an update_user() write (with last_activity) as a batch_write() operation."""
+        attributes = dict(updates)
+        attributes['last_activity'] = _utc_now_iso()
+        return ('users', [('user_id', str(user_id))], attributes, 'update')
+
     def update_user_balance(self, user_id: int, delta: float, max_retries: int = 3) -> bool:
         """
-        Update user balance with optimistic locking to prevent race conditions.
-        Uses retry mechanism if concurrent update is detected.
+        Update user balance with a single atomic INCREMENT (no read, no conflict retries).
+
+        A deduction is conditioned on balance_minutes >= -delta, so the counter
+        never goes negative. When the server rejects the increment (condition
+        check failed: insufficient balance or missing row; parameter invalid:
+        legacy non-integer column), falls back to adjust_user_balance(), which
+        reads, clamps to 0 and writes with optimistic locking. Any other error
+        (timeout, connection reset) may have been applied server-side, so it is
+        not retried — that would charge or refund twice.
 
         Args:
             user_id: The user ID
             delta: Amount to add (positive) or subtract (negative)
-            max_retries: Maximum retry attempts on conflict
+            max_retries: Maximum retry attempts on conflict (fallback path)
 
         Returns:
             True if balance was updated successfully, False otherwise
         """
         from tablestore import Row, Condition, RowExistenceExpectation, ComparatorType, SingleColumnCondition
 
+        if delta != int(delta):
+            return self.adjust_user_balance(user_id, delta, max_retries) is not None
+
+        delta = int(delta)
+        column_condition = None
+        if delta < 0:
+            column_condition = SingleColumnCondition(
+                'balance_minutes', -delta, ComparatorType.GREATER_EQUAL,
+                pass_if_missing=False
+            )
+        row = Row([('user_id', str(user_id))], {
+            'increment': [('balance_minutes', delta)],
+            'put': [('last_activity', _utc_now_iso())],
+        })
+
+        try:
+            self.client.update_row('users', row,
+                                   Condition(RowExistenceExpectation.EXPECT_EXIST, column_condition))
+            logger.info(f"Updated balance for user {user_id} (delta: {delta:+d})")
+            return True
+        except Exception as e:
+            error_str = str(e)
+            if ('OTSConditionCheckFail' in error_str or 'Condition check failed' in error_str
+                    or 'OTSParameterInvalid' in error_str):
+                logger.info(f"Balance increment for user {user_id} not applied ({e}), using read-modify-write")
+                return self.adjust_user_balance(user_id, delta, max_retries) is not None
+            logger.error(f"Balance increment for user {user_id} failed with unknown outcome: {e}")
+            return False
+
+    def adjust_user_balance(self, user_id: int, delta: float, max_retries: int = 3) -> Optional[int]:
+        """Same as update_user_balance(), but returns the balance that was written.
+
+        The conditional update only succeeds against the balance it read, so the
+        returned value is authoritative — callers don't need to re-read the user.
+
+        Returns:
+            New balance in minutes, or None if the update failed
+        """
+        from tablestore import Row, Condition, RowExistenceExpectation, ComparatorType, SingleColumnCondition
+
         raw_balance = None  # Initialize for error logging
 
         for attempt in range(max_retries):
@@ -163,7 +284,7 @@ class TablestoreService:
                 user = self.get_user(user_id)
                 if not user:
                     logger.error(f"User {user_id} not found for balance update")
-                    return False
+                    return None
 
                 # Get raw balance value for condition comparison (preserve original type)
                 raw_balance = user.get('balance_minutes', 0)
@@ -187,7 +308,7 @@ class TablestoreService:
                 update_columns = {
                     'put': [
                         ('balance_minutes', new_balance),  # Must be int for Tablestore
-                        ('last_activity', datetime.now(pytz.utc).isoformat())
+                        ('last_activity', _utc_now_iso())
                     ]
                 }
 
@@ -209,7 +330,7 @@ class TablestoreService:
 
                 self.client.update_row('users', row, condition)
                 logger.info(f"Updated balance for user {user_id}: {current_balance} -> {new_balance} (delta: {delta:+.0f})")
-                return True
+                return new_balance
 
             except Exception as e:
                 error_str = str(e)
@@ -221,12 +342,12 @@ class TablestoreService:
                         time.sleep(0.1 * (attempt + 1))  # Exponential backoff
                         continue  # Retry
                     logger.error(f"Balance update failed after {max_retries} retries for user {user_id}")
-                    return False
+                    return None
                 else:
                     logger.error(f"Error updating balance for user {user_id}: {e}", exc_info=True)
-                    return False
+                    return None
 
-        return False
+        return None
 
     def reserve_balance(self, user_id: int, minutes: int, max_retries: int = 3) -> bool:
         """Atomically check sufficiency and deduct balance at queue time.
@@ -264,7 +385,7 @@ class TablestoreService:
                 update_columns = {
                     'put': [
                         ('balance_minutes', new_balance),
-                        ('last_activity', datetime.now(pytz.utc).isoformat())
+                        ('last_activity', _utc_now_iso())
                     ]
                 }
                 row = Row(primary_key, update_columns)
@@ -312,37 +433,19 @@ class TablestoreService:
         return self.update_user(user_id, {'settings': json.dumps(settings)})
 
     def increment_micro_purchases(self, user_id: int) -> bool:
-        """Increment the micro package purchase counter for a user."""
+        """Increment the micro package purchase counter for a user (atomic INCREMENT)."""
         from tablestore import Row, Condition, RowExistenceExpectation
 
         try:
-            user = self.get_user(user_id)
-            if not user:
-                logger.error(f"User {user_id} not found for micro purchases increment")
-                return False
-
-            current_count = user.get('micro_package_purchases', 0)
-            if isinstance(current_count, str):
-                current_count = int(current_count)
-            new_count = current_count + 1
-
-            primary_key = [('user_id', str(user_id))]
-            update_columns = {
-                'put': [('micro_package_purchases', new_count)]
-            }
-            row = Row(primary_key, update_columns)
-            condition = Condition(RowExistenceExpectation.EXPECT_EXIST)
-
-            self.client.update_row('users', row, condition)
-            logger.info(f"Incremented micro_package_purchases for user {user_id}: {current_count} -> {new_count}")
+            row = Row([('user_id', str(user_id))], {'increment': [('micro_package_purchases', 1)]})
+            self.client.update_row('users', row, Condition(RowExistenceExpectation.EXPECT_EXIST))
+            logger.info(f"Incremented micro_package_purchases for user {user_id}")
             return True
 
         except Exception as e:
             logger.error(f"Error incrementing micro purchases for user {user_id}: {e}")
             return False
 
-    # ==================== USER STATE OPERATIONS ====================
-
     def get_user_state(self, user_id: int) -> Optional[Dict[str, Any]]:
         """Get user state (for batch processing)."""
         from tablestore import Row
@@ -402,7 +505,7 @@ class TablestoreService:
             attribute_columns = []
 
             for key, value in request_data.items():
-                attribute_columns.append((key, self._serialize_value(value)))
+                attribute_columns.append((key, _serialize_value(value)))
 
             row = Row(primary_key, attribute_columns)
             condition = Condition(RowExistenceExpectation.IGNORE)
@@ -473,7 +576,7 @@ class TablestoreService:
             update_columns = {'put': []}
 
             for key, value in updates.items():
-                update_columns['put'].append((key, self._serialize_value(value)))
+                update_columns['put'].append((key, _serialize_value(value)))
 
             row = Row(primary_key, update_columns)
             condition = Condition(RowExistenceExpectation.EXPECT_EXIST)
@@ -528,11 +631,11 @@ class TablestoreService:
 
             for key, value in job_data.items():
                 if key != 'job_id':
-                    attribute_columns.append((key, self._serialize_value(value)))
+                    attribute_columns.append((key, _serialize_value(value)))
 
             # Auto-add created_at if not present
             if 'created_at' not in job_data:
-                attribute_columns.append(('created_at', datetime.now(pytz.utc).isoformat()))
+                attribute_columns.append(('created_at', _utc_now_iso()))
 
             row = Row(primary_key, attribute_columns)
             condition = Condition(RowExistenceExpectation.EXPECT_NOT_EXIST)
@@ -555,7 +658,7 @@ class TablestoreService:
             update_columns = {'put': []}
 
             for key, value in updates.items():
-                update_columns['put'].append((key, self._serialize_value(value)))
+                update_columns['put'].append((key, _serialize_value(value)))
 
             row = Row(primary_key, update_columns)
             condition = Condition(RowExistenceExpectation.EXPECT_EXIST)
@@ -567,24 +670,53 @@ class TablestoreService:
             logger.error(f"Error updating job {job_id}: {e}")
             return False
 
+    # ==================== FORMAT CACHE ====================
+
+    def get_formatted_text(self, cache_key: str) -> Optional[str]:
+        """Get cached LLM formatting output (see utility.format_cache_key)."""
+        try:
+            consumed, return_row, next_token = self.client.get_row(
+                'formatted_cache', [('cache_key', cache_key)], ['text']
+            )
+            if return_row is None:
+                return None
+            return self._row_to_dict(return_row).get('text')
+        except Exception as e:
+            logger.warning(f"Error reading format cache {cache_key[:12]}: {e}")
+            return None
+
+    def put_formatted_text(self, cache_key: str, text: str) -> bool:
+        """Store LLM formatting output. Expiry is the table's TTL."""
+        from tablestore import Row, Condition, RowExistenceExpectation
+
+        try:
+            row = Row([('cache_key', cache_key)], [('text', text)])
+            self.client.put_row('formatted_cache', row, Condition(RowExistenceExpectation.IGNORE))
+            return True
+        except Exception as e:
+            logger.warning(f"Error writing format cache {cache_key[:12]}: {e}")
+            return False
+
     # ==================== LOG OPERATIONS ====================
 
+    def transcription_log_op(self, log_data: Dict[str, Any]) -> Tuple[str, List[Tuple[str, Any]], Dict[str, Any], str]:
+        """Build a transcription log row as a batch_write() operation."""
+        attributes = dict(log_data)
+        # Add timestamp if not present
+        if 'timestamp' not in attributes:
+            attributes['timestamp'] = _utc_now_iso()
+        return ('transcription_logs', [('log_id', str(uuid.uuid4()))], attributes, 'put')
+
     def log_transcription(self, log_data: Dict[str, Any]) -> bool:
         """Log a transcription event."""
         from tablestore import Row, Condition, RowExistenceExpectation
 
-        log_id = str(uuid.uuid4())
-
         try:
-            primary_key = [('log_id', log_id)]
+            _, primary_key, attributes, _ = self.transcription_log_op(log_data)
             attribute_columns = []
 
-            for key, value in log_data.items():
-                attribute_columns.append((key, self._serialize_value(value)))
-
-            # Add timestamp if not present
-            if 'timestamp' not in log_data:
-                attribute_columns.append(('timestamp', datetime.now(pytz.utc).isoformat()))
+            for key, value in attributes.items():
+                attribute_columns.append((key, _serialize_value(value)))
 
             row = Row(primary_key, attribute_columns)
             condition = Condition(RowExistenceExpectation.EXPECT_NOT_EXIST)
@@ -608,10 +740,10 @@ class TablestoreService:
 
             for key, value in payment_data.items():
                 if key != 'payment_id':
-                    attribute_columns.append((key, self._serialize_value(value)))
+                    attribute_columns.append((key, _serialize_value(value)))
 
             if 'timestamp' not in payment_data:
-                attribute_columns.append(('timestamp', datetime.now(pytz.utc).isoformat()))
+                attribute_columns.append(('timestamp', _utc_now_iso()))
 
             row = Row(primary_key, attribute_columns)
             condition = Condition(RowExistenceExpectation.EXPECT_NOT_EXIST)
@@ -624,66 +756,98 @@ class TablestoreService:
             logger.error(f"Error logging payment: {e}")
             return False
 
+    # ==================== BATCH OPERATIONS ====================
+
+    def batch_write(self, operations: List[Tuple[str, List[Tuple[str, Any]], Dict[str, Any], str]]) -> bool:
+        """
+        Write rows across tables in a single BatchWriteRow request.
+
+        Args:
+            operations: (table_name, primary_key, attributes, op_type) tuples;
+                op_type 'put' creates a new row (must not exist),
+                'update' puts columns into an existing row (must exist)
+
+        Returns:
+            True if every row was written
+        """
+        from tablestore import (Row, Condition, RowExistenceExpectation, BatchWriteRowRequest,
+                                TableInBatchWriteRowItem, PutRowItem, UpdateRowItem)
+
+        if not operations:
+            return True
+
+        try:
+            row_items: Dict[str, list] = {}
+            for table_name, primary_key, attributes, op_type in operations:
+                columns = [(key, _serialize_value(value)) for key, value in attributes.items()]
+                if op_type == 'put':
+                    item = PutRowItem(Row(primary_key, columns),
+                                      Condition(RowExistenceExpectation.EXPECT_NOT_EXIST))
+                elif op_type == 'update':
+                    item = UpdateRowItem(Row(primary_key, {'put': columns}),
+                                         Condition(RowExistenceExpectation.EXPECT_EXIST))
+                else:
+                    raise ValueError(f"Unsupported batch op_type: {op_type}")
+                row_items.setdefault(table_name, []).append(item)
+
+            request = BatchWriteRowRequest()
+            for table_name, items in row_items.items():
+                request.add(TableInBatchWriteRowItem(table_name, items))
+
+            response = self.client.batch_write_row(request)
+            if response.is_all_succeed():
+                return True
+
+            for row in response.get_failed_of_put() + response.get_failed_of_update():
+                logger.error(f"Batch write row failed: {row.error_code} {row.error_message}")
+            return False
+
+        except Exception as e:
+            logger.error(f"Error in batch write: {e}")
+            return False
+
     # ==================== HELPER METHODS ====================
 
     def _row_to_dict(self, row) -> Dict[str, Any]:
         """Convert Tablestore row to dictionary."""
-        result = {}
-
-        # Add primary key columns
-        if row.primary_key:
-            for pk in row.primary_key:
-                result[pk[0]] = pk[1]
-
-        # Add attribute columns
+        # Primary key entries are (name, value); attribute columns are (name, value, timestamp)
+        result = dict(row.primary_key) if row.primary_key else {}
         if row.attribute_columns:
             for col in row.attribute_columns:
-                result[col[0]] = self._deserialize_value(col[1])
-
+                result[col[0]] = _deserialize_value(col[1])
         return result
 
     def _serialize_value(self, value: Any) -> Any:
         """Serialize Python value for Tablestore."""
-        if isinstance(value, datetime):
-            return value.isoformat()
-        elif isinstance(value, dict) or isinstance(value, list):
-            return json.dumps(value)
-        elif isinstance(value, bool):
-            return 1 if value else 0
-        return value
+        return _serialize_value(value)
 
     def _deserialize_value(self, value: Any) -> Any:
         """Deserialize Tablestore value to Python."""
-        if isinstance(value, str):
-            # Try to parse as JSON
-            try:
-                if value.startswith('{') or value.startswith('['):
-                    return json.loads(value)
-            except json.JSONDecodeError:
-                pass
-        return value
+        return _deserialize_value(value)
 
     # ==================== ADMIN OPERATIONS ====================
 
-    def get_all_users(self, limit: int = 100) -> List[Dict[str, Any]]:
-        """Get all users (for admin). Limited to first N users."""
+    def iter_all_users(self, page_size: int = 1000) -> Iterator[Dict[str, Any]]:
+        """Stream every user, one get_range page at a time. Raises on Tablestore errors."""
         from tablestore import INF_MIN, INF_MAX, Direction
 
-        try:
-            inclusive_start_primary_key = [('user_id', INF_MIN)]
-            exclusive_end_primary_key = [('user_id', INF_MAX)]
-
-            consumed, next_start_primary_key, row_list, next_token = self.client.get_range(
+        start_primary_key = [('user_id', INF_MIN)]
+        while start_primary_key is not None:
+            consumed, start_primary_key, row_list, next_token = self.client.get_range(
                 'users',
                 Direction.FORWARD,
-                inclusive_start_primary_key,
-                exclusive_end_primary_key,
+                start_primary_key,
+                [('user_id', INF_MAX)],
                 [],
-                limit
+                page_size
             )
+            for row in row_list:
+                yield self._row_to_dict(row)
 
-            users = [self._row_to_dict(row) for row in row_list]
-            return users
+    def get_all_users(self, limit: int = 100) -> List[Dict[str, Any]]:
+        """Get all users (for admin). Limited to first N users."""
+        try:
+            return list(itertools.islice(self.iter_all_users(page_size=min(limit, 1000)), limit))
 
         except Exception as e:
             logger.error(f"Error getting all users: {e}")
@@ -796,7 +960,7 @@ class TablestoreService:
                 500
             )
 
-            cutoff_time = datetime.now(pytz.utc) - timedelta(hours=hours_threshold)
+            cutoff_time = datetime.now(timezone.utc) - timedelta(hours=hours_threshold)
             stuck_jobs = []
 
             for row in row_list:
@@ -863,7 +1027,8 @@ class TablestoreService:
                 10000
             )
 
-            cutoff_time = datetime.now(pytz.utc) - timedelta(days=days)
+            # Canonical UTC isoformat strings: string order is time order
+            cutoff = (datetime.now(timezone.utc) - timedelta(days=days)).isoformat()
             total_seconds = 0
             total_chars = 0
             count = 0
@@ -875,15 +1040,8 @@ class TablestoreService:
                 # Check timestamp
                 timestamp = row_dict.get('timestamp', '')
                 if timestamp:
-                    try:
-                        if isinstance(timestamp, str):
-                            ts_dt = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
-                        else:
-                            ts_dt = timestamp
-
-                        if ts_dt < cutoff_time:
-                            continue
-                    except Exception:
+                    timestamp = _utc_sort_key(timestamp)
+                    if timestamp is None or timestamp < cutoff:
                         continue
 
                 # Only count successful
@@ -930,7 +1088,8 @@ class TablestoreService:
                 5000
             )
 
-            cutoff_time = datetime.now(pytz.utc) - timedelta(days=days)
+            # Canonical UTC isoformat strings: string order is time order
+            cutoff = (datetime.now(timezone.utc) - timedelta(days=days)).isoformat()
             total_stars = 0
             total_minutes = 0
             count = 0
@@ -941,15 +1100,8 @@ class TablestoreService:
                 # Check timestamp
                 timestamp = row_dict.get('timestamp', '')
                 if timestamp:
-                    try:
-                        if isinstance(timestamp, str):
-                            ts_dt = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
-                        else:
-                            ts_dt = timestamp
-
-                        if ts_dt < cutoff_time:
-                            continue
-                    except Exception:
+                    timestamp = _utc_sort_key(timestamp)
+                    if timestamp is None or timestamp < cutoff:
                         continue
 
                 total_stars += row_dict.get('stars_amount', 0)
@@ -2,38 +2,155 @@
 Utility Service - General utility functions for the Telegram Whisper Bot
 """
 
+import hashlib
+import json
 import logging
+import os
 import re
+import threading
 import time
 
-import pytz
 from datetime import datetime, timedelta, timezone
 
+try:
+    import orjson as _orjson  # optional: 2-5x faster than stdlib json
+except ImportError:
+    _orjson = None
+
+
+logger = logging.getLogger(__name__)
 
 MUTE_FILE = '/tmp/twbot_mute_until'
 
-# Trace context for correlation across services (FC processes one request at a time)
-_trace_context = {}
+# Trace context for correlation across services; per thread, since poll_queue
+# runs several jobs at once
+_trace_context = threading.local()
 
 
 def set_trace_context(trace_id=None, user_id=None):
     """Set trace context for the current request. All log records will include these fields."""
     if trace_id is not None:
-        _trace_context['trace_id'] = trace_id
+        _trace_context.trace_id = trace_id
     if user_id is not None:
-        _trace_context['user_id'] = str(user_id)
+        _trace_context.user_id = str(user_id)
 
 
 def get_trace_id():
     """Return current trace_id (for passing to downstream services)."""
-    return _trace_context.get('trace_id', '')
+    return getattr(_trace_context, 'trace_id', '')
+
+
+def json_loads(data):
+    """Parse JSON from str or bytes (orjson when installed, stdlib json otherwise)."""
+    if _orjson is not None:
+        return _orjson.loads(data)
+    if isinstance(data, (bytes, bytearray)):
+        data = data.decode('utf-8')
+    return json.loads(data)
+
+
+def json_dumps(obj) -> str:
+    """Serialize to a JSON str (orjson when installed, stdlib json otherwise)."""
+    if _orjson is not None:
+        return _orjson.dumps(obj).decode('utf-8')
+    return json.dumps(obj)
+
+
+def ceil_minutes(seconds) -> int:
+    """Billable minutes for a duration in seconds (any started minute counts)."""
+    return (int(seconds) + 59) // 60
+
+
+def file_caption(text, limit=200) -> str:
+    """Caption for a transcript sent as a file: first sentence within `limit` chars."""
+    first_dot = text.find('.', 0, limit)  # bounded scan, never walks the whole transcript
+    return text[:first_dot + 1 if first_dot > 0 else limit] + "..."
+
+
+def remove_quietly(path):
+    """os.remove() that ignores missing files — for temp-file cleanup callbacks."""
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+# Transcripts at or below this length skip LLM formatting (nothing to restructure)
+LLM_MIN_CHARS = 100
+# Short, already-punctuated ASR output is a single paragraph — the LLM adds little
+PUNCTUATED_MAX_CHARS = 500
+PUNCTUATED_MIN_PER_100 = 1.0  # sentence enders per 100 chars
+
+
+def needs_llm_formatting(text, use_code_tags=False):
+    """Decide whether a monologue transcript is worth an LLM formatting call.
+
+    Skipped for short text, for code-tag mode (text is sent verbatim in
+    <code>) and for short text the ASR already punctuated.
+    """
+    if len(text) <= LLM_MIN_CHARS or use_code_tags:
+        return False
+    if len(text) <= PUNCTUATED_MAX_CHARS:
+        enders = text.count('.') + text.count('?') + text.count('!')
+        if enders * 100 >= PUNCTUATED_MIN_PER_100 * len(text):
+            return False
+    return True
+
+
+def format_cache_key(text, **options):
+    """Exact-match key for an LLM formatting request: the text plus every option that shapes the output."""
+    opts = '|'.join(f"{name}={options[name]}" for name in sorted(options))
+    return hashlib.sha256(f"{opts}|{text}".encode()).hexdigest()
+
+
+def format_with_cache(audio_service, db, text, store=None, **options):
+    """audio_service.format_text_with_llm behind the formatted_cache table.
+
+    A re-sent file or a retried job gets its earlier output without an LLM call.
+    store(fn, *args) runs the cache write (e.g. after delivery); inline when omitted.
+    """
+    key_options = {name: value for name, value in options.items() if name != 'progress_callback'}
+    cache_key = format_cache_key(text, **key_options)
+    cached = db.get_formatted_text(cache_key)
+    if cached is not None:
+        logger.debug("[format] cache hit %s", cache_key[:12])
+        return cached
+    formatted = audio_service.format_text_with_llm(text, **options)
+    if formatted != text:  # unchanged text means the LLM was skipped or failed
+        if store is None:
+            db.put_formatted_text(cache_key, formatted)
+        else:
+            store(db.put_formatted_text, cache_key, formatted)
+    return formatted
+
+
+def create_http_session(pool_size=20, retries=3):
+    """Create a requests.Session with a keep-alive connection pool.
+
+    Connection errors and 429/5xx on idempotent requests are retried by urllib3;
+    POST retries stay with the callers (Telegram has its own 429 handling).
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=Retry(total=retries, backoff_factor=0.2,
+                          status_forcelist=(429, 500, 502, 503, 504)),
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
 
 
 class _TraceContextFilter(logging.Filter):
     """Injects trace_id and user_id into every log record."""
     def filter(self, record):
-        record.trace_id = _trace_context.get('trace_id', '')
-        record.user_id = _trace_context.get('user_id', '')
+        record.trace_id = getattr(_trace_context, 'trace_id', '')
+        record.user_id = getattr(_trace_context, 'user_id', '')
         return True
 
 
@@ -236,6 +353,7 @@ class UtilityService:
     @staticmethod
     def get_moscow_time_str():
         """Get current Moscow time as formatted string"""
+        import pytz  # admin/report paths only — kept off the cold-start import
         moscow_tz = pytz.timezone("Europe/Moscow")
         now_utc = datetime.now(timezone.utc)
         now_moscow = now_utc.astimezone(moscow_tz)
@@ -244,6 +362,7 @@ class UtilityService:
     @staticmethod
     def get_moscow_time_ranges():
         """Get time ranges for statistics (today, week, month, year) in Moscow timezone"""
+        import pytz
         moscow_tz = pytz.timezone("Europe/Moscow")
         now_moscow = datetime.now(moscow_tz)
         utc_tz = pytz.utc
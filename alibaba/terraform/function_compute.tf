@@ -39,6 +39,7 @@ resource "alicloud_fc_function" "webhook_handler" {
     MNS_ENDPOINT            = "https://${data.alicloud_account.current.id}.mns.${var.region}.aliyuncs.com"
     AUDIO_JOBS_QUEUE        = alicloud_mns_queue.audio_jobs.name
     REGION                  = var.region
+    FORMAT_CACHE            = "1"
     LOG_LEVEL               = "WARNING"
   }
 }
@@ -67,6 +68,10 @@ resource "alicloud_fc_function" "audio_processor" {
   memory_size = 1024
   timeout     = 540  # 9 minutes
 
+  # Preload SDKs and service clients before the first job on a new instance
+  initializer            = "handler.initializer"
+  initialization_timeout = 30
+
   # Code will be deployed separately
   filename = "${path.module}/../audio-processor/code.zip"
 
@@ -76,6 +81,8 @@ resource "alicloud_fc_function" "audio_processor" {
     MNS_ENDPOINT        = "https://${data.alicloud_account.current.id}.mns.${var.region}.aliyuncs.com"
     REGION              = var.region
     WHISPER_BACKEND     = "qwen-asr"
+    AUDIO_WORKERS       = "4"
+    FORMAT_CACHE        = "1"
     LOG_LEVEL           = "WARNING"
   }
 }
@@ -239,6 +239,63 @@ resource "alicloud_ots_table" "user_state" {
   }
 }
 
+# Formatted text cache (LLM output keyed by sha256 of text + options)
+resource "alicloud_ots_table" "formatted_cache" {
+  instance_name = alicloud_ots_instance.main.name
+  table_name    = "formatted_cache"
+
+  primary_key {
+    name = "cache_key"
+    type = "String"
+  }
+
+  time_to_live                  = 604800  # 7 days TTL
+  max_version                   = 1
+  deviation_cell_version_in_sec = 86400
+
+  defined_column {
+    name = "text"
+    type = "String"
+  }
+}
+
+# Daily report cache (one row per UTC date, reused by timer retries)
+resource "alicloud_ots_table" "report_cache" {
+  instance_name = alicloud_ots_instance.main.name
+  table_name    = "report_cache"
+
+  primary_key {
+    name = "report_date"
+    type = "String"
+  }
+
+  time_to_live                  = 604800  # 7 days TTL
+  max_version                   = 1
+  deviation_cell_version_in_sec = 86400
+
+  defined_column {
+    name = "body"
+    type = "String"
+  }
+}
+
+# Search index on users - lets the daily report COUNT/SUM balances server-side
+resource "alicloud_ots_search_index" "users_index" {
+  instance_name = alicloud_ots_instance.main.name
+  table_name    = alicloud_ots_table.users.table_name
+  index_name    = "users_index"
+  time_to_live  = -1
+
+  schema {
+    field_schema {
+      field_name          = "balance_minutes"
+      field_type          = "Long"
+      index               = true
+      enable_sort_and_agg = true
+    }
+  }
+}
+
 # Outputs
 output "tablestore_endpoint" {
   value = "https://${alicloud_ots_instance.main.name}.${var.region}.ots.aliyuncs.com"
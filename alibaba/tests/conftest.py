@@ -0,0 +1,25 @@
+"""Shared pytest fixtures for alibaba/tests."""
+import sys
+
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def _reset_handler_caches():
+    """Module-level caches (handler user cache, shared whisper models, ffprobe results, Qwen breaker) must not leak between tests."""
+    handler = sys.modules.get('handler')
+    if handler is not None and hasattr(handler, '_user_cache'):
+        # A previous test's background bookkeeping may still refill the cache
+        if hasattr(handler, 'drain_post_work'):
+            handler.drain_post_work()
+        handler._user_cache.clear()
+    audio = sys.modules.get('audio')
+    if audio is not None and hasattr(audio.AudioService, '_shared_whisper_models'):
+        audio.AudioService._shared_whisper_models.clear()
+    if audio is not None and hasattr(audio, '_cached_ffprobe'):
+        audio._cached_ffprobe.cache_clear()
+    if audio is not None and hasattr(audio, '_cached_pyav_probe'):
+        audio._cached_pyav_probe.cache_clear()
+    if audio is not None and hasattr(audio, '_qwen_breaker'):
+        audio._qwen_breaker.record_success()
+    yield
@@ -132,7 +132,7 @@ class TestCallGeminiPro:
         mock_response.json.return_value = {
             'choices': [{'message': {'content': 'Generated text here'}}]
         }
-        with patch.object(req_lib, 'post', return_value=mock_response) as mock_post:
+        with patch.object(req_lib.Session, 'post', return_value=mock_response) as mock_post:
             result = _call_gemini_pro('system prompt', 'user prompt')
 
         assert result == 'Generated text here'
@@ -148,7 +148,7 @@ class TestCallGeminiPro:
         mock_response = MagicMock()
         mock_response.status_code = 500
         mock_response.text = 'Internal Server Error'
-        with patch.object(req_lib, 'post', return_value=mock_response):
+        with patch.object(req_lib.Session, 'post', return_value=mock_response):
             result = _call_gemini_pro('system', 'user')
         assert result is None
 
@@ -160,14 +160,14 @@ class TestCallGeminiPro:
         mock_response.json.return_value = {
             'choices': [{'message': {'content': ''}}]
         }
-        with patch.object(req_lib, 'post', return_value=mock_response):
+        with patch.object(req_lib.Session, 'post', return_value=mock_response):
             result = _call_gemini_pro('system', 'user')
         assert result is None
 
     def test_returns_none_on_timeout(self):
         import requests as req_lib
         from main import _call_gemini_pro
-        with patch.object(req_lib, 'post', side_effect=req_lib.exceptions.Timeout("timeout")):
+        with patch.object(req_lib.Session, 'post', side_effect=req_lib.exceptions.Timeout("timeout")):
             result = _call_gemini_pro('system', 'user')
         assert result is None
 
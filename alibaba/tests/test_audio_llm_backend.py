@@ -34,7 +34,7 @@ def audio_service():
 class TestFormatTextWithAssemblyAI:
     """Test AssemblyAI LLM Gateway formatting."""
 
-    @patch('requests.post')
+    @patch('requests.Session.post')
     @patch.dict(os.environ, {'ASSEMBLYAI_API_KEY': 'fake-aai-key'})
     def test_success_path(self, mock_post):
         """Successful API call returns formatted text."""
@@ -49,7 +49,7 @@ class TestFormatTextWithAssemblyAI:
         result = service.format_text_with_assemblyai(LONG_TEXT)
         assert result == 'Formatted text.'
 
-    @patch('requests.post')
+    @patch('requests.Session.post')
     @patch.dict(os.environ, {'ASSEMBLYAI_API_KEY': 'fake-aai-key'})
     def test_payload_format(self, mock_post):
         """Verify payload: model, messages, max_tokens."""
@@ -72,7 +72,7 @@ class TestFormatTextWithAssemblyAI:
         assert payload['messages'][0]['role'] == 'system'
         assert payload['messages'][1]['role'] == 'user'
 
-    @patch('requests.post')
+    @patch('requests.Session.post')
     @patch.dict(os.environ, {'ASSEMBLYAI_API_KEY': 'my-secret-key'})
     def test_auth_header_raw_key(self, mock_post):
         """Auth header should be raw key (no Bearer prefix)."""
@@ -119,7 +119,7 @@ class TestFormatTextWithAssemblyAI:
         result = service.format_text_with_assemblyai(LONG_TEXT, _is_fallback=True)
         assert result == LONG_TEXT
 
-    @patch('requests.post')
+    @patch('requests.Session.post')
     @patch.dict(os.environ, {'ASSEMBLYAI_API_KEY': 'fake-key'})
     def test_api_error_fallback_to_qwen(self, mock_post):
         """API error (429/500) should fallback to Qwen."""
@@ -134,7 +134,7 @@ class TestFormatTextWithAssemblyAI:
             mock_qwen.assert_called_once()
             assert result == 'qwen result'
 
-    @patch('requests.post')
+    @patch('requests.Session.post')
     @patch.dict(os.environ, {'ASSEMBLYAI_API_KEY': 'fake-key'})
     def test_empty_response_fallback(self, mock_post):
         """Empty response should fallback to Qwen."""
@@ -151,7 +151,7 @@ class TestFormatTextWithAssemblyAI:
             mock_qwen.assert_called_once()
             assert result == 'qwen result'
 
-    @patch('requests.post')
+    @patch('requests.Session.post')
     @patch.dict(os.environ, {'ASSEMBLYAI_API_KEY': 'fake-key'})
     def test_code_tags_cleanup(self, mock_post):
         """Code tags should be removed when use_code_tags=False."""
@@ -167,7 +167,7 @@ class TestFormatTextWithAssemblyAI:
         assert '<code>' not in result
         assert result == 'Formatted text.'
 
-    @patch('requests.post')
+    @patch('requests.Session.post')
     @patch.dict(os.environ, {'ASSEMBLYAI_API_KEY': 'fake-key'})
     def test_truncation_returns_original(self, mock_post):
         """finish_reason='length' should return original text (truncation safety)."""
@@ -186,7 +186,7 @@ class TestFormatTextWithAssemblyAI:
         result = service.format_text_with_assemblyai(LONG_TEXT)
         assert result == LONG_TEXT  # Returns original, not truncated
 
-    @patch('requests.post')
+    @patch('requests.Session.post')
     @patch.dict(os.environ, {'ASSEMBLYAI_API_KEY': 'fake-key'})
     def test_metrics_logging(self, mock_post):
         """Metrics should be logged with 'assemblyai-llm' key."""
@@ -271,7 +271,7 @@ class TestFormatTextWithLLMRouter:
 class TestQwen3ThinkingLeak:
     """Test that Qwen3 thinking tokens never leak to users."""
 
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_enable_thinking_false_in_payload(self, mock_post, audio_service):
         """API payload must include enable_thinking: False."""
         mock_resp = MagicMock()
@@ -286,7 +286,7 @@ class TestQwen3ThinkingLeak:
         payload = mock_post.call_args[1]['json']
         assert payload['parameters']['enable_thinking'] is False
 
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_think_tags_stripped_from_text_field(self, mock_post, audio_service):
         """<think> blocks in output.text must be stripped."""
         mock_resp = MagicMock()
@@ -301,7 +301,7 @@ class TestQwen3ThinkingLeak:
         assert 'rule 3' not in result
         assert result == 'Clean formatted text.'
 
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_think_tags_stripped_multiline(self, mock_post, audio_service):
         """Multi-line <think> blocks must be stripped."""
         mock_resp = MagicMock()
@@ -320,7 +320,7 @@ class TestQwen3ThinkingLeak:
         assert 'reconsider' not in result
         assert 'Отформатированный текст' in result
 
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_choices_preferred_over_text(self, mock_post, audio_service):
         """When both choices and text present, choices.content wins."""
         mock_resp = MagicMock()
@@ -342,7 +342,7 @@ class TestQwen3ThinkingLeak:
         assert result == 'Clean content from choices.'
         assert 'mixed together' not in result
 
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_fallback_to_text_when_choices_empty(self, mock_post, audio_service):
         """If choices content is empty, fall back to text field."""
         mock_resp = MagicMock()
@@ -364,7 +364,7 @@ class TestQwen3ThinkingLeak:
 class TestFallbackChains:
     """Test fallback chains between LLM backends."""
 
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_qwen_ok_no_fallback(self, mock_post, audio_service):
         """Qwen succeeds → no fallback called."""
         mock_resp = MagicMock()
@@ -379,7 +379,7 @@ class TestFallbackChains:
             mock_aai.assert_not_called()
             assert result == 'Formatted by Qwen.'
 
-    @patch('requests.post')
+    @patch('requests.Session.post')
     @patch.dict(os.environ, {'ASSEMBLYAI_API_KEY': 'fake-key'})
     def test_qwen_fail_assemblyai_ok(self, mock_post):
         """Qwen fails → AssemblyAI succeeds (default chain)."""
@@ -401,7 +401,7 @@ class TestFallbackChains:
         result = service.format_text_with_qwen(LONG_TEXT)
         assert result == 'Formatted by AAI.'
 
-    @patch('requests.post')
+    @patch('requests.Session.post')
     @patch.dict(os.environ, {'ASSEMBLYAI_API_KEY': 'fake-key'})
     def test_assemblyai_fail_qwen_ok(self, mock_post):
         """AssemblyAI fails → Qwen succeeds (assemblyai chain)."""
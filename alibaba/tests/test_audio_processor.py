@@ -26,6 +26,8 @@ def _env_setup(monkeypatch):
     monkeypatch.setenv('ALIBABA_ACCESS_KEY', 'test-ak')
     monkeypatch.setenv('ALIBABA_SECRET_KEY', 'test-sk')
     monkeypatch.setenv('DASHSCOPE_API_KEY', 'test-key')
+    import handler
+    monkeypatch.setattr(handler, 'OWNER_ID', 999)  # read once at import time
 
 
 @pytest.fixture
@@ -59,7 +61,7 @@ def mock_tg():
 @pytest.fixture
 def mock_audio():
     audio = MagicMock()
-    audio.prepare_audio_for_asr.return_value = '/tmp/test_audio.mp3'
+    audio.prepare_audio_for_asr.return_value = ('/tmp/test_audio.mp3', 30.0)
     audio.transcribe_audio.return_value = 'Transcribed text from simple ASR path.'
     audio.transcribe_with_diarization.return_value = ('Diarized raw text.', [
         {'speaker_id': 1, 'text': 'Hello', 'start': 0, 'end': 5},
@@ -351,20 +353,25 @@ class TestProcessJobSuccess:
         """Job status updated to 'completed' after success."""
         import handler
         result = handler.process_job(_make_job_data())
+        handler.drain_post_work()
 
         assert result['ok'] is True
-        # Last update_job call should set status='completed'
-        final_call = mock_db.update_job.call_args_list[-1]
-        assert final_call[0][1]['status'] == 'completed'
+        # Completion goes out in the same BatchWriteRow as the log row
+        ops = mock_db.batch_write.call_args[0][0]
+        table, primary_key, attributes, op_type = ops[-1]
+        assert (table, primary_key, op_type) == ('audio_jobs', [('job_id', 'job-001')], 'update')
+        assert attributes['status'] == 'completed'
 
     def test_transcription_logged(self, patch_services, mock_db, mock_tg, mock_audio):
         """log_transcription called with correct user_id and duration."""
         import handler
         result = handler.process_job(_make_job_data(duration=30))
+        handler.drain_post_work()
 
         assert result['ok'] is True
-        mock_db.log_transcription.assert_called_once()
-        log_data = mock_db.log_transcription.call_args[0][0]
+        mock_db.transcription_log_op.assert_called_once()
+        log_data = mock_db.transcription_log_op.call_args[0][0]
+        assert mock_db.batch_write.call_args[0][0][0] is mock_db.transcription_log_op.return_value
         assert log_data['user_id'] == '12345'
         assert log_data['duration'] == 30
         assert log_data['status'] == 'completed'
@@ -584,6 +591,7 @@ class TestTempFileCleanup:
              patch.object(handler, 'get_audio_service', return_value=mock_audio), \
              patch('os.remove') as mock_remove:
             handler.process_job(_make_job_data())
+            handler.drain_post_work()
 
         # Both local_path and converted_path should be cleaned
         removed_paths = [c[0][0] for c in mock_remove.call_args_list]
@@ -593,7 +601,7 @@ class TestTempFileCleanup:
     def test_cleanup_on_error(self, mock_db, mock_tg, mock_audio):
         """Temp files are cleaned up even when processing fails."""
         import handler
-        mock_audio.prepare_audio_for_asr.return_value = '/tmp/test_audio.mp3'
+        mock_audio.prepare_audio_for_asr.return_value = ('/tmp/test_audio.mp3', 30.0)
         mock_audio.transcribe_audio.side_effect = Exception('ASR failed')
 
         with patch.object(handler, 'get_db_service', return_value=mock_db), \
@@ -601,6 +609,7 @@ class TestTempFileCleanup:
              patch.object(handler, 'get_audio_service', return_value=mock_audio), \
              patch('os.remove') as mock_remove:
             handler.process_job(_make_job_data())
+            handler.drain_post_work()
 
         # Cleanup should still happen via finally block
         removed_paths = [c[0][0] for c in mock_remove.call_args_list]
@@ -639,6 +648,7 @@ class TestLowBalanceWarnings:
              patch.object(handler, 'get_audio_service', return_value=mock_audio), \
              patch('os.remove'):
             result = handler.process_job(_make_job_data(duration=60))
+            handler.drain_post_work()
 
         assert result['ok'] is True
         # Find low balance warning (contains /buy_minutes and 'Низкий баланс')
@@ -662,6 +672,7 @@ class TestLowBalanceWarnings:
              patch.object(handler, 'get_audio_service', return_value=mock_audio), \
              patch('os.remove'):
             result = handler.process_job(_make_job_data(duration=60))
+            handler.drain_post_work()
 
         assert result['ok'] is True
         # Find exhausted warning (contains 'исчерпан')
@@ -676,6 +687,7 @@ class TestLowBalanceWarnings:
         import handler
 
         result = handler.process_job(_make_job_data(duration=30))
+        handler.drain_post_work()
 
         assert result['ok'] is True
         # No warning calls (only result delivery, no 'Низкий баланс' or 'исчерпан')
@@ -894,9 +906,9 @@ class TestDurationZeroDetection:
     """Test document with duration=0 (forwarded audio files)."""
 
     def test_duration_zero_detects_real_duration(self, mock_db, mock_tg, mock_audio):
-        """duration=0 triggers get_audio_duration for real length detection."""
+        """duration=0 takes the real length from the conversion step (no extra ffprobe)."""
         import handler
-        mock_audio.get_audio_duration.return_value = 25.0
+        mock_audio.prepare_audio_for_asr.return_value = ('/tmp/test_audio.mp3', 25.0)
 
         with patch.object(handler, 'get_db_service', return_value=mock_db), \
              patch.object(handler, 'get_telegram_service', return_value=mock_tg), \
@@ -905,13 +917,14 @@ class TestDurationZeroDetection:
             result = handler.process_job(_make_job_data(duration=0))
 
         assert result['ok'] is True
-        # get_audio_duration called at least once for detection
-        mock_audio.get_audio_duration.assert_called()
+        # 25s < 60s -> simple ASR
+        mock_audio.transcribe_audio.assert_called_once()
+        mock_audio.transcribe_with_diarization.assert_not_called()
 
     def test_duration_zero_insufficient_balance_rejected(self, mock_db, mock_tg, mock_audio):
         """duration=0, real=1800s (30 min), balance=5 -> rejection."""
         import handler
-        mock_audio.get_audio_duration.return_value = 1800.0
+        mock_audio.prepare_audio_for_asr.return_value = ('/tmp/test_audio.mp3', 1800.0)
         mock_db.get_user.return_value = {
             'balance_minutes': 5,
             'settings': '{}',
@@ -930,7 +943,7 @@ class TestDurationZeroDetection:
     def test_duration_zero_uses_detected_for_balance(self, mock_db, mock_tg, mock_audio):
         """duration=0, real=90s -> balance deducted for 2 minutes (ceil(90/60))."""
         import handler
-        mock_audio.get_audio_duration.return_value = 90.0
+        mock_audio.prepare_audio_for_asr.return_value = ('/tmp/test_audio.mp3', 90.0)
 
         with patch.object(handler, 'get_db_service', return_value=mock_db), \
              patch.object(handler, 'get_telegram_service', return_value=mock_tg), \
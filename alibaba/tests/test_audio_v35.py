@@ -130,7 +130,7 @@ class TestConvertToMp3:
     @patch.object(AudioService, 'get_audio_duration', return_value=30.0)
     def test_has_vn_flag(self, mock_duration, mock_run, mock_size, audio_service, tmp_path):
         """convert_to_mp3 must include -vn flag."""
-        mock_run.return_value = MagicMock(returncode=0)
+        mock_run.return_value = MagicMock(returncode=0, stderr='')
         input_path = str(tmp_path / "input.m4a")
         output_path = str(tmp_path / "output.mp3")
         open(input_path, 'w').close()
@@ -145,7 +145,7 @@ class TestConvertToMp3:
     @patch.object(AudioService, 'get_audio_duration', return_value=30.0)
     def test_has_libmp3lame_codec(self, mock_duration, mock_run, mock_size, audio_service, tmp_path):
         """convert_to_mp3 must use libmp3lame codec."""
-        mock_run.return_value = MagicMock(returncode=0)
+        mock_run.return_value = MagicMock(returncode=0, stderr='')
         input_path = str(tmp_path / "input.m4a")
         output_path = str(tmp_path / "output.mp3")
         open(input_path, 'w').close()
@@ -160,7 +160,7 @@ class TestConvertToMp3:
     @patch.object(AudioService, 'get_audio_duration', return_value=5.0)
     def test_short_audio_uses_24k(self, mock_duration, mock_run, mock_size, audio_service, tmp_path):
         """Short audio (<10s) should use 24k bitrate."""
-        mock_run.return_value = MagicMock(returncode=0)
+        mock_run.return_value = MagicMock(returncode=0, stderr='')
         input_path = str(tmp_path / "input.wav")
         output_path = str(tmp_path / "output.mp3")
         open(input_path, 'w').close()
@@ -176,7 +176,7 @@ class TestConvertToMp3:
     @patch.object(AudioService, 'get_audio_duration', return_value=1200.0)
     def test_long_audio_uses_32k(self, mock_duration, mock_run, mock_size, audio_service, tmp_path):
         """Long audio (>10min) should use 32k bitrate (compressed tier)."""
-        mock_run.return_value = MagicMock(returncode=0)
+        mock_run.return_value = MagicMock(returncode=0, stderr='')
         input_path = str(tmp_path / "input.wav")
         output_path = str(tmp_path / "output.mp3")
         open(input_path, 'w').close()
@@ -193,41 +193,49 @@ class TestConvertToMp3:
 class TestPrepareAudioForAsr:
     """Test prepare_audio_for_asr pipeline."""
 
-    @patch.object(AudioService, 'convert_to_mp3', return_value='/tmp/converted.mp3')
+    @patch.object(AudioService, '_convert_to_mp3', return_value=('/tmp/converted.mp3', 42.0))
     @patch.object(AudioService, 'is_video_file', return_value=False)
     def test_audio_file_direct_conversion(self, mock_video, mock_convert, audio_service):
-        """Regular audio goes directly to convert_to_mp3."""
+        """Regular audio goes directly to MP3 conversion, duration returned alongside."""
         result = audio_service.prepare_audio_for_asr('/tmp/test.ogg')
-        assert result == '/tmp/converted.mp3'
+        assert result == ('/tmp/converted.mp3', 42.0)
         mock_convert.assert_called_once_with('/tmp/test.ogg')
 
-    @patch.object(AudioService, 'convert_to_mp3', return_value='/tmp/converted.mp3')
-    @patch.object(AudioService, 'extract_audio_from_video', return_value='/tmp/extracted.mp3')
-    @patch.object(AudioService, 'is_video_file', return_value=True)
-    @patch('os.path.exists', return_value=True)
-    @patch('os.remove')
-    def test_video_file_extracts_then_converts(self, mock_rm, mock_exists,
-                                                mock_video, mock_extract, mock_convert,
-                                                audio_service):
-        """Video file extracts audio then converts."""
-        result = audio_service.prepare_audio_for_asr('/tmp/test.mp4')
-        assert result == '/tmp/converted.mp3'
-        mock_extract.assert_called_once_with('/tmp/test.mp4')
-        mock_convert.assert_called_once_with('/tmp/extracted.mp3')
-
-    @patch.object(AudioService, 'extract_audio_from_video', return_value=None)
-    @patch.object(AudioService, 'is_video_file', return_value=True)
-    def test_video_extraction_failure(self, mock_video, mock_extract, audio_service):
-        """Returns None if video audio extraction fails."""
+    @patch.object(AudioService, '_convert_to_mp3', return_value=('/tmp/converted.mp3', 42.0))
+    @patch.object(AudioService, 'extract_audio_from_video')
+    @patch.object(AudioService, 'is_video_file')
+    def test_video_file_converts_in_one_pass(self, mock_video, mock_extract, mock_convert,
+                                             audio_service):
+        """Video goes straight to the MP3 conversion, which drops the video stream."""
         result = audio_service.prepare_audio_for_asr('/tmp/test.mp4')
-        assert result is None
+        assert result == ('/tmp/converted.mp3', 42.0)
+        mock_convert.assert_called_once_with('/tmp/test.mp4')
+        mock_video.assert_not_called()
+        mock_extract.assert_not_called()
 
-    @patch.object(AudioService, 'convert_to_mp3', return_value=None)
+    @patch.object(AudioService, '_convert_to_mp3', return_value=(None, 0.0))
     @patch.object(AudioService, 'is_video_file', return_value=False)
     def test_conversion_failure(self, mock_video, mock_convert, audio_service):
-        """Returns None if MP3 conversion fails."""
+        """Returns (None, 0.0) if MP3 conversion fails."""
         result = audio_service.prepare_audio_for_asr('/tmp/test.ogg')
-        assert result is None
+        assert result == (None, 0.0)
+
+    @patch('os.path.getsize', return_value=1000)
+    @patch('subprocess.run')
+    @patch.object(AudioService, 'get_audio_duration', return_value=600.0)
+    def test_duration_parsed_from_ffmpeg_stderr(self, mock_duration, mock_run, mock_size,
+                                                audio_service, tmp_path):
+        """Duration printed by ffmpeg wins over the ffprobe value (600s fallback)."""
+        mock_run.return_value = MagicMock(
+            returncode=0,
+            stderr='Input #0, ogg, from \'in.ogg\':\n  Duration: 00:01:23.45, start: 0.0, bitrate: 30 kb/s\n')
+        input_path = str(tmp_path / "input.ogg")
+        open(input_path, 'w').close()
+
+        path, duration = audio_service._convert_to_mp3(input_path, str(tmp_path / "out.mp3"))
+
+        assert path == str(tmp_path / "out.mp3")
+        assert duration == pytest.approx(83.45)
 
 
 # ============== split_audio_chunks Tests ==============
@@ -254,7 +262,7 @@ class TestSplitAudioChunks:
     def test_splits_into_correct_count(self, mock_duration, mock_exists,
                                         mock_size, mock_run, audio_service):
         """320s audio with 150s chunks should produce 3 chunks."""
-        mock_run.return_value = MagicMock(returncode=0)
+        mock_run.return_value = MagicMock(returncode=0, stderr='')
 
         result = audio_service.split_audio_chunks('/tmp/long.mp3')
         # 320 / 150 = 2.13 → 3 chunks (0-150, 150-300, 300-320)
@@ -294,7 +302,8 @@ class TestChunkedTranscription:
     def test_chunked_concatenates_results(self, mock_split, mock_single, audio_service):
         """_transcribe_chunked concatenates results from all chunks."""
         mock_split.return_value = ['/tmp/c0.mp3', '/tmp/c1.mp3', '/tmp/c2.mp3']
-        mock_single.side_effect = ["Part one.", "Part two.", "Part three."]
+        parts = {'/tmp/c0.mp3': "Part one.", '/tmp/c1.mp3': "Part two.", '/tmp/c2.mp3': "Part three."}
+        mock_single.side_effect = lambda path, language: parts[path]
 
         with patch('os.path.exists', return_value=False):
             result = audio_service._transcribe_chunked('/tmp/test.mp3', 'ru', 400.0)
@@ -307,7 +316,7 @@ class TestChunkedTranscription:
     def test_chunked_progress_callback(self, mock_split, mock_single, audio_service):
         """_transcribe_chunked calls progress_callback for each chunk."""
         mock_split.return_value = ['/tmp/c0.mp3', '/tmp/c1.mp3']
-        mock_single.side_effect = ["First", "Second"]
+        mock_single.side_effect = lambda path, language: {'/tmp/c0.mp3': "First", '/tmp/c1.mp3': "Second"}[path]
         callback = MagicMock()
 
         with patch('os.path.exists', return_value=False):
@@ -321,12 +330,19 @@ class TestChunkedTranscription:
     def test_chunked_graceful_degradation(self, mock_split, mock_single, audio_service):
         """If some chunks fail (<50%), return partial result."""
         mock_split.return_value = ['/tmp/c0.mp3', '/tmp/c1.mp3', '/tmp/c2.mp3', '/tmp/c3.mp3']
-        mock_single.side_effect = [
-            "Part one.",
-            RuntimeError("API error"),
-            "Part three.",
-            "Part four."
-        ]
+        outcomes = {
+            '/tmp/c0.mp3': "Part one.",
+            '/tmp/c1.mp3': RuntimeError("API error"),
+            '/tmp/c2.mp3': "Part three.",
+            '/tmp/c3.mp3': "Part four.",
+        }
+
+        def single(path, language):
+            if isinstance(outcomes[path], Exception):
+                raise outcomes[path]
+            return outcomes[path]
+
+        mock_single.side_effect = single
 
         with patch('os.path.exists', return_value=False):
             result = audio_service._transcribe_chunked('/tmp/test.mp3', 'ru', 600.0)
@@ -340,11 +356,18 @@ class TestChunkedTranscription:
     def test_chunked_too_many_failures_raises(self, mock_split, mock_single, audio_service):
         """If >50% chunks fail, raise RuntimeError."""
         mock_split.return_value = ['/tmp/c0.mp3', '/tmp/c1.mp3', '/tmp/c2.mp3']
-        mock_single.side_effect = [
-            RuntimeError("fail 1"),
-            RuntimeError("fail 2"),
-            "Part three.",
-        ]
+        outcomes = {
+            '/tmp/c0.mp3': RuntimeError("fail 1"),
+            '/tmp/c1.mp3': RuntimeError("fail 2"),
+            '/tmp/c2.mp3': "Part three.",
+        }
+
+        def single(path, language):
+            if isinstance(outcomes[path], Exception):
+                raise outcomes[path]
+            return outcomes[path]
+
+        mock_single.side_effect = single
 
         with patch('os.path.exists', return_value=False):
             with pytest.raises(RuntimeError, match="Too many chunks failed"):
@@ -361,6 +384,25 @@ class TestChunkedTranscription:
             with pytest.raises(ValueError, match="Transcription empty"):
                 audio_service._transcribe_chunked('/tmp/test.mp3', 'ru', 200.0)
 
+    @patch.object(AudioService, '_transcribe_single_qwen_asr')
+    @patch.object(AudioService, 'split_audio_chunks')
+    def test_chunked_requests_run_concurrently(self, mock_split, mock_single, audio_service):
+        """Chunk requests overlap instead of running one after another."""
+        import threading
+        mock_split.return_value = ['/tmp/c0.mp3', '/tmp/c1.mp3', '/tmp/c2.mp3']
+        barrier = threading.Barrier(3, timeout=5)
+
+        def single(path, language):
+            barrier.wait()  # times out unless all three are in flight together
+            return path[-6:-4]
+
+        mock_single.side_effect = single
+
+        with patch('os.path.exists', return_value=False):
+            result = audio_service._transcribe_chunked('/tmp/test.mp3', 'ru', 400.0)
+
+        assert result == "c0 c1 c2"
+
 
 # ============== transcribe_audio with progress_callback ==============
 
@@ -379,7 +421,7 @@ class TestTranscribeAudioCallback:
 class TestFormatWithChunkedFlag:
     """Test is_chunked parameter in LLM formatting."""
 
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_qwen_prompt_without_chunked(self, mock_post, audio_service):
         """Without is_chunked, prompt should not contain stitching instruction."""
         mock_response = MagicMock()
@@ -396,7 +438,7 @@ class TestFormatWithChunkedFlag:
         prompt = sent_payload['input']['messages'][0]['content']
         assert 'артефакты склейки' not in prompt
 
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_qwen_prompt_with_chunked(self, mock_post, audio_service):
         """With is_chunked=True, prompt must contain stitching instruction."""
         mock_response = MagicMock()
@@ -413,7 +455,7 @@ class TestFormatWithChunkedFlag:
         prompt = sent_payload['input']['messages'][0]['content']
         assert 'артефакты склейки' in prompt
 
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_qwen_prompt_has_toponym_instruction(self, mock_post, audio_service):
         """Prompt must contain toponym instruction regardless of is_chunked."""
         mock_response = MagicMock()
@@ -331,7 +331,7 @@ class TestTranscribeWithDiarization:
 class TestFormatWithDialogue:
     """Test that is_dialogue parameter is properly propagated."""
 
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_qwen_with_is_dialogue(self, mock_post, audio_service):
         """Verify is_dialogue triggers dialogue instruction in prompt."""
         mock_response = MagicMock()
@@ -914,9 +914,10 @@ class TestParseSegments:
 class TestASRLanguageHints:
     """Verify qwen3-asr-flash sends language_hints."""
 
-    @patch('requests.post')
-    def test_asr_payload_contains_language_hints(self, mock_post, audio_service):
+    def test_asr_payload_contains_language_hints(self, audio_service):
         """Verify qwen3-asr-flash payload includes language_hints: ['ru']."""
+        audio_service._session = MagicMock()
+        mock_post = audio_service._session.post
         mock_response = MagicMock()
         mock_response.status_code = 200
         mock_response.json.return_value = {
@@ -1027,7 +1028,7 @@ class TestMNSFallback:
 # ============== Diarization Debug Tests ==============
 
 class TestDiarizationDebug:
-    """Test _diarization_debug recording and get_diarization_debug() formatting."""
+    """Test per-call diarization debug recording and get_diarization_debug() formatting."""
 
     def _make_transcription_result(self, text="Hello"):
         """Helper: create a valid transcription result dict."""
@@ -1078,10 +1079,10 @@ class TestDiarizationDebug:
         mock_session.get.side_effect = get_router
         audio_service._session = mock_session
 
+        dbg = {}
         with patch('time.sleep'):
-            raw_text, segments = audio_service.transcribe_with_diarization('/tmp/test.mp3')
+            raw_text, segments = audio_service.transcribe_with_diarization('/tmp/test.mp3', debug=dbg)
 
-        dbg = audio_service._diarization_debug
         assert 'pass1_result' in dbg
         assert 'pass2_result' in dbg
         assert dbg['pass1_result'] == 'ok'
@@ -1138,17 +1139,17 @@ class TestDiarizationDebug:
         mock_session.get.side_effect = get_router
         audio_service._session = mock_session
 
+        dbg = {}
         with patch('time.sleep'):
-            raw_text, segments = audio_service.transcribe_with_diarization('/tmp/test.mp3')
+            raw_text, segments = audio_service.transcribe_with_diarization('/tmp/test.mp3', debug=dbg)
 
-        dbg = audio_service._diarization_debug
         assert dbg['pass2_result'] == 'task_failed: Model not exist'
         assert dbg['fallback'] == 'pass2_failed_using_pass1_text'
         assert 'pass2_poll_body' in dbg
 
     def test_get_diarization_debug_format(self, audio_service):
         """get_diarization_debug() returns formatted text with key sections."""
-        audio_service._diarization_debug = {
+        dbg = {
             'pass1_result': 'ok',
             'pass1_submit_status': 200,
             'pass1_task_id': 'task-aaa',
@@ -1160,7 +1161,7 @@ class TestDiarizationDebug:
             'fallback': 'pass2_failed_using_pass1_text',
         }
 
-        text = audio_service.get_diarization_debug()
+        text = audio_service.get_diarization_debug(dbg)
         assert text is not None
         assert 'DIARIZATION DEBUG' in text
         assert 'Pass 1' in text
@@ -1172,26 +1173,25 @@ class TestDiarizationDebug:
 
     def test_debug_html_escaped(self, audio_service):
         """HTML special chars in API response are escaped."""
-        audio_service._diarization_debug = {
+        dbg = {
             'pass1_result': 'ok',
             'pass2_result': 'submit_failed',
             'pass2_submit_body': '{"error": "<script>alert(1)</script>"}',
             'fallback': 'both_empty',
         }
 
-        text = audio_service.get_diarization_debug()
+        text = audio_service.get_diarization_debug(dbg)
         assert text is not None
         assert '<script>' not in text
         assert '&lt;script&gt;' in text
 
     def test_get_diarization_debug_empty(self, audio_service):
         """Returns None when no debug data."""
-        audio_service._diarization_debug = {}
-        assert audio_service.get_diarization_debug() is None
+        assert audio_service.get_diarization_debug({}) is None
 
     def test_debug_assemblyai_backend(self, audio_service):
         """Debug output for AssemblyAI backend."""
-        audio_service._diarization_debug = {
+        dbg = {
             'backend': 'assemblyai',
             'model': 'universal-3-pro',
             'spk_segments': 3,
@@ -1200,7 +1200,7 @@ class TestDiarizationDebug:
             'merged_detail': 'spk0:Привет; spk1:Здравствуйте',
             'fallback': 'none',
         }
-        text = audio_service.get_diarization_debug()
+        text = audio_service.get_diarization_debug(dbg)
         assert 'ASSEMBLYAI' in text
         assert 'universal-3-pro' in text
         assert 'segments: 3' in text
@@ -1211,7 +1211,7 @@ class TestDiarizationDebug:
 
     def test_debug_gemini_backend(self, audio_service):
         """Debug output for Gemini backend."""
-        audio_service._diarization_debug = {
+        dbg = {
             'backend': 'gemini',
             'model': 'gemini-3-flash-preview',
             'spk_segments': 5,
@@ -1219,7 +1219,7 @@ class TestDiarizationDebug:
             'merged_detail': 'spk0:Привет; spk1:Да; spk2:Нет',
             'fallback': 'none',
         }
-        text = audio_service.get_diarization_debug()
+        text = audio_service.get_diarization_debug(dbg)
         assert 'GEMINI' in text
         assert 'gemini-3-flash-preview' in text
         assert 'segments: 5' in text
@@ -1265,8 +1265,9 @@ class TestDiarizeAssemblyAI:
                 {'speaker': 'B', 'text': 'Здравствуйте.', 'start': 2000, 'end': 5000},
             ]
         })
+        dbg = {}
         with patch.dict(os.environ, {'ASSEMBLYAI_API_KEY': 'test-key'}):
-            raw, segs = audio_service._diarize_assemblyai('/tmp/test.mp3')
+            raw, segs = audio_service._diarize_assemblyai('/tmp/test.mp3', debug=dbg)
 
         assert raw == 'Привет. Здравствуйте.'
         assert len(segs) == 2
@@ -1276,8 +1277,8 @@ class TestDiarizeAssemblyAI:
         assert segs[1]['text'] == 'Здравствуйте.'
         assert segs[0]['begin_time'] == 0
         assert segs[1]['end_time'] == 5000
-        assert audio_service._diarization_debug['backend'] == 'assemblyai'
-        assert audio_service._diarization_debug['transcript_id'] == 'tx_123'
+        assert dbg['backend'] == 'assemblyai'
+        assert dbg['transcript_id'] == 'tx_123'
 
     @patch('builtins.open', MagicMock(return_value=MagicMock(
         __enter__=MagicMock(return_value=MagicMock(read=MagicMock(return_value=b'fake-audio'))),
@@ -1301,14 +1302,15 @@ class TestDiarizeAssemblyAI:
                 {'speaker': 'C', 'text': 'Hey', 'start': 2000, 'end': 3000},
             ]
         })
+        dbg = {}
         with patch.dict(os.environ, {'ASSEMBLYAI_API_KEY': 'test-key'}):
-            raw, segs = audio_service._diarize_assemblyai('/tmp/test.mp3')
+            raw, segs = audio_service._diarize_assemblyai('/tmp/test.mp3', debug=dbg)
 
         assert len(segs) == 3
         assert segs[0]['speaker_id'] == 0
         assert segs[1]['speaker_id'] == 1
         assert segs[2]['speaker_id'] == 2
-        assert audio_service._diarization_debug['unique_speakers'] == 3
+        assert dbg['unique_speakers'] == 3
 
     def test_no_api_key(self, audio_service):
         """Returns (None, []) when ASSEMBLYAI_API_KEY not set."""
@@ -1417,11 +1419,12 @@ class TestDiarizeAssemblyAI:
         })
         # Simulate wall-clock: first call sets deadline (0+240=240), then 250 > 240 → exit
         mock_monotonic.side_effect = [0, 250]
+        dbg = {}
         with patch.dict(os.environ, {'ASSEMBLYAI_API_KEY': 'test-key'}):
-            raw, segs = audio_service._diarize_assemblyai('/tmp/test.mp3')
+            raw, segs = audio_service._diarize_assemblyai('/tmp/test.mp3', debug=dbg)
         assert raw is None
         assert segs == []
-        assert audio_service._diarization_debug['error'] == 'polling_timeout'
+        assert dbg['error'] == 'polling_timeout'
 
     @patch('builtins.open', MagicMock(return_value=MagicMock(
         __enter__=MagicMock(return_value=MagicMock(read=MagicMock(return_value=b'fake-audio'))),
@@ -1481,7 +1484,7 @@ class TestDiarizeGemini:
         __enter__=MagicMock(return_value=MagicMock(read=MagicMock(return_value=b'fake-audio'))),
         __exit__=MagicMock(return_value=False)
     )))
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_success(self, mock_post, audio_service):
         """Full success path with structured output."""
         mock_post.return_value = MagicMock(status_code=200, json=lambda: {
@@ -1493,8 +1496,9 @@ class TestDiarizeGemini:
                 ]
             })}]}}]
         })
+        dbg = {}
         with patch.dict(os.environ, {'GOOGLE_API_KEY': 'test-key'}):
-            raw, segs = audio_service._diarize_gemini('/tmp/test.mp3')
+            raw, segs = audio_service._diarize_gemini('/tmp/test.mp3', debug=dbg)
 
         assert len(segs) == 3
         assert segs[0]['speaker_id'] == 0
@@ -1503,8 +1507,8 @@ class TestDiarizeGemini:
         assert segs[0]['text'] == 'Привет.'
         assert 'Привет.' in raw
         assert 'Здравствуйте.' in raw
-        assert audio_service._diarization_debug['backend'] == 'gemini'
-        assert audio_service._diarization_debug['unique_speakers'] == 2
+        assert dbg['backend'] == 'gemini'
+        assert dbg['unique_speakers'] == 2
         # Gemini doesn't provide timestamps
         assert segs[0]['begin_time'] == 0
 
@@ -1521,7 +1525,7 @@ class TestDiarizeGemini:
         __enter__=MagicMock(return_value=MagicMock(read=MagicMock(return_value=b'fake-audio'))),
         __exit__=MagicMock(return_value=False)
     )))
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_api_failure(self, mock_post, audio_service):
         """Gemini API returns non-200."""
         mock_post.return_value = MagicMock(status_code=500, text='Internal Server Error')
@@ -1534,7 +1538,7 @@ class TestDiarizeGemini:
         __enter__=MagicMock(return_value=MagicMock(read=MagicMock(return_value=b'fake-audio'))),
         __exit__=MagicMock(return_value=False)
     )))
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_gemini_api_key_env(self, mock_post, audio_service):
         """Accepts GEMINI_API_KEY as alternative env var."""
         mock_post.return_value = MagicMock(status_code=200, json=lambda: {
@@ -1552,7 +1556,7 @@ class TestDiarizeGemini:
         __enter__=MagicMock(return_value=MagicMock(read=MagicMock(return_value=b'fake-audio'))),
         __exit__=MagicMock(return_value=False)
     )))
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_empty_segments_filtered(self, mock_post, audio_service):
         """Empty text segments are filtered out."""
         mock_post.return_value = MagicMock(status_code=200, json=lambda: {
@@ -1784,7 +1788,7 @@ class TestDebugWordLevel:
 
     def test_debug_shows_timeline_normalized(self, audio_service):
         """Debug output includes timeline_normalized and txt_mode when present."""
-        audio_service._diarization_debug = {
+        dbg = {
             'spk_segments': 5,
             'txt_segments': 150,
             'txt_word_level': True,
@@ -1792,7 +1796,7 @@ class TestDebugWordLevel:
             'spk_detail': 'spk0[0-30000]',
             'txt_detail': '[0-500]Привет',
         }
-        debug_text = audio_service.get_diarization_debug()
+        debug_text = audio_service.get_diarization_debug(dbg)
         assert 'txt_mode: word-level' in debug_text
         assert 'timeline_normalized: 120000ms/118500ms' in debug_text
         assert 'txt_segments: 150' in debug_text
@@ -187,14 +187,14 @@ class TestFormatTextWithLlmChunking:
     """Tests for format_text_with_llm() with chunking integration."""
 
     def test_short_text_no_chunking(self, audio_service):
-        text = "Привет мир."
+        text = "Привет мир как дела у тебя сегодня всё ли хорошо дома."
 
         def mock_qwen(t, *args, **kwargs):
-            return "Привет, мир."
+            return "Привет, мир! Как дела у тебя сегодня, всё ли хорошо дома?"
 
         audio_service.format_text_with_qwen = mock_qwen
         result = audio_service.format_text_with_llm(text)
-        assert result == "Привет, мир."
+        assert result == "Привет, мир! Как дела у тебя сегодня, всё ли хорошо дома?"
 
     def test_long_text_triggers_chunking(self, audio_service):
         text = "Длинное предложение. " * 300
@@ -4,8 +4,9 @@ Unit tests for MNSService, MNSPublisher, PublishFuture (alibaba/shared/mns_servi
 
 Covers:
 - MNSService initialization (success, ImportError)
-- publish_message (success, delay, MNS exception, generic exception, Message import fallback)
+- publish_message (success, delay, MNS exception, generic exception, Message import fallback, cached Message resolution)
 - receive_message (success, no messages, MNS error, JSON parse error)
+- batch_receive_messages (success, no messages, unparsable message skipped)
 - delete_message (success, MNS failure, generic failure)
 - change_message_visibility (success, MNS failure, generic failure)
 - get_queue_attributes (success, MNS failure, generic failure)
@@ -19,6 +20,7 @@ import os
 import sys
 import json
 import base64
+import threading
 from unittest.mock import patch, MagicMock
 
 import pytest
@@ -114,6 +116,7 @@ class TestPublishMessage:
     def _make_service(self):
         """Create an MNSService with mocked internals."""
         svc = MNSService.__new__(MNSService)
+        svc._lock = threading.Lock()
         svc.account = MagicMock()
         svc.queue = MagicMock()
         svc.queue_name = 'test-queue'
@@ -197,6 +200,21 @@ class TestPublishMessage:
         body = json.loads(sent_msg.message_body)
         assert body['ts'] == str(dt)
 
+    def test_message_class_resolved_once(self):
+        """The version-dependent Message import runs once, not on every publish."""
+        import mns_service
+        svc = self._make_service()
+        svc.queue.send_message.return_value = MagicMock(message_id='m')
+        mns_service._mns_message_class.cache_clear()
+
+        svc.publish_message({'a': 1})
+        svc.publish_message({'a': 2})
+
+        info = mns_service._mns_message_class.cache_info()
+        assert info.misses == 1
+        assert info.hits == 1
+        assert mns_service._mns_message_class() is FakeMessage
+
 
 # ─────────────────────────────────────────────────
 # MNSService — receive_message
@@ -207,6 +225,7 @@ class TestReceiveMessage:
 
     def _make_service(self):
         svc = MNSService.__new__(MNSService)
+        svc._lock = threading.Lock()
         svc.account = MagicMock()
         svc.queue = MagicMock()
         svc.queue_name = 'test-queue'
@@ -270,6 +289,80 @@ class TestReceiveMessage:
         assert result is None
 
 
+# ─────────────────────────────────────────────────
+# MNSService — batch_receive_messages
+# ─────────────────────────────────────────────────
+
+class TestBatchReceiveMessages:
+    """Tests for MNSService.batch_receive_messages."""
+
+    def _make_service(self):
+        svc = MNSService.__new__(MNSService)
+        svc._lock = threading.Lock()
+        svc.account = MagicMock()
+        svc.queue = MagicMock()
+        svc.queue_name = 'test-queue'
+        svc.endpoint = 'https://test.mns.aliyuncs.com'
+        return svc
+
+    def _make_msg(self, body, msg_id):
+        msg = MagicMock()
+        msg.message_body = body
+        msg.message_id = msg_id
+        msg.receipt_handle = f'rh-{msg_id}'
+        msg.dequeue_count = 1
+        msg.enqueue_time = 1700000000
+        return msg
+
+    def test_batch_success(self):
+        """batch_receive_messages parses every message in the batch."""
+        svc = self._make_service()
+        svc.queue.batch_receive_message.return_value = [
+            self._make_msg(json.dumps({'job_id': '1'}), 'm1'),
+            self._make_msg(json.dumps({'job_id': '2'}), 'm2'),
+        ]
+
+        result = svc.batch_receive_messages(batch_size=4, wait_seconds=1)
+
+        assert [m['data']['job_id'] for m in result] == ['1', '2']
+        assert result[1]['receipt_handle'] == 'rh-m2'
+        svc.queue.batch_receive_message.assert_called_once_with(4, 1)
+
+    def test_batch_size_clamped(self):
+        """batch_size is clamped to the MNS limit of 16."""
+        svc = self._make_service()
+        svc.queue.batch_receive_message.return_value = []
+
+        svc.batch_receive_messages(batch_size=50)
+
+        svc.queue.batch_receive_message.assert_called_once_with(16, 1)
+
+    def test_batch_no_messages(self):
+        """batch_receive_messages returns [] when MessageNotExist."""
+        svc = self._make_service()
+
+        with patch.dict('sys.modules', {
+            'mns.mns_exception': MagicMock(MNSExceptionBase=FakeMNSException)
+        }):
+            svc.queue.batch_receive_message.side_effect = FakeMNSException("MessageNotExist")
+            result = svc.batch_receive_messages()
+
+        assert result == []
+
+    def test_batch_skips_unparsable(self):
+        """Malformed message body is skipped, the rest are returned."""
+        svc = self._make_service()
+        svc.queue.batch_receive_message.return_value = [
+            self._make_msg('not-json{{', 'bad'),
+            self._make_msg(json.dumps({'job_id': '3'}), 'ok'),
+        ]
+
+        result = svc.batch_receive_messages()
+
+        assert len(result) == 1
+        assert result[0]['message_id'] == 'ok'
+
+
 # ─────────────────────────────────────────────────
 # MNSService — delete_message
 # ─────────────────────────────────────────────────
@@ -279,6 +372,7 @@ class TestDeleteMessage:
 
     def _make_service(self):
         svc = MNSService.__new__(MNSService)
+        svc._lock = threading.Lock()
         svc.account = MagicMock()
         svc.queue = MagicMock()
         svc.queue_name = 'test-queue'
@@ -315,6 +409,29 @@ class TestDeleteMessage:
 
         assert result is False
 
+    def test_concurrent_deletes_serialized(self):
+        """Deletes from several worker threads never overlap on the shared connection."""
+        svc = self._make_service()
+        active = []
+        overlaps = []
+
+        def fake_delete(handle):
+            active.append(handle)
+            if len(active) > 1:
+                overlaps.append(handle)
+            threading.Event().wait(0.01)
+            active.remove(handle)
+
+        svc.queue.delete_message.side_effect = fake_delete
+        threads = [threading.Thread(target=svc.delete_message, args=(f'h{i}',)) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert svc.queue.delete_message.call_count == 4
+        assert overlaps == []
+
 
 # ─────────────────────────────────────────────────
 # MNSService — change_message_visibility
@@ -325,6 +442,7 @@ class TestChangeMessageVisibility:
 
     def _make_service(self):
         svc = MNSService.__new__(MNSService)
+        svc._lock = threading.Lock()
         svc.account = MagicMock()
         svc.queue = MagicMock()
         svc.queue_name = 'test-queue'
@@ -372,6 +490,7 @@ class TestGetQueueAttributes:
 
     def _make_service(self):
         svc = MNSService.__new__(MNSService)
+        svc._lock = threading.Lock()
         svc.account = MagicMock()
         svc.queue = MagicMock()
         svc.queue_name = 'test-queue'
@@ -430,6 +549,7 @@ class TestProcessMessages:
 
     def _make_service(self):
         svc = MNSService.__new__(MNSService)
+        svc._lock = threading.Lock()
         svc.account = MagicMock()
         svc.queue = MagicMock()
         svc.queue_name = 'test-queue'
@@ -89,7 +89,7 @@ def mock_tg():
 @pytest.fixture
 def mock_audio():
     audio = MagicMock()
-    audio.prepare_audio_for_asr.return_value = '/tmp/test_audio.mp3'
+    audio.prepare_audio_for_asr.return_value = ('/tmp/test_audio.mp3', 30.0)
     audio.transcribe_audio.return_value = 'Transcribed text from simple ASR.'
     audio.transcribe_with_diarization.return_value = ('Text with diarization.', [
         {'speaker_id': 1, 'text': 'Hello', 'start': 0, 'end': 5},
@@ -173,9 +173,9 @@ class TestAudioProcessorDiarization:
 class TestDocumentDurationDetection:
     """Test duration=0 document handling."""
 
-    def test_duration_zero_calls_get_audio_duration(self, mock_db, mock_tg, mock_audio):
-        """Document with duration=0 should detect real duration via get_audio_duration."""
-        mock_audio.get_audio_duration.return_value = 25.0
+    def test_duration_zero_uses_conversion_duration(self, mock_db, mock_tg, mock_audio):
+        """Document with duration=0 takes real duration from prepare_audio_for_asr."""
+        mock_audio.prepare_audio_for_asr.return_value = ('/tmp/test_audio.mp3', 25.0)
         import handler
         with patch.object(handler, 'get_db_service', return_value=mock_db), \
              patch.object(handler, 'get_telegram_service', return_value=mock_tg), \
@@ -184,16 +184,14 @@ class TestDocumentDurationDetection:
             result = handler.process_job(_make_job_data(duration=0))
 
         assert result['ok'] is True
-        # Called for duration detection + later for is_chunked check
-        mock_audio.get_audio_duration.assert_any_call('/tmp/test_audio.mp3')
-        assert mock_audio.get_audio_duration.call_count >= 1
+        mock_audio.prepare_audio_for_asr.assert_called_once_with('/tmp/test_audio.ogg', passthrough=True)
         # 25s < 60s -> simple ASR
         mock_audio.transcribe_audio.assert_called_once()
         mock_audio.transcribe_with_diarization.assert_not_called()
 
     def test_duration_zero_long_audio_diarization(self, mock_db, mock_tg, mock_audio):
         """Document with duration=0 but real 90s -> diarization."""
-        mock_audio.get_audio_duration.return_value = 90.0
+        mock_audio.prepare_audio_for_asr.return_value = ('/tmp/test_audio.mp3', 90.0)
         import handler
         with patch.object(handler, 'get_db_service', return_value=mock_db), \
              patch.object(handler, 'get_telegram_service', return_value=mock_tg), \
@@ -206,7 +204,7 @@ class TestDocumentDurationDetection:
 
     def test_document_insufficient_balance_rejection(self, mock_db, mock_tg, mock_audio):
         """Document duration=0, real=1800s (30 min), balance=5 min -> rejection."""
-        mock_audio.get_audio_duration.return_value = 1800.0
+        mock_audio.prepare_audio_for_asr.return_value = ('/tmp/test_audio.mp3', 1800.0)
         mock_db.get_user.return_value = {
             'balance_minutes': 5,
             'settings': '{}',
@@ -233,7 +231,7 @@ class TestDocumentDurationDetection:
 
     def test_document_sufficient_balance_proceeds(self, mock_db, mock_tg, mock_audio):
         """Document duration=0, real=120s (2 min), balance=100 -> proceed."""
-        mock_audio.get_audio_duration.return_value = 120.0
+        mock_audio.prepare_audio_for_asr.return_value = ('/tmp/test_audio.mp3', 120.0)
         import handler
         with patch.object(handler, 'get_db_service', return_value=mock_db), \
              patch.object(handler, 'get_telegram_service', return_value=mock_tg), \
@@ -0,0 +1,2702 @@
+#!/usr/bin/env python3
+"""
+Unit tests for v5.2.0 performance work:
+- Concurrent MNS batch processing in poll_queue
+- Shared keep-alive HTTP session for Telegram + DashScope
+- Concurrent independent I/O in process_job (start + bookkeeping)
+- TTL cache for user settings
+- orjson-backed json_loads/json_dumps with stdlib fallback
+- Env config hoisted to module constants, error-message lookup table
+- OGG/Opus passthrough for Telegram voice notes (no MP3 transcode)
+- 1 MiB streaming chunks for Telegram / URL downloads
+- Single BatchWriteRow for the transcription log + user last_activity + job completion
+- str.translate ё→е table, progress strings from ProgressManager.STAGES
+- FC initializer preloads service clients
+- LLM formatting skipped for code-tag mode and short punctuated text
+- Bounded first-sentence search for file captions
+- Single-pass event normalization + dispatch table in handler()
+- No typing action right after a progress edit (only before ffmpeg / LLM)
+- Throttled per-chunk progress edits
+- Progress edits / typing sent from a background UI executor
+- ExitStack temp-file cleanup registered at download time
+- Telegram getFile + user lookup prefetched at job start
+- Post-delivery bookkeeping off the job's return path, drained by handler()
+- Telegram media converted by ffmpeg while it downloads (stdin pipe)
+- Webhook keeps one pooled HTTP session across per-request service rebuilds
+- Throttled progress text coalesced and sent on the trailing edge
+- Conversion duration reused for the LLM is_chunked decision (no re-probe)
+- Temp-file unlinks moved to the post-delivery pool
+- Shared ceil_minutes() helper; balance deduction returns the written balance
+- Diarization stage callbacks deduplicated and kept off the diarization thread
+- MNS delete retries backed off on the post pool, not in the polling worker
+- One structured completion record per job; stage logs demoted to DEBUG
+- faster-whisper decodes VAD segments in batches (WHISPER_BATCH_SIZE)
+- Distilled faster-whisper models use independent 30s windows
+- int8_float16 faster-whisper weights on GPU (WHISPER_COMPUTE_TYPE)
+- Greedy faster-whisper decoding with temperature fallback (WHISPER_BEAM_SIZE)
+- faster-whisper preloaded and warmed once per process, shared across instances
+- FFmpeg Whisper stderr parsed line by line as it streams (no full capture)
+- Flat Whisper segments matched by a precompiled regex, brace scan as fallback
+- Audio base64-encoded from a read-only mmap (no raw bytes copy)
+- MP3 input already at the target tier skips the re-encode (copy remux if only the container differs)
+- ffprobe results cached per (path, mtime, size)
+- One ffprobe call (format + first audio stream) serves both duration and info
+- OSS uploads from 4 MB sent as parallel multipart parts
+- Temp OSS objects deleted on a background pool
+- Concurrent jobs decode on parallel faster-whisper workers (WHISPER_NUM_WORKERS)
+- Page cache of read-once temp audio dropped after ffmpeg / base64 encode
+- faster-whisper fed 16 kHz float32 PCM from ffmpeg; no MP3 transcode for audio input
+- DashScope LLM calls on the pooled session; one oss2 Session shared by every Bucket
+- faster-whisper CPU threads split across workers (WHISPER_CPU_THREADS, OMP_NUM_THREADS)
+- Exact-match cache of LLM formatting output keyed by text + options (FORMAT_CACHE)
+- Short transcripts returned by format_text_with_llm before backend dispatch
+- Balance and purchase counters updated with one atomic INCREMENT (no read, no CAS retries)
+- Formatting prompt head rendered once per flag combination; the transcript is appended
+- Slow LLM formatting calls hedged on the other backend after LLM_HEDGE_DELAY
+- Circuit breaker sends Qwen formatting straight to AssemblyAI during outages
+- Audio metadata read in-process with PyAV when installed; ffprobe as fallback
+- Users streamed page by page (iter_all_users); get_all_users no longer stops at one page
+- Row columns deserialized with a first-character JSON gate (orjson when installed)
+- Tablestore timestamps from stdlib timezone.utc (no pytz on the write path)
+- Column values serialized through an exact-type dispatch table
+- Temp audio unlinked on the post pool while LLM formatting runs
+- LLM fallback reuses the prompt built by the primary backend
+- Stats cutoffs compared as ISO strings (fromisoformat only for legacy formats)
+- Firestore migration writes rows with concurrent BatchWriteRow requests, retrying failed rows
+- Daily report cached per UTC day (memory, then report_cache table); user totals from the search index
+
+Run with: python -m pytest alibaba/tests/test_performance_v52.py -v
+"""
+import io
+import json
+import os
+import sys
+import threading
+import time
+from unittest.mock import MagicMock, patch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), 'webhook-handler'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), 'audio-processor'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), 'shared'))
+
+import pytest
+
+ALIBABA_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _load_module(name, *path):
+    """Import a script / handler by file path (several deployables share module names)."""
+    import importlib.util
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ALIBABA_DIR, *path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# === Fixtures ===
+
+@pytest.fixture(autouse=True)
+def _env_setup(monkeypatch):
+    monkeypatch.setenv('TELEGRAM_BOT_TOKEN', 'test-token')
+    monkeypatch.setenv('OWNER_ID', '999')
+    monkeypatch.setenv('TABLESTORE_ENDPOINT', 'https://test.ots.aliyuncs.com')
+    monkeypatch.setenv('TABLESTORE_INSTANCE', 'test')
+    monkeypatch.setenv('ALIBABA_ACCESS_KEY', 'test-ak')
+    monkeypatch.setenv('ALIBABA_SECRET_KEY', 'test-sk')
+    monkeypatch.setenv('DASHSCOPE_API_KEY', 'test-key')
+    monkeypatch.setenv('MNS_ENDPOINT', 'https://mns.test.com')
+
+
+@pytest.fixture
+def mns_handler(monkeypatch):
+    """handler module with MNS configured and MNSService mocked."""
+    import handler
+    monkeypatch.setattr(handler, 'MNS_ENDPOINT', 'https://mns.test.com')
+    monkeypatch.setattr(handler, 'ALIBABA_ACCESS_KEY', 'test-ak')
+    monkeypatch.setattr(handler, 'ALIBABA_SECRET_KEY', 'test-sk')
+    mns = MagicMock()
+    with patch('services.mns_service.MNSService', return_value=mns):
+        yield handler, mns
+
+
+@pytest.fixture
+def mock_db():
+    db = MagicMock()
+    db.get_job.return_value = None
+    db.update_job.return_value = True
+    db.get_user.return_value = {'balance_minutes': 100, 'settings': '{}'}
+    db.update_user_balance.return_value = True
+    db.log_transcription.return_value = True
+    return db
+
+
+@pytest.fixture
+def mock_tg():
+    tg = MagicMock()
+    tg.send_message.return_value = {'ok': True, 'result': {'message_id': 42}}
+    tg.edit_message_text.return_value = {'ok': True}
+    tg.get_file_path.return_value = 'file/path.ogg'
+    tg.download_file.return_value = '/tmp/test_audio.ogg'
+    return tg
+
+
+@pytest.fixture
+def mock_audio():
+    audio = MagicMock()
+    audio.prepare_audio_for_asr.return_value = ('/tmp/test_audio.mp3', 30.0)
+    audio.transcribe_audio.return_value = 'Transcribed text from simple ASR path.'
+    audio.get_audio_duration.return_value = 30.0
+    audio.get_diarization_debug.return_value = None
+    audio.format_text_with_llm.return_value = 'Formatted text from LLM.'
+    audio.ASR_MAX_CHUNK_DURATION = 600
+    return audio
+
+
+@pytest.fixture
+def patch_services(mock_db, mock_tg, mock_audio):
+    import handler
+    with patch.object(handler, 'get_db_service', return_value=mock_db), \
+         patch.object(handler, 'get_telegram_service', return_value=mock_tg), \
+         patch.object(handler, 'get_audio_service', return_value=mock_audio), \
+         patch('os.remove'):
+        yield
+
+
+def _make_job_data(duration=30, job_id='job-001', status_message_id=42):
+    return {
+        'job_id': job_id,
+        'user_id': '12345',
+        'chat_id': '67890',
+        'file_id': 'file-abc',
+        'file_type': 'voice',
+        'duration': duration,
+        'status_message_id': status_message_id,
+    }
+
+
+def _msg(job_id):
+    return {'data': {'job_id': job_id}, 'receipt_handle': f'rh-{job_id}', 'message_id': f'm-{job_id}'}
+
+
+# === Concurrent poll_queue ===
+
+class TestConcurrentPollQueue:
+    """poll_queue pulls a batch and runs process_job for each message in parallel."""
+
+    def test_empty_queue(self, mns_handler):
+        handler, mns = mns_handler
+        mns.batch_receive_messages.return_value = []
+
+        result = handler.poll_queue()
+
+        assert result == {'statusCode': 200, 'body': 'No messages in queue'}
+
+    def test_batch_size_from_workers(self, mns_handler, monkeypatch):
+        handler, mns = mns_handler
+        monkeypatch.setattr(handler, 'AUDIO_WORKERS', 3)
+        mns.batch_receive_messages.return_value = []
+
+        handler.poll_queue()
+
+        assert mns.batch_receive_messages.call_args.kwargs['batch_size'] == 3
+
+    def test_single_message_body(self, mns_handler):
+        handler, mns = mns_handler
+        mns.batch_receive_messages.return_value = [_msg('j1')]
+
+        with patch.object(handler, 'process_job', return_value={'ok': True}):
+            result = handler.poll_queue()
+
+        assert result['body'] == 'Processed job j1'
+        mns.delete_message.assert_called_once_with('rh-j1')
+
+    def test_jobs_run_concurrently(self, mns_handler):
+        """All jobs in the batch are in flight at the same time."""
+        handler, mns = mns_handler
+        mns.batch_receive_messages.return_value = [_msg('a'), _msg('b'), _msg('c')]
+        barrier = threading.Barrier(3, timeout=5)
+
+        def fake_process(job_data):
+            barrier.wait()  # deadlocks (BrokenBarrierError) if run sequentially
+            return {'ok': True}
+
+        with patch.object(handler, 'process_job', side_effect=fake_process):
+            result = handler.poll_queue()
+
+        assert result['statusCode'] == 200
+        assert result['body'].count('Processed job') == 3
+        assert mns.delete_message.call_count == 3
+
+    def test_failed_job_not_deleted(self, mns_handler):
+        """Only messages whose job succeeded are deleted from the queue."""
+        handler, mns = mns_handler
+        mns.batch_receive_messages.return_value = [_msg('ok'), _msg('bad')]
+
+        def fake_process(job_data):
+            if job_data['job_id'] == 'bad':
+                return {'ok': False, 'error': 'boom'}
+            return {'ok': True}
+
+        with patch.object(handler, 'process_job', side_effect=fake_process):
+            result = handler.poll_queue()
+
+        mns.delete_message.assert_called_once_with('rh-ok')
+        assert 'Job bad failed: boom' in result['body']
+
+    def test_exception_in_one_job_isolated(self, mns_handler):
+        """An exception in one worker does not fail the whole batch."""
+        handler, mns = mns_handler
+        mns.batch_receive_messages.return_value = [_msg('ok'), _msg('crash')]
+
+        def fake_process(job_data):
+            if job_data['job_id'] == 'crash':
+                raise RuntimeError('kaboom')
+            return {'ok': True}
+
+        with patch.object(handler, 'process_job', side_effect=fake_process):
+            result = handler.poll_queue()
+
+        assert result['statusCode'] == 200
+        mns.delete_message.assert_called_once_with('rh-ok')
+
+
+class TestServiceGetterLock:
+    """Lazy service getters initialise exactly once under concurrency."""
+
+    def test_telegram_service_single_init(self, monkeypatch):
+        import handler
+        monkeypatch.setattr(handler, '_telegram_service', None)
+        monkeypatch.setattr(handler, 'TELEGRAM_BOT_TOKEN', 'test-token')
+        created = []
+
+        def fake_tg(token, session=None):
+            created.append(token)
+            return MagicMock()
+
+        with patch('services.telegram.TelegramService', side_effect=fake_tg):
+            threads = [threading.Thread(target=handler.get_telegram_service) for _ in range(8)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+        assert len(created) == 1
+
+
+class TestSharedHttpSession:
+    """One pooled requests.Session is injected into Telegram and Audio services."""
+
+    def test_create_http_session_pool(self):
+        from utility import create_http_session
+        session = create_http_session(pool_size=7)
+        adapter = session.get_adapter('https://api.telegram.org')
+        assert adapter._pool_maxsize == 7
+        assert adapter.max_retries.total == 3
+        assert 429 in adapter.max_retries.status_forcelist
+
+    def test_telegram_service_uses_injected_session(self):
+        from telegram import TelegramService
+        session = MagicMock()
+        tg = TelegramService('token', session=session)
+        tg.send_chat_action(1, 'typing')
+        session.post.assert_called_once()
+
+    def test_audio_service_uses_injected_session(self):
+        from audio import AudioService
+        session = MagicMock()
+        audio = AudioService(whisper_backend='qwen-asr', alibaba_api_key='k', http_session=session)
+        assert audio._http_session is session
+
+    def test_webhook_rebuilt_telegram_service_keeps_session(self, monkeypatch):
+        import main as webhook_main
+        monkeypatch.setattr(webhook_main, '_telegram_service', None)
+        first = webhook_main.get_telegram_service()
+        monkeypatch.setattr(webhook_main, '_telegram_service', None)
+        second = webhook_main.get_telegram_service()
+
+        assert first is not second
+        assert first.session is second.session is webhook_main._http_session
+
+    def test_getters_share_module_session(self, monkeypatch):
+        import handler
+        monkeypatch.setattr(handler, '_telegram_service', None)
+        monkeypatch.setattr(handler, '_audio_service', None)
+        monkeypatch.setattr(handler, 'TELEGRAM_BOT_TOKEN', 'test-token')
+        monkeypatch.setattr(handler, 'DASHSCOPE_API_KEY', 'test-key')
+
+        tg = handler.get_telegram_service()
+        audio = handler.get_audio_service()
+
+        assert tg.session is handler._http_session
+        assert audio._http_session is handler._http_session
+
+
+class TestConcurrentJobIO:
+    """Independent Tablestore/Telegram calls in process_job overlap."""
+
+    def test_processing_status_and_progress_overlap(self, patch_services, mock_db, mock_tg):
+        import handler
+        barrier = threading.Barrier(2, timeout=5)
+
+        def update_job(job_id, fields):
+            if fields.get('status') == 'processing':
+                barrier.wait()
+            return True
+
+        def edit(chat_id, msg_id, text, *args, **kwargs):
+            if text == "🔄 Обработка началась...":
+                barrier.wait()
+            return {'ok': True}
+
+        mock_db.update_job.side_effect = update_job
+        mock_tg.edit_message_text.side_effect = edit
+
+        result = handler.process_job(_make_job_data())
+
+        assert result == {'ok': True, 'result': 'completed'}
+
+    def test_new_progress_message_id_used(self, patch_services, mock_tg):
+        """Without status_message_id, the concurrently sent message becomes the progress id."""
+        import handler
+        mock_tg.send_message.return_value = {'ok': True, 'result': {'message_id': 77}}
+
+        handler.process_job(_make_job_data(status_message_id=None))
+
+        assert any(c.args[1] == 77 for c in mock_tg.edit_message_text.call_args_list)
+
+    def test_bookkeeping_overlaps(self, patch_services, mock_db):
+        """The completion batch write and the balance re-read run together."""
+        import handler
+        barrier = threading.Barrier(2, timeout=5)
+        mock_db.batch_write.side_effect = lambda ops: barrier.wait() or True
+
+        calls = []
+
+        def get_user(user_id):
+            calls.append(user_id)
+            if len(calls) == 2:
+                barrier.wait()
+            return {'balance_minutes': 100, 'settings': '{}'}
+
+        mock_db.get_user.side_effect = get_user
+
+        result = handler.process_job(_make_job_data())
+        handler.drain_post_work()
+
+        assert result == {'ok': True, 'result': 'completed'}
+        assert len(calls) == 2
+
+
+class TestUserSettingsCache:
+    """Repeat jobs from the same user skip the settings read."""
+
+    def test_cache_hit_skips_db(self):
+        import handler
+        db = MagicMock()
+        db.get_user.return_value = {'settings': '{}', 'balance_minutes': 10}
+
+        handler._get_user_cached(db, 1)
+        handler._get_user_cached(db, 1)
+
+        assert db.get_user.call_count == 1
+
+    def test_expired_entry_refetched(self, monkeypatch):
+        import handler
+        monkeypatch.setattr(handler, 'USER_CACHE_TTL', -1)
+        db = MagicMock()
+        db.get_user.return_value = {'settings': '{}'}
+
+        handler._get_user_cached(db, 1)
+        handler._get_user_cached(db, 1)
+
+        assert db.get_user.call_count == 2
+
+    def test_fresh_bypasses_and_refreshes(self):
+        import handler
+        db = MagicMock()
+        db.get_user.side_effect = [{'balance_minutes': 10}, {'balance_minutes': 3}]
+
+        handler._get_user_cached(db, 1)
+        fresh = handler._get_user_cached(db, 1, fresh=True)
+
+        assert fresh == {'balance_minutes': 3}
+        assert handler._get_user_cached(db, 1) == {'balance_minutes': 3}
+
+    def test_missing_user_not_cached(self):
+        import handler
+        db = MagicMock()
+        db.get_user.return_value = None
+
+        handler._get_user_cached(db, 1)
+        handler._get_user_cached(db, 1)
+
+        assert db.get_user.call_count == 2
+
+    def test_max_size_bounded(self, monkeypatch):
+        import handler
+        monkeypatch.setattr(handler, 'USER_CACHE_MAX', 3)
+        db = MagicMock()
+        db.get_user.return_value = {'settings': '{}'}
+
+        for uid in range(10):
+            handler._get_user_cached(db, uid)
+
+        assert len(handler._user_cache) <= 3
+
+    def test_second_job_reads_settings_from_cache(self, patch_services, mock_db):
+        """Second job for the same user: only the post-delivery balance read hits the DB."""
+        import handler
+        handler.process_job(_make_job_data(job_id='j1'))
+        handler.drain_post_work()
+        mock_db.get_user.reset_mock()
+
+        handler.process_job(_make_job_data(job_id='j2'))
+        handler.drain_post_work()
+
+        assert mock_db.get_user.call_count == 1
+
+    def test_document_job_bypasses_cache(self, patch_services, mock_db, mock_audio):
+        """duration=0 needs a current balance, so settings are read fresh."""
+        import handler
+        handler._get_user_cached(mock_db, 12345)
+        mock_db.get_user.reset_mock()
+
+        handler.process_job(_make_job_data(duration=0))
+        handler.drain_post_work()
+
+        assert mock_db.get_user.call_count == 2
+
+
+class TestFastJson:
+    """utility.json_loads/json_dumps work with and without orjson."""
+
+    @pytest.mark.parametrize('use_orjson', [True, False])
+    def test_roundtrip(self, use_orjson, monkeypatch):
+        import utility
+        if not use_orjson:
+            monkeypatch.setattr(utility, '_orjson', None)
+        data = {'text': 'Привет', 'n': 1, 'items': [1, 2]}
+
+        dumped = utility.json_dumps(data)
+
+        assert isinstance(dumped, str)
+        assert utility.json_loads(dumped) == data
+        assert utility.json_loads(dumped.encode('utf-8')) == data
+
+    @pytest.mark.parametrize('use_orjson', [True, False])
+    def test_invalid_raises_value_error(self, use_orjson, monkeypatch):
+        import utility
+        if not use_orjson:
+            monkeypatch.setattr(utility, '_orjson', None)
+        with pytest.raises(ValueError):
+            utility.json_loads(b'{not json')
+
+    def test_handler_parses_bytes_event(self, patch_services):
+        import json
+        import handler
+        event = json.dumps({'Message': json.dumps(_make_job_data())}).encode('utf-8')
+
+        result = handler.handler(event, None)
+
+        assert result == {'ok': True, 'result': 'completed'}
+
+
+class TestHoistedConfig:
+    """Env is read once at import; error classification uses a lookup table."""
+
+    def test_poll_queue_uses_module_queue_name(self, mns_handler, monkeypatch):
+        handler, mns = mns_handler
+        monkeypatch.setattr(handler, 'AUDIO_JOBS_QUEUE', 'custom-queue')
+        mns.batch_receive_messages.return_value = []
+
+        with patch('services.mns_service.MNSService', return_value=mns) as mns_cls:
+            handler.poll_queue()
+
+        assert mns_cls.call_args.kwargs['queue_name'] == 'custom-queue'
+
+    @pytest.mark.parametrize('error, expected', [
+        ('InvalidParameter: audio too long', 'слишком длинное'),
+        ('Audio duration exceeds limit', 'слишком длинное'),
+        ('Read timeout', 'слишком много времени'),
+        ('Transcription empty', 'распознать речь'),
+        ('No speech detected', 'распознать речь'),
+        ('Something odd', 'Попробуйте позже'),
+    ])
+    def test_user_error_message(self, error, expected):
+        import handler
+        assert expected in handler._user_error_message(Exception(error))
+
+
+class TestVoicePassthrough:
+    """Voice notes skip the MP3 transcode; other inputs are still converted."""
+
+    @pytest.fixture
+    def audio_service(self):
+        from audio import AudioService
+        return AudioService(whisper_backend='qwen-asr', alibaba_api_key='test-key')
+
+    def test_ogg_passthrough_skips_convert(self, audio_service):
+        with patch.object(audio_service, '_check_mime_type', return_value=True), \
+             patch.object(audio_service, 'get_audio_duration', return_value=12.5), \
+             patch.object(audio_service, '_convert_to_mp3') as mock_convert:
+            result = audio_service.prepare_audio_for_asr('/tmp/file_1.oga', passthrough=True)
+
+        assert result == ('/tmp/file_1.oga', 12.5)
+        mock_convert.assert_not_called()
+
+    def test_passthrough_ignored_for_other_containers(self, audio_service):
+        with patch.object(audio_service, '_check_mime_type', return_value=True), \
+             patch.object(audio_service, 'is_video_file', return_value=False), \
+             patch.object(audio_service, '_convert_to_mp3', return_value=('/tmp/out.mp3', 5.0)) as mock_convert:
+            result = audio_service.prepare_audio_for_asr('/tmp/file.m4a', passthrough=True)
+
+        assert result == ('/tmp/out.mp3', 5.0)
+        mock_convert.assert_called_once()
+
+    def test_ogg_converted_without_passthrough(self, audio_service):
+        with patch.object(audio_service, '_check_mime_type', return_value=True), \
+             patch.object(audio_service, 'is_video_file', return_value=False), \
+             patch.object(audio_service, '_convert_to_mp3', return_value=('/tmp/out.mp3', 5.0)) as mock_convert:
+            audio_service.prepare_audio_for_asr('/tmp/file.ogg')
+
+        mock_convert.assert_called_once()
+
+    def test_chunks_keep_input_container(self, audio_service):
+        """Stream-copy split of an OGG input writes OGG chunks."""
+        with patch.object(audio_service, 'get_audio_duration', return_value=400.0), \
+             patch('subprocess.run'), \
+             patch('os.path.exists', return_value=True), \
+             patch('os.path.getsize', return_value=100):
+            chunks = audio_service.split_audio_chunks('/tmp/voice.oga', chunk_duration=150)
+
+        assert len(chunks) == 3
+        assert all(c.endswith('.oga') for c in chunks)
+        for c in chunks:
+            os.remove(c)
+
+    def test_gemini_diarization_labels_ogg(self, monkeypatch):
+        from audio import AudioService
+        monkeypatch.setenv('GOOGLE_API_KEY', 'k')
+        session = MagicMock()
+        session.post.return_value.status_code = 500
+        audio_service = AudioService(whisper_backend='qwen-asr', http_session=session)
+        with patch.object(audio_service, '_file_base64', return_value='QQ=='):
+            audio_service._diarize_gemini('/tmp/voice.oga')
+        part = session.post.call_args[1]['json']['contents'][0]['parts'][0]
+        assert part['inlineData']['mimeType'] == 'audio/ogg'
+        assert audio_service._audio_mime_type('/tmp/a.mp3') == 'audio/mpeg'
+
+    def test_voice_job_cleans_up_once(self, patch_services, mock_audio):
+        """When converted_path == local_path the file is removed once."""
+        import handler
+        mock_audio.prepare_audio_for_asr.return_value = ('/tmp/test_audio.ogg', 30.0)
+
+        with patch('os.remove') as mock_remove:
+            result = handler.process_job(_make_job_data())
+            handler.drain_post_work()
+
+        assert result == {'ok': True, 'result': 'completed'}
+        mock_audio.prepare_audio_for_asr.assert_called_once_with('/tmp/test_audio.ogg', passthrough=True)
+        assert [c.args[0] for c in mock_remove.call_args_list] == ['/tmp/test_audio.ogg']
+
+
+class TestDownloadChunking:
+    """Downloads stream to /tmp in 1 MiB writes instead of 8 KB ones."""
+
+    def test_telegram_download_chunk_size(self, tmp_path):
+        from telegram import TelegramService
+        session = MagicMock()
+        session.get.return_value.iter_content.return_value = [b'a' * 10, b'b' * 10]
+        tg = TelegramService('test-token', session=session)
+
+        path = tg.download_file('voice/file.oga', target_dir=str(tmp_path))
+
+        session.get.return_value.iter_content.assert_called_once_with(chunk_size=1 << 20)
+        with open(path, 'rb') as f:
+            assert f.read() == b'a' * 10 + b'b' * 10
+
+    def test_url_import_chunk_size(self):
+        import handler
+        assert handler.DOWNLOAD_CHUNK_SIZE == 1 << 20
+
+    def test_concurrent_url_imports_get_distinct_files(self):
+        """Two imports in the same second must not share (and overwrite) one temp path."""
+        import handler
+        response = MagicMock()
+        response.headers = {'content-type': 'audio/mpeg', 'content-length': '3'}
+        response.iter_content.return_value = [b'abc']
+
+        with patch('requests.get', return_value=response), \
+             patch.object(handler.time, 'time', return_value=1700000000.0):
+            paths = [handler._download_from_url('https://example.com/a.mp3') for _ in range(2)]
+        try:
+            assert paths[0] != paths[1]
+            assert all(p.endswith('.mp3') for p in paths)
+        finally:
+            for p in paths:
+                os.remove(p)
+
+
+class TestBatchWrite:
+    """TablestoreService.batch_write: one BatchWriteRow across tables."""
+
+    @pytest.fixture
+    def ts(self):
+        from tablestore_service import TablestoreService
+        ts = TablestoreService.__new__(TablestoreService)
+        ts.client = MagicMock()
+        return ts
+
+    def test_groups_rows_by_table(self, ts):
+        from tablestore import PutRowItem, UpdateRowItem
+        ts.client.batch_write_row.return_value.is_all_succeed.return_value = True
+
+        ok = ts.batch_write([
+            ts.transcription_log_op({'user_id': '1', 'duration': 30}),
+            ('audio_jobs', [('job_id', 'j1')], {'status': 'completed', 'meta': {'a': 1}}, 'update'),
+        ])
+
+        assert ok is True
+        ts.client.batch_write_row.assert_called_once()
+        request = ts.client.batch_write_row.call_args[0][0]
+        assert set(request.items) == {'transcription_logs', 'audio_jobs'}
+        log_item = request.items['transcription_logs'].row_items[0]
+        job_item = request.items['audio_jobs'].row_items[0]
+        assert isinstance(log_item, PutRowItem)
+        assert isinstance(job_item, UpdateRowItem)
+        assert dict(log_item.row.attribute_columns)['duration'] == 30
+        assert 'timestamp' in dict(log_item.row.attribute_columns)
+        assert job_item.row.attribute_columns == {'put': [('status', 'completed'), ('meta', '{"a": 1}')]}
+
+    def test_failed_row_returns_false(self, ts):
+        response = ts.client.batch_write_row.return_value
+        response.is_all_succeed.return_value = False
+        response.get_failed_of_put.return_value = []
+        response.get_failed_of_update.return_value = [MagicMock(error_code='OTSConditionCheckFail')]
+
+        ok = ts.batch_write([('audio_jobs', [('job_id', 'j1')], {'status': 'completed'}, 'update')])
+
+        assert ok is False
+
+    def test_client_error_returns_false(self, ts):
+        ts.client.batch_write_row.side_effect = Exception('network down')
+        assert ts.batch_write([('audio_jobs', [('job_id', 'j1')], {'status': 'x'}, 'update')]) is False
+
+    def test_empty_is_noop(self, ts):
+        assert ts.batch_write([]) is True
+        ts.client.batch_write_row.assert_not_called()
+
+    def test_user_update_op_sets_last_activity(self, ts):
+        table, primary_key, attributes, op_type = ts.user_update_op(12345, {'x': 1})
+        assert (table, primary_key, op_type) == ('users', [('user_id', '12345')], 'update')
+        assert attributes['x'] == 1 and 'last_activity' in attributes
+
+    def test_completion_batches_log_user_and_job(self, patch_services, mock_db):
+        import handler
+        handler.process_job(_make_job_data())
+        handler.drain_post_work()
+        mock_db.batch_write.assert_called_once()
+        ops = mock_db.batch_write.call_args[0][0]
+        assert ops[1] is mock_db.user_update_op.return_value
+        mock_db.user_update_op.assert_called_once_with('12345', {})
+        assert ops[2][0] == 'audio_jobs'
+
+    def test_log_transcription_still_single_put(self, ts):
+        assert ts.log_transcription({'user_id': '1'}) is True
+        table, row, _ = ts.client.put_row.call_args[0]
+        assert table == 'transcription_logs'
+        assert row.primary_key[0][0] == 'log_id'
+
+
+class TestYoTable:
+    """use_yo=False strips ё/Ё in a single translate pass."""
+
+    def test_translate_matches_replace_chain(self):
+        import handler
+        text = 'Ёлка, ёж и всё остальное. ЁЁ ёё'
+        assert text.translate(handler._YO_TABLE) == text.replace('ё', 'е').replace('Ё', 'Е')
+
+    def test_short_text_without_yo(self, mock_audio, mock_tg):
+        import handler
+        result = handler._format_transcription(
+            mock_audio, 'Всё ещё ёлка', False, {'use_yo': False},
+            '/tmp/a.mp3', mock_tg, 1, None)
+        assert result == 'Все еще елка'
+
+    def test_fallback_progress_uses_stage_text(self, mock_audio, mock_tg):
+        """Without a ProgressManager, fallback edits reuse the STAGES strings."""
+        import handler
+        mock_audio.transcribe_audio.side_effect = lambda path, progress_callback: progress_callback(2, 3) or 'ok'
+        handler._transcribe_simple(mock_audio, mock_tg, '/tmp/a.mp3', 1, 5)
+        mock_tg.edit_message_text.assert_called_once_with(1, 5, '🎙 Распознаю речь... (часть 2 из 3)')
+
+
+class TestInitializer:
+    """handler.initializer warms services once per instance."""
+
+    def test_preloads_services(self, mock_db, mock_tg, mock_audio):
+        import handler
+        with patch.object(handler, 'get_db_service', return_value=mock_db) as get_db, \
+             patch.object(handler, 'get_telegram_service', return_value=mock_tg) as get_tg, \
+             patch.object(handler, 'get_audio_service', return_value=mock_audio) as get_audio:
+            handler.initializer(None)
+
+        get_db.assert_called_once()
+        get_tg.assert_called_once()
+        get_audio.assert_called_once()
+        mock_audio._get_oss_bucket.assert_called_once()
+
+    def test_failure_does_not_raise(self):
+        """Missing config must not fail the instance — getters retry lazily."""
+        import handler
+        with patch.object(handler, 'get_db_service', side_effect=ValueError('no creds')):
+            handler.initializer(None)
+
+
+class TestSkipLlmFormatting:
+    """needs_llm_formatting short-circuits LLM calls that add nothing."""
+
+    UNPUNCTUATED = 'ну вот значит мы пришли туда и там никого не было совсем ' * 3
+    PUNCTUATED = 'Мы пришли туда. Там никого не было! Что делать дальше? Решили подождать. ' * 2
+
+    def test_short_text_skipped(self):
+        from utility import needs_llm_formatting
+        assert needs_llm_formatting('Короткий текст без точек') is False
+
+    def test_code_tags_skipped(self):
+        from utility import needs_llm_formatting
+        assert needs_llm_formatting(self.UNPUNCTUATED, use_code_tags=True) is False
+
+    def test_punctuated_short_text_skipped(self):
+        from utility import needs_llm_formatting
+        assert needs_llm_formatting(self.PUNCTUATED) is False
+
+    def test_unpunctuated_text_formatted(self):
+        from utility import needs_llm_formatting
+        assert needs_llm_formatting(self.UNPUNCTUATED) is True
+
+    def test_long_punctuated_text_still_formatted(self):
+        """Long text still needs paragraph splitting even when punctuated."""
+        from utility import needs_llm_formatting
+        assert needs_llm_formatting(self.PUNCTUATED * 5) is True
+
+    def test_code_tags_job_skips_llm(self, mock_audio, mock_tg):
+        import handler
+        result = handler._format_transcription(
+            mock_audio, self.UNPUNCTUATED, False, {'use_code_tags': True},
+            '/tmp/a.mp3', mock_tg, 1, None)
+        assert result == self.UNPUNCTUATED
+        mock_audio.format_text_with_llm.assert_not_called()
+
+
+class TestFileCaption:
+    """File-mode caption only scans the first 200 chars for a sentence end."""
+
+    def _caption(self, text):
+        import handler
+        tg = MagicMock()
+        handler._deliver_result(tg, 1, None, text, {'long_text_mode': 'file'})
+        return tg.send_as_file.call_args.kwargs['caption']
+
+    def test_first_sentence(self):
+        assert self._caption('Первое предложение. ' + 'x' * 5000) == 'Первое предложение....'
+
+    def test_no_dot_in_window(self):
+        text = 'a' * 300 + '. end'
+        assert self._caption(text) == 'a' * 200 + '...'
+
+    def test_leading_dot_uses_window(self):
+        from utility import file_caption
+        text = '.' + 'a' * 300
+        assert file_caption(text) == text[:200] + '...'
+
+
+class TestEventDispatch:
+    """handler() parses once, classifies, then dispatches via _DISPATCH."""
+
+    @pytest.mark.parametrize('event, kind', [
+        ({'action': 'poll_queue'}, 'poll'),
+        (b'{"action": "poll_queue"}', 'poll'),
+        ({'triggerName': 't', 'payload': '{"action": "poll_queue"}'}, 'poll'),
+        ({'triggerName': 't', 'payload': {'job_id': 'j1'}}, 'mns'),
+        ({'Message': '{"job_id": "j1"}'}, 'mns'),
+        ('{"job_id": "j1"}', 'mns'),
+        ({'body': '{"job_id": "j1"}'}, 'job'),
+        ({'foo': 'bar'}, 'unknown'),
+    ])
+    def test_normalize_kind(self, event, kind):
+        import handler
+        assert handler._normalize_event(event)[1] == kind
+
+    def test_body_unwrapped(self):
+        import handler
+        assert handler._normalize_event({'body': '{"job_id": "j1"}'}) == ({'job_id': 'j1'}, 'job')
+
+    def test_dispatch_to_process_job(self):
+        import handler
+        with patch.object(handler, 'process_job', return_value={'ok': True}) as mock_job:
+            assert handler.handler({'body': {'job_id': 'j1'}}, None) == {'ok': True}
+        mock_job.assert_called_once_with({'job_id': 'j1'})
+
+    def test_unknown_event(self):
+        import handler
+        assert handler.handler({'foo': 'bar'}, None) == {'statusCode': 200, 'body': 'Unknown event format'}
+
+    def test_bad_json_returns_500(self):
+        import handler
+        assert handler.handler(b'not json', None)['statusCode'] == 500
+
+
+class TestChatActionDedup:
+    """send_chat_action is skipped where a progress edit already shows activity."""
+
+    def test_with_progress_message_only_before_convert(self, mock_tg, mock_audio):
+        import handler
+        with patch.object(handler, '_send_typing') as mock_typing:
+            handler._download_and_convert(mock_tg, mock_audio, 'file-abc', 1, 42, file_type='voice')
+        assert mock_typing.call_count == 1
+
+    def test_without_progress_message_every_stage(self, mock_tg, mock_audio):
+        import handler
+        with patch.object(handler, '_send_typing') as mock_typing:
+            handler._download_and_convert(mock_tg, mock_audio, 'file-abc', 1, None, file_type='voice')
+        assert mock_typing.call_count == 3
+
+
+class TestChunkProgressThrottle:
+    """Per-chunk ticks are rate-limited; stage changes and the last chunk are not."""
+
+    def test_chunks_throttled_last_forced(self, mock_tg):
+        from handler import ProgressManager
+        pm = ProgressManager(mock_tg, 1, 42)
+        for i in range(1, 21):
+            pm.chunk('transcribe_chunk', i, 20)
+
+        texts = [c.args[2] for c in mock_tg.edit_message_text.call_args_list]
+        assert texts == ['🎙 Распознаю речь... (часть 1 из 20)',
+                         '🎙 Распознаю речь... (часть 20 из 20)']
+
+    def test_identical_text_not_resent(self, mock_tg):
+        from handler import ProgressManager
+        pm = ProgressManager(mock_tg, 1, 42)
+        pm.stage('format')
+        pm.stage('format')
+        assert mock_tg.edit_message_text.call_count == 1
+
+    def test_failed_edit_retried(self, mock_tg):
+        """A failed edit does not count as shown."""
+        from handler import ProgressManager
+        mock_tg.edit_message_text.side_effect = [Exception('429'), {'ok': True}]
+        pm = ProgressManager(mock_tg, 1, 42)
+        pm.stage('format')
+        pm.stage('format')
+        assert mock_tg.edit_message_text.call_count == 2
+
+
+class TestProgressCoalescing:
+    """A throttled update is sent once the interval ends, unless superseded."""
+
+    def test_trailing_edge_sends_latest(self, mock_tg, monkeypatch):
+        from handler import ProgressManager
+        monkeypatch.setattr(ProgressManager, 'MIN_UPDATE_INTERVAL', 0.05)
+        pm = ProgressManager(mock_tg, 1, 42)
+        pm.update('first')
+        pm.update('second')
+        pm.update('third')
+
+        time.sleep(0.2)
+
+        texts = [c.args[2] for c in mock_tg.edit_message_text.call_args_list]
+        assert texts == ['first', 'third']
+
+    def test_flush_cancels_trailing(self, mock_tg, monkeypatch):
+        from handler import ProgressManager
+        monkeypatch.setattr(ProgressManager, 'MIN_UPDATE_INTERVAL', 0.05)
+        pm = ProgressManager(mock_tg, 1, 42)
+        pm.update('first')
+        pm.update('second')
+        pm.flush()
+
+        time.sleep(0.2)
+
+        assert mock_tg.edit_message_text.call_count == 1
+
+    def test_forced_update_replaces_trailing(self, mock_tg, monkeypatch):
+        from handler import ProgressManager
+        monkeypatch.setattr(ProgressManager, 'MIN_UPDATE_INTERVAL', 0.05)
+        pm = ProgressManager(mock_tg, 1, 42)
+        pm.update('first')
+        pm.update('second')
+        pm.update('stage', force=True)
+
+        time.sleep(0.2)
+
+        texts = [c.args[2] for c in mock_tg.edit_message_text.call_args_list]
+        assert texts == ['first', 'stage']
+
+
+class TestBackgroundUi:
+    """Progress edits run on _ui_executor; the newest text wins."""
+
+    def test_edit_does_not_block(self, mock_tg):
+        import handler
+        release = threading.Event()
+        mock_tg.edit_message_text.side_effect = lambda *a, **k: release.wait(5)
+        pm = handler.ProgressManager(mock_tg, 1, 42, executor=handler._ui_executor)
+
+        started = time.monotonic()
+        pm.stage('download')
+        assert time.monotonic() - started < 1
+
+        release.set()
+        pm.flush()
+        mock_tg.edit_message_text.assert_called_once_with(1, 42, '📥 Загружаю файл...')
+
+    def test_stale_edit_superseded(self, mock_tg):
+        import handler
+        release = threading.Event()
+        texts = []
+
+        def edit(chat_id, msg_id, text):
+            texts.append(text)
+            release.wait(5)
+
+        mock_tg.edit_message_text.side_effect = edit
+        pm = handler.ProgressManager(mock_tg, 1, 42, executor=handler._ui_executor)
+        pm.stage('download')
+        while not texts:
+            time.sleep(0.01)
+        pm.stage('convert')      # queued behind the in-flight edit
+        pm.stage('transcribe')   # supersedes 'convert'
+        release.set()
+        pm.flush()
+        time.sleep(0.05)
+
+        assert texts == ['📥 Загружаю файл...', '🎙 Распознаю речь...']
+
+    def test_deliver_waits_for_pending_edit(self, mock_tg):
+        """The result edit always lands after the last progress edit."""
+        import handler
+        order = []
+
+        def edit(chat_id, msg_id, text, parse_mode=None):
+            time.sleep(0.05)
+            order.append(text)
+
+        mock_tg.edit_message_text.side_effect = edit
+        pm = handler.ProgressManager(mock_tg, 1, 42, executor=handler._ui_executor)
+        handler._deliver_result(mock_tg, 1, 42, 'Готовый текст.', {}, progress=pm)
+
+        assert order == ['📤 Отправляю результат...', 'Готовый текст.']
+
+    def test_send_typing_uses_executor(self, mock_tg):
+        import handler
+        handler._send_typing(mock_tg, 7)
+        handler._ui_executor.submit(lambda: None).result()
+        deadline = time.monotonic() + 2
+        while not mock_tg.send_chat_action.called and time.monotonic() < deadline:
+            time.sleep(0.01)
+        mock_tg.send_chat_action.assert_called_once_with(7, 'typing')
+
+
+class TestTempCleanupStack:
+    """Temp files are registered for cleanup as soon as they exist."""
+
+    def test_download_removed_when_conversion_fails(self, patch_services, mock_audio):
+        import handler
+        mock_audio.prepare_audio_for_asr.return_value = (None, 0.0)
+
+        with patch('os.remove') as mock_remove:
+            result = handler.process_job(_make_job_data())
+            handler.drain_post_work()
+
+        assert result['ok'] is False
+        assert [c.args[0] for c in mock_remove.call_args_list] == ['/tmp/test_audio.ogg']
+
+    def test_converted_removed_before_download(self, patch_services):
+        import handler
+        with patch('os.remove') as mock_remove:
+            handler.process_job(_make_job_data())
+            handler.drain_post_work()
+
+        assert [c.args[0] for c in mock_remove.call_args_list] == ['/tmp/test_audio.mp3', '/tmp/test_audio.ogg']
+
+    def test_cleanup_runs_after_return(self, patch_services):
+        """Unlinks run on the post pool; process_job does not wait for them."""
+        import handler
+        release = threading.Event()
+        with patch('os.remove', side_effect=lambda path: release.wait(5)) as mock_remove:
+            result = handler.process_job(_make_job_data())
+            assert result == {'ok': True, 'result': 'completed'}
+            release.set()
+            handler.drain_post_work()
+
+        assert mock_remove.call_count == 2
+
+    def test_removed_while_formatting(self, patch_services, mock_audio):
+        """Temp files are unlinked on the post pool before the LLM call returns."""
+        import handler
+        mock_audio.transcribe_audio.return_value = 'ну вот значит мы пришли туда и там никого не было ' * 3
+        removed_during_format = []
+
+        def format_text(*args, **kwargs):
+            handler.drain_post_work()
+            removed_during_format.extend(c.args[0] for c in mock_remove.call_args_list)
+            return 'Formatted.'
+
+        mock_audio.format_text_with_llm.side_effect = format_text
+        with patch('os.remove') as mock_remove:
+            handler.process_job(_make_job_data())
+            handler.drain_post_work()
+
+        assert removed_during_format == ['/tmp/test_audio.mp3', '/tmp/test_audio.ogg']
+        assert mock_remove.call_count == 2
+
+
+class TestJobStartPrefetch:
+    """getFile and the user lookup run alongside the dedup check."""
+
+    def test_prefetch_overlaps_dedup(self, patch_services, mock_db, mock_tg):
+        import handler
+        barrier = threading.Barrier(3, timeout=5)
+        mock_db.get_job.side_effect = lambda job_id: barrier.wait() and None
+        mock_tg.get_file_path.side_effect = lambda file_id: barrier.wait() or 'file/path.ogg'
+
+        def get_user(user_id):
+            if not getattr(get_user, 'done', False):
+                get_user.done = True
+                barrier.wait()
+            return {'balance_minutes': 100, 'settings': '{}'}
+
+        mock_db.get_user.side_effect = get_user
+
+        result = handler.process_job(_make_job_data())
+
+        assert result == {'ok': True, 'result': 'completed'}
+        mock_tg.get_file_path.assert_called_once_with('file-abc')
+
+    def test_no_telegram_lookup_for_oss_upload(self, patch_services, mock_tg):
+        import handler
+        job = dict(_make_job_data(), file_type='oss_upload', file_id='uploads/a.mp3')
+        with patch.object(handler, '_download_from_oss', return_value='/tmp/a.mp3'):
+            handler.process_job(job)
+        mock_tg.get_file_path.assert_not_called()
+
+
+class TestPostDeliveryBookkeeping:
+    """process_job returns once the result is sent; handler() drains the rest."""
+
+    def test_job_returns_before_bookkeeping(self, patch_services, mock_db, mock_tg):
+        import handler
+        release = threading.Event()
+        mock_db.batch_write.side_effect = lambda ops: release.wait(5)
+
+        result = handler.process_job(_make_job_data())
+
+        assert result == {'ok': True, 'result': 'completed'}
+        assert mock_tg.edit_message_text.called or mock_tg.send_message.called
+        release.set()
+        assert handler.drain_post_work() is True
+        mock_db.batch_write.assert_called_once()
+
+    def test_handler_waits_for_bookkeeping(self, patch_services, mock_db):
+        import handler
+        mock_db.batch_write.side_effect = lambda ops: time.sleep(0.05) or True
+
+        handler.handler(json.dumps({'Message': json.dumps(_make_job_data())}), None)
+
+        mock_db.batch_write.assert_called_once()
+
+    def test_bookkeeping_error_is_logged(self, patch_services, mock_db):
+        import handler
+        mock_db.batch_write.side_effect = Exception('ots down')
+
+        result = handler.process_job(_make_job_data())
+
+        assert result['ok'] is True
+        assert handler.drain_post_work() is True
+
+
+class TestStreamingConversion:
+    """Telegram media with a known duration is fed to ffmpeg as it downloads."""
+
+    @pytest.fixture
+    def stream_parts(self, tmp_path):
+        from audio import Mp3Stream
+        output = tmp_path / 'out.mp3'
+        output.write_bytes(b'mp3')
+        process = MagicMock()
+        stderr_file = MagicMock()
+        stderr_file.read.return_value = b'  Duration: 00:01:05.50, start: 0.0\n'
+        return Mp3Stream(process, str(output), stderr_file, 60.0, 300), process, output
+
+    def test_stream_finish_returns_output_and_duration(self, stream_parts):
+        stream, process, output = stream_parts
+        process.wait.return_value = 0
+        stream.write(b'chunk')
+
+        assert stream.finish() == (str(output), 65.5)
+        process.stdin.write.assert_called_once_with(b'chunk')
+        process.stdin.close.assert_called_once()
+
+    def test_broken_pipe_marks_failed(self, stream_parts):
+        stream, process, output = stream_parts
+        process.stdin.write.side_effect = BrokenPipeError
+        process.wait.return_value = 1
+
+        stream.write(b'a')
+        stream.write(b'b')
+
+        assert stream.failed
+        assert process.stdin.write.call_count == 1
+        assert stream.finish() == (None, 0.0)
+        assert not output.exists()
+
+    def test_download_feeds_chunks(self, tmp_path):
+        from telegram import TelegramService
+        session = MagicMock()
+        session.get.return_value.iter_content.return_value = [b'a', b'b']
+        tg = TelegramService('test-token', session=session)
+        received = []
+
+        tg.download_file('music/file.mp3', target_dir=str(tmp_path), on_chunk=received.append)
+
+        assert received == [b'a', b'b']
+
+    def _run(self, tg, audio, file_type, duration_hint):
+        import handler
+        return handler._download_and_convert(tg, audio, 'file-abc', 1, None,
+                                             file_type=file_type, duration_hint=duration_hint)
+
+    def test_audio_with_duration_streams(self, mock_tg, mock_audio):
+        stream = mock_audio.start_mp3_stream.return_value
+        stream.finish.return_value = ('/tmp/streamed.mp3', 95.0)
+
+        with patch('os.remove') as mock_remove:
+            result = self._run(mock_tg, mock_audio, 'audio', 95)
+
+        assert result == ('/tmp/test_audio.ogg', '/tmp/streamed.mp3', 95.0)
+        mock_remove.assert_called_once_with('/tmp/test_audio.ogg')  # download freed early
+        mock_audio.start_mp3_stream.assert_called_once_with(95)
+        assert mock_tg.download_file.call_args.kwargs['on_chunk'] == stream.write
+        stream.finish.assert_called_once_with('/tmp/test_audio.ogg')
+        mock_audio.prepare_audio_for_asr.assert_not_called()
+
+    def test_failed_stream_falls_back_to_file(self, mock_tg, mock_audio):
+        mock_audio.start_mp3_stream.return_value.finish.return_value = (None, 0.0)
+
+        result = self._run(mock_tg, mock_audio, 'video', 95)
+
+        assert result[1] == '/tmp/test_audio.mp3'
+        mock_audio.prepare_audio_for_asr.assert_called_once_with('/tmp/test_audio.ogg', passthrough=False)
+
+    @pytest.mark.parametrize('file_type,duration_hint', [('voice', 30), ('document', 0)])
+    def test_no_stream_for_voice_or_unknown_duration(self, mock_tg, mock_audio, file_type, duration_hint):
+        self._run(mock_tg, mock_audio, file_type, duration_hint)
+
+        mock_audio.start_mp3_stream.assert_not_called()
+        assert mock_tg.download_file.call_args.kwargs['on_chunk'] is None
+
+    def test_failed_download_aborts_stream(self, mock_tg, mock_audio):
+        mock_tg.download_file.return_value = None
+
+        with pytest.raises(Exception, match='Failed to download'):
+            self._run(mock_tg, mock_audio, 'audio', 95)
+
+        mock_audio.start_mp3_stream.return_value.abort.assert_called_once()
+
+    def test_download_exception_aborts_stream(self, mock_tg, mock_audio):
+        mock_tg.download_file.side_effect = TimeoutError('read timed out')
+        with pytest.raises(TimeoutError):
+            self._run(mock_tg, mock_audio, 'audio', 95)
+
+        mock_audio.start_mp3_stream.return_value.abort.assert_called_once()
+
+
+class TestFormatDurationReuse:
+    """_format_transcription takes the duration process_job already has."""
+
+    UNPUNCTUATED = 'ну вот значит мы пришли туда и там никого не было совсем ' * 3
+
+    def test_known_duration_skips_probe(self, mock_audio, mock_tg):
+        import handler
+        handler._format_transcription(mock_audio, self.UNPUNCTUATED, False, {},
+                                      '/tmp/a.mp3', mock_tg, 1, None, audio_duration=900.0)
+
+        mock_audio.get_audio_duration.assert_not_called()
+        assert mock_audio.format_text_with_llm.call_args.kwargs['is_chunked'] is True
+
+    def test_process_job_passes_conversion_duration(self, patch_services, mock_audio):
+        import handler
+        mock_audio.transcribe_audio.return_value = self.UNPUNCTUATED
+
+        handler.process_job(_make_job_data())
+
+        mock_audio.get_audio_duration.assert_not_called()
+        mock_audio.format_text_with_llm.assert_called_once()
+
+
+class TestBalanceDeduction:
+    """adjust_user_balance returns the written balance; callers skip re-reads."""
+
+    @pytest.fixture
+    def ts(self):
+        from tablestore_service import TablestoreService
+        ts = TablestoreService.__new__(TablestoreService)
+        ts.client = MagicMock()
+        ts.get_user = MagicMock(return_value={'balance_minutes': 7})
+        return ts
+
+    def test_ceil_minutes(self):
+        from utility import ceil_minutes
+        assert [ceil_minutes(s) for s in (0, 1, 60, 61, 119.5)] == [0, 1, 1, 2, 2]
+
+    def test_adjust_returns_new_balance(self, ts):
+        assert ts.adjust_user_balance(1, -3) == 4
+        assert ts.adjust_user_balance(1, -10) == 0  # clamped, still a success
+
+    def test_adjust_failure_returns_none(self, ts):
+        ts.get_user.return_value = None
+        assert ts.adjust_user_balance(1, -3) is None
+        ts.client.update_row.side_effect = Exception('OTSConditionCheckFail')
+        assert ts.update_user_balance(1, -3) is False
+
+    def test_update_is_single_increment(self, ts):
+        from tablestore import ComparatorType
+        assert ts.update_user_balance(1, -3) is True
+        ts.get_user.assert_not_called()
+        table, row, condition = ts.client.update_row.call_args[0]
+        assert row.attribute_columns['increment'] == [('balance_minutes', -3)]
+        assert condition.column_condition.comparator == ComparatorType.GREATER_EQUAL
+        assert condition.column_condition.column_value == 3
+
+    def test_credit_has_no_column_condition(self, ts):
+        assert ts.update_user_balance(1, 10) is True
+        _, row, condition = ts.client.update_row.call_args[0]
+        assert row.attribute_columns['increment'] == [('balance_minutes', 10)]
+        assert condition.column_condition is None
+
+    def test_insufficient_balance_falls_back_to_clamp(self, ts):
+        """A failed conditional increment is retried as read-modify-write clamped at 0."""
+        ts.client.update_row.side_effect = [Exception('OTSConditionCheckFail'), None]
+        assert ts.update_user_balance(1, -10) is True
+        ts.get_user.assert_called_once()
+        _, row, _ = ts.client.update_row.call_args[0]
+        assert ('balance_minutes', 0) in row.attribute_columns['put']
+
+    def test_unknown_outcome_not_retried(self, ts):
+        """A timeout may have applied the increment; falling back would apply delta twice."""
+        ts.client.update_row.side_effect = TimeoutError('read timed out')
+        assert ts.update_user_balance(1, -3) is False
+        ts.get_user.assert_not_called()
+        ts.client.update_row.assert_called_once()
+
+    def test_legacy_column_falls_back(self, ts):
+        ts.client.update_row.side_effect = [Exception('OTSParameterInvalid: column type mismatch'), None]
+        assert ts.update_user_balance(1, -3) is True
+        ts.get_user.assert_called_once()
+
+    def test_micro_purchases_increment(self, ts):
+        assert ts.increment_micro_purchases(1) is True
+        ts.get_user.assert_not_called()
+        _, row, _ = ts.client.update_row.call_args[0]
+        assert row.attribute_columns == {'increment': [('micro_package_purchases', 1)]}
+
+    def test_update_keeps_bool_contract(self, ts):
+        assert ts.update_user_balance(1, -10) is True
+
+    def test_webhook_warns_from_written_balance(self):
+        import main
+        db = MagicMock()
+        db.adjust_user_balance.return_value = 2
+        tg = MagicMock()
+        tg.edit_message_text.return_value = True
+        audio = MagicMock()
+        audio.transcribe_audio.return_value = 'Короткий текст.'
+        audio.prepare_audio_for_asr.return_value = ('/tmp/a.mp3', 30.0)
+        audio.ASR_MAX_CHUNK_DURATION = 150
+        user = {'balance_minutes': 50, 'settings': '{}'}
+        message = {'chat': {'id': 1}, 'from': {'id': 1}, 'voice': {'file_id': 'f', 'duration': 30}}
+
+        with patch.object(main, 'get_db_service', return_value=db), \
+             patch.object(main, 'get_telegram_service', return_value=tg), \
+             patch('services.audio.AudioService', return_value=audio), \
+             patch('os.remove'):
+            main.process_audio_sync(message, user, 'f', 'voice', 30, status_message_id=5)
+
+        db.get_user.assert_not_called()
+        assert any('Осталось: 2 мин' in str(c) for c in tg.send_message.call_args_list)
+
+
+class TestDiarizeProgress:
+    """Diarization stage text never blocks the diarization thread."""
+
+    def _run(self, mock_audio, mock_tg, progress=None):
+        import handler
+
+        def fake_diarize(path, progress_callback=None, debug=None):
+            for stage in ('🔄 A', '🔄 A', '🔄 B'):
+                progress_callback(stage)
+            return 'text', []
+
+        mock_audio.transcribe_with_diarization.side_effect = fake_diarize
+        mock_audio.transcribe_audio.return_value = 'text'
+        with patch.object(handler, '_ui_executor') as executor:
+            handler._transcribe(mock_audio, mock_tg, '/tmp/a.mp3', 600, 1, 42, False,
+                                progress=progress)
+        return executor
+
+    def test_fallback_edits_go_to_ui_executor(self, mock_audio, mock_tg):
+        executor = self._run(mock_audio, mock_tg)
+
+        mock_tg.edit_message_text.assert_not_called()
+        stages = [c.args[3] for c in executor.submit.call_args_list
+                  if c.args[0] is mock_tg.edit_message_text]
+        assert stages == ['🔄 A', '🔄 B']
+
+    def test_repeated_stage_not_forwarded(self, mock_audio, mock_tg):
+        progress = MagicMock()
+        self._run(mock_audio, mock_tg, progress=progress)
+
+        assert [c.args[0] for c in progress.update.call_args_list] == ['🔄 A', '🔄 B']
+
+
+class TestPolledMessageDelete:
+    """A failed MNS delete is retried on the post pool, not inline."""
+
+    MSG = {'data': {'job_id': 'j1'}, 'receipt_handle': 'rh-1'}
+
+    def test_success_deletes_once(self):
+        import handler
+        mns = MagicMock()
+        mns.delete_message.return_value = True
+
+        with patch.object(handler, 'process_job', return_value={'ok': True}), \
+             patch.object(handler, '_submit_post') as submit:
+            assert handler._process_polled_message(mns, self.MSG) == 'Processed job j1'
+
+        mns.delete_message.assert_called_once_with('rh-1')
+        submit.assert_not_called()
+
+    def test_failed_delete_retried_in_background(self):
+        import handler
+        mns = MagicMock()
+        mns.delete_message.side_effect = [False, Exception('timeout'), True]
+
+        with patch.object(handler, 'process_job', return_value={'ok': True}), \
+             patch.object(handler.time, 'sleep') as sleep:
+            assert handler._process_polled_message(mns, self.MSG) == 'Processed job j1'
+            handler.drain_post_work()
+
+        assert mns.delete_message.call_count == 3
+        assert [c.args[0] for c in sleep.call_args_list] == [1, 2]
+
+
+class TestJobTrace:
+    """process_job logs one structured INFO record with per-stage timings."""
+
+    def test_single_completion_record(self, patch_services):
+        import handler
+        with patch.object(handler.logger, 'info') as info:
+            handler.process_job(_make_job_data())
+
+        records = [c for c in info.call_args_list if 'job_trace' in c.kwargs.get('extra', {})]
+        assert len(records) == 1
+        job_trace = records[0].kwargs['extra']['job_trace']
+        assert job_trace['job_id'] == 'job-001'
+        for stage in ('start', 'download', 'transcribe', 'format', 'deliver'):
+            assert f'{stage}_ms' in job_trace
+        assert job_trace['is_dialogue'] is False
+
+    def test_stage_logs_are_debug(self, patch_services):
+        import handler
+        with patch.object(handler.logger, 'info') as info:
+            handler.process_job(_make_job_data())
+
+        assert not any(str(c.args[0]).startswith('[') for c in info.call_args_list)
+
+
+class TestPerJobState:
+    """Jobs running side by side in poll_queue keep their own trace and diarization debug."""
+
+    def test_trace_context_per_thread(self):
+        from utility import get_trace_id, set_trace_context
+        barrier = threading.Barrier(2, timeout=5)
+        seen = {}
+
+        def job(trace_id):
+            set_trace_context(trace_id=trace_id, user_id=trace_id)
+            barrier.wait()  # both jobs have set their context before either reads it
+            seen[trace_id] = get_trace_id()
+
+        threads = [threading.Thread(target=job, args=(t,)) for t in ('t1', 't2')]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert seen == {'t1': 't1', 't2': 't2'}
+
+    def test_diarization_debug_passed_per_call(self, mock_audio, mock_tg):
+        import handler
+
+        def fake_diarize(path, progress_callback=None, debug=None):
+            debug['backend'] = 'gemini'
+            return 'text', []
+
+        mock_audio.transcribe_with_diarization.side_effect = fake_diarize
+        mock_audio.transcribe_audio.return_value = 'text'
+        debug = {}
+        handler._transcribe(mock_audio, mock_tg, '/tmp/a.mp3', 600, 1, 42, False, debug=debug)
+
+        assert debug == {'backend': 'gemini'}
+
+
+class TestFasterWhisperBatching:
+    """transcribe_with_faster_whisper passes batch_size to the batched pipeline."""
+
+    def _service(self, monkeypatch, batch_size):
+        from audio import AudioService
+        monkeypatch.setenv('WHISPER_BATCH_SIZE', batch_size)
+        service = AudioService(whisper_backend='faster-whisper')
+        service._faster_whisper_model = MagicMock()
+        segment = MagicMock(text=' Привет, как дела? ')
+        service._faster_whisper_model.transcribe.return_value = ([segment], MagicMock())
+        monkeypatch.setattr(service, '_decode_to_pcm16k', MagicMock(return_value='pcm'))
+        return service
+
+    def test_batch_size_passed(self, monkeypatch):
+        service = self._service(monkeypatch, '8')
+        assert service.transcribe_with_faster_whisper('/tmp/a.mp3') == 'Привет, как дела?'
+        kwargs = service._faster_whisper_model.transcribe.call_args.kwargs
+        assert kwargs['batch_size'] == 8
+        assert kwargs['vad_filter'] is True
+
+    def test_greedy_with_temperature_fallback(self, monkeypatch):
+        monkeypatch.delenv('WHISPER_BEAM_SIZE', raising=False)
+        service = self._service(monkeypatch, '16')
+        service.transcribe_with_faster_whisper('/tmp/a.mp3')
+        kwargs = service._faster_whisper_model.transcribe.call_args.kwargs
+        assert kwargs['beam_size'] == 1
+        assert kwargs['temperature'][0] == 0.0 and len(kwargs['temperature']) > 1
+
+    def test_beam_size_env(self, monkeypatch):
+        monkeypatch.setenv('WHISPER_BEAM_SIZE', '5')
+        service = self._service(monkeypatch, '16')
+        service.transcribe_with_faster_whisper('/tmp/a.mp3')
+        assert service._faster_whisper_model.transcribe.call_args.kwargs['beam_size'] == 5
+
+    def test_zero_disables_batching(self, monkeypatch):
+        service = self._service(monkeypatch, '0')
+        service.transcribe_with_faster_whisper('/tmp/a.mp3')
+        assert 'batch_size' not in service._faster_whisper_model.transcribe.call_args.kwargs
+
+    def test_distil_model_uses_chunked_decoding(self, monkeypatch):
+        monkeypatch.setenv('WHISPER_MODEL', 'Systran/faster-distil-whisper-large-v3')
+        service = self._service(monkeypatch, '16')
+        service.transcribe_with_faster_whisper('/tmp/a.mp3')
+        kwargs = service._faster_whisper_model.transcribe.call_args.kwargs
+        assert kwargs['condition_on_previous_text'] is False
+        assert kwargs['chunk_length'] == 30
+
+    def test_default_model_keeps_context(self, monkeypatch):
+        service = self._service(monkeypatch, '16')
+        service.transcribe_with_faster_whisper('/tmp/a.mp3')
+        assert 'chunk_length' not in service._faster_whisper_model.transcribe.call_args.kwargs
+
+    def test_model_gets_decoded_pcm(self, monkeypatch):
+        service = self._service(monkeypatch, '16')
+        service.transcribe_with_faster_whisper('/tmp/a.mp3')
+        service._decode_to_pcm16k.assert_called_once_with('/tmp/a.mp3')
+        assert service._faster_whisper_model.transcribe.call_args[0] == ('pcm',)
+
+
+class TestPcmDecode:
+    """faster-whisper input is decoded once to 16 kHz mono float32; no MP3 in between."""
+
+    def test_decode_reads_f32le_stdout(self):
+        import numpy as np
+        from audio import AudioService
+        samples = np.array([0.0, 0.5, -0.5], dtype=np.float32)
+        svc = AudioService(whisper_backend='qwen-asr')
+        with patch('subprocess.run', return_value=MagicMock(stdout=samples.tobytes())) as mock_run:
+            pcm = svc._decode_to_pcm16k('/tmp/a.ogg')
+        np.testing.assert_array_equal(pcm, samples)
+        args = mock_run.call_args[0][0]
+        assert args[args.index('-f') + 1] == 'f32le'
+        assert args[args.index('-ar') + 1] == '16000'
+        assert args[args.index('-ac') + 1] == '1'
+
+    def test_faster_whisper_skips_mp3_transcode(self):
+        from audio import AudioService
+        svc = AudioService(whisper_backend='qwen-asr')
+        svc.whisper_backend = AudioService.BACKEND_FASTER_WHISPER
+        with patch.object(svc, '_check_mime_type', return_value=True), \
+             patch.object(svc, 'is_video_file', return_value=False), \
+             patch.object(svc, 'get_audio_duration', return_value=12.0), \
+             patch.object(svc, '_convert_to_mp3') as mock_convert:
+            assert svc.prepare_audio_for_asr('/tmp/a.m4a') == ('/tmp/a.m4a', 12.0)
+        mock_convert.assert_not_called()
+
+    def test_faster_whisper_still_converts_video(self):
+        from audio import AudioService
+        svc = AudioService(whisper_backend='qwen-asr')
+        svc.whisper_backend = AudioService.BACKEND_FASTER_WHISPER
+        with patch.object(svc, '_check_mime_type', return_value=True), \
+             patch.object(svc, 'is_video_file', return_value=True), \
+             patch.object(svc, '_convert_to_mp3', return_value=('/tmp/out.mp3', 12.0)):
+            assert svc.prepare_audio_for_asr('/tmp/a.mp4') == ('/tmp/out.mp3', 12.0)
+
+
+class TestFasterWhisperComputeType:
+    """GPU loads int8_float16 weights unless WHISPER_COMPUTE_TYPE overrides it."""
+
+    def _init(self, monkeypatch, cuda):
+        from audio import AudioService
+        fw = MagicMock()
+        torch = MagicMock()
+        torch.cuda.is_available.return_value = cuda
+        fw.WhisperModel.return_value.transcribe.return_value = ([], None)
+        monkeypatch.setenv('WHISPER_BATCH_SIZE', '0')
+        with patch.dict(sys.modules, {'faster_whisper': fw, 'torch': torch}):
+            AudioService(whisper_backend='faster-whisper')
+        return fw.WhisperModel.call_args.kwargs['compute_type']
+
+    def test_gpu_default_int8_float16(self, monkeypatch):
+        monkeypatch.delenv('WHISPER_COMPUTE_TYPE', raising=False)
+        assert self._init(monkeypatch, cuda=True) == 'int8_float16'
+
+    def test_cpu_default_int8(self, monkeypatch):
+        monkeypatch.delenv('WHISPER_COMPUTE_TYPE', raising=False)
+        assert self._init(monkeypatch, cuda=False) == 'int8'
+
+    def test_env_override(self, monkeypatch):
+        monkeypatch.setenv('WHISPER_COMPUTE_TYPE', 'float16')
+        assert self._init(monkeypatch, cuda=True) == 'float16'
+
+
+class TestFasterWhisperWorkers:
+    """Jobs polled together transcribe on parallel CTranslate2 workers."""
+
+    def _model_kwargs(self, monkeypatch):
+        from audio import AudioService
+        fw = MagicMock()
+        fw.WhisperModel.return_value.transcribe.return_value = ([], None)
+        monkeypatch.setenv('WHISPER_BATCH_SIZE', '0')
+        with patch.dict(sys.modules, {'faster_whisper': fw, 'torch': MagicMock()}):
+            AudioService(whisper_backend='faster-whisper')
+        return fw.WhisperModel.call_args.kwargs
+
+    def _num_workers(self, monkeypatch):
+        return self._model_kwargs(monkeypatch)['num_workers']
+
+    def test_defaults_to_audio_workers(self, monkeypatch):
+        monkeypatch.delenv('WHISPER_NUM_WORKERS', raising=False)
+        monkeypatch.setenv('AUDIO_WORKERS', '3')
+        assert self._num_workers(monkeypatch) == 3
+
+    def test_env_override(self, monkeypatch):
+        monkeypatch.setenv('WHISPER_NUM_WORKERS', '2')
+        assert self._num_workers(monkeypatch) == 2
+
+    def test_cpu_threads_split_across_workers(self, monkeypatch):
+        monkeypatch.setenv('WHISPER_NUM_WORKERS', '2')
+        monkeypatch.delenv('WHISPER_CPU_THREADS', raising=False)
+        monkeypatch.delenv('OMP_NUM_THREADS', raising=False)
+        monkeypatch.setattr(os, 'cpu_count', lambda: 8)
+        assert self._model_kwargs(monkeypatch)['cpu_threads'] == 4
+        assert os.environ['OMP_NUM_THREADS'] == '4'
+
+    def test_cpu_threads_env(self, monkeypatch):
+        monkeypatch.setenv('WHISPER_CPU_THREADS', '3')
+        monkeypatch.setenv('OMP_NUM_THREADS', '1')
+        assert self._model_kwargs(monkeypatch)['cpu_threads'] == 3
+        assert os.environ['OMP_NUM_THREADS'] == '1'  # an explicit setting wins
+
+
+class TestFasterWhisperPreload:
+    """The model loads (and warms up) once per process, at construction."""
+
+    @pytest.fixture
+    def fw(self, monkeypatch):
+        fw = MagicMock()
+        fw.WhisperModel.return_value.transcribe.return_value = ([], None)
+        torch = MagicMock()
+        torch.cuda.is_available.return_value = False
+        with patch.dict(sys.modules, {'faster_whisper': fw, 'torch': torch}):
+            yield fw
+
+    def test_instances_share_one_model(self, fw):
+        from audio import AudioService
+        first = AudioService(whisper_backend='faster-whisper')
+        second = AudioService(whisper_backend='faster-whisper')
+
+        fw.WhisperModel.assert_called_once()
+        assert first._faster_whisper_model is second._faster_whisper_model
+        assert first._faster_whisper_model is fw.BatchedInferencePipeline.return_value
+
+    def test_warm_up_decodes_silence(self, fw):
+        from audio import AudioService
+        AudioService(whisper_backend='faster-whisper')
+
+        audio = fw.WhisperModel.return_value.transcribe.call_args.args[0]
+        assert len(audio) == 16000 and not audio.any()
+
+    def test_preload_failure_is_deferred(self):
+        from audio import AudioService
+        with patch.dict(sys.modules, {'faster_whisper': None}):  # ImportError on import
+            service = AudioService(whisper_backend='faster-whisper')
+        assert service._faster_whisper_model is None
+
+
+class TestFfmpegWhisperStreaming:
+    """transcribe_with_ffmpeg_whisper parses segments from streamed stderr."""
+
+    @pytest.fixture
+    def audio_service(self):
+        from audio import AudioService
+        return AudioService(whisper_backend='qwen-asr', alibaba_api_key='test-key')
+
+    def _run(self, audio_service, lines, returncode=0):
+        import subprocess
+        process = MagicMock()
+        process.stderr = io.StringIO("".join(lines))
+        process.wait.return_value = returncode
+        with patch.object(audio_service, 'get_audio_duration', return_value=30.0), \
+             patch.object(subprocess, 'Popen', return_value=process) as popen:
+            result = audio_service.transcribe_with_ffmpeg_whisper('/tmp/a.mp3')
+        assert popen.call_args.kwargs['stderr'] == subprocess.PIPE
+        return result
+
+    def test_segments_across_lines(self, audio_service):
+        lines = [
+            "[whisper @ 0x1] run transcription at 0 ms\n",
+            '{"t0": 0, "t1": 900,\n',
+            ' "text": " Привет, это первая часть."}\n',
+            'size=N/A time=00:00:05\n',
+            '{"t0": 900, "t1": 1800, "text": " И вторая часть."}\n',
+        ]
+        assert self._run(audio_service, lines) == 'Привет, это первая часть. И вторая часть.'
+
+    def test_legacy_format_fallback(self, audio_service):
+        lines = ["[Parsed_whisper_0 @ 0xabc] Текст без JSON формата\n"]
+        assert self._run(audio_service, lines) == 'Текст без JSON формата'
+
+    def test_nonzero_exit_raises(self, audio_service):
+        import subprocess
+        with pytest.raises(subprocess.CalledProcessError):
+            self._run(audio_service, ['error\n'], returncode=1)
+
+    def test_scanner_matches_whole_string_parse(self, audio_service):
+        stderr = 'x {"text": " a b c "} y {not json} {"t0": 1, "text": "d e f"}'
+        assert audio_service._parse_ffmpeg_whisper_output(stderr) == 'a b c d e f'
+
+    def test_regex_path_handles_escapes(self):
+        from audio import _WhisperSegmentScanner
+        scanner = _WhisperSegmentScanner()
+        scanner.feed('log {"t0": 0, "text": "он сказал \\"да\\" {громко}"} end\n')
+        assert scanner.texts == ['он сказал "да" {громко}']
+
+    def test_plain_lines_skip_scan(self):
+        from audio import _WhisperSegmentScanner
+        scanner = _WhisperSegmentScanner()
+        with patch.object(scanner, '_emit') as emit:
+            scanner.feed('size=N/A time=00:00:05.00 bitrate=N/A\n')
+        emit.assert_not_called()
+
+
+class TestFileBase64:
+    """Audio uploads are base64-encoded from an mmap of the file."""
+
+    def test_matches_plain_encode(self, tmp_path):
+        import base64
+        from audio import AudioService
+        data = bytes(range(256)) * 100
+        path = tmp_path / 'a.mp3'
+        path.write_bytes(data)
+        assert AudioService._file_base64(str(path)) == base64.b64encode(data).decode()
+
+    def test_empty_file(self, tmp_path):
+        from audio import AudioService
+        path = tmp_path / 'empty.mp3'
+        path.write_bytes(b'')
+        assert AudioService._file_base64(str(path)) == ''
+
+
+class TestMp3Reuse:
+    """MP3 input that already matches the selected tier is not re-encoded."""
+
+    MP3_INFO = {'format': 'mp3', 'codec': 'mp3', 'sample_rate': 16000,
+                'bit_rate': 48000, 'channels': 1, 'duration': 60.0}
+
+    @pytest.fixture
+    def audio_service(self):
+        from audio import AudioService
+        svc = AudioService(whisper_backend='qwen-asr')
+        with patch.object(svc, 'get_audio_duration', return_value=60.0):
+            yield svc
+
+    def test_matching_mp3_returned_as_is(self, audio_service):
+        with patch.object(audio_service, 'get_audio_info', return_value=dict(self.MP3_INFO)), \
+             patch('subprocess.run') as mock_run:
+            assert audio_service._convert_to_mp3('/tmp/in.mp3') == ('/tmp/in.mp3', 60.0)
+        mock_run.assert_not_called()
+
+    def test_mp3_in_other_container_is_remuxed(self, audio_service):
+        info = dict(self.MP3_INFO, format='matroska,webm')
+        with patch.object(audio_service, 'get_audio_info', return_value=info), \
+             patch('subprocess.run', return_value=MagicMock(stderr='')) as mock_run, \
+             patch('os.path.getsize', return_value=1000):
+            path, _ = audio_service._convert_to_mp3('/tmp/in.mka')
+        os.unlink(path)
+        args = mock_run.call_args[0][0]
+        assert args[args.index('-c:a') + 1] == 'copy'
+        assert 'libmp3lame' not in args
+
+    @pytest.mark.parametrize('override', [
+        {'codec': 'opus'}, {'channels': 2}, {'sample_rate': 44100}, {'bit_rate': 128000},
+    ])
+    def test_mismatch_transcodes(self, audio_service, override):
+        info = dict(self.MP3_INFO, **override)
+        with patch.object(audio_service, 'get_audio_info', return_value=info), \
+             patch('subprocess.run', return_value=MagicMock(stderr='')) as mock_run, \
+             patch('os.path.getsize', return_value=1000):
+            path, _ = audio_service._convert_to_mp3('/tmp/in.mp3')
+        os.unlink(path)
+        assert 'libmp3lame' in mock_run.call_args[0][0]
+
+    def test_explicit_output_path_always_writes(self, audio_service, tmp_path):
+        out = str(tmp_path / 'out.mp3')
+        with patch.object(audio_service, 'get_audio_info', return_value=dict(self.MP3_INFO)) as mock_info, \
+             patch('subprocess.run', return_value=MagicMock(stderr='')), \
+             patch('os.path.getsize', return_value=1000):
+            assert audio_service._convert_to_mp3('/tmp/in.mp3', out)[0] == out
+        mock_info.assert_not_called()
+
+
+class TestFfprobeCache:
+    """An unchanged file is probed once; a rewritten file is probed again."""
+
+    PROBE = MagicMock(stdout=json.dumps({'format': {'duration': '12.5'}}))
+
+    def test_repeat_probe_cached(self, tmp_path):
+        from audio import AudioService
+        path = tmp_path / 'a.mp3'
+        path.write_bytes(b'abc')
+        svc = AudioService(whisper_backend='qwen-asr')
+        with patch('subprocess.run', return_value=self.PROBE) as mock_run:
+            assert svc.get_audio_duration(str(path)) == 12.5
+            assert svc.get_audio_duration(str(path)) == 12.5
+        assert mock_run.call_count == 1
+
+    def test_changed_file_reprobed(self, tmp_path):
+        from audio import AudioService
+        path = tmp_path / 'a.mp3'
+        path.write_bytes(b'abc')
+        svc = AudioService(whisper_backend='qwen-asr')
+        with patch('subprocess.run', return_value=self.PROBE) as mock_run:
+            svc.get_audio_duration(str(path))
+            path.write_bytes(b'abcdef')
+            svc.get_audio_duration(str(path))
+        assert mock_run.call_count == 2
+
+    def test_failure_not_cached(self, tmp_path):
+        import subprocess
+        from audio import AudioService
+        path = tmp_path / 'a.mp3'
+        path.write_bytes(b'abc')
+        svc = AudioService(whisper_backend='qwen-asr')
+        error = subprocess.CalledProcessError(1, 'ffprobe')
+        with patch('subprocess.run', side_effect=[error, self.PROBE]):
+            assert svc.get_audio_duration(str(path)) == 600.0
+            assert svc.get_audio_duration(str(path)) == 12.5
+
+
+class TestSingleProbe:
+    """Duration and stream info come from one ffprobe of the first audio stream."""
+
+    def test_duration_and_info_share_one_call(self, tmp_path):
+        from audio import AudioService
+        path = tmp_path / 'v.mp4'
+        path.write_bytes(b'abc')
+        probe = MagicMock(stdout=json.dumps({
+            'format': {'duration': '30.0', 'bit_rate': 'N/A', 'format_name': 'mov,mp4'},
+            'streams': [{'codec_name': 'aac', 'sample_rate': '44100', 'channels': 2}],
+        }))
+        svc = AudioService(whisper_backend='qwen-asr')
+        with patch('subprocess.run', return_value=probe) as mock_run:
+            assert svc.get_audio_duration(str(path)) == 30.0
+            info = svc.get_audio_info(str(path))
+        assert mock_run.call_count == 1
+        assert mock_run.call_args[0][0][mock_run.call_args[0][0].index('-select_streams') + 1] == 'a:0'
+        assert info == {'format': 'mov,mp4', 'codec': 'aac', 'sample_rate': 44100,
+                        'bit_rate': 0, 'channels': 2, 'duration': 30.0}
+
+    def test_video_check_reuses_probe(self, tmp_path):
+        """is_video_file() then get_audio_duration() on the same file: one ffprobe."""
+        from audio import AudioService
+        path = tmp_path / 'v.mp4'
+        path.write_bytes(b'abc')
+        probe = MagicMock(stdout=json.dumps({'format': {'duration': '30.0', 'format_name': 'mov,mp4'}}))
+        svc = AudioService(whisper_backend='qwen-asr')
+        with patch('subprocess.run', return_value=probe) as mock_run:
+            assert svc.is_video_file(str(path)) is True
+            assert svc.get_audio_duration(str(path)) == 30.0
+        assert mock_run.call_count == 1
+
+    def test_video_extension_fallback(self):
+        from audio import AudioService
+        svc = AudioService(whisper_backend='qwen-asr')
+        with patch.object(svc, 'get_audio_info', return_value=None):
+            assert svc.is_video_file('/tmp/CLIP.MOV') is True
+            assert svc.is_video_file('/tmp/a.ogg') is False
+
+    def test_stdout_parsed_as_bytes(self, tmp_path):
+        from audio import AudioService
+        path = tmp_path / 'a.mp3'
+        path.write_bytes(b'abc')
+        svc = AudioService(whisper_backend='qwen-asr')
+        with patch('subprocess.run', return_value=MagicMock(stdout=b'{"format": {"duration": "7.5"}}')) as mock_run:
+            assert svc.get_audio_duration(str(path)) == 7.5
+        assert 'text' not in mock_run.call_args.kwargs
+
+    def test_missing_duration_falls_back(self, tmp_path):
+        from audio import AudioService
+        path = tmp_path / 'a.mp3'
+        path.write_bytes(b'abc')
+        svc = AudioService(whisper_backend='qwen-asr')
+        with patch('subprocess.run', return_value=MagicMock(stdout='{"format": {}}')):
+            assert svc.get_audio_duration(str(path)) == 600.0
+
+
+class TestOssMultipartUpload:
+    """Large OSS uploads go through oss2.resumable_upload with parallel parts."""
+
+    def _upload(self, size):
+        from audio import AudioService
+        svc = AudioService(whisper_backend='qwen-asr')
+        svc.oss_config = {'bucket': 'b'}
+        svc._oss_bucket = MagicMock()
+        with patch('os.path.getsize', return_value=size), \
+             patch('oss2.resumable_upload') as mock_resumable:
+            key, _ = svc._upload_to_oss_with_url('/tmp/a.mp3')
+        return svc._oss_bucket, mock_resumable, key
+
+    def test_small_file_single_put(self):
+        bucket, mock_resumable, key = self._upload(1024 * 1024)
+        bucket.put_object_from_file.assert_called_once_with(key, '/tmp/a.mp3')
+        mock_resumable.assert_not_called()
+
+    def test_large_file_parallel_parts(self):
+        bucket, mock_resumable, key = self._upload(18 * 1024 * 1024)
+        bucket.put_object_from_file.assert_not_called()
+        args, kwargs = mock_resumable.call_args
+        assert args == (bucket, key, '/tmp/a.mp3')
+        assert kwargs['num_threads'] == 4
+        assert kwargs['part_size'] == 2 * 1024 * 1024
+        assert kwargs['store'].dir.startswith('/tmp/')
+
+
+class TestOssBackgroundDelete:
+    """OSS cleanup is queued; the caller does not wait for delete_object."""
+
+    def test_cleanup_does_not_block(self):
+        from audio import AudioService
+        svc = AudioService(whisper_backend='qwen-asr')
+        svc._oss_bucket = MagicMock()
+        release, deleted = threading.Event(), threading.Event()
+
+        def slow_delete(key):
+            release.wait(5)
+            deleted.set()
+        svc._oss_bucket.delete_object.side_effect = slow_delete
+
+        svc._cleanup_oss_key('diarization/a.mp3')  # returns while the delete is blocked
+        assert not deleted.is_set()
+        release.set()
+
+        assert deleted.wait(5)
+        svc._oss_bucket.delete_object.assert_called_once_with('diarization/a.mp3')
+
+    def test_drain_waits_for_pending_delete(self):
+        from audio import AudioService
+        svc = AudioService(whisper_backend='qwen-asr')
+        svc._oss_bucket = MagicMock()
+        release = threading.Event()
+        svc._oss_bucket.delete_object.side_effect = lambda key: release.wait(5)
+
+        svc._cleanup_oss_key('diarization/b.mp3')
+        assert AudioService.drain_oss_cleanup(timeout=0.05) is False
+        release.set()
+        assert AudioService.drain_oss_cleanup(timeout=5) is True
+        assert not AudioService._oss_cleanup_pending
+
+    def test_handler_drain_includes_oss_deletes(self):
+        import handler
+        audio_module = MagicMock()
+        audio_module.AudioService.drain_oss_cleanup.return_value = False
+        with patch.dict(sys.modules, {'services.audio': audio_module}):
+            assert handler.drain_post_work(timeout=1) is False
+        audio_module.AudioService.drain_oss_cleanup.assert_called_once()
+
+    def test_delete_failure_swallowed(self):
+        from audio import AudioService
+        bucket = MagicMock()
+        bucket.delete_object.side_effect = RuntimeError('boom')
+        AudioService._delete_oss_key(bucket, 'k')  # logs, does not raise
+
+    def test_delete_from_oss_url(self):
+        from audio import AudioService
+        svc = AudioService(whisper_backend='qwen-asr')
+        with patch.object(svc, '_cleanup_oss_key') as mock_cleanup:
+            svc._delete_from_oss('oss://bucket/audio/x.mp3')
+        mock_cleanup.assert_called_once_with('audio/x.mp3')
+
+
+@pytest.mark.skipif(not hasattr(os, 'posix_fadvise'), reason='posix_fadvise is Linux-only')
+class TestPageCacheHints:
+    """Read-once temp audio is released from the page cache after use."""
+
+    def test_dropped_after_conversion(self, tmp_path):
+        from audio import AudioService
+        src = tmp_path / 'in.ogg'
+        src.write_bytes(b'ogg')
+        svc = AudioService(whisper_backend='qwen-asr')
+        with patch.object(svc, 'get_audio_duration', return_value=5.0), \
+             patch.object(svc, 'get_audio_info', return_value=None), \
+             patch('subprocess.run', return_value=MagicMock(stderr='')), \
+             patch('os.path.getsize', return_value=1000), \
+             patch('os.posix_fadvise') as mock_fadvise:
+            path, _ = svc._convert_to_mp3(str(src))
+        os.unlink(path)
+        mock_fadvise.assert_called_once()
+        assert mock_fadvise.call_args[0][1:] == (0, 0, os.POSIX_FADV_DONTNEED)
+
+    def test_missing_file_ignored(self):
+        from audio import AudioService
+        AudioService._drop_page_cache('/nonexistent/file.ogg')  # no error
+
+    def test_base64_drops_after_encode(self, tmp_path):
+        from audio import AudioService
+        src = tmp_path / 'a.mp3'
+        src.write_bytes(b'abc')
+        with patch('os.posix_fadvise') as mock_fadvise:
+            assert AudioService._file_base64(str(src)) == 'YWJj'
+        assert mock_fadvise.call_args[0][3] == os.POSIX_FADV_DONTNEED
+
+
+class TestPooledClients:
+    """LLM formatting and OSS reuse keep-alive connections instead of fresh TLS per call."""
+
+    def test_qwen_llm_uses_shared_session(self, monkeypatch):
+        from audio import AudioService
+        monkeypatch.setenv('DASHSCOPE_API_KEY', 'k')
+        session = MagicMock()
+        session.post.return_value.status_code = 500
+        svc = AudioService(whisper_backend='qwen-asr', http_session=session)
+        text = ' '.join(['слово'] * 20)
+        with patch('requests.post') as plain_post:
+            svc.format_text_with_qwen(text, _is_fallback=True)
+        session.post.assert_called_once()
+        plain_post.assert_not_called()
+
+    def test_buckets_share_one_oss_session(self):
+        import oss2
+        from audio import AudioService
+        config = {'bucket': 'b', 'endpoint': 'oss.example.com',
+                  'access_key_id': 'ak', 'access_key_secret': 'sk'}
+        with patch.object(AudioService, '_oss_session', None), \
+             patch.object(oss2, 'Bucket') as mock_bucket:
+            AudioService(whisper_backend='qwen-asr', oss_config=config)._get_oss_bucket()
+            AudioService(whisper_backend='qwen-asr', oss_config=config)._get_oss_bucket()
+            sessions = [c.kwargs['session'] for c in mock_bucket.call_args_list]
+        assert len(sessions) == 2 and sessions[0] is sessions[1]
+
+
+class TestFormatCache:
+    """Re-sent audio with the same transcript and settings reuses the cached LLM output."""
+
+    TEXT = 'ну вот значит мы пришли туда и там никого не было совсем ' * 3
+
+    def test_key_depends_on_options(self):
+        from utility import format_cache_key
+        assert format_cache_key('a', use_yo=True, backend='qwen') == \
+            format_cache_key('a', backend='qwen', use_yo=True)
+        assert format_cache_key('a', use_yo=True) != format_cache_key('a', use_yo=False)
+        assert format_cache_key('a', use_yo=True) != format_cache_key('b', use_yo=True)
+
+    def test_disabled_by_default(self, mock_audio, mock_db):
+        import handler
+        with patch.object(handler, 'FORMAT_CACHE', False), \
+             patch.object(handler, 'get_db_service', return_value=mock_db):
+            result = handler._format_with_llm(mock_audio, self.TEXT, use_yo=True)
+        assert result == 'Formatted text from LLM.'
+        mock_db.get_formatted_text.assert_not_called()
+
+    def test_hit_skips_llm(self, mock_audio, mock_db):
+        import handler
+        mock_db.get_formatted_text.return_value = 'Cached text.'
+        with patch.object(handler, 'FORMAT_CACHE', True), \
+             patch.object(handler, 'get_db_service', return_value=mock_db):
+            result = handler._format_with_llm(
+                mock_audio, self.TEXT, progress_callback=MagicMock(), use_yo=True)
+        assert result == 'Cached text.'
+        mock_audio.format_text_with_llm.assert_not_called()
+
+    def test_miss_stores_after_llm(self, mock_audio, mock_db):
+        import handler
+        from utility import format_cache_key
+        mock_db.get_formatted_text.return_value = None
+        with patch.object(handler, 'FORMAT_CACHE', True), \
+             patch.object(handler, 'get_db_service', return_value=mock_db):
+            result = handler._format_with_llm(mock_audio, self.TEXT, use_yo=True)
+            handler.drain_post_work()
+        assert result == 'Formatted text from LLM.'
+        mock_db.put_formatted_text.assert_called_once_with(
+            format_cache_key(self.TEXT, use_yo=True), 'Formatted text from LLM.')
+
+    def test_unchanged_text_not_stored(self, mock_audio, mock_db):
+        """LLM failure returns the input text; caching it would pin the failure."""
+        import handler
+        mock_db.get_formatted_text.return_value = None
+        mock_audio.format_text_with_llm.return_value = self.TEXT
+        with patch.object(handler, 'FORMAT_CACHE', True), \
+             patch.object(handler, 'get_db_service', return_value=mock_db):
+            handler._format_with_llm(mock_audio, self.TEXT, use_yo=True)
+            handler.drain_post_work()
+        mock_db.put_formatted_text.assert_not_called()
+
+    def test_shared_wrapper_stores_inline(self, mock_audio, mock_db):
+        """Without a store callback (webhook path) the cache write is synchronous."""
+        from utility import format_cache_key, format_with_cache
+        mock_db.get_formatted_text.return_value = None
+        result = format_with_cache(mock_audio, mock_db, self.TEXT, progress_callback=MagicMock(), use_yo=True)
+        assert result == 'Formatted text from LLM.'
+        mock_db.put_formatted_text.assert_called_once_with(
+            format_cache_key(self.TEXT, use_yo=True), 'Formatted text from LLM.')
+
+
+class TestShortTextBeforeDispatch:
+    """Clips under 10 words never reach a formatting backend."""
+
+    def test_short_text_skips_backends(self):
+        from audio import AudioService
+        svc = AudioService(whisper_backend='qwen-asr')
+        with patch.object(svc, 'format_text_with_qwen') as qwen, \
+             patch.object(svc, 'format_text_with_assemblyai') as aai:
+            assert svc.format_text_with_llm('Привет . . . как дела', backend='qwen') == 'Привет ... как дела'
+        qwen.assert_not_called()
+        aai.assert_not_called()
+
+    def test_ten_words_dispatched(self):
+        from audio import AudioService
+        svc = AudioService(whisper_backend='qwen-asr')
+        text = ' '.join(['слово'] * 10)
+        with patch.object(svc, 'format_text_with_qwen', return_value='ok') as qwen:
+            assert svc.format_text_with_llm(text, backend='qwen') == 'ok'
+        qwen.assert_called_once()
+
+
+class TestPromptTemplate:
+    """The instruction head is cached per flag set; the transcript is never templated."""
+
+    def test_head_cached_and_text_appended(self):
+        import audio
+        from audio import AudioService
+        svc = AudioService(whisper_backend='qwen-asr')
+        audio._format_prompt_head.cache_clear()
+        first = svc._build_format_prompt('первый {текст}', False, True, False, False)
+        second = svc._build_format_prompt('второй', False, True, False, False)
+        assert audio._format_prompt_head.cache_info().hits == 1
+        assert first.endswith('Текст для форматирования:\n\nпервый {текст}')
+        assert first[:-len('первый {текст}')] == second[:-len('второй')]
+
+    def test_flags_select_instructions(self):
+        from audio import AudioService
+        svc = AudioService(whisper_backend='qwen-asr')
+        prompt = svc._build_format_prompt('t', True, False, True, True, speaker_labels=True)
+        assert 'Оберни ВЕСЬ текст в теги <code></code>.' in prompt
+        assert 'Заменяй все буквы ё на е.' in prompt
+        assert '10. ВАЖНО' in prompt and 'МЕТКАМИ СПИКЕРОВ' in prompt
+
+
+class TestLlmHedging:
+    """LLM_HEDGE_DELAY races a slow primary backend against the other one."""
+
+    TEXT = 'ну вот значит мы пришли туда и там никого не было совсем ' * 3
+
+    def _service(self, monkeypatch, delay):
+        from audio import AudioService
+        monkeypatch.setenv('LLM_HEDGE_DELAY', delay)
+        return AudioService(whisper_backend='qwen-asr')
+
+    def test_off_by_default(self, monkeypatch):
+        svc = self._service(monkeypatch, '0')
+        with patch.object(svc, 'format_text_with_qwen', return_value='Q.') as qwen, \
+             patch.object(svc, 'format_text_with_assemblyai') as aai, \
+             patch.object(svc._llm_hedge_pool, 'submit') as submit:
+            assert svc.format_text_with_llm(self.TEXT, backend='qwen') == 'Q.'
+        qwen.assert_called_once()
+        aai.assert_not_called()
+        submit.assert_not_called()
+
+    def test_fast_primary_not_hedged(self, monkeypatch):
+        svc = self._service(monkeypatch, '5')
+        with patch.object(svc, 'format_text_with_qwen', return_value='Q.'), \
+             patch.object(svc, 'format_text_with_assemblyai') as aai:
+            assert svc.format_text_with_llm(self.TEXT, backend='qwen') == 'Q.'
+        aai.assert_not_called()
+
+    def test_slow_primary_loses_to_secondary(self, monkeypatch):
+        svc = self._service(monkeypatch, '0.01')
+        release = threading.Event()
+
+        def slow_qwen(*args, **kwargs):
+            release.wait(5)
+            return 'Q.'
+
+        with patch.object(svc, 'format_text_with_qwen', side_effect=slow_qwen), \
+             patch.object(svc, 'format_text_with_assemblyai', return_value='A.') as aai:
+            assert svc.format_text_with_llm(self.TEXT, backend='qwen') == 'A.'
+            release.set()
+        assert aai.call_args.kwargs['_is_fallback'] is True
+
+    def test_unchanged_secondary_waits_for_primary(self, monkeypatch):
+        """A secondary that returned the input (its own failure) does not win."""
+        svc = self._service(monkeypatch, '0.01')
+        started = threading.Event()
+
+        def slow_qwen(*args, **kwargs):
+            started.wait(5)
+            return 'Q.'
+
+        def failing_aai(text, *args, **kwargs):
+            started.set()
+            return text
+
+        with patch.object(svc, 'format_text_with_qwen', side_effect=slow_qwen), \
+             patch.object(svc, 'format_text_with_assemblyai', side_effect=failing_aai):
+            assert svc.format_text_with_llm(self.TEXT, backend='qwen') == 'Q.'
+
+    def test_primary_failure_falls_back_once(self, monkeypatch):
+        """The hedged primary runs as _is_fallback; an early failure starts the other backend."""
+        svc = self._service(monkeypatch, '5')
+        with patch.object(svc, 'format_text_with_qwen', side_effect=lambda text, *a, **k: text) as qwen, \
+             patch.object(svc, 'format_text_with_assemblyai', return_value='A.') as aai:
+            assert svc.format_text_with_llm(self.TEXT, backend='qwen') == 'A.'
+        assert qwen.call_args.kwargs['_is_fallback'] is True
+        aai.assert_called_once()
+
+    def test_queue_time_not_counted(self, monkeypatch):
+        """Waiting for a free hedge-pool thread does not trigger a hedge."""
+        from concurrent.futures import ThreadPoolExecutor
+        from audio import AudioService
+        svc = self._service(monkeypatch, '0.05')
+        pool = ThreadPoolExecutor(max_workers=1)
+        monkeypatch.setattr(AudioService, '_llm_hedge_pool', pool)
+        pool.submit(time.sleep, 0.2)  # another job holds the only thread
+        with patch.object(svc, 'format_text_with_qwen', return_value='Q.'), \
+             patch.object(svc, 'format_text_with_assemblyai') as aai:
+            assert svc.format_text_with_llm(self.TEXT, backend='qwen') == 'Q.'
+        aai.assert_not_called()
+        pool.shutdown()
+
+
+class TestQwenCircuitBreaker:
+    """Five consecutive Qwen failures skip Qwen for a cooldown, then one probe."""
+
+    TEXT = ' '.join(['слово'] * 20)
+
+    def test_breaker_states(self):
+        from audio import _CircuitBreaker
+        breaker = _CircuitBreaker('test', threshold=2, cooldown=0.05)
+        breaker.record_failure()
+        assert breaker.allow() is True
+        breaker.record_failure()
+        assert breaker.allow() is False
+        time.sleep(0.06)
+        assert breaker.allow() is True    # half-open probe
+        assert breaker.allow() is False   # only one probe in flight
+        breaker.record_failure()
+        assert breaker.allow() is False   # re-opened
+        time.sleep(0.06)
+        assert breaker.allow() is True
+        breaker.record_success()
+        assert breaker.allow() is True and breaker.allow() is True
+
+    def test_open_circuit_skips_qwen_request(self, monkeypatch):
+        import audio
+        from audio import AudioService
+        monkeypatch.setenv('DASHSCOPE_API_KEY', 'k')
+        session = MagicMock()
+        session.post.return_value.status_code = 503
+        svc = AudioService(whisper_backend='qwen-asr', http_session=session)
+        with patch.object(svc, 'format_text_with_assemblyai', return_value='A.') as aai:
+            for _ in range(audio._qwen_breaker.threshold):
+                assert svc.format_text_with_qwen(self.TEXT) == 'A.'
+            assert session.post.call_count == audio._qwen_breaker.threshold
+            assert svc.format_text_with_qwen(self.TEXT) == 'A.'
+        assert session.post.call_count == audio._qwen_breaker.threshold
+        assert aai.call_count == audio._qwen_breaker.threshold + 1
+
+    def test_success_resets_count(self, monkeypatch):
+        import audio
+        from audio import AudioService
+        monkeypatch.setenv('DASHSCOPE_API_KEY', 'k')
+        session = MagicMock()
+        svc = AudioService(whisper_backend='qwen-asr', http_session=session)
+        for _ in range(audio._qwen_breaker.threshold - 1):
+            audio._qwen_breaker.record_failure()
+        session.post.return_value.status_code = 200
+        session.post.return_value.json.return_value = {
+            'output': {'choices': [{'message': {'content': 'Готовый текст.'}}]}}
+        assert svc.format_text_with_qwen(self.TEXT) == 'Готовый текст.'
+        audio._qwen_breaker.record_failure()
+        assert audio._qwen_breaker.allow() is True
+
+
+class TestPyAvProbe:
+    """With PyAV importable, probing opens the file in-process instead of forking ffprobe."""
+
+    @staticmethod
+    def _fake_av(container=None, error=None):
+        av = MagicMock(time_base=1000000)
+        if error:
+            av.open.side_effect = error
+        else:
+            av.open.return_value.__enter__.return_value = container
+        return av
+
+    @staticmethod
+    def _container():
+        ctx = MagicMock(sample_rate=16000, layout=MagicMock(nb_channels=1))
+        ctx.name = 'opus'
+        container = MagicMock(duration=12500000, bit_rate=24000)
+        container.format.name = 'ogg'
+        container.streams.audio = [MagicMock(codec_context=ctx)]
+        return container
+
+    def test_pyav_used_without_subprocess(self, tmp_path):
+        import audio
+        from audio import AudioService
+        path = tmp_path / 'a.ogg'
+        path.write_bytes(b'abc')
+        av = self._fake_av(self._container())
+        svc = AudioService(whisper_backend='qwen-asr')
+        with patch.object(audio, '_pyav', return_value=av), \
+             patch('subprocess.run') as mock_run:
+            assert svc.get_audio_info(str(path)) == {
+                'format': 'ogg', 'codec': 'opus', 'sample_rate': 16000,
+                'bit_rate': 24000, 'channels': 1, 'duration': 12.5}
+            assert svc.get_audio_duration(str(path)) == 12.5
+        mock_run.assert_not_called()
+        av.open.assert_called_once()
+
+    def test_unreadable_file_falls_back_to_ffprobe(self, tmp_path):
+        import audio
+        from audio import AudioService
+        path = tmp_path / 'a.amr'
+        path.write_bytes(b'abc')
+        av = self._fake_av(error=ValueError('unsupported'))
+        probe = MagicMock(stdout=json.dumps({'format': {'duration': '3.0'}}))
+        svc = AudioService(whisper_backend='qwen-asr')
+        with patch.object(audio, '_pyav', return_value=av), \
+             patch('subprocess.run', return_value=probe) as mock_run:
+            assert svc.get_audio_duration(str(path)) == 3.0
+        mock_run.assert_called_once()
+
+    def test_no_pyav_uses_ffprobe(self, tmp_path):
+        import audio
+        from audio import AudioService
+        path = tmp_path / 'a.mp3'
+        path.write_bytes(b'abc')
+        probe = MagicMock(stdout=json.dumps({'format': {'duration': '4.0'}}))
+        svc = AudioService(whisper_backend='qwen-asr')
+        with patch.object(audio, '_pyav', return_value=None), \
+             patch('subprocess.run', return_value=probe) as mock_run:
+            assert svc.get_audio_duration(str(path)) == 4.0
+        mock_run.assert_called_once()
+
+
+class TestUserPaging:
+    """iter_all_users follows next_start_primary_key across get_range pages."""
+
+    @pytest.fixture
+    def ts(self):
+        from tablestore_service import TablestoreService
+        ts = TablestoreService.__new__(TablestoreService)
+        ts.client = MagicMock()
+        ts._row_to_dict = lambda row: {'user_id': row}
+        return ts
+
+    def test_follows_pages(self, ts):
+        ts.client.get_range.side_effect = [
+            (None, [('user_id', 'b')], ['a'], None),
+            (None, None, ['b', 'c'], None),
+        ]
+        assert [u['user_id'] for u in ts.iter_all_users(page_size=2)] == ['a', 'b', 'c']
+        assert ts.client.get_range.call_args_list[1][0][2] == [('user_id', 'b')]
+
+    def test_get_all_users_stops_at_limit(self, ts):
+        ts.client.get_range.side_effect = [
+            (None, [('user_id', 'c')], ['a', 'b'], None),
+            (None, None, ['c', 'd'], None),
+        ]
+        assert [u['user_id'] for u in ts.get_all_users(limit=3)] == ['a', 'b', 'c']
+        assert ts.client.get_range.call_args_list[0][0][5] == 3
+
+    def test_lazy_single_page(self, ts):
+        ts.client.get_range.return_value = (None, [('user_id', 'z')], ['a', 'b'], None)
+        assert len(ts.get_all_users(limit=2)) == 2
+        ts.client.get_range.assert_called_once()
+
+    def test_error_returns_empty(self, ts):
+        ts.client.get_range.side_effect = Exception('boom')
+        assert ts.get_all_users() == []
+
+
+class TestRowToDict:
+    """_row_to_dict: primary key + attribute columns, JSON parsed only when it looks like JSON."""
+
+    def test_row_conversion(self):
+        from tablestore import Row
+        from tablestore_service import TablestoreService
+        ts = TablestoreService.__new__(TablestoreService)
+        row = Row([('user_id', '1')], [
+            ('settings', '{"use_yo": true}', 1), ('tags', '[1, 2]', 1),
+            ('name', 'Alice', 1), ('note', '{not json', 1), ('balance_minutes', 5, 1), ('empty', '', 1),
+        ])
+        assert ts._row_to_dict(row) == {
+            'user_id': '1', 'settings': {'use_yo': True}, 'tags': [1, 2],
+            'name': 'Alice', 'note': '{not json', 'balance_minutes': 5, 'empty': '',
+        }
+
+    def test_plain_strings_skip_parser(self):
+        import tablestore_service
+        with patch.object(tablestore_service, '_json_loads') as loads:
+            assert tablestore_service._deserialize_value('Alice') == 'Alice'
+            assert tablestore_service._deserialize_value(7) == 7
+        loads.assert_not_called()
+
+
+class TestUtcTimestamps:
+    def test_stdlib_utc_isoformat(self):
+        from datetime import datetime
+        import tablestore_service
+        stamp = tablestore_service._utc_now_iso()
+        assert stamp.endswith('+00:00')
+        assert datetime.fromisoformat(stamp).utcoffset().total_seconds() == 0
+        assert not hasattr(tablestore_service, 'pytz')
+
+    def test_stats_cutoff_is_string_compare(self):
+        from datetime import datetime, timedelta, timezone
+        from tablestore_service import TablestoreService
+        ts = TablestoreService.__new__(TablestoreService)
+        ts.client = MagicMock()
+        now = datetime.now(timezone.utc)
+        rows = [
+            {'timestamp': (now - timedelta(hours=1)).isoformat(), 'status': 'completed', 'duration': 60, 'stars_amount': 5},
+            {'timestamp': (now - timedelta(days=2)).isoformat(), 'status': 'completed', 'duration': 30, 'stars_amount': 7},
+        ]
+        ts._row_to_dict = lambda row: row
+        ts.client.get_range.return_value = (None, None, rows, None)
+        with patch('tablestore_service.datetime') as dt:
+            dt.now.side_effect = datetime.now
+            assert ts.get_transcription_stats(days=1)['total_seconds'] == 60
+            assert ts.get_payment_stats(days=1)['total_stars'] == 5
+        dt.fromisoformat.assert_not_called()
+
+    def test_stats_normalize_legacy_timestamps(self):
+        from datetime import datetime, timedelta, timezone
+        from tablestore_service import TablestoreService, _utc_sort_key
+        ts = TablestoreService.__new__(TablestoreService)
+        ts.client = MagicMock()
+        recent = datetime.now(timezone.utc) - timedelta(minutes=5)
+        rows = [
+            {'timestamp': recent.strftime('%Y-%m-%dT%H:%M:%SZ'), 'status': 'completed', 'duration': 1},
+            {'timestamp': str(recent), 'status': 'completed', 'duration': 2},
+            {'timestamp': (recent - timedelta(days=3)).strftime('%Y-%m-%d %H:%M:%S'), 'status': 'completed', 'duration': 4},
+            {'timestamp': 12345, 'status': 'completed', 'duration': 8},
+            {'timestamp': 'garbage', 'status': 'completed', 'duration': 16},
+        ]
+        ts._row_to_dict = lambda row: row
+        ts.client.get_range.return_value = (None, None, rows, None)
+        assert ts.get_transcription_stats(days=1)['total_seconds'] == 3
+        assert _utc_sort_key('2026-01-02T05:00:00+03:00') == '2026-01-02T02:00:00+00:00'
+
+
+class TestSerializeValue:
+    def test_values(self):
+        from collections import OrderedDict
+        from datetime import datetime, timezone
+        from tablestore_service import _serialize_value
+        stamp = datetime(2025, 1, 2, 3, 4, 5, tzinfo=timezone.utc)
+        assert _serialize_value(True) == 1 and type(_serialize_value(True)) is int
+        assert _serialize_value(False) == 0
+        assert _serialize_value(5) == 5 and _serialize_value(1.5) == 1.5
+        assert _serialize_value('x') == 'x' and _serialize_value(None) is None
+        assert _serialize_value({'a': 1}) == '{"a": 1}'
+        assert _serialize_value([1, 2]) == '[1, 2]'
+        assert _serialize_value(OrderedDict(a=1)) == '{"a": 1}'
+        assert _serialize_value(stamp) == '2025-01-02T03:04:05+00:00'
+
+
+class TestFallbackPromptReuse:
+    def test_prompt_built_once_across_fallback(self, monkeypatch):
+        from audio import AudioService
+        monkeypatch.setenv('DASHSCOPE_API_KEY', 'k')
+        monkeypatch.setenv('ASSEMBLYAI_API_KEY', 'k')
+        session = MagicMock()
+        session.post.return_value.status_code = 500
+        svc = AudioService(whisper_backend='qwen-asr', http_session=session)
+        text = ' '.join(['слово'] * 20)
+        with patch.object(svc, '_build_format_prompt', wraps=svc._build_format_prompt) as build:
+            assert svc.format_text_with_qwen(text) == text
+        build.assert_called_once()
+        assert session.post.call_count == 2
+        qwen_prompt = session.post.call_args_list[0][1]['json']['input']['messages'][0]['content']
+        gateway_prompt = session.post.call_args_list[1][1]['json']['messages'][1]['content']
+        assert gateway_prompt is qwen_prompt
+
+
+class _FakeBatchClient:
+    """batch_write_row stub: fails listed keys a given number of times, can raise once."""
+
+    def __init__(self, fail=None, raise_once=False, delay=0):
+        self.fail = dict(fail or {})
+        self.raise_once = raise_once
+        self.delay = delay
+        self.requests = []
+        self.finished = 0
+        self._lock = threading.Lock()
+
+    def batch_write_row(self, request):
+        from types import SimpleNamespace
+        (table_item,) = request.items.values()
+        keys = [item.row.primary_key[0][1] for item in table_item.row_items]
+        with self._lock:
+            self.requests.append(keys)
+            if self.raise_once:
+                self.raise_once = False
+                raise ConnectionError('reset by peer')
+            failed = []
+            for index, key in enumerate(keys):
+                if self.fail.get(key, 0) > 0:
+                    self.fail[key] -= 1
+                    failed.append(SimpleNamespace(index=index, error_code='OTSServerBusy',
+                                                  error_message='busy'))
+        time.sleep(self.delay)
+        with self._lock:
+            self.finished += 1
+        return SimpleNamespace(get_failed_of_put=lambda: failed)
+
+
+class TestMigrationBatchWrite:
+    """migrate_firestore_to_tablestore writes BatchWriteRow batches and retries failed rows."""
+
+    @pytest.fixture
+    def migrate(self):
+        module = _load_module('migrate_firestore_to_tablestore', 'scripts', 'migrate_firestore_to_tablestore.py')
+        with patch.object(module.time, 'sleep'):
+            yield module
+
+    @staticmethod
+    def _rows(*keys):
+        from tablestore import Row
+        return [Row([('user_id', key)], [('balance_minutes', 1)]) for key in keys]
+
+    def test_failed_rows_retried_by_index(self, migrate):
+        client = _FakeBatchClient(fail={'b': 1, 'd': 2})
+
+        assert migrate._write_batch(client, 'users', self._rows('a', 'b', 'c', 'd', 'e')) == 5
+        assert client.requests == [['a', 'b', 'c', 'd', 'e'], ['b', 'd'], ['d']]
+
+    def test_raised_request_retried(self, migrate):
+        client = _FakeBatchClient(raise_once=True)
+
+        assert migrate._write_batch(client, 'users', self._rows('a', 'b')) == 2
+        assert client.requests == [['a', 'b'], ['a', 'b']]
+
+    def test_exhausted_rows_not_counted(self, migrate):
+        client = _FakeBatchClient(fail={'b': 99})
+
+        assert migrate._write_batch(client, 'users', self._rows('a', 'b', 'c')) == 2
+        assert len(client.requests) == migrate.BATCH_RETRIES + 1
+        assert client.requests[-1] == ['b']
+
+    def test_batches_split_and_counted(self, migrate, monkeypatch):
+        monkeypatch.setattr(migrate, 'BATCH_SIZE', 2)
+        client = _FakeBatchClient(fail={'c': 1})
+
+        assert migrate.batch_put_rows(client, 'users', iter(self._rows('a', 'b', 'c', 'd', 'e'))) == 5
+        assert sorted(client.requests) == [['a', 'b'], ['c'], ['c', 'd'], ['e']]
+
+    def test_duplicate_key_flushes_batch(self, migrate):
+        client = _FakeBatchClient()
+
+        assert migrate.batch_put_rows(client, 'users', iter(self._rows('a', 'b', 'a'))) == 3
+        assert sorted(client.requests) == [['a'], ['a', 'b']]
+
+    def test_in_flight_batches_bounded(self, migrate, monkeypatch):
+        """The row stream is not read ahead of the writers by more than 2 * WRITE_WORKERS batches."""
+        monkeypatch.setattr(migrate, 'BATCH_SIZE', 1)
+        monkeypatch.setattr(migrate, 'WRITE_WORKERS', 2)
+        client = _FakeBatchClient(delay=0.005)
+        lag = []
+
+        def rows():
+            for index, row in enumerate(self._rows(*map(str, range(20)))):
+                lag.append(index - client.finished)
+                yield row
+
+        assert migrate.batch_put_rows(client, 'users', rows()) == 20
+        assert max(lag) <= 2 * migrate.WRITE_WORKERS + 1
+
+
+class _FakeReportClient:
+    """OTSClient stub for scheduled-reports: rows per table, optional search / cache responses."""
+
+    def __init__(self, tables=None, search=None, cached_body=None):
+        self.tables = tables or {}
+        self.search_response = search
+        self.cached_body = cached_body
+        self.put_rows = []
+        self.range_calls = []
+
+    def get_row(self, table_name, primary_key, columns_to_get=None, column_filter=None, max_version=None):
+        from tablestore import Row
+        row = Row(primary_key, [('body', self.cached_body)]) if self.cached_body else None
+        return None, row, None
+
+    def put_row(self, table_name, row, condition=None):
+        self.put_rows.append((table_name, row))
+
+    def search(self, table_name, index_name, search_query, columns_to_get=None):
+        if self.search_response is None:
+            raise Exception('OTSObjectNotExist: index does not exist')
+        return self.search_response
+
+    def xget_range(self, table_name, direction, start, end, consumed, columns_to_get=None,
+                   column_filter=None, **kwargs):
+        self.range_calls.append((table_name, column_filter))
+        return iter(self.tables.get(table_name, []))
+
+
+class TestDailyReport:
+    """scheduled-reports: report cache order, search-index totals, timestamp window."""
+
+    @pytest.fixture
+    def reports(self):
+        module = _load_module('scheduled_reports_handler', 'scheduled-reports', 'handler.py')
+        module._report_cache.clear()
+        return module
+
+    def test_memory_cache_first(self, reports):
+        import pytz
+        from datetime import datetime
+        today = datetime.now(pytz.utc).strftime('%Y-%m-%d')
+        reports._report_cache[today] = 'warm report'
+        client = MagicMock()
+
+        assert reports.get_daily_report(client) == 'warm report'
+        assert client.method_calls == []
+
+    def test_table_cache_before_generate(self, reports):
+        client = _FakeReportClient(cached_body='stored report')
+
+        with patch.object(reports, 'generate_daily_report') as generate:
+            assert reports.get_daily_report(client) == 'stored report'
+            assert reports.get_daily_report(client) == 'stored report'
+
+        generate.assert_not_called()
+        assert list(reports._report_cache.values()) == ['stored report']
+
+    def test_generated_report_cached(self, reports):
+        client = _FakeReportClient()
+
+        with patch.object(reports, 'generate_daily_report', return_value='fresh report') as generate:
+            assert reports.get_daily_report(client) == 'fresh report'
+            assert reports.get_daily_report(client) == 'fresh report'
+
+        generate.assert_called_once()
+        assert [table for table, _ in client.put_rows] == ['report_cache']
+
+    def test_error_not_cached(self, reports):
+        client = _FakeReportClient()
+
+        with patch.object(reports, 'generate_daily_report', side_effect=Exception('OTSServerBusy')):
+            assert 'OTSServerBusy' in reports.get_daily_report(client)
+
+        assert reports._report_cache == {}
+        assert client.put_rows == []
+
+    def test_user_totals_from_search_index(self, reports):
+        from types import SimpleNamespace
+        client = _FakeReportClient(search=SimpleNamespace(
+            total_count=5, agg_results=[SimpleNamespace(name='total_balance', value=120.0)]))
+
+        assert reports._user_totals(client) == (5, 120)
+        assert client.range_calls == []
+
+    def test_user_totals_scan_fallback(self, reports):
+        from tablestore import Row
+        client = _FakeReportClient(tables={'users': [
+            Row([('user_id', '1')], [('balance_minutes', 30)]),
+            Row([('user_id', '2')], [('balance_minutes', 12)]),
+            Row([('user_id', '3')], []),
+        ]})
+
+        assert reports._user_totals(client) == (3, 42)
+        assert [table for table, _ in client.range_calls] == ['users']
+
+    def test_rows_since_normalizes_timestamps(self, reports):
+        """Rows written with 'Z', a space separator or another offset are judged by their UTC time."""
+        import pytz
+        from datetime import datetime
+        from tablestore import Row
+        stamps = {
+            'canonical_in': '2026-10-17T10:00:00+00:00',
+            'canonical_out': '2026-10-17T08:00:00+00:00',
+            'zulu_in': '2026-10-17T09:30:00Z',
+            'offset_in': '2026-10-17T13:00:00+03:00',
+            'offset_out': '2026-10-17T11:00:00+03:00',
+            'naive_space_in': '2026-10-17 09:15:00',
+            'garbage_out': 'n/a',
+            'int_out': 1760000000,
+        }
+        client = _FakeReportClient(tables={'payment_logs': [
+            Row([('payment_id', name)], [('stars_amount', 1), ('timestamp', stamp)])
+            for name, stamp in stamps.items()
+        ]})
+        since = datetime(2026, 10, 17, 9, 0, tzinfo=pytz.utc)
+
+        rows = reports._rows_since(client, 'payment_logs', 'payment_id', since, ['stars_amount', 'timestamp'])
+        kept = sorted(row.primary_key[0][1] for row in rows)
+
+        assert kept == ['canonical_in', 'naive_space_in', 'offset_in', 'zulu_in']
+        column_filter = client.range_calls[0][1]
+        assert column_filter.column_value == '2026-10-16'
+
+    def test_generate_report_counts(self, reports):
+        import pytz
+        from datetime import datetime, timedelta
+        from tablestore import Row
+        recent = (datetime.now(pytz.utc) - timedelta(hours=1)).isoformat()
+        old = (datetime.now(pytz.utc) - timedelta(days=3)).isoformat()
+        client = _FakeReportClient(tables={
+            'transcription_logs': [
+                Row([('log_id', 'l1')], [('user_id', '1'), ('duration', 120), ('char_count', 500), ('timestamp', recent)]),
+                Row([('log_id', 'l2')], [('user_id', '1'), ('duration', 60), ('char_count', 100), ('timestamp', recent)]),
+                Row([('log_id', 'l3')], [('user_id', '2'), ('duration', 600), ('char_count', 9), ('timestamp', old)]),
+            ],
+            'payment_logs': [Row([('payment_id', 'p1')], [('stars_amount', 50), ('timestamp', recent)])],
+            'users': [Row([('user_id', '1')], [('balance_minutes', 7)])],
+        })
+
+        report = reports.generate_daily_report(client)
+
+        assert 'Транскрипций: 2' in report
+        assert 'Обработано: 3 мин' in report
+        assert 'Активных пользователей: 1' in report
+        assert 'Платежей: 1 (50⭐)' in report
+        assert 'Пользователей: 1' in report
@@ -224,7 +224,7 @@ class TestThinkingLeakStrip:
     """Tests for <think> tag stripping and thinking leak detection in format_text_with_assemblyai()."""
 
     def _make_response(self, content, finish_reason='stop'):
-        """Helper: mock requests.post response for AssemblyAI."""
+        """Helper: mock requests.Session.post response for AssemblyAI."""
         mock_resp = MagicMock()
         mock_resp.status_code = 200
         mock_resp.json.return_value = {
@@ -238,7 +238,7 @@ class TestThinkingLeakStrip:
         text = "Привет мир, это тестовый текст для проверки."
         response_with_think = "<think>I need to format this carefully...</think>\nПривет мир, это тестовый текст для проверки."
 
-        with patch('requests.post', return_value=self._make_response(response_with_think)):
+        with patch('requests.Session.post', return_value=self._make_response(response_with_think)):
             with patch.dict(os.environ, {'ASSEMBLYAI_API_KEY': 'test-key'}):
                 result = audio_service.format_text_with_assemblyai(text)
 
@@ -251,7 +251,7 @@ class TestThinkingLeakStrip:
         text = "Тестовый текст для проверки форматирования."
         response = "<think>\nWait, Rule 11 says...\nI'll keep the labels.\n</think>\nТестовый текст для проверки форматирования."
 
-        with patch('requests.post', return_value=self._make_response(response)):
+        with patch('requests.Session.post', return_value=self._make_response(response)):
             with patch.dict(os.environ, {'ASSEMBLYAI_API_KEY': 'test-key'}):
                 result = audio_service.format_text_with_assemblyai(text)
 
@@ -264,7 +264,7 @@ class TestThinkingLeakStrip:
         text = "Спикер 1: Привет, как дела?\nСпикер 2: Хорошо, спасибо."
         response = "Спикер 1: Привет, как дела?\nWait, I'll check Rule 11 first.\nСпикер 2: Хорошо, спасибо.\nActually, the speaker labels look correct."
 
-        with patch('requests.post', return_value=self._make_response(response)):
+        with patch('requests.Session.post', return_value=self._make_response(response)):
             with patch.dict(os.environ, {'ASSEMBLYAI_API_KEY': 'test-key'}):
                 result = audio_service.format_text_with_assemblyai(text)
 
@@ -278,7 +278,7 @@ class TestThinkingLeakStrip:
         text = "Это простой текст на русском языке для проверки."
         clean_response = "Это простой текст на русском языке для проверки."
 
-        with patch('requests.post', return_value=self._make_response(clean_response)):
+        with patch('requests.Session.post', return_value=self._make_response(clean_response)):
             with patch.dict(os.environ, {'ASSEMBLYAI_API_KEY': 'test-key'}):
                 result = audio_service.format_text_with_assemblyai(text)
 
@@ -290,7 +290,7 @@ class TestThinkingLeakStrip:
         # Response is mostly English reasoning
         response = "Wait, let me think about this.\nI'll format it.\nLet me check.\nП."
 
-        with patch('requests.post', return_value=self._make_response(response)):
+        with patch('requests.Session.post', return_value=self._make_response(response)):
             with patch.dict(os.environ, {'ASSEMBLYAI_API_KEY': 'test-key'}):
                 result = audio_service.format_text_with_assemblyai(text)
 
@@ -303,7 +303,7 @@ class TestThinkingLeakStrip:
         mock_resp = self._make_response("Тестовый текст для проверки наличия системного сообщения в запросе к Gemini через шлюз.")
         mock_post = MagicMock(return_value=mock_resp)
 
-        with patch('requests.post', mock_post):
+        with patch('requests.Session.post', mock_post):
             with patch.dict(os.environ, {'ASSEMBLYAI_API_KEY': 'test-key'}):
                 audio_service.format_text_with_assemblyai(text)
 
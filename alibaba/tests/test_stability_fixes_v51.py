@@ -8,7 +8,7 @@ Unit tests for v5.1.0 stability fixes:
 - LLM timeout (300s, no fallback on timeout)
 - MIME validation on cloud drive import
 - Signed URL expiry (30 min)
-- DashScope session pooling (ASR + LLM methods)
+- DashScope session pooling (ASR + LLM methods, Qwen3-ASR over self._http_session)
 
 Run with: python -m pytest alibaba/tests/test_stability_fixes_v51.py -v
 """
@@ -62,15 +62,17 @@ class TestJsonParsingGuard:
         mock_session.post.return_value = mock_response
         audio_service._session = mock_session
 
+        dbg = {}
         result = audio_service._submit_async_transcription(
             'https://example.com/audio.mp3',
             'fun-asr-mtl',
             {'language_hints': ['ru']},
             'test-api-key',
-            debug_prefix='pass1'
+            debug_prefix='pass1',
+            debug=dbg
         )
         assert result is None
-        assert audio_service._diarization_debug.get('pass1_result') == 'malformed_submit_json'
+        assert dbg.get('pass1_result') == 'malformed_submit_json'
 
     def test_poll_response_malformed_json(self, audio_service):
         """Malformed poll response → continue polling, not crash."""
@@ -136,6 +138,7 @@ class TestJsonParsingGuard:
         mock_session.get.side_effect = [poll_resp, trans_resp]
         audio_service._session = mock_session
 
+        dbg = {}
         with patch('time.sleep'):
             result = audio_service._submit_async_transcription(
                 'https://example.com/audio.mp3',
@@ -144,10 +147,11 @@ class TestJsonParsingGuard:
                 'test-api-key',
                 poll_interval=1,
                 max_wait=10,
-                debug_prefix='pass1'
+                debug_prefix='pass1',
+                debug=dbg
             )
         assert result is None
-        assert audio_service._diarization_debug.get('pass1_result') == 'malformed_transcription_json'
+        assert dbg.get('pass1_result') == 'malformed_transcription_json'
 
     def test_error_response_malformed_json(self, audio_service):
         """Non-200 submit with malformed error body → graceful handling."""
@@ -178,7 +182,7 @@ class TestJsonGuardsGemini:
         mock_resp.status_code = 200
         mock_resp.json.side_effect = ValueError("Invalid JSON")
 
-        with patch('requests.post', return_value=mock_resp), \
+        with patch('requests.Session.post', return_value=mock_resp), \
              patch.dict(os.environ, {'GOOGLE_API_KEY': 'test-key'}):
             result = audio_service._diarize_gemini('/tmp/test.mp3')
             assert result == (None, [])
@@ -187,9 +191,10 @@ class TestJsonGuardsGemini:
 class TestJsonGuardsAsr:
     """Qwen ASR JSON guards."""
 
-    @patch('requests.post')
-    def test_qwen_asr_200_malformed_json(self, mock_post, audio_service, tmp_path):
+    def test_qwen_asr_200_malformed_json(self, audio_service, tmp_path):
         """Qwen ASR: 200 but malformed JSON → RuntimeError."""
+        audio_service._session = MagicMock()
+        mock_post = audio_service._session.post
         audio_file = tmp_path / "test.mp3"
         audio_file.write_bytes(b'\xff\xfb\x90\x00' * 100)
 
@@ -201,9 +206,10 @@ class TestJsonGuardsAsr:
         with pytest.raises(RuntimeError, match="malformed JSON"):
             audio_service._transcribe_single_qwen_asr(str(audio_file))
 
-    @patch('requests.post')
-    def test_qwen_asr_error_malformed_json(self, mock_post, audio_service, tmp_path):
+    def test_qwen_asr_error_malformed_json(self, audio_service, tmp_path):
         """Qwen ASR: non-200 with malformed error body → still raises RuntimeError."""
+        audio_service._session = MagicMock()
+        mock_post = audio_service._session.post
         audio_file = tmp_path / "test.mp3"
         audio_file.write_bytes(b'\xff\xfb\x90\x00' * 100)
 
@@ -220,7 +226,7 @@ class TestJsonGuardsAsr:
 class TestJsonGuardsLlm:
     """LLM JSON guards (Qwen + AssemblyAI)."""
 
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_qwen_llm_malformed_json_returns_original(self, mock_post, audio_service):
         """Qwen LLM: malformed JSON → return original text."""
         mock_resp = MagicMock()
@@ -232,7 +238,7 @@ class TestJsonGuardsLlm:
         result = audio_service.format_text_with_qwen(original)
         assert result == original
 
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_assemblyai_llm_malformed_json_returns_original(self, mock_post, audio_service):
         """AssemblyAI LLM: malformed JSON → return original text."""
         mock_resp = MagicMock()
@@ -503,7 +509,7 @@ class TestBalanceReservation:
 class TestLlmFallbackTimeout:
     """AssemblyAI LLM timeout should be 300s for Gemini 3 Flash (no timeout-based fallback)."""
 
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_assemblyai_timeout_is_300s(self, mock_post, audio_service):
         """Verify timeout=300 in format_text_with_assemblyai request."""
         mock_resp = MagicMock()
@@ -523,7 +529,7 @@ class TestLlmFallbackTimeout:
         _, kwargs = mock_post.call_args
         assert kwargs.get('timeout') == 300
 
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_timeout_returns_original_not_fallback(self, mock_post, audio_service):
         """Timeout should return original text, NOT trigger Qwen fallback."""
         mock_post.side_effect = requests.exceptions.Timeout("Connection timed out")
@@ -757,9 +763,11 @@ class TestSessionPooling:
         assert mock_session.get.call_count == 2
         assert result is not None
 
-    @patch('requests.post')
-    def test_qwen_asr_uses_requests_post(self, mock_post, audio_service, tmp_path):
-        """Qwen ASR should use requests.post (not session) for single calls."""
+    def test_qwen_asr_uses_session(self, audio_service, tmp_path):
+        """Qwen ASR should post through the pooled self._http_session."""
+        mock_session = MagicMock()
+        audio_service._session = mock_session
+        mock_post = mock_session.post
         audio_file = tmp_path / "test.mp3"
         audio_file.write_bytes(b'\xff\xfb\x90\x00' * 100)
 
@@ -528,14 +528,14 @@ class TestDownloadRouting:
         tg.get_file_path.return_value = 'file/path.ogg'
         tg.download_file.return_value = '/tmp/test.ogg'
         audio = MagicMock()
-        audio.prepare_audio_for_asr.return_value = '/tmp/test.mp3'
+        audio.prepare_audio_for_asr.return_value = ('/tmp/test.mp3', 30.0)
         return tg, audio
 
     def test_oss_upload_routes_to_oss(self, mock_services):
         import handler
         tg, audio = mock_services
         with patch.object(handler, '_download_from_oss', return_value='/tmp/oss_file.mp3') as mock_oss:
-            local, converted = handler._download_and_convert(
+            local, converted, duration = handler._download_and_convert(
                 tg, audio, 'uploads/123/abc.mp3', 12345, None,
                 file_type='oss_upload'
             )
@@ -546,7 +546,7 @@ class TestDownloadRouting:
         import handler
         tg, audio = mock_services
         with patch.object(handler, '_download_from_url', return_value='/tmp/url_file.mp3') as mock_url:
-            local, converted = handler._download_and_convert(
+            local, converted, duration = handler._download_and_convert(
                 tg, audio, 'https://download.example.com/file.mp3', 12345, None,
                 file_type='url_import'
             )
@@ -556,7 +556,7 @@ class TestDownloadRouting:
     def test_default_routes_to_telegram(self, mock_services):
         import handler
         tg, audio = mock_services
-        local, converted = handler._download_and_convert(
+        local, converted, duration = handler._download_and_convert(
             tg, audio, 'AgACAgIAAxkBAAI', 12345, None, file_type=None
         )
         tg.get_file_path.assert_called_once()
@@ -565,7 +565,7 @@ class TestDownloadRouting:
     def test_voice_type_routes_to_telegram(self, mock_services):
         import handler
         tg, audio = mock_services
-        local, converted = handler._download_and_convert(
+        local, converted, duration = handler._download_and_convert(
             tg, audio, 'AgACAgIAAxkBAAI', 12345, None, file_type='voice'
         )
         tg.get_file_path.assert_called_once()
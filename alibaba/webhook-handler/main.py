@@ -3,10 +3,10 @@ Telegram Webhook Handler for Alibaba Cloud Function Compute
 Full implementation with Tablestore, MNS, and Qwen-ASR
 v3.1.0 - Complete admin commands and callback handlers
 """
+import contextlib
 import json
 import logging
 import os
-import sys
 import math
 import csv
 import tempfile
@@ -14,11 +14,9 @@ import time
 from collections import defaultdict
 from typing import Any, Dict, Optional, List
 
-# Add shared services to path
-sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'telegram_bot_shared'))
-
 # Configure structured JSON logging for SLS
-from services.utility import UtilityService
+from services.utility import (UtilityService, ceil_minutes, create_http_session, file_caption,
+                              format_with_cache, json_loads, needs_llm_formatting, remove_quietly)
 UtilityService.setup_logging(
     'webhook-handler',
     bot_token=os.environ.get('TELEGRAM_BOT_TOKEN'),
@@ -32,6 +30,8 @@ TABLESTORE_INSTANCE = os.environ.get('TABLESTORE_INSTANCE', 'twbot-prod')
 MNS_ENDPOINT = os.environ.get('MNS_ENDPOINT')
 AUDIO_JOBS_QUEUE = os.environ.get('AUDIO_JOBS_QUEUE', 'telegram-whisper-bot-prod-audio-jobs')
 REGION = os.environ.get('REGION', 'eu-central-1')
+OSS_BUCKET = os.environ.get('OSS_BUCKET', 'twbot-prod-audio')
+OSS_ENDPOINT = os.environ.get('OSS_ENDPOINT', 'oss-eu-central-1.aliyuncs.com')
 
 # Credentials - FC provides these automatically via STS
 # Try multiple possible env var names
@@ -56,6 +56,12 @@ TELEGRAM_BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN')
 # Longer audio (>=15s): async for parallel processing + diarization for >=60s
 SYNC_PROCESSING_THRESHOLD = 15
 
+# Exact-match cache of LLM formatting output in the formatted_cache table ("1" = on)
+FORMAT_CACHE = os.environ.get('FORMAT_CACHE', '') == '1'
+
+# use_yo=False: ё→е in one pass
+_YO_TABLE = str.maketrans('ёЁ', 'еЕ')
+
 # Rate limiting: max requests per user in a sliding window
 _RATE_LIMIT_MAX = 10  # max requests
 _RATE_LIMIT_WINDOW = 1.0  # seconds
@@ -135,6 +141,10 @@ PRODUCT_PACKAGES = {
     }
 }
 
+# Keep-alive pool for Telegram + DashScope. Services are rebuilt per request
+# (fresh credentials), the session and its open TLS connections are not.
+_http_session = create_http_session()
+
 # Global service instances (lazy initialization)
 _db_service = None
 _telegram_service = None
@@ -170,7 +180,7 @@ def get_telegram_service():
     global _telegram_service
     if _telegram_service is None:
         from services.telegram import TelegramService
-        _telegram_service = TelegramService(TELEGRAM_BOT_TOKEN)
+        _telegram_service = TelegramService(TELEGRAM_BOT_TOKEN, session=_http_session)
     return _telegram_service
 
 
@@ -214,10 +224,9 @@ def handler(event, context):
         http_method = 'POST'
 
         if isinstance(event, bytes):
-            # Raw bytes - try to parse as JSON
+            # Raw bytes - try to parse as JSON (orjson reads bytes without a decode copy)
             try:
-                event_str = event.decode('utf-8')
-                event = json.loads(event_str)
+                event = json_loads(event)
             except (json.JSONDecodeError, UnicodeDecodeError):
                 logger.warning(f"Could not parse event bytes")
                 event = {}
@@ -234,7 +243,7 @@ def handler(event, context):
 
             if body:
                 try:
-                    request_body = json.loads(body) if isinstance(body, str) else body
+                    request_body = json_loads(body) if isinstance(body, str) else body
                 except json.JSONDecodeError:
                     pass
 
@@ -440,7 +449,7 @@ def handle_audio_message(message: Dict[str, Any], user: Dict[str, Any]) -> str:
 
     # Check user balance with package recommendation
     balance = user.get('balance_minutes', 0)
-    duration_minutes = (duration + 59) // 60  # Round up
+    duration_minutes = ceil_minutes(duration)
 
     if balance < duration_minutes:
         deficit = duration_minutes - balance
@@ -474,8 +483,15 @@ def handle_audio_message(message: Dict[str, Any], user: Dict[str, Any]) -> str:
         return process_audio_sync(message, user, file_id, file_type, duration, status_message_id)
 
 
+def _format_with_llm(audio_service, db, text, **options):
+    """format_text_with_llm behind the formatted_cache table when FORMAT_CACHE is on."""
+    if not FORMAT_CACHE:
+        return audio_service.format_text_with_llm(text, **options)
+    return format_with_cache(audio_service, db, text, **options)
+
+
 def process_audio_sync(message: Dict[str, Any], user: Dict[str, Any],
-                       file_id: str, _file_type: str, duration: int,
+                       file_id: str, file_type: str, duration: int,
                        status_message_id: Optional[int] = None) -> str:
     """Process audio synchronously (for short files)."""
     chat_id = message.get('chat', {}).get('id')
@@ -484,8 +500,7 @@ def process_audio_sync(message: Dict[str, Any], user: Dict[str, Any],
     tg = get_telegram_service()
     db = get_db_service()
 
-    local_path = None
-    converted_path = None
+    cleanup = contextlib.ExitStack()
 
     logger.info(f"[routing] sync=True, duration={duration}s, user={user_id}")
 
@@ -493,7 +508,8 @@ def process_audio_sync(message: Dict[str, Any], user: Dict[str, Any],
         # Update progress: downloading
         if status_message_id:
             tg.edit_message_text(chat_id, status_message_id, "📥 Загружаю файл...")
-        tg.send_chat_action(chat_id, 'typing')
+        else:
+            tg.send_chat_action(chat_id, 'typing')
 
         # Download file from Telegram
         telegram_file_path = tg.get_file_path(file_id)
@@ -505,6 +521,7 @@ def process_audio_sync(message: Dict[str, Any], user: Dict[str, Any],
         if not local_path:
             tg.send_message(chat_id, "Не удалось скачать файл. Попробуйте ещё раз.")
             return 'download_failed'
+        cleanup.callback(remove_quietly, local_path)
 
         # Transcribe with Qwen-ASR
         from services.audio import AudioService
@@ -515,19 +532,20 @@ def process_audio_sync(message: Dict[str, Any], user: Dict[str, Any],
         audio_service = AudioService(
             whisper_backend='qwen-asr',
             oss_config={
-                'bucket': os.environ.get('OSS_BUCKET', 'twbot-prod-audio'),
-                'endpoint': os.environ.get('OSS_ENDPOINT', 'oss-eu-central-1.aliyuncs.com'),
+                'bucket': OSS_BUCKET,
+                'endpoint': OSS_ENDPOINT,
                 'access_key_id': ak,
                 'access_key_secret': sk,
                 'security_token': st,
-            }
+            },
+            http_session=_http_session,
         )
 
         # For documents (duration=0), get actual duration via ffprobe
         if duration == 0 and local_path:
             actual_duration = audio_service.get_audio_duration(local_path)
             duration = int(actual_duration)
-            duration_minutes = (duration + 59) // 60
+            duration_minutes = ceil_minutes(duration)
             # Re-check balance with actual duration + package recommendation
             balance = user.get('balance_minutes', 0)
             if balance < duration_minutes:
@@ -548,7 +566,6 @@ def process_audio_sync(message: Dict[str, Any], user: Dict[str, Any],
                     msg += f"Рекомендуем: <b>{recommended['title']}</b> ({recommended['minutes']} мин за {recommended['stars_amount']}⭐)\n"
                 msg += "\n/buy_minutes — все пакеты"
                 tg.send_message(chat_id, msg, parse_mode='HTML')
-                os.remove(local_path)
                 return 'insufficient_balance'
 
         # Update progress: transcribing
@@ -556,14 +573,18 @@ def process_audio_sync(message: Dict[str, Any], user: Dict[str, Any],
             tg.edit_message_text(chat_id, status_message_id, "🎙 Распознаю речь...")
         tg.send_chat_action(chat_id, 'typing')
 
-        converted_path = audio_service.prepare_audio_for_asr(local_path)
+        converted_path, audio_duration = audio_service.prepare_audio_for_asr(
+            local_path, passthrough=(file_type == 'voice'))
         if not converted_path:
             tg.send_message(chat_id, "Не удалось обработать аудио. Попробуйте другой формат.")
             return 'conversion_failed'
+        # converted_path == local_path when the transcode was skipped
+        if converted_path != local_path:
+            cleanup.callback(remove_quietly, converted_path)
 
         # Extract settings from already-loaded user dict (avoid duplicate DB call)
         settings_json = user.get('settings', '{}')
-        settings = json.loads(settings_json) if isinstance(settings_json, str) else (settings_json or {})
+        settings = json_loads(settings_json) if isinstance(settings_json, str) else (settings_json or {})
         use_code_tags = settings.get('use_code_tags', False)
         use_yo = settings.get('use_yo', True)
 
@@ -583,7 +604,6 @@ def process_audio_sync(message: Dict[str, Any], user: Dict[str, Any],
             return 'no_speech'
 
         # Determine if audio was chunked (for LLM prompt)
-        audio_duration = audio_service.get_audio_duration(converted_path)
         is_chunked = audio_duration > audio_service.ASR_MAX_CHUNK_DURATION
 
         # Format text with Gemini 3 Flash LLM (with Qwen fallback)
@@ -592,28 +612,28 @@ def process_audio_sync(message: Dict[str, Any], user: Dict[str, Any],
                 if status_message_id:
                     tg.edit_message_text(chat_id, status_message_id, "✏️ Форматирую диалог...")
                 tg.send_chat_action(chat_id, 'typing')
-                formatted_text = audio_service.format_text_with_llm(
-                    text, use_code_tags=use_code_tags, use_yo=use_yo,
+                formatted_text = _format_with_llm(
+                    audio_service, db, text, use_code_tags=use_code_tags, use_yo=use_yo,
                     is_chunked=is_chunked, is_dialogue=True,
                     backend=settings.get('llm_backend', 'assemblyai'),
                     speaker_labels=settings.get('speaker_labels', False))
             else:
                 formatted_text = text
             if not use_yo:
-                formatted_text = formatted_text.replace('ё', 'е').replace('Ё', 'Е')
-        elif len(text) > 100:
+                formatted_text = formatted_text.translate(_YO_TABLE)
+        elif needs_llm_formatting(text, use_code_tags):
             if status_message_id:
                 tg.edit_message_text(chat_id, status_message_id, "✏️ Форматирую текст...")
             tg.send_chat_action(chat_id, 'typing')
-            formatted_text = audio_service.format_text_with_llm(
-                text, use_code_tags=use_code_tags, use_yo=use_yo,
+            formatted_text = _format_with_llm(
+                audio_service, db, text, use_code_tags=use_code_tags, use_yo=use_yo,
                 is_chunked=is_chunked, is_dialogue=is_dialogue,
                 backend=settings.get('llm_backend', 'assemblyai'),
                 speaker_labels=settings.get('speaker_labels', False))
         else:
             formatted_text = text
             if not use_yo:
-                formatted_text = formatted_text.replace('ё', 'е').replace('Ё', 'Е')
+                formatted_text = formatted_text.translate(_YO_TABLE)
 
         # Send result: edit status message or send new one
         if use_code_tags:
@@ -624,13 +644,13 @@ def process_audio_sync(message: Dict[str, Any], user: Dict[str, Any],
             parse_mode = ''
 
         # Deduct balance BEFORE delivery to prevent free transcriptions on failure
-        duration_minutes = (duration + 59) // 60
-        balance = user.get('balance_minutes', 0)
-        balance_updated = db.update_user_balance(user_id, -duration_minutes)
+        duration_minutes = ceil_minutes(duration)
+        new_balance = db.adjust_user_balance(user_id, -duration_minutes)
+        balance_updated = new_balance is not None
         if not balance_updated:
             logger.error(f"CRITICAL: Failed to deduct {duration_minutes} min from user {user_id} balance!")
             try:
-                owner_id = int(os.environ.get('OWNER_ID', 0))
+                owner_id = OWNER_ID
                 if owner_id:
                     tg.send_message(
                         owner_id,
@@ -650,17 +670,15 @@ def process_audio_sync(message: Dict[str, Any], user: Dict[str, Any],
         elif long_text_mode == 'file':
             if status_message_id:
                 tg.delete_message(chat_id, status_message_id)
-            first_dot = formatted_text.find('.')
-            caption = (formatted_text[:first_dot+1] if 0 < first_dot < 200 else formatted_text[:200]) + "..."
+            caption = file_caption(formatted_text)
             tg.send_as_file(chat_id, formatted_text, caption=caption)
         else:
             if status_message_id:
                 tg.delete_message(chat_id, status_message_id)
             tg.send_long_message(chat_id, result_text, parse_mode=parse_mode)
 
-        # Check for low balance warning (calculate from known values)
+        # Low balance warning (balance as written by the deduction)
         if balance_updated:
-            new_balance = max(0, int(balance) - duration_minutes)
             if 0 < new_balance < 5:
                 tg.send_message(
                     chat_id,
@@ -704,12 +722,7 @@ def process_audio_sync(message: Dict[str, Any], user: Dict[str, Any],
 
     finally:
         # Cleanup temp files on both success and error paths
-        for path in (local_path, converted_path):
-            if path:
-                try:
-                    os.remove(path)
-                except OSError:
-                    pass
+        cleanup.close()
 
 
 def queue_audio_async(message: Dict[str, Any], user: Dict[str, Any],
@@ -726,7 +739,7 @@ def queue_audio_async(message: Dict[str, Any], user: Dict[str, Any],
     tg = get_telegram_service()
 
     # Atomic balance reservation — prevents race condition on parallel uploads
-    duration_minutes = (duration + 59) // 60
+    duration_minutes = ceil_minutes(duration)
     if duration_minutes > 0:
         if not db.reserve_balance(user_id, duration_minutes):
             balance = user.get('balance_minutes', 0)
@@ -1870,7 +1883,7 @@ def _call_gemini_pro(system_prompt: str, user_prompt: str) -> Optional[str]:
     }
 
     try:
-        response = requests.post(url, headers=headers, json=payload, timeout=300)
+        response = _http_session.post(url, headers=headers, json=payload, timeout=(5, 300))
         if response.status_code == 200:
             data = response.json()
             content = data.get('choices', [{}])[0].get('message', {}).get('content', '')
@@ -2634,8 +2647,8 @@ def _handle_signed_url_request(body: Dict[str, Any], event: Dict[str, Any]) -> D
         ak = ALIBABA_ACCESS_KEY or os.environ.get('ALIBABA_ACCESS_KEY')
         sk = ALIBABA_SECRET_KEY or os.environ.get('ALIBABA_SECRET_KEY')
         st = ALIBABA_SECURITY_TOKEN or os.environ.get('ALIBABA_CLOUD_SECURITY_TOKEN')
-        oss_endpoint = os.environ.get('OSS_ENDPOINT', 'oss-eu-central-1.aliyuncs.com')
-        oss_bucket_name = os.environ.get('OSS_BUCKET', 'twbot-prod-audio')
+        oss_endpoint = OSS_ENDPOINT
+        oss_bucket_name = OSS_BUCKET
 
         if not oss_endpoint.startswith('http'):
             oss_endpoint = f'https://{oss_endpoint}'
@@ -2765,8 +2778,8 @@ def _handle_process_upload(body: Dict[str, Any], event: Dict[str, Any]) -> Dict[
                 ak = ALIBABA_ACCESS_KEY or os.environ.get('ALIBABA_ACCESS_KEY')
                 sk = ALIBABA_SECRET_KEY or os.environ.get('ALIBABA_SECRET_KEY')
                 st = ALIBABA_SECURITY_TOKEN or os.environ.get('ALIBABA_CLOUD_SECURITY_TOKEN')
-                oss_endpoint = os.environ.get('OSS_ENDPOINT', 'oss-eu-central-1.aliyuncs.com')
-                oss_bucket_name = os.environ.get('OSS_BUCKET', 'twbot-prod-audio')
+                oss_endpoint = OSS_ENDPOINT
+                oss_bucket_name = OSS_BUCKET
                 if not oss_endpoint.startswith('http'):
                     oss_endpoint = f'https://{oss_endpoint}'
                 if st: